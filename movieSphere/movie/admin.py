@@ -1,8 +1,10 @@
 from django.contrib import admin
 from django.utils.html import format_html
 
+from .forms import ChunkedUploadField
+from .images import variant_url
 from .models import Category, Genre, Movie, MovieShots, Actor, Rating, RatingStar, Reviews, Profile, Season, Episode, \
-    MovieInteraction, MovieInteractionState
+    MovieInteraction, MovieInteractionState, PopularitySnapshot, ChunkedUpload
 from django.db import models
 from django import forms
 
@@ -19,7 +21,8 @@ class GenreAdmin(admin.ModelAdmin):
 
     def genre_image(self, obj):
         if obj.image:
-            return format_html('<img src="{}" style="width: 50px; height: 50px; border-radius: 6px;" />', obj.image.url)
+            return format_html('<img src="{}" style="width: 50px; height: 50px; border-radius: 6px;" />',
+                               variant_url(obj.image, 100))
         return "No Image"
 
     genre_image.short_description = 'Image'
@@ -30,13 +33,18 @@ class ActorAdmin(admin.ModelAdmin):
     search_fields = ('name',)
     list_filter = ('age',)
     save_on_top = True
+    readonly_fields = ('movies_count', 'acting_count', 'directing_count', 'first_year', 'last_year')
     fieldsets = (
         ('Инфо', {
             'fields': ('name', 'age', 'birth_date', 'birth_place', 'descriptions', 'image')
         }),
 
         ('Жанры', {
-            'fields': ('genres', 'movies_count')
+            'fields': ('genres',)
+        }),
+
+        ('Фильмография', {
+            'fields': ('movies_count', 'acting_count', 'directing_count', 'first_year', 'last_year')
         }),
 
         ('Карьера', {
@@ -53,7 +61,7 @@ class ActorAdmin(admin.ModelAdmin):
     def actor_image(self, obj):
         if obj.image:
             return format_html('<img src="{}" style="width: 100px; height: 100px; border-radius: 6px;" />',
-                               obj.image.url)
+                               variant_url(obj.image, 200))
         return "No Image"
 
     actor_image.short_description = 'Image'
@@ -65,13 +73,31 @@ class ActorAdmin(admin.ModelAdmin):
         js = ('js/admin.js',)
 
 
+class ChunkedUploadAdminMixin:
+    """Большие видео загружаются в админке частями (см. ChunkedUpload), а не одним запросом"""
+    chunked_upload_fields = {}
+
+    def formfield_for_dbfield(self, db_field, request, **kwargs):
+        if db_field.name in self.chunked_upload_fields:
+            return ChunkedUploadField(self.chunked_upload_fields[db_field.name], user=request.user,
+                                      label=db_field.verbose_name)
+        return super().formfield_for_dbfield(db_field, request, **kwargs)
+
+    def save_model(self, request, obj, form, change):
+        # Загрузки забираются только после проверки всей формы; сохранение идет в той же транзакции
+        for name in self.chunked_upload_fields:
+            if name in form.fields:
+                form.fields[name].claim(form[name].data)
+        super().save_model(request, obj, form, change)
+
+
 class ReviewInline(admin.TabularInline):
     model = Reviews
     extra = 1
     readonly_fields = ('email', 'text')
 
 
-class MovieAdmin(admin.ModelAdmin):
+class MovieAdmin(ChunkedUploadAdminMixin, admin.ModelAdmin):
     list_display = (
         'title', 'world_premiere', 'category',
         'draft', 'is_series', 'poster_thumbnail', 'duration_hours', 'duration_minutes',
@@ -79,7 +105,8 @@ class MovieAdmin(admin.ModelAdmin):
     list_filter = ('year', 'category', 'draft')
     search_fields = ('title', 'description')
     prepopulated_fields = {"url": ("title",)}
-    readonly_fields = ('preview_poster_thumbnail', 'poster_thumbnail')
+    readonly_fields = ('preview_poster_thumbnail', 'poster_thumbnail', 'average_rating', 'rating_sum', 'rating_count')
+    chunked_upload_fields = {'trailer': 'movie.trailer', 'movie_file': 'movie.movie_file'}
     fieldsets = (
         ('Название', {
             'fields': ('title', 'tagline', 'description')
@@ -94,7 +121,7 @@ class MovieAdmin(admin.ModelAdmin):
         }),
 
         ('Год', {
-            'fields': ('country', 'year', 'world_premiere', 'average_rating',)
+            'fields': ('country', 'year', 'world_premiere', 'average_rating', 'rating_sum', 'rating_count')
 
         }),
 
@@ -136,14 +163,14 @@ class MovieAdmin(admin.ModelAdmin):
 
     def preview_poster_thumbnail(self, obj):
         if obj.preview_poster:
-            return format_html('<img src="{}" style="width: 350px; height: 100px;" />', obj.preview_poster.url)
+            return format_html('<img src="{}" style="width: 350px; height: 100px;" />', variant_url(obj.preview_poster, 640))
         return "No Image"
 
     preview_poster_thumbnail.short_description = 'Постер ListView'
 
     def poster_thumbnail(self, obj):
         if obj.poster:
-            return format_html('<img src="{}" style="width: 100px; height: 100px;" />', obj.poster.url)
+            return format_html('<img src="{}" style="width: 100px; height: 100px;" />', variant_url(obj.poster, 200))
         return "No Image"
 
     poster_thumbnail.short_description = 'Постер'
@@ -155,10 +182,17 @@ class SeasonAdmin(admin.ModelAdmin):
     search_fields = ('movie__title', 'season_number', 'title')
 
 
-class EpisodeAdmin(admin.ModelAdmin):
+class EpisodeAdmin(ChunkedUploadAdminMixin, admin.ModelAdmin):
     list_display = ('season', 'episode_number', 'title')
     list_filter = ('season', 'episode_number')
     search_fields = ('season__movie__title', 'season__season_number', 'episode_number', 'title')
+    chunked_upload_fields = {'video': 'episode.video'}
+
+
+class ChunkedUploadAdmin(admin.ModelAdmin):
+    list_display = ('filename', 'target', 'user', 'offset', 'size', 'updated_at', 'completed_at')
+    list_filter = ('target',)
+    readonly_fields = ('target', 'filename', 'size', 'chunk_size', 'offset', 'file', 'completed_at')
 
 
 class MovieShotsAdmin(admin.ModelAdmin):
@@ -181,6 +215,11 @@ class ReviewsAdmin(admin.ModelAdmin):
     search_fields = ('email', 'movie__title', 'text')
 
 
+class PopularitySnapshotAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'movie_count', 'created_at', 'stale_since')
+    readonly_fields = ('movie_count', 'created_at', 'stale_since')
+
+
 class ProfileAdmin(admin.ModelAdmin):
     list_display = ('user', 'phone', 'email', 'username')
     search_fields = ('user__username', 'email')
@@ -200,3 +239,5 @@ admin.site.register(Season, SeasonAdmin)
 admin.site.register(Episode, EpisodeAdmin)
 admin.site.register(MovieInteraction)
 admin.site.register(MovieInteractionState)
+admin.site.register(PopularitySnapshot, PopularitySnapshotAdmin)
+admin.site.register(ChunkedUpload, ChunkedUploadAdmin)
@@ -0,0 +1,335 @@
+"""JSON API каталога только для чтения: ``/api/v1/<тип>/`` - страница списка, ``/api/v1/<тип>/<id>/`` - объект.
+
+Типы - movies, actors, genres, seasons и episodes; черновики фильмов и их сезоны не выдаются.
+``fields[<тип>]=a,b`` выбирает атрибуты и связи объектов типа (по умолчанию - все атрибуты без связей),
+``include=genres,seasons.episodes`` вкладывает связанные объекты; связь из fields, которой нет в include,
+выдается списком id. Queryset строится под выбранные поля: only() по нужным колонкам, select_related для
+категории и по одному prefetch на связь, поэтому страница из 100 объектов - несколько запросов.
+
+ETag - хеш версии API, адреса, разобранных параметров и версий разделов каталога (``CatalogVersion``), от
+которых зависит ответ; Last-Modified - время последнего изменения этих разделов. Условный запрос получает 304
+после одного запроса версий, без выборки объектов и сериализации.
+"""
+import hashlib
+import json
+from calendar import timegm
+
+from django.conf import settings
+from django.core.exceptions import BadRequest
+from django.db.models import Prefetch
+
+from .models import Actor, CatalogVersion, Episode, Genre, Movie, Season
+from .pagination import KeysetPaginator
+
+API_VERSION = 1
+MAX_PAGE_SIZE = 100
+MAX_INCLUDE_DEPTH = 3
+
+
+def _page_size():
+    return getattr(settings, 'API_PAGE_SIZE', 50)
+
+
+def _number(value):
+    return float(value) if value is not None else None
+
+
+def _iso(value):
+    return value.isoformat() if value is not None else None
+
+
+class Attribute:
+    """Атрибут объекта: колонка модели (или поле связанной через select_related модели) и преобразование"""
+
+    def __init__(self, column, render=None, related=None):
+        self.column = column
+        self.render = render
+        self.related = related
+        # Имя значения в values() - для выгрузки без создания объектов моделей
+        self.lookup = f'{column}__{related}' if related else column
+
+    @property
+    def columns(self):
+        return (self.column, self.lookup) if self.related else (self.column,)
+
+    def value(self, obj):
+        value = getattr(obj, self.column)
+        if self.related:
+            value = getattr(value, self.related) if value is not None else None
+        return self.render(value) if self.render else value
+
+    def row_value(self, row, model):
+        value = row[self.lookup]
+        return self.render(value) if self.render else value
+
+
+class FileAttribute(Attribute):
+    """Файл выдается адресом в хранилище или None"""
+
+    def value(self, obj):
+        field_file = getattr(obj, self.column)
+        return field_file.url if field_file else None
+
+    def row_value(self, row, model):
+        name = row[self.lookup]
+        return model._meta.get_field(self.column).storage.url(name) if name else None
+
+
+class Relation:
+    """Связь с объектами другого типа; reverse_field - внешний ключ на родителя у обратной связи"""
+
+    def __init__(self, type, lookup, reverse_field=None):
+        self.type = type
+        self.lookup = lookup
+        self.reverse_field = reverse_field
+
+
+class Resource:
+    def __init__(self, type, model, attributes, relations=None, filters=None, sections=(), visible=None,
+                 ordering=('pk',)):
+        self.type = type
+        self.model = model
+        self.attributes = attributes
+        self.relations = relations or {}
+        # Фильтры списка: параметр запроса -> поле, значения - id или числа
+        self.filters = filters or {}
+        self.sections = sections
+        self.visible = visible or {}
+        self.ordering = ordering
+
+    def queryset(self):
+        return self.model.objects.filter(**self.visible).order_by(*self.ordering)
+
+    def selected(self, fields, include):
+        """Имена выбранных атрибутов и связей в порядке объявления"""
+        names = fields.get(self.type)
+        attributes = [name for name in self.attributes if names is None or name in names]
+        relations = [name for name in self.relations if name in include or (names is not None and name in names)]
+        return attributes, relations
+
+
+RESOURCES = {resource.type: resource for resource in (
+    Resource('movies', Movie, {
+        'title': Attribute('title'),
+        'tagline': Attribute('tagline'),
+        'description': Attribute('description'),
+        'slug': Attribute('url'),
+        'year': Attribute('year'),
+        'country': Attribute('country'),
+        'world_premiere': Attribute('world_premiere', _iso),
+        'duration_hours': Attribute('duration_hours'),
+        'duration_minutes': Attribute('duration_minutes'),
+        'average_rating': Attribute('average_rating', _number),
+        'rating_count': Attribute('rating_count'),
+        'budget': Attribute('budget'),
+        'box_office_usa': Attribute('box_office_usa'),
+        'box_office_world': Attribute('box_office_world'),
+        'category': Attribute('category', related='name'),
+        'is_series': Attribute('is_series'),
+        'is_editors_choice': Attribute('is_editors_choice'),
+        'poster': FileAttribute('poster'),
+        'preview_poster': FileAttribute('preview_poster'),
+        'trailer': FileAttribute('trailer'),
+        'external_link': Attribute('external_link'),
+        'updated_at': Attribute('updated_at', _iso),
+    }, relations={
+        'genres': Relation('genres', 'genre'),
+        'actors': Relation('actors', 'actors'),
+        'directors': Relation('actors', 'directors'),
+        'seasons': Relation('seasons', 'seasons', reverse_field='movie'),
+    }, filters={
+        'genre': 'genre', 'actor': 'actors', 'director': 'directors', 'year': 'year',
+    }, sections=('movies',), visible={'draft': False}),
+    Resource('actors', Actor, {
+        'name': Attribute('name'),
+        'age': Attribute('age'),
+        'image': FileAttribute('image'),
+        'career': Attribute('career'),
+        'height': Attribute('height'),
+        'birth_date': Attribute('birth_date', _iso),
+        'birth_place': Attribute('birth_place'),
+        'descriptions': Attribute('descriptions'),
+        'movies_count': Attribute('movies_count'),
+        'acting_count': Attribute('acting_count'),
+        'directing_count': Attribute('directing_count'),
+        'first_year': Attribute('first_year'),
+        'last_year': Attribute('last_year'),
+    }, relations={
+        'genres': Relation('genres', 'genres'),
+    }, filters={'genre': 'genres'}, sections=('actors',)),
+    Resource('genres', Genre, {
+        'name': Attribute('name'),
+        'slug': Attribute('url'),
+        'image': FileAttribute('image'),
+        'descriptions': Attribute('descriptions'),
+    }, sections=('genres',)),
+    # Сезоны черновиков скрыты вместе с фильмом, поэтому ответ зависит и от раздела фильмов
+    Resource('seasons', Season, {
+        'movie': Attribute('movie_id'),
+        'season_number': Attribute('season_number'),
+        'title': Attribute('title'),
+    }, relations={
+        'episodes': Relation('episodes', 'episodes', reverse_field='season'),
+    }, filters={'movie': 'movie'}, sections=('seasons', 'movies'), visible={'movie__draft': False},
+        ordering=('movie_id', 'season_number')),
+    Resource('episodes', Episode, {
+        'season': Attribute('season_id'),
+        'episode_number': Attribute('episode_number'),
+        'title': Attribute('title'),
+        'description': Attribute('description'),
+        'duration_minutes': Attribute('duration_minutes'),
+        'video': FileAttribute('video'),
+        'external_link': Attribute('external_link'),
+    }, filters={'season': 'season', 'movie': 'season__movie'}, sections=('seasons', 'movies'),
+        visible={'season__movie__draft': False}, ordering=('season_id', 'episode_number')),
+)}
+
+
+def build_queryset(resource, fields, include, extra_columns=()):
+    """Queryset под выбранные поля: only() по их колонкам, select_related и вложенные Prefetch связей"""
+    attributes, relations = resource.selected(fields, include)
+    columns = ['pk', *extra_columns]
+    related = []
+    for name in attributes:
+        attribute = resource.attributes[name]
+        columns.extend(attribute.columns)
+        if attribute.related:
+            related.append(attribute.column)
+    # Колонки сортировки нужны для курсора страницы
+    columns.extend(column.lstrip('-') for column in resource.ordering)
+    queryset = resource.queryset().only(*dict.fromkeys(columns))
+    if related:
+        queryset = queryset.select_related(*related)
+    for name in relations:
+        relation = resource.relations[name]
+        target = RESOURCES[relation.type]
+        extra = (relation.reverse_field,) if relation.reverse_field else ()
+        if name in include:
+            nested = build_queryset(target, fields, include[name], extra)
+        else:
+            nested = target.queryset().only('pk', *extra)
+        queryset = queryset.prefetch_related(Prefetch(relation.lookup, queryset=nested))
+    return queryset
+
+
+def serialize(obj, resource, fields, include):
+    attributes, relations = resource.selected(fields, include)
+    data = {'id': obj.pk}
+    for name in attributes:
+        data[name] = resource.attributes[name].value(obj)
+    for name in relations:
+        relation = resource.relations[name]
+        items = getattr(obj, relation.lookup).all()
+        if name in include:
+            target = RESOURCES[relation.type]
+            data[name] = [serialize(item, target, fields, include[name]) for item in items]
+        else:
+            data[name] = [item.pk for item in items]
+    return data
+
+
+def sections(resource, fields, include):
+    """Разделы каталога, от которых зависит ответ: сам тип и типы выданных связей"""
+    found = set(resource.sections)
+    for name in resource.selected(fields, include)[1]:
+        target = RESOURCES[resource.relations[name].type]
+        found.update(sections(target, fields, include[name]) if name in include else target.sections)
+    return found
+
+
+def _names(value):
+    return [name for name in (part.strip() for part in value.split(',')) if name]
+
+
+def _positive_int(name, value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise BadRequest(f"Параметр {name} должен быть числом")
+    if number < 0:
+        raise BadRequest(f"Параметр {name} должен быть неотрицательным")
+    return number
+
+
+class ApiQuery:
+    """Разобранные параметры запроса к типу; неизвестные и некорректные параметры - BadRequest"""
+
+    def __init__(self, resource, params, detail=False):
+        self.resource = resource
+        self.fields = {}
+        self.include = {}
+        self.filters = {}
+        self.limit = _page_size()
+        self.cursor = None
+        for key, value in params.items():
+            if key.startswith('fields[') and key.endswith(']'):
+                self._parse_fields(key[len('fields['):-1], value)
+            elif key == 'include':
+                self._parse_include(value)
+            elif detail:
+                raise BadRequest(f"Неизвестный параметр {key}")
+            elif key == 'limit':
+                self.limit = _positive_int(key, value)
+                if not 1 <= self.limit <= MAX_PAGE_SIZE:
+                    raise BadRequest(f"limit должен быть от 1 до {MAX_PAGE_SIZE}")
+            elif key == 'cursor':
+                self.cursor = value or None
+            elif key in resource.filters:
+                self.filters[resource.filters[key]] = _positive_int(key, value)
+            else:
+                raise BadRequest(f"Неизвестный параметр {key}")
+
+    def _parse_fields(self, type, value):
+        target = RESOURCES.get(type)
+        if target is None:
+            raise BadRequest(f"Неизвестный тип {type}")
+        names = set(_names(value))
+        unknown = names - set(target.attributes) - set(target.relations)
+        if unknown:
+            raise BadRequest(f"Неизвестные поля {type}: {', '.join(sorted(unknown))}")
+        self.fields[type] = names
+
+    def _parse_include(self, value):
+        for path in _names(value):
+            names = path.split('.')
+            if len(names) > MAX_INCLUDE_DEPTH:
+                raise BadRequest(f"Слишком глубокий include: {path}")
+            node, resource = self.include, self.resource
+            for name in names:
+                relation = resource.relations.get(name)
+                if relation is None:
+                    raise BadRequest(f"Неизвестная связь {resource.type}.{name}")
+                node = node.setdefault(name, {})
+                resource = RESOURCES[relation.type]
+
+    def _canonical(self):
+        return json.dumps([
+            API_VERSION, self.resource.type, {type: sorted(names) for type, names in self.fields.items()},
+            self.include, self.filters, self.limit, self.cursor,
+        ], sort_keys=True)
+
+    def validators(self, path):
+        """(strong ETag, время последнего изменения в секундах или None) - один запрос версий разделов"""
+        versions = CatalogVersion.current(sorted(sections(self.resource, self.fields, self.include)))
+        numbers = [(name, version) for name, (version, _) in sorted(versions.items())]
+        digest = hashlib.sha1(f"{path}|{self._canonical()}|{numbers}".encode()).hexdigest()
+        changed = [changed_at for _, changed_at in versions.values() if changed_at is not None]
+        return f'"{digest}"', timegm(max(changed).utctimetuple()) if changed else None
+
+    def queryset(self):
+        return build_queryset(self.resource, self.fields, self.include).filter(**self.filters)
+
+    def serialize(self, obj):
+        return serialize(obj, self.resource, self.fields, self.include)
+
+    def detail(self, pk):
+        obj = self.queryset().filter(pk=pk).first()
+        return None if obj is None else {'data': self.serialize(obj)}
+
+    def page(self):
+        page = KeysetPaginator(self.queryset(), self.limit).page(self.cursor)
+        return {
+            'data': [self.serialize(obj) for obj in page],
+            'next': page.next_cursor,
+            'previous': page.previous_cursor,
+        }
@@ -0,0 +1,150 @@
+"""Потоковая выгрузка каталога в NDJSON, сжатый gzip (``manage.py export_catalog`` и ``/export/catalog/``).
+
+Строка - фильм в представлении API (``movie.api``) с жанрами, актерами, режиссерами, сезонами с эпизодами и
+агрегатами оценок. Фильмы читаются keyset-пачками по ``CHUNK_SIZE`` (pk больше последнего выданного), связи
+пачки - несколькими запросами values() без создания объектов моделей, и каждая пачка сразу сжимается и
+отдается, поэтому память не зависит от размера каталога.
+
+Инкрементальная выгрузка (``since``) берет фильмы с ``Movie.updated_at`` не раньше since; снятые в черновики
+фильмы выдаются строкой ``{"id": ..., "deleted": true}``. Удаленные из базы фильмы инкрементальная выгрузка
+не видит - их убирает полная выгрузка. Следующую выгрузку нужно запускать с since, равным началу текущей:
+фильмы, измененные во время выгрузки, попадут в следующую.
+"""
+import json
+import logging
+import time
+import zlib
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import api
+from .models import Actor, Episode, Genre, Movie, Season
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 500
+COMPRESS_LEVEL = 6
+MOVIE_FIELDS = tuple(api.RESOURCES['movies'].attributes)
+FIELDS = {
+    'genres': ('name', 'slug'),
+    'actors': ('name',),
+    'seasons': ('season_number', 'title'),
+    'episodes': ('episode_number', 'title', 'description', 'duration_minutes', 'video', 'external_link'),
+}
+
+
+class ExportStats:
+    """Счетчики выгрузки: строки, сжатые байты и время с начала"""
+
+    def __init__(self):
+        self.started_at = timezone.now()
+        self.started = time.monotonic()
+        self.rows = 0
+        self.bytes = 0
+
+    @property
+    def seconds(self):
+        return time.monotonic() - self.started
+
+    @property
+    def rate(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return f"{self.rows} строк, {self.bytes / 1024 / 1024:.1f} МБ за {self.seconds:.1f} с ({self.rate:.0f} строк/с)"
+
+
+def parse_since(value):
+    """Время ISO 8601; без часового пояса считается в поясе проекта"""
+    since = parse_datetime(value)
+    if since is None:
+        raise ValueError(f"Некорректное время: {value}")
+    return timezone.make_aware(since) if timezone.is_naive(since) else since
+
+
+def _values(resource, queryset, names):
+    """{id: запись} по строкам values() - без создания объектов моделей"""
+    attributes = [(name, resource.attributes[name]) for name in names]
+    rows = queryset.values('pk', *dict.fromkeys(attribute.lookup for _, attribute in attributes))
+    return {row['pk']: {'id': row['pk'], **{name: attribute.row_value(row, resource.model)
+                                            for name, attribute in attributes}} for row in rows}
+
+
+def _add_relations(records):
+    """
+    Дополняет записи пачки фильмов связями: по запросу на связь и на каждый связанный тип. Связи выбираются
+    по списку id пачки: в выгрузке с since id идут с пропусками, и диапазон захватывал бы чужие строки.
+    """
+    movie_ids = list(records)
+    links, targets = {}, {}
+    for name, relation in (('genres', 'genre'), ('actors', 'actors'), ('directors', 'directors')):
+        field = getattr(Movie, relation).field
+        movie_column, target_column = field.m2m_field_name(), field.m2m_reverse_field_name()
+        through = field.remote_field.through
+        rows = through.objects.filter(**{f'{movie_column}__in': movie_ids})
+        targets[name] = rows.values(target_column)
+        links[name] = rows.order_by(target_column).values_list(movie_column, target_column)
+    genres = _values(api.RESOURCES['genres'], Genre.objects.filter(pk__in=targets['genres']), FIELDS['genres'])
+    people = _values(api.RESOURCES['actors'], Actor.objects.filter(
+        Q(pk__in=targets['actors']) | Q(pk__in=targets['directors'])), FIELDS['actors'])
+    for record in records.values():
+        record.update(genres=[], actors=[], directors=[], seasons=[])
+    for name, found in (('genres', genres), ('actors', people), ('directors', people)):
+        for movie_id, target_id in links[name]:
+            records[movie_id][name].append(found[target_id])
+
+    seasons = _values(api.RESOURCES['seasons'], Season.objects.filter(movie_id__in=movie_ids).order_by(
+        'movie_id', 'season_number'), ('movie', *FIELDS['seasons']))
+    for season in seasons.values():
+        records[season.pop('movie')]['seasons'].append(season)
+        season['episodes'] = []
+    if seasons:
+        episodes = Episode.objects.filter(season__movie_id__in=movie_ids).order_by('season_id', 'episode_number')
+        for episode in _values(api.RESOURCES['episodes'], episodes, ('season', *FIELDS['episodes'])).values():
+            seasons[episode.pop('season')]['episodes'].append(episode)
+    return list(records.values())
+
+
+def _keyset_chunks(queryset, chunk_size, load):
+    """Пачки load(queryset) по возрастанию pk; следующая пачка - pk больше последнего"""
+    last = None
+    while True:
+        chunk = load((queryset if last is None else queryset.filter(pk__gt=last)).order_by('pk')[:chunk_size])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last = list(chunk)[-1]
+
+
+def records(since=None, chunk_size=CHUNK_SIZE):
+    """Пачки записей выгрузки (списки словарей)"""
+    resource = api.RESOURCES['movies']
+    movies = resource.queryset()
+    if since is not None:
+        movies = movies.filter(updated_at__gte=since)
+    for chunk in _keyset_chunks(movies, chunk_size, lambda queryset: _values(resource, queryset, MOVIE_FIELDS)):
+        yield _add_relations(chunk)
+    if since is not None:
+        hidden = Movie.objects.filter(draft=True, updated_at__gte=since)
+        for ids in _keyset_chunks(hidden, chunk_size, lambda queryset: list(queryset.values_list('pk', flat=True))):
+            yield [{'id': movie_id, 'deleted': True} for movie_id in ids]
+
+
+def stream(since=None, chunk_size=CHUNK_SIZE, stats=None):
+    """gzip-поток NDJSON: по куску сжатых данных на пачку фильмов"""
+    stats = stats or ExportStats()
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in records(since, chunk_size):
+        lines = ''.join(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n' for record in chunk)
+        data = compressor.compress(lines.encode())
+        stats.rows += len(chunk)
+        stats.bytes += len(data)
+        if data:
+            yield data
+    data = compressor.flush()
+    stats.bytes += len(data)
+    yield data
+    logger.info("Выгрузка каталога: %s", stats)
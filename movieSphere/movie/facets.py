@@ -0,0 +1,45 @@
+"""Списки фильтров каталога (жанры и годы) с количеством фильмов.
+
+Списки меняются только при сохранении фильма или жанра, поэтому хранятся в кеше и сбрасываются
+сигналами. Таймаут страхует процессы с локальным кешем, до которых сброс не доходит.
+"""
+from datetime import date
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q
+from django.db.models.functions import ExtractYear
+
+from .models import Genre, Movie
+
+FACETS_CACHE_KEY = 'movie:catalog_facets'
+
+
+def _build_facets():
+    genres = list(
+        Genre.objects.annotate(movie_count=Count('movie', filter=Q(movie__draft=False)))
+        .order_by('pk').values('name', 'url', 'movie_count')
+    )
+    year_rows = (
+        Movie.objects.filter(draft=False).annotate(movie_year=ExtractYear('world_premiere'))
+        .values('movie_year').annotate(movie_count=Count('id')).order_by('movie_year')
+    )
+    year_counts = {row['movie_year']: row['movie_count'] for row in year_rows}
+    return {'genres': genres, 'years': list(year_counts), 'year_counts': year_counts}
+
+
+def get_catalog_facets():
+    return cache.get_or_set(FACETS_CACHE_KEY, _build_facets, getattr(settings, 'FACETS_CACHE_TIMEOUT', 300))
+
+
+def invalidate_catalog_facets():
+    cache.delete(FACETS_CACHE_KEY)
+
+
+def year_range_filter(years):
+    """Фильтр по годам премьеры через диапазоны дат, чтобы работал индекс по world_premiere"""
+    condition = Q()
+    for year in sorted({int(year) for year in years if str(year).isdigit()}):
+        if 1 <= year < 9999:
+            condition |= Q(world_premiere__gte=date(year, 1, 1), world_premiere__lt=date(year + 1, 1, 1))
+    return condition
@@ -2,9 +2,11 @@ from django import forms
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from django.contrib.auth.models import User
 
-from .models import Reviews, Rating, RatingStar, Profile, MovieInteraction
+from .models import Reviews, Rating, RatingStar, Profile, MovieInteraction, ChunkedUpload, ChunkedUploadError
 from django.core.validators import validate_email
 from django.core.exceptions import ValidationError
+from django.conf import settings
+from django.urls import reverse
 
 
 class ReviewForm(forms.ModelForm):
@@ -116,4 +118,59 @@ class UserLoginForm(AuthenticationForm):
 class InteractionForm(forms.ModelForm):
     class Meta:
         model = MovieInteraction
-        fields = ['is_favorite', 'is_watched', 'is_planned']
\ No newline at end of file
+        fields = ['is_favorite', 'is_watched', 'is_planned']
+
+
+class ChunkedUploadWidget(forms.Widget):
+    """Выбор файла, который загружается частями через JS; в форму уходит только id завершенной загрузки"""
+    template_name = 'movie/widgets/chunked_upload.html'
+
+    def __init__(self, target, attrs=None):
+        self.target = target
+        super().__init__(attrs)
+
+    class Media:
+        js = ('javascript/chunked_upload.js',)
+
+    def format_value(self, value):
+        # После ошибки в другом поле форма приходит обратно с id еще не забранной загрузки
+        return value if isinstance(value, str) else ''
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        context['widget'].update({
+            'target': self.target,
+            'current_file': value if getattr(value, 'url', None) and value else None,
+            'start_url': reverse('chunked_upload_start'),
+            'chunk_size': settings.CHUNKED_UPLOAD_CHUNK_SIZE,
+        })
+        return context
+
+
+class ChunkedUploadField(forms.Field):
+    """
+    Поле файла, загруженного частями; пустое значение оставляет прежний файл. Проверка формы только
+    убеждается, что загрузка завершена и принадлежит пользователю; забирает ее claim() после сохранения,
+    чтобы ошибка в другом поле не потеряла файл.
+    """
+
+    def __init__(self, target, user=None, **kwargs):
+        self.target = target
+        self.user = user
+        kwargs.update(required=False, widget=ChunkedUploadWidget(target))
+        super().__init__(**kwargs)
+
+    def clean(self, value):
+        if not value:
+            return None
+        if self.user is None or not self.user.is_authenticated:
+            raise forms.ValidationError("Загрузка файла не завершена")
+        try:
+            return ChunkedUpload.completed(value, self.user, self.target).file
+        except ChunkedUploadError:
+            raise forms.ValidationError("Загрузка файла не завершена")
+
+    def claim(self, value):
+        """Забирает проверенную загрузку; value - сырое значение поля из формы"""
+        if value:
+            ChunkedUpload.claim(value, self.user, self.target)
@@ -0,0 +1,84 @@
+"""Кеш HTML-фрагментов фильмов (карточки, актеры, жанры, отзывы).
+
+У каждого фильма есть версия для каждой группы фрагментов (``card``, ``people``, ``genres``,
+``reviews``), и версия входит в ключ фрагмента. Сигналы меняют версию только у затронутых фильмов
+и групп, после чего старые фрагменты просто перестают запрашиваться и вытесняются по таймауту.
+"""
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+SECTIONS = ('card', 'people', 'genres', 'reviews')
+STATS_KEYS = {'hits': 'movie:fragment_stats:hits', 'misses': 'movie:fragment_stats:misses'}
+STATS_FLUSH_EVERY = 100
+
+_pending_stats = {'hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+
+def _version_key(movie_id, section):
+    return f'movie:fragment_version:{section}:{movie_id}'
+
+
+def fragment_timeout():
+    return getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 60 * 60)
+
+
+def fragment_key(movie_id, section, name):
+    version_key = _version_key(movie_id, section)
+    version = cache.get(version_key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(version_key, version, None):
+            version = cache.get(version_key, version)
+    return f'movie:fragment:{name}:{movie_id}:{version}'
+
+
+def invalidate_fragments(movie_ids, sections=SECTIONS):
+    """Меняет версии фрагментов указанных фильмов; прежние фрагменты больше не читаются"""
+    versions = {_version_key(movie_id, section): uuid.uuid4().hex
+                for movie_id in set(movie_ids) if movie_id is not None for section in sections}
+    if versions:
+        cache.set_many(versions, None)
+
+
+def record(outcome):
+    """Копит попадания и промахи в процессе и раз в STATS_FLUSH_EVERY событий переносит их в кеш"""
+    with _stats_lock:
+        _pending_stats[outcome] += 1
+        if sum(_pending_stats.values()) < STATS_FLUSH_EVERY:
+            return
+        pending = dict(_pending_stats)
+        _pending_stats.update(hits=0, misses=0)
+    flush_stats(pending)
+
+
+def flush_stats(pending=None):
+    if pending is None:
+        with _stats_lock:
+            pending = dict(_pending_stats)
+            _pending_stats.update(hits=0, misses=0)
+    for outcome, count in pending.items():
+        if not count:
+            continue
+        try:
+            cache.incr(STATS_KEYS[outcome], count)
+        except ValueError:
+            if not cache.add(STATS_KEYS[outcome], count, None):
+                cache.incr(STATS_KEYS[outcome], count)
+
+
+def get_stats():
+    values = cache.get_many(STATS_KEYS.values())
+    stats = {outcome: values.get(key, 0) for outcome, key in STATS_KEYS.items()}
+    total = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / total if total else 0.0
+    return stats
+
+
+def reset_stats():
+    with _stats_lock:
+        _pending_stats.update(hits=0, misses=0)
+    cache.delete_many(list(STATS_KEYS.values()))
@@ -0,0 +1,365 @@
+"""Поиск имен и названий с опечатками и записанных другим алфавитом (кириллица и латиница).
+
+Название сводится к ключу - словам латиницей: кириллица транслитерируется, а варианты написания одного звука
+схлопываются (c/k/ck, tch/ч, ph/f, w/v, y/i, двойные буквы), поэтому "Бенедикт Камбербэтч" и
+"Benedict Cumberbatch" дают "benedikt kamberbech" и "benedikt kumberbach". Слово запроса совпадает со словом
+названия, если расстояние Дамерау-Левенштейна (с перестановкой соседних букв) не больше ``max_edits``:
+0 для слов до 3 букв, 1 - до 6, иначе 2. Запись найдена, если совпали все слова запроса.
+
+Чтобы не сравнивать запрос с каждой записью, ``NgramIndex`` ищет по словарю различных слов ключей: для каждой
+триграммы слова (с краями ``$слово$``) хранится список слов с ней. Одна правка портит не больше ``GRAM + 1``
+триграмм, поэтому у подходящего слова общих со словом запроса триграмм не меньше порога; слова, набравшие
+порог, проверяются расстоянием (не больше ``MAX_CANDIDATES`` с наибольшим числом общих триграмм). Записи
+находятся пересечением списков записей подходящих слов.
+
+Индексы фильмов и персон живут в памяти процесса так же, как индекс подсказок (``movie.typeahead``): строятся
+при первом запросе, а изменения отдельных записей доходят до остальных процессов через ``movie.shared_index``.
+"""
+import functools
+import re
+import threading
+import unicodedata
+from array import array
+
+import numpy as np
+
+from .models import Actor, Movie
+from .shared_index import SharedIndex
+
+MOVIE, PERSON = 0, 1
+GRAM = 3
+MAX_CANDIDATES = 1000
+MAX_WORDS = 8
+MAX_KEY_LENGTH = 64
+KEY = 'movie:fuzzy'
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+_CYRILLIC = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ж': 'zh', 'з': 'z', 'и': 'i', 'к': 'k',
+    'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f',
+    'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch', 'ъ': '', 'ы': 'i', 'ь': '', 'э': 'e', 'ю': 'iu',
+    'я': 'ia', 'і': 'i', 'є': 'e', 'ґ': 'g',
+}
+_TRANSLITERATION = str.maketrans(_CYRILLIC)
+# Сочетания с c и h; порядок важен: tch и ck раньше одиночной c, kh раньше немой h после гласной (John - Джон)
+_SPELLINGS = [(re.compile(pattern), replacement) for pattern, replacement in (
+    (r'shch', 'sch'), (r'tch', 'ch'), (r'^chr', 'kr'), (r'ck', 'k'), (r'ph', 'f'), (r'th', 't'), (r'kh', 'h'), (r'(?<=[aeiou])h(?![aeiou])', ''),
+    (r'c(?=[eiy])', 's'), (r'c(?!h)', 'k'),
+)]
+_LETTERS = str.maketrans({'q': 'k', 'x': 'ks', 'w': 'v', 'y': 'i', 'j': 'dzh'})
+_DOUBLE_RE = re.compile(r'(.)\1+')
+# Natalie - Натали, Lee - Ли, Andrey - Андрей
+_ENDING_RE = re.compile(r'(?:ie|ei|ee)$')
+# Диакритические знаки после разложения NFKD; translate по таблице заметно быстрее проверки каждого символа
+_COMBINING = dict.fromkeys(code for code in range(0x10000) if unicodedata.combining(chr(code)))
+
+def fold(text):
+    """Нижний регистр без диакритики и лишних пробелов: "Amélie  Poulain" -> "amelie poulain", "Ёлки" -> "елки" """
+    return ' '.join(unicodedata.normalize('NFKD', text or '').translate(_COMBINING).casefold().split())
+
+
+@functools.lru_cache(maxsize=100_000)
+def _word_key(word):
+    word = word.translate(_TRANSLITERATION)
+    if 'c' in word or 'h' in word:
+        for pattern, replacement in _SPELLINGS:
+            word = pattern.sub(replacement, word)
+    return _ENDING_RE.sub('i', _DOUBLE_RE.sub(r'\1', word.translate(_LETTERS)))
+
+
+def normalize(text):
+    """Слова ключа названия: "Бенедикт Камбербэтч" -> ['benedikt', 'kamberbech']"""
+    words = (_word_key(word)[:MAX_KEY_LENGTH] for word in _WORD_RE.findall(fold(text).replace('_', ' ')))
+    return [word for word in words if word][:MAX_WORDS]
+
+
+@functools.lru_cache(maxsize=100_000)
+def grams(word):
+    padded = f'${word}$'
+    return frozenset(padded[start:start + GRAM] for start in range(max(len(padded) - GRAM + 1, 1)))
+
+
+def max_edits(word):
+    return 0 if len(word) <= 3 else 1 if len(word) <= 6 else 2
+
+
+def distances(word, others):
+    """
+    Расстояния Дамерау-Левенштейна (перестановка соседних букв - одна правка) от word до каждого слова others.
+    Битово-параллельный алгоритм Хююрё считает все слова сразу: столбец матрицы правок хранится битами одного
+    uint64, и за шаг обрабатывается очередная буква всех слов. Слова длиннее ``MAX_KEY_LENGTH`` не бывают.
+    """
+    lengths = np.fromiter(map(len, others), dtype=np.int64, count=len(others))
+    if not word or not len(others):
+        return lengths
+    width = max(int(lengths.max()), 1)
+    letters = np.array(others, dtype=f'<U{width}').view(np.uint32).reshape(len(others), width)
+    alphabet = sorted(set(word))
+    codes = np.array([ord(char) for char in alphabet], dtype=np.uint32)
+    masks = np.array([sum(1 << i for i, char in enumerate(word) if char == letter) for letter in alphabet],
+                     dtype=np.uint64)
+
+    one, full, last = np.uint64(1), np.uint64((1 << len(word)) - 1), np.uint64(1 << (len(word) - 1))
+    vp = np.full(len(others), full)
+    vn = d0 = previous = np.zeros(len(others), dtype=np.uint64)
+    scores = np.full(len(others), len(word), dtype=np.int64)
+    for position in range(width):
+        column = letters[:, position]
+        found = np.minimum(np.searchsorted(codes, column), len(codes) - 1)
+        pm = np.where(codes[found] == column, masks[found], np.uint64(0))
+        transposed = ((~d0 & pm) << one) & previous
+        d0 = ((((pm & vp) + vp) ^ vp) | pm | vn | transposed) & full
+        hp = vn | ~(d0 | vp)
+        hn = d0 & vp
+        active = position < lengths
+        scores += active & ((hp & last) != 0)
+        scores -= active & ((hp & last) == 0) & ((hn & last) != 0)
+        hp = ((hp << one) | one) & full
+        vp = ((hn << one) | ~(d0 | hp)) & full
+        vn = hp & d0
+        previous = pm
+    return scores
+
+
+def rank(query, rows):
+    """
+    id строк (id, название), подходящих под запрос, от лучших к худшим - для коротких списков без индекса.
+    Название, содержащее запрос подстрокой, подходит без правок.
+    """
+    query_words, folded = normalize(query), fold(query)
+    if not query_words:
+        return []
+    rows = [(object_id, fold(label), normalize(label)) for object_id, label in rows]
+    vocabulary = sorted({word for _, _, words in rows for word in words})
+    # Для каждого слова запроса - правки до подходящих слов названий
+    similar = []
+    for query_word in query_words:
+        edits = distances(query_word, vocabulary)
+        similar.append({word: int(count) for word, count in zip(vocabulary, edits) if count <= max_edits(query_word)})
+    found = []
+    for position, (object_id, label, words) in enumerate(rows):
+        if folded in label:
+            found.append((0, position, object_id))
+            continue
+        best = [min((edits[word] for word in words if word in edits), default=None) for edits in similar]
+        if None not in best:
+            found.append((sum(best), position, object_id))
+    return [object_id for _, _, object_id in sorted(found)]
+
+
+class NgramIndex:
+    """
+    Индекс по словам ключей: у каждого различного слова - номер, триграммы и список записей, где оно встречается.
+    Поиск идет по словарю слов, а не по записям: слова, похожие на каждое слово запроса, находятся по общим
+    триграммам и проверяются расстоянием, затем их списки записей пересекаются. Записи лежат по номерам: номера
+    слов - в списке, id и популярность - в массивах; номера записей по id - в массиве, индексируемом id. Номера
+    удаленных записей и слов, оставшихся без записей, переиспользуются. Все обращения идут под блокировкой.
+    """
+
+    def __init__(self):
+        self._record_words = []
+        self._object_ids = array('q')
+        self._popularity = array('q')
+        self._slot_by_id = array('l')
+        self._free = []
+        self._words = []
+        self._word_ids = {}
+        self._word_lengths = array('i')
+        self._word_records = []
+        self._free_words = []
+        self._grams = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._record_words) - len(self._free)
+
+    @classmethod
+    def build(cls, rows):
+        """rows - итерируемые кортежи (id, название, популярность)"""
+        index = cls()
+        for object_id, label, popularity in rows:
+            index._add(object_id, label, popularity)
+        return index
+
+    def put(self, object_id, label, popularity=0):
+        """Добавляет или заменяет запись"""
+        with self._lock:
+            self._remove(object_id)
+            self._add(object_id, label, popularity)
+
+    def remove(self, object_id):
+        with self._lock:
+            self._remove(object_id)
+
+    def search(self, query, limit=10):
+        """Подходящие записи [(id, число правок), ...]: сначала с меньшим числом правок, затем популярные"""
+        query_words = normalize(query)
+        if not query_words:
+            return []
+        with self._lock:
+            slots = edits = None
+            for query_word in query_words:
+                word_slots, word_edits = self._records(query_word)
+                if slots is None:
+                    slots, edits = word_slots, word_edits
+                else:
+                    slots, first, second = np.intersect1d(slots, word_slots, assume_unique=True, return_indices=True)
+                    edits = edits[first] + word_edits[second]
+                if not len(slots):
+                    return []
+            popularity = np.frombuffer(self._popularity, dtype=np.int64)[slots]
+            object_ids = np.frombuffer(self._object_ids, dtype=np.int64)[slots]
+            order = np.lexsort((object_ids, -popularity, edits))[:limit]
+            return [(int(object_ids[position]), int(edits[position])) for position in order]
+
+    def _similar_words(self, query_word):
+        """Номера слов словаря в пределах max_edits от слова запроса и их расстояния"""
+        limit = max_edits(query_word)
+        if limit == 0:
+            word_id = self._word_ids.get(query_word)
+            return ([word_id], [0]) if word_id is not None else ([], [])
+        query_grams = grams(query_word)
+        postings = [np.frombuffer(self._grams[gram], dtype=np.int32) for gram in query_grams if gram in self._grams]
+        if not postings:
+            return [], []
+        counts = np.bincount(np.concatenate(postings), minlength=len(self._words))
+        del postings
+        lengths = np.frombuffer(self._word_lengths, dtype=np.int32)
+        candidates = np.flatnonzero((counts >= max(len(query_grams) - (GRAM + 1) * limit, 1))
+                                    & (np.abs(lengths - len(query_word)) <= limit))
+        if len(candidates) > MAX_CANDIDATES:
+            candidates = candidates[np.argpartition(-counts[candidates], MAX_CANDIDATES)[:MAX_CANDIDATES]]
+        edits = distances(query_word, [self._words[word_id] for word_id in candidates.tolist()])
+        keep = edits <= limit
+        return candidates[keep].tolist(), edits[keep].tolist()
+
+    def _records(self, query_word):
+        """Номера записей, где есть слово, похожее на слово запроса, и наименьшее число правок для каждой"""
+        found, word_edits = self._similar_words(query_word)
+        if not found:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64)
+        slots = np.concatenate([np.frombuffer(self._word_records[word_id], dtype=np.int32) for word_id in found])
+        edits = np.repeat(word_edits, [len(self._word_records[word_id]) for word_id in found])
+        order = np.lexsort((edits, slots))
+        slots, edits = slots[order], edits[order]
+        first = np.ones(len(slots), dtype=bool)
+        first[1:] = slots[1:] != slots[:-1]
+        return slots[first], edits[first]
+
+    def _add(self, object_id, label, popularity):
+        if self._free:
+            slot = self._free.pop()
+            self._object_ids[slot] = object_id
+            self._popularity[slot] = popularity
+        else:
+            slot = len(self._record_words)
+            self._record_words.append(())
+            self._object_ids.append(object_id)
+            self._popularity.append(popularity)
+        word_ids = tuple(dict.fromkeys(self._word_id(word) for word in normalize(label)))
+        for word_id in word_ids:
+            self._word_records[word_id].append(slot)
+        self._record_words[slot] = word_ids
+        # id выдаются базой подряд, поэтому массив по id почти без пустот
+        if object_id >= len(self._slot_by_id):
+            self._slot_by_id.extend([-1] * (object_id + 1 - len(self._slot_by_id)))
+        self._slot_by_id[object_id] = slot
+
+    def _word_id(self, word):
+        word_id = self._word_ids.get(word)
+        if word_id is not None:
+            return word_id
+        if self._free_words:
+            word_id = self._free_words.pop()
+            self._words[word_id] = word
+            self._word_lengths[word_id] = len(word)
+        else:
+            word_id = len(self._words)
+            self._words.append(word)
+            self._word_lengths.append(len(word))
+            self._word_records.append(array('i'))
+        self._word_ids[word] = word_id
+        for gram in grams(word):
+            self._grams.setdefault(gram, array('i')).append(word_id)
+        return word_id
+
+    def _remove(self, object_id):
+        slot = self._slot_by_id[object_id] if object_id < len(self._slot_by_id) else -1
+        if slot < 0:
+            return
+        for word_id in self._record_words[slot]:
+            records = self._word_records[word_id]
+            del records[records.index(slot)]
+            if not records:
+                self._remove_word(word_id)
+        self._slot_by_id[object_id] = -1
+        self._record_words[slot] = ()
+        self._free.append(slot)
+
+    def _remove_word(self, word_id):
+        word = self._words[word_id]
+        for gram in grams(word):
+            posting = self._grams[gram]
+            del posting[posting.index(word_id)]
+            if not posting:
+                del self._grams[gram]
+        del self._word_ids[word]
+        self._words[word_id] = ''
+        self._free_words.append(word_id)
+
+
+def load():
+    movies = Movie.objects.values_list('pk', 'title', 'rating_count').iterator(chunk_size=5000)
+    people = Actor.objects.values_list('pk', 'name', 'movies_count').iterator(chunk_size=5000)
+    return {MOVIE: NgramIndex.build(movies), PERSON: NgramIndex.build(people)}
+
+
+def _apply(indexes, change):
+    action, kind, object_id, *values = change
+    if action == 'put':
+        indexes[kind].put(object_id, *values)
+    else:
+        indexes[kind].remove(object_id)
+
+
+_shared = SharedIndex(KEY, load, _apply, "индекс нечеткого поиска")
+
+
+def get_indexes():
+    """Индексы процесса {MOVIE: ..., PERSON: ...}; изменения из других процессов дочитываются из кеша"""
+    return _shared.get()
+
+
+def warm_up():
+    """Начинает строить индексы в фоне при старте процесса (SEARCH_INDEX_WARM_UP)"""
+    _shared.warm_up()
+
+
+def reset():
+    _shared.reset()
+
+
+def invalidate():
+    """После массовых изменений мимо сигналов (импорт): все процессы, включая текущий, перестраивают индексы"""
+    _shared.invalidate()
+
+
+def search(kind, query, limit=10):
+    """id записей вида kind, подходящих под запрос с опечатками, от лучших к худшим"""
+    return [object_id for object_id, _ in get_indexes()[kind].search(query, limit)]
+
+
+def movie_saved(movie_id, title, rating_count):
+    _shared.changed(('put', MOVIE, movie_id, title, rating_count))
+
+
+def movie_deleted(movie_id):
+    _shared.changed(('remove', MOVIE, movie_id))
+
+
+def person_saved(actor_id, name, movies_count):
+    _shared.changed(('put', PERSON, actor_id, name, movies_count))
+
+
+def person_deleted(actor_id):
+    _shared.changed(('remove', PERSON, actor_id))
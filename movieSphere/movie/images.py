@@ -0,0 +1,182 @@
+"""Уменьшенные копии изображений (постеры, фото актеров, картинки жанров, аватары).
+
+Для каждого загруженного изображения строятся варианты фиксированной ширины в WebP и JPEG.
+Имена вариантов зависят от содержимого исходника (``derivatives/ab/<sha256>-<ширина>.<формат>``),
+поэтому одинаковые картинки не пересчитываются, а новая загрузка под тем же именем получает новые URL.
+Список вариантов исходника хранится в манифесте на диске рядом с вариантами и кешируется в Django cache;
+шаблонный тег ``{% responsive_image %}`` строит по нему ``srcset``, а если вариантов ещё нет, отдаёт оригинал.
+Варианты новых загрузок строит не запрос, а ``manage.py build_image_variants --pending`` (см. ``ImageVariantsUpdate``).
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.cache import cache
+from PIL import Image, ImageOps
+
+DERIVATIVES_DIR = 'derivatives'
+# Ширины вариантов для каждого вида изображений
+IMAGE_VARIANTS = {
+    'poster': (200, 300, 450, 600, 900),
+    'preview': (640, 1280, 1920),
+    'actor': (100, 200, 400),
+    'genre': (160, 320, 640),
+    'avatar': (70, 140, 210),
+}
+# Ширина на странице по умолчанию (атрибут sizes), по ней браузер выбирает вариант с учетом плотности экрана
+IMAGE_SIZES = {
+    'poster': '(max-width: 600px) 340px, 300px',
+    'preview': '100vw',
+    'actor': '200px',
+    'genre': '320px',
+    'avatar': '70px',
+}
+# Какие поля моделей к какому виду относятся
+IMAGE_FIELDS = {
+    ('movie', 'poster'): 'poster',
+    ('movie', 'preview_poster'): 'preview',
+    ('actor', 'image'): 'actor',
+    ('genre', 'image'): 'genre',
+    ('profile', 'photo'): 'avatar',
+}
+FORMATS = (
+    ('webp', 'WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+    ('jpg', 'JPEG', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+MANIFEST_VERSION = 1
+
+
+def _media_path(name):
+    return os.path.join(settings.MEDIA_ROOT, name)
+
+
+def _manifest_name(source_name):
+    digest = hashlib.sha1(source_name.encode()).hexdigest()
+    return f'{DERIVATIVES_DIR}/manifests/{digest[:2]}/{digest}.json'
+
+
+def _cache_key(source_name):
+    return f'movie:image_variants:{hashlib.sha1(source_name.encode()).hexdigest()}'
+
+
+def _write_atomic(path, write):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            write(file)
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+def content_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_manifest(source_name):
+    """Манифест вариантов исходника, если он совпадает с текущим файлом по размеру и времени изменения"""
+    try:
+        stat_result = os.stat(_media_path(source_name))
+        with open(_media_path(_manifest_name(source_name))) as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if (manifest.get('version') != MANIFEST_VERSION or manifest.get('size') != stat_result.st_size
+            or manifest.get('mtime_ns') != stat_result.st_mtime_ns):
+        return None
+    return manifest
+
+
+def generate_variants(source_name, kind, force=False):
+    """Строит недостающие варианты исходника и записывает манифест; возвращает манифест"""
+    path = _media_path(source_name)
+    manifest = None if force else read_manifest(source_name)
+    if manifest is not None and manifest.get('kind') == kind:
+        return manifest
+
+    stat_result = os.stat(path)
+    digest = content_hash(path)
+    with Image.open(path) as original:
+        image = ImageOps.exif_transpose(original)
+        image.load()
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+
+    # Варианты шире исходника не нужны: вместо них берётся сам исходник в новых форматах
+    widths = sorted({min(width, image.width) for width in IMAGE_VARIANTS[kind]})
+    variants = []
+    for width in widths:
+        height = max(round(image.height * width / image.width), 1)
+        resized = image.resize((width, height), Image.LANCZOS) if width != image.width else image
+        for extension, pillow_format, mime_type, options in FORMATS:
+            name = f'{DERIVATIVES_DIR}/{digest[:2]}/{digest[:32]}-{width}.{extension}'
+            target = _media_path(name)
+            if force or not os.path.exists(target):
+                converted = resized.convert('RGBA' if has_alpha and extension == 'webp' else 'RGB')
+                _write_atomic(target, lambda file: converted.save(file, pillow_format, **options))
+            variants.append({'name': name, 'width': width, 'height': height, 'type': mime_type})
+
+    manifest = {
+        'version': MANIFEST_VERSION, 'kind': kind, 'source': source_name, 'hash': digest,
+        'size': stat_result.st_size, 'mtime_ns': stat_result.st_mtime_ns,
+        'width': image.width, 'height': image.height, 'variants': variants,
+    }
+    _write_atomic(_media_path(_manifest_name(source_name)),
+                  lambda file: file.write(json.dumps(manifest).encode()))
+    cache.set(_cache_key(source_name), manifest, None)
+    return manifest
+
+
+def get_variants(field_file):
+    """Манифест вариантов поля-изображения или None, если варианты ещё не построены"""
+    if not field_file:
+        return None
+    key = _cache_key(field_file.name)
+    manifest = cache.get(key)
+    if manifest is None:
+        manifest = read_manifest(field_file.name)
+        if manifest is None:
+            return None
+        cache.set(key, manifest, None)
+    return manifest
+
+
+def invalidate_variants(source_name):
+    cache.delete(_cache_key(source_name))
+
+
+def srcset(manifest, mime_type):
+    return ', '.join(f"{settings.MEDIA_URL}{variant['name']} {variant['width']}w"
+                     for variant in manifest['variants'] if variant['type'] == mime_type)
+
+
+def variant_url(field_file, width):
+    """URL самого маленького JPEG-варианта не уже width (или оригинала, если вариантов нет)"""
+    manifest = get_variants(field_file)
+    if manifest is None:
+        return field_file.url if field_file else ''
+    jpegs = [variant for variant in manifest['variants'] if variant['type'] == 'image/jpeg']
+    chosen = next((variant for variant in jpegs if variant['width'] >= width), jpegs[-1])
+    return settings.MEDIA_URL + chosen['name']
+
+
+def image_kind(instance, field_name):
+    return IMAGE_FIELDS.get((instance._meta.model_name, field_name))
+
+
+def process_image(job):
+    """Задача для пула процессов: (имя файла, вид, force) -> (имя файла, ошибка или None)"""
+    source_name, kind, force = job
+    try:
+        generate_variants(source_name, kind, force)
+    except (OSError, ValueError, Image.DecompressionBombError) as error:
+        return source_name, str(error)
+    return source_name, None
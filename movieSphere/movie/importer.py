@@ -0,0 +1,413 @@
+"""Массовая загрузка каталога из NDJSON или CSV (``manage.py import_catalog``).
+
+NDJSON - по фильму на строку в формате выгрузки ``movie.export`` (строки ``"deleted"`` пропускаются), поэтому
+выгрузку можно загрузить в другую базу. CSV - по фильму на строку с колонками атрибутов фильма; в колонках
+genres (slug жанров), actors и directors (имена) значения разделяются ``LIST_SEPARATOR``. Файлы ``.gz``
+читаются со сжатием.
+
+Фильм определяется по slug (``Movie.url``): повторный импорт обновляет фильм, а не создает копию. Жанры
+ищутся по slug, персоны - по имени, категории - по названию; словари "ключ -> id" загружаются в память один
+раз, недостающие жанры и персоны создаются. Пишется пачками: bulk_create новых фильмов, сезонов и эпизодов,
+``update_rows`` существующих, связи фильмов пачки в таблицах связей заменяются одним bulk_create на связь.
+Сезоны и эпизоды добавляются и обновляются по номерам, отсутствующие во входных данных не удаляются.
+
+Каждая пачка - отдельная транзакция; после её фиксации номер следующей строки записывается в файл контрольной
+точки (``Checkpoint``), и прерванный импорт продолжается с этой строки. bulk-операции не вызывают сигналы,
+поэтому после пачки обновляются поисковый индекс, статистика персон, версии разделов API и кеши фрагментов,
+а в конце - фасеты, подсказки и нечеткий поиск. Похожие фильмы пересчитывает ``manage.py build_similar_movies``.
+"""
+import csv
+import gzip
+import json
+import os
+import time
+from functools import partial
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.utils import timezone
+
+from . import fuzzy, random_movie, typeahead
+from .facets import invalidate_catalog_facets
+from .fragments import invalidate_fragments
+from .models import Actor, CatalogVersion, Category, Episode, Genre, Movie, Season, update_rows
+from .search import get_search_backend
+
+BATCH_SIZE = 1000
+LIST_SEPARATOR = '|'
+# Ключ входных данных -> поле фильма; остальные ключи (id, average_rating, rating_count, ...) не загружаются
+MOVIE_FIELDS = {
+    'title': 'title', 'tagline': 'tagline', 'description': 'description', 'year': 'year', 'country': 'country',
+    'world_premiere': 'world_premiere', 'duration_hours': 'duration_hours', 'duration_minutes': 'duration_minutes',
+    'budget': 'budget', 'box_office_usa': 'box_office_usa', 'box_office_world': 'box_office_world',
+    'is_series': 'is_series', 'is_editors_choice': 'is_editors_choice', 'draft': 'draft',
+    'external_link': 'external_link', 'poster': 'poster', 'preview_poster': 'preview_poster', 'trailer': 'trailer',
+}
+SEASON_FIELDS = ('title',)
+EPISODE_FIELDS = ('title', 'description', 'duration_minutes', 'video', 'external_link')
+RELATIONS = {'genres': 'genre', 'actors': 'actors', 'directors': 'directors'}
+TRUE_VALUES = ('1', 'true', 'yes', 't')
+
+
+class ImportStats:
+    """Счетчики импорта: прочитанные строки, созданные и обновленные фильмы, ошибки строк"""
+
+    def __init__(self, resumed_from=0):
+        self.started = time.monotonic()
+        self.resumed_from = resumed_from
+        self.rows = 0
+        self.created = 0
+        self.updated = 0
+        self.errors = []
+
+    @property
+    def seconds(self):
+        return time.monotonic() - self.started
+
+    @property
+    def rate(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return (f"{self.resumed_from + self.rows} строк (создано {self.created}, обновлено {self.updated}, "
+                f"ошибок {len(self.errors)}) за {self.seconds:.1f} с ({self.rate:.0f} строк/с)")
+
+
+class Checkpoint:
+    """Файл с номером первой неимпортированной строки; привязан к размеру входного файла"""
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source_size = os.path.getsize(source)
+
+    def load(self):
+        try:
+            with open(self.path) as stream:
+                state = json.load(stream)
+        except FileNotFoundError:
+            return 0
+        if state.get('size') != self.source_size:
+            raise ValueError(f"Контрольная точка {self.path} записана для другого файла")
+        return state['rows']
+
+    def save(self, rows):
+        # Запись через временный файл: прерывание посреди записи не портит точку
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'w') as stream:
+            json.dump({'rows': rows, 'size': self.source_size}, stream)
+        os.replace(temporary, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def read_rows(path, format=None):
+    """(номер строки, строка NDJSON или словарь CSV); формат - по расширению, если не указан"""
+    compressed = path.endswith('.gz')
+    name = path[:-len('.gz')] if compressed else path
+    format = format or ('csv' if name.endswith('.csv') else 'ndjson')
+    opener = gzip.open if compressed else open
+    with opener(path, 'rt', encoding='utf-8', newline='') as stream:
+        if format == 'csv':
+            # Номер строки - номер записи после заголовка
+            for number, row in enumerate(csv.DictReader(stream), start=2):
+                yield number, {key: value for key, value in row.items() if key and value not in ('', None)}
+        else:
+            yield from enumerate(stream, start=1)
+
+
+def _clean(model, name, value):
+    field = model._meta.get_field(name)
+    if isinstance(field, models.FileField):
+        # Выгрузка отдает адреса файлов (null - файла нет); в поле хранится имя относительно MEDIA_ROOT
+        if value is not None and not isinstance(value, str):
+            raise ValueError(f"{name}: ожидается путь к файлу")
+        media_url = field.storage.base_url
+        value = value[len(media_url):] if value and value.startswith(media_url) else value or ''
+    elif value is None and not field.null:
+        # to_python(None) возвращает None, и строка упала бы на NOT NULL уже в bulk_create вместе со всей пачкой
+        raise ValueError(f"{name}: значение обязательно")
+    elif isinstance(field, models.BooleanField) and isinstance(value, str):
+        return value.strip().lower() in TRUE_VALUES
+    try:
+        # Приведение типа и валидаторы поля (длина, формат ссылки); пустые строки принимаются как в выгрузке
+        value = field.to_python(value)
+        field.run_validators(value)
+        return value
+    except ValidationError as error:
+        raise ValueError(f"{name}: {'; '.join(error.messages)}")
+
+
+def _items(value):
+    """Список из NDJSON или строка CSV через LIST_SEPARATOR"""
+    if isinstance(value, str):
+        return [item.strip() for item in value.split(LIST_SEPARATOR) if item.strip()]
+    if not isinstance(value, list):
+        raise ValueError("Связи должны быть списком")
+    return value
+
+
+def _genre_key(item):
+    slug, name = (item.get('slug'), item.get('name')) if isinstance(item, dict) else (item, None)
+    if not slug:
+        raise ValueError("genres: пустой slug")
+    slug = _clean(Genre, 'url', slug)
+    return slug, _name(name or slug, 'genres')
+
+
+def _person_name(item, key):
+    return _name(item.get('name') if isinstance(item, dict) else item, key)
+
+
+def _name(value, key):
+    """Имя жанра или персоны; длинное обрезается до длины поля"""
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError(f"{key}: пустое имя")
+    return value.strip()[:100]
+
+
+def _nested(items, key):
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise ValueError(f"{key} должны быть списком объектов")
+    return items
+
+
+def normalize(row):
+    """Запись импорта из строки файла; None - строку нужно пропустить, ValueError - строка некорректна"""
+    if isinstance(row, str):
+        if not row.strip():
+            return None
+        row = json.loads(row)
+    if not isinstance(row, dict):
+        raise ValueError("Строка должна быть объектом")
+    if row.get('deleted'):
+        return None
+    slug = row.get('slug') or row.get('url')
+    if not slug:
+        raise ValueError("Нет slug фильма")
+    record = {
+        'slug': _clean(Movie, 'url', slug),
+        'fields': {name: _clean(Movie, name, row[key]) for key, name in MOVIE_FIELDS.items() if key in row},
+        'category': row.get('category', ...),
+    }
+    for key in RELATIONS:
+        record[key] = None
+        if key in row:
+            record[key] = [_genre_key(item) if key == 'genres' else _person_name(item, key)
+                           for item in _items(row[key])]
+    record['seasons'] = None
+    if 'seasons' in row:
+        record['seasons'] = [{
+            'season_number': _clean(Season, 'season_number', season.get('season_number')),
+            'fields': {name: _clean(Season, name, season[name]) for name in SEASON_FIELDS if name in season},
+            'episodes': [{
+                'episode_number': _clean(Episode, 'episode_number', episode.get('episode_number')),
+                'fields': {name: _clean(Episode, name, episode[name]) for name in EPISODE_FIELDS if name in episode},
+            } for episode in _nested(season.get('episodes', []), 'episodes')],
+        } for season in _nested(row['seasons'], 'seasons')]
+    return record
+
+
+def _first_by_key(rows):
+    """{ключ: id} по парам (id, ключ); при повторе ключа остается меньший id"""
+    found = {}
+    for pk, key in rows:
+        found.setdefault(key, pk)
+    return found
+
+
+class CatalogImporter:
+    """
+    Словари естественных ключей (slug фильма и жанра, имя персоны, название категории) загружаются при
+    создании и пополняются созданными объектами. id новых строк берутся из ответа bulk_create (SQLite 3.35+ и
+    PostgreSQL возвращают их без отдельного запроса).
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.movies = dict(Movie.objects.values_list('url', 'pk').iterator(chunk_size=10000))
+        self.genres = dict(Genre.objects.values_list('url', 'pk'))
+        self.people = _first_by_key(Actor.objects.order_by('pk').values_list('pk', 'name').iterator(chunk_size=10000))
+        self.categories = _first_by_key(Category.objects.order_by('pk').values_list('pk', 'name'))
+
+    def import_batch(self, records):
+        """Записывает пачку одной транзакцией; record['line'] - номер строки для ошибок"""
+        # Повтор фильма в пачке: остается последняя строка
+        records = list({record['slug']: record for record in records}.values())
+        records = [record for record in records if self._check(record)]
+        if not records:
+            return
+        with transaction.atomic():
+            self._add_genres(records)
+            self._add_people(records)
+            movie_ids = self._write_movies(records)
+            removed_people = self._write_relations(records)
+            self._write_seasons(records)
+            self._after_batch(movie_ids, removed_people)
+
+    def _check(self, record):
+        category = record['category']
+        if category is not ... and category is not None and category not in self.categories:
+            self.stats.errors.append((record['line'], f"Неизвестная категория {category}"))
+            return False
+        if record['slug'] not in self.movies and 'title' not in record['fields']:
+            self.stats.errors.append((record['line'], "Нет названия нового фильма"))
+            return False
+        return True
+
+    def _add_genres(self, records):
+        missing = {}
+        for record in records:
+            for slug, name in record['genres'] or ():
+                if slug not in self.genres:
+                    missing.setdefault(slug, name)
+        created = Genre.objects.bulk_create(
+            [Genre(url=slug, name=name, descriptions='') for slug, name in missing.items()])
+        self.genres.update((genre.url, genre.pk) for genre in created)
+
+    def _add_people(self, records):
+        missing = dict.fromkeys(name for record in records for key in ('actors', 'directors')
+                                for name in record[key] or () if name not in self.people)
+        created = Actor.objects.bulk_create([Actor(name=name) for name in missing], batch_size=1000)
+        self.people.update((name, actor.pk) for name, actor in zip(missing, created))
+
+    def _write_movies(self, records):
+        now = timezone.now()
+        new, existing = [], []
+        for record in records:
+            (existing if record['slug'] in self.movies else new).append(record)
+
+        created = Movie.objects.bulk_create([
+            Movie(url=record['slug'], **record['fields'], **self._category(record)) for record in new
+        ], batch_size=500)
+        self.movies.update((movie.url, movie.pk) for movie in created)
+        self.stats.created += len(created)
+
+        if existing:
+            fields = sorted({name for record in existing for name in record['fields']})
+            if any(record['category'] is not ... for record in existing):
+                fields.append('category')
+            movies = Movie.objects.only('pk', *fields).in_bulk([self.movies[record['slug']] for record in existing])
+            for record in existing:
+                movie = movies[self.movies[record['slug']]]
+                for name, value in {**record['fields'], **self._category(record)}.items():
+                    setattr(movie, name, value)
+                movie.updated_at = now
+            update_rows(movies.values(), [*fields, 'updated_at'])
+            self.stats.updated += len(existing)
+        return [self.movies[record['slug']] for record in records]
+
+    def _category(self, record):
+        category = record['category']
+        if category is ...:
+            return {}
+        return {'category_id': self.categories[category] if category is not None else None}
+
+    def _write_relations(self, records):
+        """Заменяет связи фильмов, у которых связь есть во входных данных; возвращает id персон снятых ролей"""
+        removed_people = set()
+        for key, relation in RELATIONS.items():
+            replaced = [record for record in records if record[key] is not None]
+            if not replaced:
+                continue
+            field = getattr(Movie, relation).field
+            through = field.remote_field.through
+            movie_column, target_column = field.m2m_column_name(), field.m2m_reverse_name()
+            movie_ids = [self.movies[record['slug']] for record in replaced]
+            previous = through.objects.filter(**{f'{movie_column}__in': movie_ids})
+            if key != 'genres':
+                removed_people.update(previous.values_list(target_column, flat=True))
+            previous.delete()
+            lookup = self.genres if key == 'genres' else self.people
+            pairs = dict.fromkeys(
+                (self.movies[record['slug']], lookup[item[0] if key == 'genres' else item])
+                for record in replaced for item in record[key]
+            )
+            through.objects.bulk_create(
+                [through(**{movie_column: movie_id, target_column: target_id}) for movie_id, target_id in pairs],
+                batch_size=1000,
+            )
+        return removed_people
+
+    def _write_seasons(self, records):
+        records = [record for record in records if record['seasons'] is not None]
+        if not records:
+            return
+        movie_ids = [self.movies[record['slug']] for record in records]
+        seasons = {(movie_id, number): pk for pk, movie_id, number in Season.objects.filter(
+            movie_id__in=movie_ids).values_list('pk', 'movie_id', 'season_number')}
+        rows = {(self.movies[record['slug']], season['season_number']): season
+                for record in records for season in record['seasons']}
+        self._upsert(Season, seasons, rows, 'movie_id', 'season_number', SEASON_FIELDS)
+
+        season_ids = list(seasons.values())
+        episodes = {(season_id, number): pk for pk, season_id, number in Episode.objects.filter(
+            season_id__in=season_ids).values_list('pk', 'season_id', 'episode_number')}
+        rows = {(seasons[key], episode['episode_number']): episode
+                for key, season in rows.items() for episode in season['episodes']}
+        self._upsert(Episode, episodes, rows, 'season_id', 'episode_number', EPISODE_FIELDS)
+
+    @staticmethod
+    def _upsert(model, existing, rows, parent, number, fields):
+        """bulk_create новых и update_rows существующих строк по ключу (id родителя, номер); existing пополняется"""
+        new = [key for key in rows if key not in existing]
+        created = model.objects.bulk_create(
+            [model(**{parent: key[0], number: key[1]}, **rows[key]['fields']) for key in new], batch_size=1000)
+        existing.update(zip(new, (obj.pk for obj in created)))
+        updated = [key for key in rows if key not in new and rows[key]['fields']]
+        changed = sorted({name for key in updated for name in rows[key]['fields']})
+        if changed:
+            objects = model.objects.only('pk', *changed).in_bulk([existing[key] for key in updated])
+            for key in updated:
+                for name, value in rows[key]['fields'].items():
+                    setattr(objects[existing[key]], name, value)
+            update_rows(objects.values(), changed)
+
+    def _after_batch(self, movie_ids, removed_people):
+        """То, что при сохранении по одному делают сигналы"""
+        get_search_backend().index(Movie.objects.filter(pk__in=movie_ids).only('pk', 'title', 'description'))
+        Actor.refresh_stats_for_movies(movie_ids)
+        Actor.refresh_stats(removed_people)
+        transaction.on_commit(partial(CatalogVersion.bump, 'movies', 'actors', 'genres', 'seasons'))
+        transaction.on_commit(partial(invalidate_fragments, movie_ids))
+        transaction.on_commit(partial(random_movie.invalidate_payloads, movie_ids))
+
+    def finish(self):
+        invalidate_catalog_facets()
+        random_movie.invalidate_candidates()
+        typeahead.invalidate()
+        fuzzy.invalidate()
+
+
+def import_file(path, format=None, batch_size=BATCH_SIZE, checkpoint=None, progress=None):
+    """
+    Импортирует файл пачками по batch_size строк, продолжая с контрольной точки; progress(stats) вызывается
+    после каждой пачки. Некорректные строки пропускаются и попадают в stats.errors.
+    """
+    start = checkpoint.load() if checkpoint else 0
+    stats = ImportStats(resumed_from=start)
+    importer = CatalogImporter(stats)
+    rows = islice(read_rows(path, format), start, None)
+    while batch := list(islice(rows, batch_size)):
+        records = []
+        for line, row in batch:
+            try:
+                record = normalize(row)
+            except ValueError as error:
+                stats.errors.append((line, str(error)))
+                continue
+            if record is not None:
+                record['line'] = line
+                records.append(record)
+        importer.import_batch(records)
+        stats.rows += len(batch)
+        if checkpoint:
+            checkpoint.save(start + stats.rows)
+        if progress:
+            progress(stats)
+    importer.finish()
+    if checkpoint:
+        checkpoint.clear()
+    return stats
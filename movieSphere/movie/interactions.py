@@ -0,0 +1,95 @@
+"""Отметки пользователя (избранное, просмотрено, в планах) сразу для многих фильмов.
+
+Списки фильмов получают отметки для всех карточек одним запросом по уникальному индексу
+``(user_id, movie_id)``: через ``InteractionStatusMixin``/``annotate_movies`` при рендеринге на сервере
+или через ``/interactions/?ids=...`` из JavaScript. Ответы кешируются по ключу с версией пользователя;
+переключение отметки меняет версию, и старые ответы перестают читаться.
+"""
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import BadRequest
+
+from .models import MovieInteraction
+
+MAX_IDS = 300
+EMPTY_STATUS = dict.fromkeys(MovieInteraction.FLAGS.values(), False)
+
+
+def _version_key(user_id):
+    return f'movie:interaction_version:{user_id}'
+
+
+def _timeout():
+    return getattr(settings, 'INTERACTION_STATUS_CACHE_TIMEOUT', 60 * 60)
+
+
+def statuses_version(user_id):
+    version_key = _version_key(user_id)
+    version = cache.get(version_key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(version_key, version, None):
+            version = cache.get(version_key, version)
+    return version
+
+
+def invalidate_statuses(user_id):
+    cache.set(_version_key(user_id), uuid.uuid4().hex, None)
+
+
+def parse_movie_ids(value):
+    """Список id из строки "1,2,3"; повторы отбрасываются, порядок сохраняется"""
+    try:
+        movie_ids = list(dict.fromkeys(int(part) for part in value.split(',') if part.strip()))
+    except ValueError:
+        raise BadRequest("Некорректный список фильмов")
+    if len(movie_ids) > MAX_IDS:
+        raise BadRequest(f"Не больше {MAX_IDS} фильмов за запрос")
+    return movie_ids
+
+
+def ids_digest(movie_ids):
+    return hashlib.sha1(','.join(map(str, sorted(movie_ids))).encode()).hexdigest()
+
+
+def load_statuses(user_id, movie_ids):
+    """Отметки по фильмам одним запросом; фильмы без отметок получают все флаги False"""
+    flags = list(MovieInteraction.FLAGS.values())
+    statuses = {movie_id: EMPTY_STATUS for movie_id in movie_ids}
+    rows = MovieInteraction.objects.filter(user_id=user_id, movie_id__in=movie_ids).values_list('movie_id', *flags)
+    for movie_id, *values in rows:
+        statuses[movie_id] = dict(zip(flags, values))
+    return statuses
+
+
+def get_statuses(user_id, movie_ids, version=None):
+    if not movie_ids:
+        return {}
+    version = version or statuses_version(user_id)
+    key = f'movie:interaction_statuses:{user_id}:{version}:{ids_digest(movie_ids)}'
+    statuses = cache.get(key)
+    if statuses is None:
+        statuses = load_statuses(user_id, movie_ids)
+        cache.set(key, statuses, _timeout())
+    return statuses
+
+
+def annotate_movies(user, movies):
+    """Проставляет каждому фильму атрибут interaction_status (None для анонимов); возвращает словарь статусов"""
+    movies = list(movies)
+    statuses = get_statuses(user.pk, [movie.pk for movie in movies]) if user.is_authenticated else {}
+    for movie in movies:
+        movie.interaction_status = statuses.get(movie.pk)
+    return statuses
+
+
+class InteractionStatusMixin:
+    """Для ListView: отметки пользователя для всех фильмов страницы в контексте и на самих объектах"""
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['interaction_statuses'] = annotate_movies(self.request.user, context['object_list'])
+        return context
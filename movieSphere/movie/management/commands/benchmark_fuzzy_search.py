@@ -0,0 +1,81 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from movie.fuzzy import NgramIndex
+
+FIRST_NAMES = [
+    ('Benedict', 'Бенедикт'), ('John', 'Джон'), ('Michael', 'Майкл'), ('Andrey', 'Андрей'), ('Sergey', 'Сергей'),
+    ('Anna', 'Анна'), ('Maria', 'Мария'), ('Charlize', 'Шарлиз'), ('Keanu', 'Киану'), ('Tom', 'Том'),
+    ('Nikolai', 'Николай'), ('Elena', 'Елена'), ('Dmitry', 'Дмитрий'), ('Jessica', 'Джессика'), ('Peter', 'Питер'),
+    ('Alexander', 'Александр'), ('Olga', 'Ольга'), ('Christopher', 'Кристофер'), ('Natalie', 'Натали'),
+    ('Yuri', 'Юрий'), ('Ivan', 'Иван'), ('Catherine', 'Кэтрин'), ('Philip', 'Филип'), ('Victor', 'Виктор'),
+]
+# Слоги фамилий латиницей и кириллицей: одна фамилия получается в двух написаниях
+SYLLABLES = [
+    ('ka', 'ка'), ('ber', 'бер'), ('batch', 'бэтч'), ('cum', 'кам'), ('zvya', 'звя'), ('gin', 'гин'),
+    ('tsev', 'цев'), ('kha', 'ха'), ('ben', 'бен'), ('sky', 'ский'), ('ro', 'ро'), ('man', 'ман'), ('son', 'сон'),
+    ('shu', 'шу'), ('kov', 'ков'), ('vich', 'вич'), ('te', 'те'), ('ron', 'рон'), ('mi', 'ми'), ('lo', 'ло'),
+    ('zhen', 'жен'), ('chuk', 'чук'), ('der', 'дер'), ('ley', 'ли'), ('fi', 'фи'), ('ner', 'нер'), ('go', 'го'),
+    ('dar', 'дар'), ('stein', 'стайн'), ('berg', 'берг'), ('pe', 'пе'), ('tro', 'тро'), ('val', 'вал'),
+    ('yu', 'ю'), ('ya', 'я'), ('shch', 'щ'), ('nov', 'нов'), ('ga', 'га'), ('ri', 'ри'), ('ton', 'тон'),
+]
+
+
+class Command(BaseCommand):
+    help = "Нечеткий поиск имен: время построения индекса, задержка и полнота запросов с опечаткой в другом алфавите"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--names', type=int, default=500_000)
+        parser.add_argument('--surnames', type=int, default=150_000)
+        parser.add_argument('--queries', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        surnames = [[rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))] for _ in range(options['surnames'])]
+        people = []
+        for _ in range(options['names']):
+            first, surname = rng.choice(FIRST_NAMES), rng.choice(surnames)
+            latin = f"{first[0]} {''.join(syllable[0] for syllable in surname).capitalize()}"
+            cyrillic = f"{first[1]} {''.join(syllable[1] for syllable in surname).capitalize()}"
+            people.append((latin, cyrillic))
+
+        started = time.perf_counter()
+        # Половина записей хранится кириллицей, половина латиницей; запрос - в другом алфавите
+        index = NgramIndex.build(
+            (object_id, names[object_id % 2], rng.randint(0, 1000)) for object_id, names in enumerate(people))
+        self.stdout.write(f"Индекс: {len(index)} записей за {time.perf_counter() - started:.1f} с")
+
+        timings, found = [], 0
+        for _ in range(options['queries']):
+            object_id = rng.randrange(len(people))
+            query = self.typo(people[object_id][1 - object_id % 2], rng)
+            started = time.perf_counter()
+            result = index.search(query, 10)
+            timings.append((time.perf_counter() - started) * 1000)
+            # Одинаковых имен в наборе несколько, подходит любое из них
+            found += people[object_id] in {people[result_id] for result_id, _ in result}
+        timings.sort()
+        self.stdout.write(
+            f"Запросы: медиана {statistics.median(timings):.2f} мс, "
+            f"p95 {timings[int(len(timings) * 0.95)]:.2f} мс, максимум {timings[-1]:.2f} мс; "
+            f"искомое имя в первой десятке: {found / len(timings):.1%}"
+        )
+
+    @staticmethod
+    def typo(name, rng):
+        """Одна опечатка в фамилии: замена, пропуск или перестановка соседних букв"""
+        first, surname = name.split(' ', 1)
+        letters = list(surname)
+        position = rng.randrange(1, len(letters) - 1)
+        kind = rng.randrange(3)
+        if kind == 0:
+            letters[position] = rng.choice('aeiou' if surname.isascii() else 'аеиоу')
+        elif kind == 1:
+            del letters[position]
+        else:
+            letters[position], letters[position + 1] = letters[position + 1], letters[position]
+        return f"{first} {''.join(letters)}"
@@ -0,0 +1,71 @@
+import random
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.core.paginator import Paginator
+from django.db.models import Avg
+
+from movie.management.benchmark import scratch_database, measure
+from movie.models import Movie, Rating, RatingStar, PopularitySnapshot
+from movie.views import PopularityPaginator
+
+
+class Command(BaseCommand):
+    help = "Сравнивает старый (Avg по рейтингам) и новый (снимок) способы выборки популярных фильмов"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--movies', type=int, default=10000)
+        parser.add_argument('--ratings', type=int, default=1000000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--page', type=int, default=100)
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            self.seed(options['movies'], options['ratings'])
+            self.run(options['repeat'], options['page'])
+
+    def seed(self, movie_count, rating_count):
+        self.stdout.write(f"Заполнение: {movie_count} фильмов, {rating_count} оценок...")
+        stars = RatingStar.objects.bulk_create(RatingStar(value=value) for value in range(1, 11))
+        Movie.objects.bulk_create(
+            (Movie(title=f"Фильм {i}", url=f"movie-{i}", description="", country="")
+             for i in range(movie_count)), batch_size=1000
+        )
+        movie_ids = list(Movie.objects.values_list('pk', flat=True))
+        rng = random.Random(42)
+        batch = []
+        for i in range(rating_count):
+            batch.append(Rating(ip=str(i), star=rng.choice(stars), movie_id=rng.choice(movie_ids)))
+            if len(batch) == 10000:
+                Rating.objects.bulk_create(batch)
+                batch = []
+        Rating.objects.bulk_create(batch)
+        call_command('rebuild_rating_aggregates', stdout=self.stdout)
+
+    def run(self, repeat, page):
+        def legacy_top():
+            return list(Movie.objects.annotate(average_rating_value=Avg('rating__star__value')).filter(
+                average_rating_value__isnull=False).order_by('-average_rating_value')[:10])
+
+        def legacy_page():
+            query = Movie.objects.annotate(average_rating_value=Avg('rating__star__value')).filter(
+                average_rating_value__isnull=False).order_by('-average_rating_value')
+            return list(Paginator(query, 5).get_page(page).object_list)
+
+        def snapshot_top():
+            return list(Movie.get_popular_movies(limit=10))
+
+        def snapshot_page():
+            return list(PopularityPaginator(PopularitySnapshot.current(), 5).get_page(page).object_list)
+
+        rebuild_median, _ = measure(PopularitySnapshot.rebuild, repeat=1)
+        self.stdout.write(f"Построение снимка: {rebuild_median:.1f} мс")
+
+        for name, func in (
+            ("Топ-10, Avg по рейтингам", legacy_top),
+            ("Топ-10, снимок", snapshot_top),
+            (f"Страница {page}, Avg + COUNT", legacy_page),
+            (f"Страница {page}, снимок", snapshot_page),
+        ):
+            median, best = measure(func, repeat=repeat)
+            self.stdout.write(f"{name:<32} медиана {median:9.2f} мс, минимум {best:9.2f} мс")
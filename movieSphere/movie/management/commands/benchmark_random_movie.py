@@ -0,0 +1,102 @@
+import random
+import time
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Avg
+from django.http import JsonResponse
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from movie.management.benchmark import scratch_database
+from movie.models import Movie, Rating, RatingStar, PopularitySnapshot, Season, Episode
+from movie.views import get_random_movie
+
+
+def legacy_get_random_movie(request):
+    """Прежняя реализация: агрегат популярности и по запросу на каждый сезон"""
+    movie = random.choice(Movie.objects.annotate(average_rating_value=Avg('rating__star__value')).filter(
+        average_rating_value__isnull=False).order_by('-average_rating_value')[:10])
+    data = {
+        'title': movie.title,
+        'description': movie.description,
+        'preview_poster': movie.preview_poster.url if movie.preview_poster else '',
+        'trailer_url': movie.trailer.url if movie.trailer else None,
+        'movie_url': movie.movie_file.url if movie.movie_file else None,
+        'is_series': movie.is_series,
+        'seasons': [{
+            'id': season.id,
+            'season_number': season.season_number,
+            'episodes': [{
+                'id': episode.id,
+                'episode_number': episode.episode_number,
+                'title': episode.title,
+                'description': episode.description,
+                'video_url': episode.video.url
+            } for episode in season.episodes.all()]
+        } for season in movie.seasons.all()] if movie.is_series else None,
+    }
+    return JsonResponse(data)
+
+
+class Command(BaseCommand):
+    help = "Пропускная способность get_random_movie: прежняя реализация и готовые ответы из кеша"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--movies', type=int, default=2000)
+        parser.add_argument('--ratings', type=int, default=100000)
+        parser.add_argument('--seasons', type=int, default=5)
+        parser.add_argument('--episodes', type=int, default=12)
+        parser.add_argument('--requests', type=int, default=500)
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            self.seed(options)
+            self.run(options['requests'])
+
+    def seed(self, options):
+        self.stdout.write(f"Заполнение: {options['movies']} фильмов, {options['ratings']} оценок...")
+        stars = RatingStar.objects.bulk_create(RatingStar(value=value) for value in range(1, 11))
+        Movie.objects.bulk_create(
+            (Movie(title=f"Сериал {i}", url=f"series-{i}", description="Описание", country="", is_series=True)
+             for i in range(options['movies'])), batch_size=1000
+        )
+        movie_ids = list(Movie.objects.values_list('pk', flat=True))
+        rng = random.Random(42)
+        Rating.objects.bulk_create(
+            (Rating(ip=str(i), star=rng.choice(stars), movie_id=rng.choice(movie_ids))
+             for i in range(options['ratings'])), batch_size=10000
+        )
+        call_command('rebuild_rating_aggregates', stdout=self.stdout)
+        PopularitySnapshot.rebuild()
+
+        top_ids = list(Movie.get_popular_movies(limit=10).values_list('pk', flat=True))
+        legacy_ids = Movie.objects.annotate(average_rating_value=Avg('rating__star__value')).filter(
+            average_rating_value__isnull=False).order_by('-average_rating_value').values_list('pk', flat=True)[:10]
+        seasons = Season.objects.bulk_create(
+            Season(movie_id=movie_id, season_number=number)
+            for movie_id in set(top_ids) | set(legacy_ids) for number in range(1, options['seasons'] + 1)
+        )
+        Episode.objects.bulk_create(
+            Episode(season=season, episode_number=number, title=f"Серия {number}", video='media/episodes/e.mp4')
+            for season in seasons for number in range(1, options['episodes'] + 1)
+        )
+
+    def run(self, request_count):
+        request = RequestFactory().get('/get_random_movie/')
+        cache.clear()
+        for name, view in (("Прежняя реализация", legacy_get_random_movie),
+                           ("Готовые ответы из кеша", get_random_movie)):
+            view(request)  # прогрев
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                for _ in range(request_count):
+                    assert view(request).status_code == 200
+                elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"{name:<24} {request_count / elapsed:10.1f} запросов/с, "
+                f"{elapsed / request_count * 1000:8.3f} мс на запрос, "
+                f"{len(queries) / request_count:5.1f} SQL на запрос"
+            )
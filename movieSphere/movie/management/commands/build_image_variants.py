@@ -0,0 +1,62 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from movie.images import IMAGE_FIELDS, process_image
+from movie.models import Movie, Actor, Genre, Profile, ImageVariantsUpdate
+from movie.signals import reset_image_fragments
+
+
+def _setup_worker():
+    django.setup()
+
+
+class Command(BaseCommand):
+    help = ("Строит уменьшенные копии (WebP и JPEG) для уже загруженных изображений; "
+            "с --pending - только новые загрузки, отмеченные при сохранении (для запуска по расписанию)")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Количество процессов")
+        parser.add_argument('--force', action='store_true', help="Пересобрать варианты с актуальным манифестом")
+        parser.add_argument('--pending', action='store_true', help="Только изображения, ожидающие обработки")
+
+    def jobs(self, force):
+        seen = set()
+        for model in (Movie, Actor, Genre, Profile):
+            fields = [field for (model_name, field) in IMAGE_FIELDS if model_name == model._meta.model_name]
+            for row in model.objects.values_list(*fields).iterator():
+                for field, name in zip(fields, row):
+                    if name and name not in seen:
+                        seen.add(name)
+                        yield name, IMAGE_FIELDS[(model._meta.model_name, field)], force
+
+    def pending_jobs(self, force):
+        for name, kind in ImageVariantsUpdate.objects.values_list('file', 'kind').iterator():
+            yield name, kind, force
+
+    def reset_fragments(self, names):
+        """Фрагменты объектов с этими картинками собраны до появления вариантов"""
+        for model in (Movie, Actor, Genre, Profile):
+            fields = [field for (model_name, field) in IMAGE_FIELDS if model_name == model._meta.model_name]
+            for field in fields:
+                for instance in model.objects.filter(**{f'{field}__in': names}):
+                    reset_image_fragments(instance)
+
+    def handle(self, *args, **options):
+        started = timezone.now()
+        jobs = list(self.pending_jobs(options['force']) if options['pending'] else self.jobs(options['force']))
+        failed = 0
+        with ProcessPoolExecutor(max_workers=max(options['workers'], 1), initializer=_setup_worker) as executor:
+            for name, error in executor.map(process_image, jobs, chunksize=8):
+                if error:
+                    failed += 1
+                    self.stderr.write(f"{name}: {error}")
+        if options['pending']:
+            names = [name for name, _, _ in jobs]
+            # Отметки, поставленные во время обработки, остаются до следующего запуска
+            ImageVariantsUpdate.objects.filter(file__in=names, marked_at__lte=started).delete()
+            self.reset_fragments(names)
+        self.stdout.write(self.style.SUCCESS(f"Обработано изображений: {len(jobs) - failed}, с ошибками: {failed}"))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from movie import recommendations
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает персональные рекомендации всех пользователей по их отметкам"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1, help="Число процессов (шардов пользователей)")
+        parser.add_argument('--per-user', type=int, default=None, help="Сколько фильмов рекомендовать пользователю")
+
+    def handle(self, *args, **options):
+        users, seconds = recommendations.build(max(options['processes'], 1), options['per_user'])
+        self.stdout.write(self.style.SUCCESS(f"Рекомендации пересчитаны для {users} пользователей за {seconds:.1f} с"))
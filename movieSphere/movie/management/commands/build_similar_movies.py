@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from movie import similarity
+
+
+class Command(BaseCommand):
+    help = "Строит таблицу похожих фильмов по общим жанрам, актерам и режиссерам (или обновляет отдельные фильмы)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--movie', type=int, action='append', dest='movie_ids',
+            help="Пересчитать только соседей, затронутых изменением этого фильма (можно повторять)",
+        )
+        parser.add_argument(
+            '--pending', action='store_true',
+            help="Пересчитать соседей фильмов, связи которых изменились (для запуска по расписанию)",
+        )
+        parser.add_argument('--block-size', type=int, default=similarity.BLOCK_SIZE)
+        parser.add_argument('--top-k', type=int, default=None)
+
+    def handle(self, *args, **options):
+        if options['pending']:
+            updated = similarity.update_pending(options['block_size'], options['top_k'])
+            self.stdout.write(self.style.SUCCESS(f"Пересчитано фильмов: {updated}"))
+            return
+        if options['movie_ids']:
+            updated = similarity.update_movies(options['movie_ids'], options['block_size'], options['top_k'])
+            self.stdout.write(self.style.SUCCESS(f"Пересчитано фильмов: {updated}"))
+            return
+        built = similarity.rebuild(options['block_size'], options['top_k'])
+        self.stdout.write(self.style.SUCCESS(f"Фильмов с похожими: {built}"))
@@ -0,0 +1,16 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from movie.models import ChunkedUpload
+
+
+class Command(BaseCommand):
+    help = "Удаляет брошенные загрузки частями и так и не забранные формой завершенные вместе с их файлами"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=float, default=24, help="Сколько часов загрузка может простаивать")
+
+    def handle(self, *args, **options):
+        removed = ChunkedUpload.clean_abandoned(timedelta(hours=options['hours']))
+        self.stdout.write(self.style.SUCCESS(f"Удалено загрузок: {removed}"))
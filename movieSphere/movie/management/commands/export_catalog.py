@@ -0,0 +1,35 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from movie import export
+
+
+class Command(BaseCommand):
+    help = "Выгружает каталог в NDJSON, сжатый gzip: полностью или фильмы, измененные с --since"
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="Файл выгрузки или - для стандартного вывода")
+        parser.add_argument('--since', help="Только фильмы, измененные с этого времени (ISO 8601)")
+        parser.add_argument('--chunk-size', type=int, default=export.CHUNK_SIZE, help="Фильмов в пачке")
+
+    def handle(self, *args, **options):
+        try:
+            since = export.parse_since(options['since']) if options['since'] else None
+        except ValueError as error:
+            raise CommandError(str(error))
+        stats = export.ExportStats()
+        chunks = export.stream(since, max(options['chunk_size'], 1), stats)
+        if options['output'] == '-':
+            for data in chunks:
+                sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+            # Стандартный вывод занят выгрузкой
+            report = self.stderr
+        else:
+            with open(options['output'], 'wb') as output:
+                for data in chunks:
+                    output.write(data)
+            report = self.stdout
+        report.write(self.style.SUCCESS(f"Выгружено: {stats}"))
+        report.write(f"Следующая инкрементальная выгрузка: --since {stats.started_at.isoformat()}")
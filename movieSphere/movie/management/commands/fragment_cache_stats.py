@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from movie.fragments import get_stats, reset_stats
+
+
+class Command(BaseCommand):
+    help = "Показывает попадания и промахи кеша фрагментов фильмов"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help="Обнулить счетчики после вывода")
+
+    def handle(self, *args, **options):
+        stats = get_stats()
+        self.stdout.write(
+            f"Попаданий: {stats['hits']}, промахов: {stats['misses']}, доля попаданий: {stats['hit_rate']:.1%}"
+        )
+        if options['reset']:
+            reset_stats()
+            self.stdout.write("Счетчики обнулены")
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from movie import importer
+
+SHOWN_ERRORS = 20
+
+
+class Command(BaseCommand):
+    help = "Загружает каталог из NDJSON (формат export_catalog) или CSV; прерванный импорт продолжается с контрольной точки"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Файл NDJSON или CSV, можно сжатый gzip (.gz)")
+        parser.add_argument('--format', choices=('csv', 'ndjson'), help="По умолчанию - по расширению файла")
+        parser.add_argument('--batch-size', type=int, default=importer.BATCH_SIZE, help="Строк в транзакции")
+        parser.add_argument('--restart', action='store_true', help="Начать сначала, не используя контрольную точку")
+
+    def handle(self, *args, **options):
+        try:
+            checkpoint = importer.Checkpoint(f"{options['path']}.checkpoint", options['path'])
+        except OSError as error:
+            raise CommandError(str(error))
+        if options['restart']:
+            checkpoint.clear()
+        try:
+            stats = importer.import_file(options['path'], options['format'], max(options['batch_size'], 1),
+                                         checkpoint, progress=lambda stats: self.stdout.write(str(stats)))
+        except ValueError as error:
+            raise CommandError(str(error))
+        self.stdout.write(self.style.SUCCESS(f"Импортировано: {stats}"))
+        for line, message in stats.errors[:SHOWN_ERRORS]:
+            self.stderr.write(f"Строка {line}: {message}")
+        if len(stats.errors) > SHOWN_ERRORS:
+            self.stderr.write(f"... и еще {len(stats.errors) - SHOWN_ERRORS}")
+        self.stdout.write("Похожие фильмы пересчитываются командой build_similar_movies")
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from movie.models import Movie, Episode, MediaSeekIndex
+
+
+class Command(BaseCommand):
+    help = ("Переносит moov в начало загруженных MP4/MOV и строит индексы ключевых кадров; "
+            "с --pending - только новые загрузки, отмеченные при сохранении (для запуска по расписанию)")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="Обработать и файлы с актуальным индексом")
+        parser.add_argument('--pending', action='store_true', help="Только файлы, ожидающие обработки")
+
+    def video_files(self, pending):
+        if pending:
+            # У всех видеополей одно хранилище; FieldFile нужен только для пути к файлу
+            field = Episode._meta.get_field('video')
+            for name in list(MediaSeekIndex.objects.filter(pending=True).values_list('file', flat=True)):
+                yield field.attr_class(None, field, name)
+            return
+        for movie in Movie.objects.only('id', 'trailer', 'movie_file').iterator():
+            yield movie.trailer
+            yield movie.movie_file
+        for episode in Episode.objects.only('id', 'video').iterator():
+            yield episode.video
+
+    def handle(self, *args, **options):
+        prepared = skipped = 0
+        for field_file in self.video_files(options['pending']):
+            if not field_file:
+                continue
+            if MediaSeekIndex.prepare(field_file, force=options['force']) is None:
+                skipped += 1
+                self.stdout.write(f"Пропущен: {field_file.name}")
+            else:
+                prepared += 1
+        self.stdout.write(self.style.SUCCESS(f"Обработано видео: {prepared}, пропущено: {skipped}"))
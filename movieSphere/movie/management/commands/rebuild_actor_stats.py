@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from movie.models import Actor
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает статистику фильмографии всех актеров и режиссеров (фильмы, роли, годы, лучшие фильмы)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        actor_ids = list(Actor.objects.values_list('pk', flat=True))
+        Actor.refresh_stats(actor_ids, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Пересчитано персон: {len(actor_ids)}"))
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from movie.models import CatalogVersion, Movie
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает сумму, количество и среднее оценок фильмов по таблице рейтингов"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help="Только показать расхождения, ничего не записывая (код выхода 1 при расхождении)",
+        )
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            aggregates = Movie.rating_aggregates_from_ratings()
+            drifted = []
+            for movie in Movie.objects.only('id', 'title', 'rating_sum', 'rating_count', 'average_rating').iterator():
+                total, count = aggregates.get(movie.id, (0, 0))
+                average = Movie.average_from(total, count)
+                if (movie.rating_sum, movie.rating_count, movie.average_rating) != (total, count, average):
+                    if options['check']:
+                        self.stdout.write(
+                            f"{movie.title} (id={movie.id}): "
+                            f"сохранено {movie.rating_sum}/{movie.rating_count}/{movie.average_rating}, "
+                            f"ожидается {total}/{count}/{average}"
+                        )
+                    movie.rating_sum, movie.rating_count, movie.average_rating = total, count, average
+                    movie.updated_at = timezone.now()
+                    drifted.append(movie)
+
+            if options['check']:
+                if drifted:
+                    raise CommandError(f"Расхождение агрегатов рейтинга у {len(drifted)} фильмов")
+                self.stdout.write(self.style.SUCCESS("Агрегаты рейтинга совпадают с таблицей рейтингов"))
+                return
+
+            Movie.objects.bulk_update(
+                drifted, ['rating_sum', 'rating_count', 'average_rating', 'updated_at'],
+                batch_size=options['batch_size'],
+            )
+            if drifted:
+                CatalogVersion.bump('movies')
+        self.stdout.write(self.style.SUCCESS(f"Пересчитано фильмов: {len(drifted)}"))
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from movie.models import RatingCount
+
+
+class Command(BaseCommand):
+    help = "Сверяет гистограммы оценок фильмов с таблицей рейтингов и пересобирает разошедшиеся счетчики"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help="Только показать расхождения, ничего не записывая (код выхода 1 при расхождении)",
+        )
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            expected = RatingCount.histograms_from_ratings()
+            stored = {(row.movie_id, row.value): row for row in RatingCount.objects.select_for_update()}
+            drifted = []
+            stale = []
+            for key in expected.keys() | stored.keys():
+                count = expected.get(key, 0)
+                row = stored.get(key)
+                saved = row.count if row else 0
+                if row is None:
+                    drifted.append(RatingCount(movie_id=key[0], value=key[1], count=count))
+                elif row.count != count:
+                    row.count = count
+                    (stale if count == 0 else drifted).append(row)
+                else:
+                    continue
+                if options['check']:
+                    self.stdout.write(f"Фильм id={key[0]}, оценка {key[1]}: "
+                                      f"сохранено {saved}, ожидается {count}")
+
+            if options['check']:
+                if drifted or stale:
+                    raise CommandError(f"Расхождение счетчиков оценок: {len(drifted) + len(stale)}")
+                self.stdout.write(self.style.SUCCESS("Счетчики оценок совпадают с таблицей рейтингов"))
+                return
+
+            RatingCount.objects.filter(pk__in=[row.pk for row in stale]).delete()
+            RatingCount.objects.bulk_update([row for row in drifted if row.pk], ['count'],
+                                            batch_size=options['batch_size'])
+            RatingCount.objects.bulk_create([row for row in drifted if not row.pk], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Исправлено счетчиков: {len(drifted) + len(stale)}"))
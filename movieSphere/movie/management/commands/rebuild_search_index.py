@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from movie.models import Movie
+from movie.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = "Полностью перестраивает поисковый индекс фильмов"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            indexed = get_search_backend().rebuild(Movie.objects.all(), max(options['batch_size'], 1))
+        self.stdout.write(self.style.SUCCESS(f"Проиндексировано фильмов: {indexed}"))
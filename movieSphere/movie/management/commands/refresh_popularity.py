@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from movie.models import PopularitySnapshot
+
+
+class Command(BaseCommand):
+    help = "Строит новую версию рейтинга популярности (для запуска по расписанию)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--if-stale', action='store_true',
+            help="Пересобирать только если с момента построения менялись оценки",
+        )
+        parser.add_argument('--status', action='store_true', help="Показать версию и возраст текущего рейтинга")
+
+    def handle(self, *args, **options):
+        latest = PopularitySnapshot.objects.order_by('-pk').first()
+
+        if options['status']:
+            if latest is None:
+                self.stdout.write("Рейтинг популярности ещё не построен")
+                return
+            self.stdout.write(
+                f"Версия {latest.pk}, фильмов: {latest.movie_count}, "
+                f"построен {latest.created_at:%Y-%m-%d %H:%M:%S} ({int(latest.age.total_seconds())} с назад)"
+            )
+            if latest.stale_since:
+                self.stdout.write(f"Оценки менялись с {latest.stale_since:%Y-%m-%d %H:%M:%S}")
+            else:
+                self.stdout.write("Рейтинг актуален")
+            return
+
+        if options['if_stale'] and latest is not None and latest.stale_since is None:
+            self.stdout.write(f"Версия {latest.pk} актуальна, пересборка не нужна")
+            return
+
+        snapshot = PopularitySnapshot.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Построена версия {snapshot.pk}, фильмов: {snapshot.movie_count}"))
@@ -0,0 +1,38 @@
+# Generated by Django 5.0.6 on 2026-10-18 10:00
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def fill_rating_aggregates(apps, schema_editor):
+    Movie = apps.get_model('movie', 'Movie')
+    Rating = apps.get_model('movie', 'Rating')
+    rows = Rating.objects.values('movie_id').annotate(total=Sum('star__value'), count=Count('id'))
+    for row in rows:
+        total = row['total'] or 0
+        Movie.objects.filter(pk=row['movie_id']).update(
+            rating_sum=total,
+            rating_count=row['count'],
+            average_rating=round(total / row['count'], 2),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0019_alter_actor_age'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='movie',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Количество оценок'),
+        ),
+        migrations.AddField(
+            model_name='movie',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, verbose_name='Сумма оценок'),
+        ),
+        migrations.RunPython(fill_rating_aggregates, migrations.RunPython.noop),
+    ]
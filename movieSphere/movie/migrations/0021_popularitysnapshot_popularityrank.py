@@ -0,0 +1,42 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0020_movie_rating_count_movie_rating_sum'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PopularitySnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Построен')),
+                ('stale_since', models.DateTimeField(blank=True, null=True, verbose_name='Устарел с')),
+                ('movie_count', models.PositiveIntegerField(default=0, verbose_name='Количество фильмов')),
+            ],
+            options={
+                'verbose_name': 'Рейтинг популярности',
+                'verbose_name_plural': 'Рейтинги популярности',
+            },
+        ),
+        migrations.CreateModel(
+            name='PopularityRank',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveIntegerField(verbose_name='Место')),
+                ('score', models.DecimalField(decimal_places=2, max_digits=4, verbose_name='Средний рейтинг')),
+                ('movie', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='popularity_ranks', to='movie.movie')),
+                ('snapshot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ranks', to='movie.popularitysnapshot')),
+            ],
+            options={
+                'verbose_name': 'Место в рейтинге',
+                'verbose_name_plural': 'Места в рейтинге',
+                'unique_together': {('snapshot', 'rank')},
+            },
+        ),
+    ]
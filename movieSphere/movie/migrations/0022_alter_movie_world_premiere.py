@@ -0,0 +1,19 @@
+# Generated by Django 5.0.6 on 2026-10-18 12:00
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0021_popularitysnapshot_popularityrank'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='movie',
+            name='world_premiere',
+            field=models.DateField(db_index=True, default=datetime.date.today, verbose_name='Премьера в мире'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0022_alter_movie_world_premiere'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaSeekIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.CharField(max_length=255, unique=True, verbose_name='Файл')),
+                ('file_size', models.PositiveBigIntegerField(default=0, verbose_name='Размер файла')),
+                ('file_mtime_ns', models.PositiveBigIntegerField(default=0, verbose_name='Время изменения файла')),
+                ('duration', models.FloatField(default=0, verbose_name='Длительность (секунды)')),
+                ('keyframes', models.BinaryField(default=b'', verbose_name='Ключевые кадры')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлен')),
+            ],
+            options={
+                'verbose_name': 'Индекс перемотки',
+                'verbose_name_plural': 'Индексы перемотки',
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.0.6 on 2026-10-18 14:00
+
+import uuid
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0023_mediaseekindex'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChunkedUpload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('target', models.CharField(choices=[('movie.trailer', 'movie.trailer'), ('movie.movie_file', 'movie.movie_file'), ('episode.video', 'episode.video')], max_length=50, verbose_name='Поле')),
+                ('filename', models.CharField(max_length=255, verbose_name='Имя файла')),
+                ('size', models.PositiveBigIntegerField(verbose_name='Размер')),
+                ('chunk_size', models.PositiveIntegerField(verbose_name='Размер части')),
+                ('offset', models.PositiveBigIntegerField(default=0, verbose_name='Получено байт')),
+                ('file', models.CharField(blank=True, max_length=255, verbose_name='Сохраненный файл')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Начата')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлена')),
+                ('completed_at', models.DateTimeField(blank=True, null=True, verbose_name='Завершена')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Загрузка частями',
+                'verbose_name_plural': 'Загрузки частями',
+            },
+        ),
+    ]
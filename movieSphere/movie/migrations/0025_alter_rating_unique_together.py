@@ -0,0 +1,39 @@
+# Generated by Django 5.0.6 on 2026-10-18 15:00
+
+from django.db import migrations
+from django.db.models import Count, Max, Sum
+
+
+def remove_duplicate_ratings(apps, schema_editor):
+    """Оставляет последний голос каждого посетителя за фильм и пересчитывает агрегаты затронутых фильмов"""
+    Movie = apps.get_model('movie', 'Movie')
+    Rating = apps.get_model('movie', 'Rating')
+    duplicates = Rating.objects.values('movie_id', 'ip').annotate(count=Count('id'), last=Max('id')).filter(count__gt=1)
+    movie_ids = set()
+    for row in duplicates:
+        Rating.objects.filter(movie_id=row['movie_id'], ip=row['ip']).exclude(pk=row['last']).delete()
+        movie_ids.add(row['movie_id'])
+    rows = Rating.objects.filter(movie_id__in=movie_ids).values('movie_id').annotate(
+        total=Sum('star__value'), count=Count('id'))
+    for row in rows:
+        total = row['total'] or 0
+        Movie.objects.filter(pk=row['movie_id']).update(
+            rating_sum=total,
+            rating_count=row['count'],
+            average_rating=round(total / row['count'], 2),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0024_chunkedupload'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_ratings, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='rating',
+            unique_together={('movie', 'ip')},
+        ),
+    ]
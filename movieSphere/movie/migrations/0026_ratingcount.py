@@ -0,0 +1,40 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_rating_counts(apps, schema_editor):
+    Rating = apps.get_model('movie', 'Rating')
+    RatingCount = apps.get_model('movie', 'RatingCount')
+    rows = Rating.objects.values('movie_id', 'star__value').annotate(count=Count('id'))
+    RatingCount.objects.bulk_create(
+        (RatingCount(movie_id=row['movie_id'], value=row['star__value'], count=row['count']) for row in rows),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0025_alter_rating_unique_together'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RatingCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.SmallIntegerField(verbose_name='Значение')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='Количество голосов')),
+                ('movie', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rating_counts', to='movie.movie', verbose_name='фильм')),
+            ],
+            options={
+                'verbose_name': 'Счетчик оценок',
+                'verbose_name_plural': 'Счетчики оценок',
+                'unique_together': {('movie', 'value')},
+            },
+        ),
+        migrations.RunPython(fill_rating_counts, migrations.RunPython.noop),
+    ]
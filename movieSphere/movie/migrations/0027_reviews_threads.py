@@ -0,0 +1,59 @@
+# Generated by Django 5.0.6 on 2026-10-18 17:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def fill_review_paths(apps, schema_editor):
+    Reviews = apps.get_model('movie', 'Reviews')
+    reviews = {review.pk: review for review in Reviews.objects.only('pk', 'parent').order_by('pk')}
+    placed = set()
+    for review in reviews.values():
+        # Поднимаемся до ближайшего размещенного предка и размещаем цепочку сверху вниз
+        chain = {}
+        current = review
+        while current is not None and current.pk not in placed and current.pk not in chain:
+            chain[current.pk] = current
+            current = reviews.get(current.parent_id)
+        for item in reversed(chain.values()):
+            # Родитель из этой же цепочки, который еще не размещен, означает цикл - разрываем его
+            parent = reviews.get(item.parent_id) if item.parent_id in placed else None
+            item.path = (parent.path if parent else '') + f"{item.pk:010d}/"
+            item.depth = parent.depth + 1 if parent else 0
+            item.root_id = parent.root_id if parent else item.pk
+            placed.add(item.pk)
+    Reviews.objects.bulk_update(reviews.values(), ['path', 'depth', 'root'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0026_ratingcount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reviews',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Вложенность'),
+        ),
+        migrations.AddField(
+            model_name='reviews',
+            name='path',
+            field=models.CharField(blank=True, editable=False, max_length=341, verbose_name='Путь в ветке'),
+        ),
+        migrations.AddField(
+            model_name='reviews',
+            name='root',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='thread_reviews', to='movie.reviews', verbose_name='Начало ветки'),
+        ),
+        migrations.RunPython(fill_review_paths, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='reviews',
+            index=models.Index(fields=['movie', 'depth', 'id'], name='movie_reviews_roots_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reviews',
+            index=models.Index(fields=['root', 'path'], name='movie_reviews_thread_idx'),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 5.0.6 on 2026-10-18 18:00
+
+from django.db import migrations, models
+
+
+def fill_actor_stats(apps, schema_editor):
+    Actor = apps.get_model('movie', 'Actor')
+    Movie = apps.get_model('movie', 'Movie')
+    films = {}
+    roles = {}
+    for role, through in enumerate((Movie.actors.through, Movie.directors.through)):
+        rows = through.objects.values_list(
+            'actor_id', 'movie_id', 'movie__year', 'movie__average_rating', 'movie__rating_count')
+        for actor_id, movie_id, year, average, count in rows.iterator():
+            films.setdefault(actor_id, {})[movie_id] = (year, average, count)
+            roles.setdefault(actor_id, ([], []))[role].append(movie_id)
+
+    actors = list(Actor.objects.all())
+    for actor in actors:
+        movies = films.get(actor.pk, {})
+        years = [year for year, _, _ in movies.values()]
+        actor.movies_count = len(movies)
+        actor.acting_count = len(roles.get(actor.pk, ([], []))[0])
+        actor.directing_count = len(roles.get(actor.pk, ([], []))[1])
+        actor.first_year = min(years, default=None)
+        actor.last_year = max(years, default=None)
+        actor.top_movie_ids = sorted(
+            movies, key=lambda movie_id: (-movies[movie_id][1], -movies[movie_id][2], movie_id))[:3]
+    Actor.objects.bulk_update(
+        actors, ['movies_count', 'acting_count', 'directing_count', 'first_year', 'last_year', 'top_movie_ids'],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0027_reviews_threads'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='actor',
+            name='acting_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Фильмов в роли актера'),
+        ),
+        migrations.AddField(
+            model_name='actor',
+            name='directing_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Фильмов в роли режиссера'),
+        ),
+        migrations.AddField(
+            model_name='actor',
+            name='first_year',
+            field=models.PositiveSmallIntegerField(blank=True, editable=False, null=True, verbose_name='Первый фильм'),
+        ),
+        migrations.AddField(
+            model_name='actor',
+            name='last_year',
+            field=models.PositiveSmallIntegerField(blank=True, editable=False, null=True, verbose_name='Последний фильм'),
+        ),
+        migrations.AddField(
+            model_name='actor',
+            name='top_movie_ids',
+            field=models.JSONField(blank=True, default=list, editable=False, verbose_name='Лучшие фильмы'),
+        ),
+        migrations.AlterField(
+            model_name='actor',
+            name='movies_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Movies Count'),
+        ),
+        migrations.RunPython(fill_actor_stats, migrations.RunPython.noop),
+    ]
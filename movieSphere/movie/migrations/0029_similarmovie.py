@@ -0,0 +1,29 @@
+# Generated by Django 5.0.6 on 2026-10-18 19:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0028_actor_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimilarMovie',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField(verbose_name='Место')),
+                ('score', models.FloatField(verbose_name='Близость')),
+                ('movie', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similar_links', to='movie.movie', verbose_name='фильм')),
+                ('similar', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='movie.movie', verbose_name='Похожий фильм')),
+            ],
+            options={
+                'verbose_name': 'Похожий фильм',
+                'verbose_name_plural': 'Похожие фильмы',
+                'unique_together': {('movie', 'rank')},
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.0.6 on 2026-10-18 21:00
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0030_recommendation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogVersion',
+            fields=[
+                ('name', models.CharField(max_length=20, primary_key=True, serialize=False, verbose_name='Раздел')),
+                ('version', models.PositiveBigIntegerField(default=0, verbose_name='Версия')),
+                ('changed_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Изменен')),
+            ],
+            options={
+                'verbose_name': 'Версия раздела каталога',
+                'verbose_name_plural': 'Версии разделов каталога',
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.0.6 on 2026-10-18 22:00
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0031_catalogversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='movie',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now, verbose_name='Обновлен'),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 23:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0032_movie_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediaseekindex',
+            name='pending',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='Ожидает обработки'),
+        ),
+    ]
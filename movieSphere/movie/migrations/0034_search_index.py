@@ -0,0 +1,52 @@
+# Generated by Django 5.0.6 on 2026-10-18 23:30
+
+from django.db import migrations
+
+# Структура таблицы movie_search на момент миграции; код movie.search не импортируется, чтобы миграция
+# не менялась вместе с ним
+SQLITE_CREATE = (
+    "CREATE VIRTUAL TABLE movie_search USING fts5(title, description, tokenize='unicode61 remove_diacritics 2')",
+)
+POSTGRESQL_CREATE = (
+    "CREATE TABLE movie_search ("
+    "movie_id bigint PRIMARY KEY REFERENCES movie_movie (id) ON DELETE CASCADE, "
+    "document tsvector NOT NULL, "
+    "title_length integer NOT NULL DEFAULT 0, "
+    "description_length integer NOT NULL DEFAULT 0)",
+    "CREATE INDEX movie_search_document_idx ON movie_search USING GIN (document)",
+    "INSERT INTO movie_search (movie_id, document, title_length, description_length) "
+    "SELECT id, setweight(to_tsvector('russian', title), 'A') "
+    "|| setweight(to_tsvector('russian', coalesce(description, '')), 'B'), "
+    "(SELECT count(*) FROM regexp_matches(title, '\\w+', 'g')), "
+    "(SELECT count(*) FROM regexp_matches(coalesce(description, ''), '\\w+', 'g')) "
+    "FROM movie_movie",
+)
+
+
+def create_search_index(apps, schema_editor):
+    # На SQLite основы слов считаются в Python; пустой индекс заполняет post_migrate (movie.signals)
+    statements = {'sqlite': SQLITE_CREATE, 'postgresql': POSTGRESQL_CREATE}.get(schema_editor.connection.vendor)
+    if statements is None:
+        return
+    # Таблица могла остаться от post_migrate в прежних версиях и иметь старую структуру
+    drop_search_index(apps, schema_editor)
+    with schema_editor.connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS movie_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0033_mediaseekindex_pending'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
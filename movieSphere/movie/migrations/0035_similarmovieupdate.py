@@ -0,0 +1,25 @@
+# Generated by Django 5.0.6 on 2026-10-18 23:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0034_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimilarMovieUpdate',
+            fields=[
+                ('movie', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='movie.movie', verbose_name='фильм')),
+                ('marked_at', models.DateTimeField(auto_now=True, verbose_name='Отмечен')),
+            ],
+            options={
+                'verbose_name': 'Пересчет похожих фильмов',
+                'verbose_name_plural': 'Пересчеты похожих фильмов',
+            },
+        ),
+    ]
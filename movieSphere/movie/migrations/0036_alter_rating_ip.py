@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 23:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0035_similarmovieupdate'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='rating',
+            name='ip',
+            field=models.CharField(max_length=45, verbose_name='IP адрес'),
+        ),
+    ]
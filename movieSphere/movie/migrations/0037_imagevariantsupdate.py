@@ -0,0 +1,26 @@
+# Generated by Django 5.0.6 on 2026-10-18 23:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movie', '0036_alter_rating_ip'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageVariantsUpdate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.CharField(max_length=255, unique=True, verbose_name='Файл')),
+                ('kind', models.CharField(max_length=20, verbose_name='Вид')),
+                ('marked_at', models.DateTimeField(auto_now=True, verbose_name='Отмечен')),
+            ],
+            options={
+                'verbose_name': 'Построение вариантов изображения',
+                'verbose_name_plural': 'Построение вариантов изображений',
+            },
+        ),
+    ]
@@ -1,11 +1,46 @@
+import hashlib
+import os
+import shutil
+import struct
+import uuid
+from bisect import bisect_right
 from datetime import date
 from decimal import Decimal
+from itertools import islice
 
+from django.apps import apps
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db import models
-from django.db.models import Avg
+from django.db import connection, models, transaction
+from django.db.models import Count, F, Sum, Case, When, Value, FloatField
+from django.db.models.functions import Cast, Greatest
 from django.urls import reverse
+from django.utils import timezone
+
+from . import mp4
+
+
+def update_rows(objects, fields):
+    """
+    Записывает поля объектов одним подготовленным UPDATE ... WHERE pk = %s на все строки (executemany).
+    В отличие от bulk_update не строит выражение CASE WHEN на каждую строку, что на тысячах строк в
+    десятки раз быстрее. Как и bulk_update, не вызывает save() и сигналы.
+    """
+    objects = list(objects)
+    if not objects:
+        return
+    meta = objects[0]._meta
+    quote = connection.ops.quote_name
+    fields = [meta.get_field(name) for name in fields]
+    assignments = ', '.join(f"{quote(field.column)} = %s" for field in fields)
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"UPDATE {quote(meta.db_table)} SET {assignments} WHERE {quote(meta.pk.column)} = %s",
+            [[*(field.get_db_prep_save(getattr(obj, field.attname), connection) for field in fields), obj.pk]
+             for obj in objects],
+        )
 
 
 class Category(models.Model):
@@ -33,7 +68,16 @@ class Actor(models.Model):
     descriptions = models.TextField("Описание", blank=True, null=True)
     birth_place = models.CharField("Birth Place", max_length=255, blank=True, null=True)
     genres = models.ManyToManyField('Genre', verbose_name="Genres", related_name="actors")
-    movies_count = models.PositiveIntegerField("Movies Count", default=0)
+    # Статистика фильмографии пересчитывается refresh_stats при изменении ролей, фильмов и оценок
+    movies_count = models.PositiveIntegerField("Movies Count", default=0, editable=False)
+    acting_count = models.PositiveIntegerField("Фильмов в роли актера", default=0, editable=False)
+    directing_count = models.PositiveIntegerField("Фильмов в роли режиссера", default=0, editable=False)
+    first_year = models.PositiveSmallIntegerField("Первый фильм", null=True, blank=True, editable=False)
+    last_year = models.PositiveSmallIntegerField("Последний фильм", null=True, blank=True, editable=False)
+    top_movie_ids = models.JSONField("Лучшие фильмы", default=list, blank=True, editable=False)
+
+    TOP_MOVIES = 3
+    STATS_FIELDS = ['movies_count', 'acting_count', 'directing_count', 'first_year', 'last_year', 'top_movie_ids']
 
     def __str__(self):
         return self.name
@@ -42,8 +86,60 @@ class Actor(models.Model):
         return reverse("actor_detail", kwargs={"pk": self.pk})
 
     def get_popular_movies(self):
-        return self.film_actor.annotate(average_rating_value=Avg('rating__star__value')).order_by(
-            '-average_rating_value')[:3]
+        """Лучшие по рейтингу фильмы персоны из сохраненной статистики, в порядке рейтинга"""
+        movies = Movie.objects.filter(pk__in=self.top_movie_ids).prefetch_related('genre').in_bulk()
+        return [movies[movie_id] for movie_id in self.top_movie_ids if movie_id in movies]
+
+    @classmethod
+    def refresh_stats(cls, actor_ids, batch_size=1000):
+        """Пересчитывает статистику фильмографии персон по ролям в фильмах; четыре запроса на пачку"""
+        actor_ids = sorted(set(actor_ids))
+        for start in range(0, len(actor_ids), batch_size):
+            cls._refresh_stats_batch(actor_ids[start:start + batch_size])
+
+    @classmethod
+    def _refresh_stats_batch(cls, actor_ids):
+        films = {actor_id: {} for actor_id in actor_ids}
+        roles = {actor_id: ([], []) for actor_id in actor_ids}
+        for role, through in enumerate((Movie.actors.through, Movie.directors.through)):
+            rows = through.objects.filter(actor_id__in=actor_ids).values_list(
+                'actor_id', 'movie_id', 'movie__year', 'movie__average_rating', 'movie__rating_count')
+            for actor_id, movie_id, year, average, count in rows:
+                films[actor_id][movie_id] = (year, average, count)
+                roles[actor_id][role].append(movie_id)
+
+        changed = []
+        for actor in cls.objects.filter(pk__in=actor_ids).only('pk', *cls.STATS_FIELDS):
+            movies = films[actor.pk]
+            years = [year for year, _, _ in movies.values()]
+            stats = {
+                'movies_count': len(movies),
+                'acting_count': len(roles[actor.pk][0]),
+                'directing_count': len(roles[actor.pk][1]),
+                'first_year': min(years, default=None),
+                'last_year': max(years, default=None),
+                'top_movie_ids': sorted(movies, key=lambda movie_id: (
+                    -movies[movie_id][1], -movies[movie_id][2], movie_id))[:cls.TOP_MOVIES],
+            }
+            # Записываются только персоны с изменившейся статистикой
+            if any(getattr(actor, name) != value for name, value in stats.items()):
+                for name, value in stats.items():
+                    setattr(actor, name, value)
+                changed.append(actor)
+        update_rows(changed, cls.STATS_FIELDS)
+        if changed:
+            CatalogVersion.bump('actors')
+
+    @classmethod
+    def refresh_stats_for_movies(cls, movie_ids):
+        """Пересчитывает статистику всех актеров и режиссеров указанных фильмов"""
+        movie_ids = [movie_id for movie_id in set(movie_ids) if movie_id is not None]
+        if not movie_ids:
+            return
+        actor_ids = set(Movie.actors.through.objects.filter(movie_id__in=movie_ids).values_list('actor_id', flat=True))
+        actor_ids.update(Movie.directors.through.objects.filter(movie_id__in=movie_ids).values_list(
+            'actor_id', flat=True))
+        cls.refresh_stats(actor_ids)
 
     class Meta:
         verbose_name = "Актеры и режиссеры"
@@ -77,10 +173,12 @@ class Movie(models.Model):
     directors = models.ManyToManyField('Actor', verbose_name="Режиссеры", related_name="film_director")
     actors = models.ManyToManyField('Actor', verbose_name="Актеры", related_name="film_actor")
     genre = models.ManyToManyField('Genre', verbose_name="Жанры")
-    world_premiere = models.DateField("Премьера в мире", default=date.today)
+    world_premiere = models.DateField("Премьера в мире", default=date.today, db_index=True)
     duration_hours = models.PositiveIntegerField(default=0)
     duration_minutes = models.PositiveIntegerField(default=0)
     average_rating = models.DecimalField("Средний рейтинг", max_digits=4, decimal_places=2, default=0.00)
+    rating_sum = models.PositiveIntegerField("Сумма оценок", default=0)
+    rating_count = models.PositiveIntegerField("Количество оценок", default=0)
     budget = models.PositiveIntegerField("Бюджет", default=0, help_text="указывать сумму в долларах")
     box_office_usa = models.PositiveIntegerField("Сборы в США", default=0, help_text="указывать сумму в долларах")
     box_office_world = models.PositiveIntegerField("Сборы в мире", default=0, help_text="указывать сумму в долларах")
@@ -92,6 +190,8 @@ class Movie(models.Model):
     external_link = models.URLField("Ссылка на внешний источник", blank=True, null=True)
     is_series = models.BooleanField("Сериал", default=False)
     is_editors_choice = models.BooleanField("Выбор редакции", default=False)  # Новое поле
+    # Меняется и при изменении связей, сезонов и оценок (см. touch) - по нему идет инкрементальная выгрузка
+    updated_at = models.DateTimeField("Обновлен", auto_now=True, db_index=True)
 
     def __str__(self):
         return self.title
@@ -99,40 +199,103 @@ class Movie(models.Model):
     def get_absolute_url(self):
         return reverse("movie_detail", kwargs={"slug": self.url})
 
+    @staticmethod
+    def average_from(rating_sum, rating_count):
+        if not rating_count:
+            return Decimal('0.00')
+        return round(Decimal(rating_sum) / Decimal(rating_count), 2)
+
+    @classmethod
+    def apply_rating_delta(cls, movie_id, sum_delta, count_delta):
+        """Атомарно сдвигает сумму и количество оценок фильма и пересчитывает среднее"""
+        new_sum = F('rating_sum') + sum_delta
+        new_count = F('rating_count') + count_delta
+        cls.objects.filter(pk=movie_id).update(
+            updated_at=timezone.now(),
+            rating_sum=new_sum,
+            rating_count=new_count,
+            average_rating=Case(
+                When(rating_count__lte=-count_delta, then=Value(Decimal('0.00'))),
+                default=Cast(new_sum, FloatField()) / new_count,
+                output_field=models.DecimalField(max_digits=4, decimal_places=2),
+            ),
+        )
+
+    @classmethod
+    def touch(cls, movie_ids):
+        """Отмечает фильмы измененными, когда меняются их связи, сезоны или связанные объекты"""
+        movie_ids = [movie_id for movie_id in set(movie_ids) if movie_id is not None]
+        if movie_ids:
+            cls.objects.filter(pk__in=movie_ids).update(updated_at=timezone.now())
+
+    @classmethod
+    def rating_aggregates_from_ratings(cls):
+        """Сумма и количество оценок по каждому фильму, посчитанные по таблице рейтингов"""
+        rows = Rating.objects.values('movie_id').annotate(total=Sum('star__value'), count=Count('id'))
+        return {row['movie_id']: (row['total'] or 0, row['count']) for row in rows}
+
     def calculate_average_rating(self):
-        avg_rating = self.rating_set.aggregate(Avg('star__value'))['star__value__avg']
-        if avg_rating is not None:
-            self.average_rating = round(avg_rating, 2)
-        else:
-            self.average_rating = Decimal('0.00')
-        self.save(update_fields=['average_rating'])
+        aggregates = self.rating_set.aggregate(total=Sum('star__value'), count=Count('id'))
+        self.rating_sum = aggregates['total'] or 0
+        self.rating_count = aggregates['count']
+        self.average_rating = self.average_from(self.rating_sum, self.rating_count)
+        self.save(update_fields=['rating_sum', 'rating_count', 'average_rating', 'updated_at'])
         return self.average_rating
 
     @classmethod
-    def get_popular_movies(cls, limit=None):
-        query = cls.objects.annotate(average_rating_value=Avg('rating__star__value')).filter(
-            average_rating_value__isnull=False).order_by('-average_rating_value')
+    def get_popular_movies(cls, limit=None, offset=0, snapshot=None):
+        """Фильмы в порядке снимка рейтинга популярности, выбранные диапазоном мест; без снимка - по агрегатам оценок"""
+        snapshot = snapshot or PopularitySnapshot.current()
+        if snapshot is None:
+            movies = PopularitySnapshot.ranked_movies()
+            return movies[offset:offset + limit] if limit else movies[offset:]
+        ranks = {'popularity_ranks__snapshot': snapshot}
+        if offset:
+            ranks['popularity_ranks__rank__gt'] = offset
         if limit:
-            query = query[:limit]
-        return query
+            ranks['popularity_ranks__rank__lte'] = offset + limit
+        return cls.objects.filter(**ranks).order_by('popularity_ranks__rank')
 
     @classmethod
     def get_editors_choice(cls):
         return cls.objects.filter(is_editors_choice=True)
 
-    def get_reviews(self):
-        return self.reviews_set.filter(parent__isnull=True)
+    @classmethod
+    def get_detail_queryset(cls):
+        """Фильм со всеми связями страницы фильма: люди, жанры, сезоны с эпизодами"""
+        return cls.objects.select_related('category').prefetch_related(
+            'genre', 'directors', 'actors',
+            models.Prefetch('seasons', queryset=Season.objects.order_by('season_number').prefetch_related(
+                models.Prefetch('episodes', queryset=Episode.objects.order_by('episode_number'))
+            )),
+        )
+
+    def get_review_threads(self, after=None, limit=None):
+        """Страница веток отзывов одним запросом, см. Reviews.get_threads"""
+        return Reviews.get_threads(self.pk, after, limit or getattr(settings, 'REVIEW_THREADS_PER_PAGE', 20))
+
+    def get_similar_movies(self, limit=None):
+        """Похожие фильмы по убыванию близости одним запросом по индексу (movie, rank), см. movie.similarity"""
+        links = self.similar_links.select_related('similar').order_by('rank')
+        if limit:
+            links = links[:limit]
+        similar = []
+        for link in links:
+            link.similar.similarity = link.score
+            similar.append(link.similar)
+        return similar
 
     def get_total_episodes(self):
-        return Episode.objects.filter(season__movie=self).count()
+        return sum(len(season.episodes.all()) for season in self.seasons.all())
 
     def get_episode_duration(self):
-        first_episode = Episode.objects.filter(season__movie=self).first()
+        episodes = [episode for season in self.seasons.all() for episode in season.episodes.all()]
+        first_episode = min(episodes, key=lambda episode: episode.pk, default=None)
         return first_episode.duration_minutes if first_episode else 0
 
     def get_series_info(self):
         return {
-            'seasons_count': self.seasons.count(),
+            'seasons_count': len(self.seasons.all()),
             'total_episodes': self.get_total_episodes(),
             'episode_duration': self.get_episode_duration()
         }
@@ -177,7 +340,272 @@ class Episode(models.Model):
         unique_together = ('season', 'episode_number')
 
 
+class MediaSeekIndex(models.Model):
+    """Ключевые кадры видеофайла: время -> смещение в байтах, чтобы переходить по времени без чтения файла"""
+    ENTRY = struct.Struct('<IQ')
+
+    file = models.CharField("Файл", max_length=255, unique=True)
+    file_size = models.PositiveBigIntegerField("Размер файла", default=0)
+    file_mtime_ns = models.PositiveBigIntegerField("Время изменения файла", default=0)
+    duration = models.FloatField("Длительность (секунды)", default=0)
+    keyframes = models.BinaryField("Ключевые кадры", default=b'')
+    pending = models.BooleanField("Ожидает обработки", default=False, db_index=True)
+    updated_at = models.DateTimeField("Обновлен", auto_now=True)
+
+    def __str__(self):
+        return self.file
+
+    def keyframe_list(self):
+        """Список (время в мс, смещение в байтах) по возрастанию времени"""
+        return list(self.ENTRY.iter_unpack(bytes(self.keyframes)))
+
+    def offset_for(self, seconds):
+        """Смещение последнего ключевого кадра не позже указанного времени"""
+        entries = self.keyframe_list()
+        position = bisect_right([milliseconds for milliseconds, _ in entries], int(seconds * 1000))
+        return entries[position - 1][1] if position else 0
+
+    def is_current(self, stat_result):
+        return self.file_size == stat_result.st_size and self.file_mtime_ns == stat_result.st_mtime_ns
+
+    @classmethod
+    def mark_pending(cls, names):
+        """
+        Отмечает новые загрузки для ``manage.py prepare_media --pending``. Перезапись многогигабайтного файла
+        не выполняется в запросе, загрузившем его: это делает команда, запущенная по расписанию или воркером.
+        """
+        names = [name for name in names if mp4.is_video(name)]
+        cls.objects.bulk_create([cls(file=name, pending=True) for name in names],
+                                update_conflicts=True, unique_fields=['file'], update_fields=['pending'])
+
+    @classmethod
+    def prepare(cls, field_file, force=False):
+        """
+        Переносит moov в начало MP4/MOV и сохраняет индекс ключевых кадров.
+        Возвращает индекс или None, если файл не видео, не лежит на локальном диске или не разобран;
+        отметка ``pending`` снимается в любом случае.
+        """
+        seek_index = cls._process(field_file, force)
+        if seek_index is None:
+            cls.objects.filter(file=field_file.name, pending=True).update(pending=False)
+        return seek_index
+
+    @classmethod
+    def _process(cls, field_file, force):
+        try:
+            path = field_file.path
+        except (NotImplementedError, ValueError):
+            return None
+        if not mp4.is_video(path) or not os.path.isfile(path):
+            return None
+        existing = cls.objects.filter(file=field_file.name).first()
+        if existing is not None and not force and not existing.pending and existing.is_current(os.stat(path)):
+            return existing
+
+        try:
+            mp4.faststart(path)
+            index = mp4.keyframe_index(path)
+        except mp4.MP4Error:
+            return None
+        if index is None:
+            return None
+        duration, keyframes = index
+        stat_result = os.stat(path)
+        seek_index, _ = cls.objects.update_or_create(file=field_file.name, defaults={
+            'file_size': stat_result.st_size,
+            'file_mtime_ns': stat_result.st_mtime_ns,
+            'duration': duration,
+            'keyframes': b''.join(cls.ENTRY.pack(milliseconds, offset) for milliseconds, offset in keyframes),
+            'pending': False,
+        })
+        return seek_index
+
+    class Meta:
+        verbose_name = "Индекс перемотки"
+        verbose_name_plural = "Индексы перемотки"
+
+
+class ChunkedUploadError(Exception):
+    """Ошибка протокола загрузки частями; status - HTTP-код ответа"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class ChunkedUpload(models.Model):
+    """
+    Загрузка большого видео частями. Части пишутся прямо в файл на диске по смещению, каждая
+    проверяется по SHA-256; после обрыва клиент узнает смещение и продолжает с него. Контрольная
+    сумма всего файла - SHA-256 от склеенных SHA-256 частей, ее можно посчитать, не держа файл в памяти.
+    """
+    TARGETS = {
+        'movie.trailer': ('movie', 'Movie', 'trailer'),
+        'movie.movie_file': ('movie', 'Movie', 'movie_file'),
+        'episode.video': ('movie', 'Episode', 'video'),
+    }
+    READ_SIZE = 64 * 1024
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, verbose_name="Пользователь", on_delete=models.CASCADE)
+    target = models.CharField("Поле", max_length=50, choices=[(target, target) for target in TARGETS])
+    filename = models.CharField("Имя файла", max_length=255)
+    size = models.PositiveBigIntegerField("Размер")
+    chunk_size = models.PositiveIntegerField("Размер части")
+    offset = models.PositiveBigIntegerField("Получено байт", default=0)
+    file = models.CharField("Сохраненный файл", max_length=255, blank=True)
+    created_at = models.DateTimeField("Начата", auto_now_add=True)
+    updated_at = models.DateTimeField("Обновлена", auto_now=True)
+    completed_at = models.DateTimeField("Завершена", null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.offset}/{self.size})"
+
+    @property
+    def partial_path(self):
+        return os.path.join(settings.CHUNKED_UPLOAD_TEMP_DIR, f'{self.pk}.part')
+
+    def target_field(self):
+        app_label, model_name, field_name = self.TARGETS[self.target]
+        return apps.get_model(app_label, model_name)._meta.get_field(field_name)
+
+    def status(self):
+        return {
+            'id': str(self.pk), 'offset': self.offset, 'size': self.size, 'chunk_size': self.chunk_size,
+            'complete': self.completed_at is not None, 'file': self.file,
+        }
+
+    @classmethod
+    def start(cls, user, target, filename, size):
+        if target not in cls.TARGETS:
+            raise ChunkedUploadError("Неизвестное поле для загрузки")
+        if not filename or size < 0:
+            raise ChunkedUploadError("Нужны имя и размер файла")
+        upload = cls.objects.create(user=user, target=target, filename=os.path.basename(filename), size=size,
+                                    chunk_size=settings.CHUNKED_UPLOAD_CHUNK_SIZE)
+        os.makedirs(settings.CHUNKED_UPLOAD_TEMP_DIR, exist_ok=True)
+        open(upload.partial_path, 'wb').close()
+        return upload
+
+    def write_chunk(self, offset, stream, length, checksum):
+        """Пишет часть из потока запроса на диск кусками по READ_SIZE и сдвигает смещение загрузки"""
+        if self.completed_at is not None:
+            raise ChunkedUploadError("Загрузка уже завершена", status=409)
+        if offset != self.offset:
+            raise ChunkedUploadError(f"Ожидалась часть со смещения {self.offset}", status=409)
+        if length <= 0 or length > self.chunk_size or offset + length > self.size:
+            raise ChunkedUploadError("Неверный размер части")
+
+        digest = hashlib.sha256()
+        with open(self.partial_path, 'r+b') as file:
+            file.seek(offset)
+            remaining = length
+            while remaining:
+                data = stream.read(min(self.READ_SIZE, remaining))
+                if not data:
+                    break
+                digest.update(data)
+                file.write(data)
+                remaining -= len(data)
+            if remaining or digest.hexdigest() != checksum.lower():
+                file.truncate(offset)
+                raise ChunkedUploadError("Часть повреждена: не совпадает размер или SHA-256")
+            file.truncate(offset + length)
+
+        # Параллельный повтор той же части не должен сдвинуть смещение дважды
+        if not ChunkedUpload.objects.filter(pk=self.pk, offset=offset).update(
+                offset=offset + length, updated_at=timezone.now()):
+            raise ChunkedUploadError("Часть уже получена", status=409)
+        self.offset = offset + length
+
+    def file_checksum(self):
+        """SHA-256 от склеенных SHA-256 частей уже полученного файла"""
+        digest = hashlib.sha256()
+        with open(self.partial_path, 'rb') as file:
+            for _ in range(0, self.size, self.chunk_size):
+                chunk_digest = hashlib.sha256()
+                remaining = self.chunk_size
+                while remaining and (data := file.read(min(self.READ_SIZE, remaining))):
+                    chunk_digest.update(data)
+                    remaining -= len(data)
+                digest.update(chunk_digest.digest())
+        return digest.hexdigest()
+
+    def complete(self, checksum):
+        """Проверяет файл целиком и переносит его в хранилище поля; возвращает имя файла в хранилище"""
+        if self.completed_at is not None:
+            return self.file
+        if self.offset != self.size:
+            raise ChunkedUploadError(f"Получено {self.offset} из {self.size} байт", status=409)
+        if self.file_checksum() != checksum.lower():
+            raise ChunkedUploadError("Контрольная сумма файла не совпадает")
+
+        field = self.target_field()
+        name = field.storage.get_available_name(field.generate_filename(None, self.filename),
+                                                max_length=field.max_length)
+        target_path = field.storage.path(name)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        shutil.move(self.partial_path, target_path)
+        os.chmod(target_path, 0o644)
+        self.file = name
+        self.completed_at = timezone.now()
+        self.save(update_fields=['file', 'completed_at', 'updated_at'])
+        return name
+
+    @classmethod
+    def completed(cls, pk, user, target):
+        """Завершенная и еще не забранная загрузка пользователя для поля target"""
+        try:
+            upload = cls.objects.filter(pk=pk, user=user, target=target, completed_at__isnull=False).first()
+        except ValidationError:
+            upload = None
+        if upload is None:
+            raise ChunkedUploadError("Загрузка файла не найдена или не завершена", status=404)
+        return upload
+
+    @classmethod
+    def claim(cls, pk, user, target):
+        """Забирает завершенную загрузку пользователя для поля target и возвращает имя файла; повторно не выдается"""
+        with transaction.atomic():
+            upload = cls.completed(pk, user, target)
+            if not cls.objects.filter(pk=upload.pk).delete()[0]:
+                raise ChunkedUploadError("Загрузка файла уже забрана", status=409)
+        return upload.file
+
+    def file_in_use(self):
+        app_label, model_name, field_name = self.TARGETS[self.target]
+        return apps.get_model(app_label, model_name).objects.filter(**{field_name: self.file}).exists()
+
+    @classmethod
+    def clean_abandoned(cls, older_than):
+        """
+        Удаляет незавершенные загрузки без новых частей дольше older_than (timedelta) и завершенные, которые
+        за это время так и не забрала форма; файл в хранилище остается, если на него уже ссылается запись
+        """
+        cutoff = timezone.now() - older_than
+        abandoned = cls.objects.filter(models.Q(completed_at__isnull=True, updated_at__lt=cutoff) |
+                                       models.Q(completed_at__lt=cutoff))
+        removed = 0
+        for upload in abandoned.iterator():
+            if upload.completed_at is None:
+                try:
+                    os.remove(upload.partial_path)
+                except FileNotFoundError:
+                    pass
+            elif upload.file and not upload.file_in_use():
+                upload.target_field().storage.delete(upload.file)
+            upload.delete()
+            removed += 1
+        return removed
+
+    class Meta:
+        verbose_name = "Загрузка частями"
+        verbose_name_plural = "Загрузки частями"
+
+
 class MovieInteraction(models.Model):
+    FLAGS = {'favorite': 'is_favorite', 'watched': 'is_watched', 'planned': 'is_planned'}
+
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     movie = models.ForeignKey(Movie, on_delete=models.CASCADE)
     is_favorite = models.BooleanField("избранное", default=False)
@@ -187,6 +615,60 @@ class MovieInteraction(models.Model):
     def __str__(self):
         return f"{self.user.username} - {self.movie.title}"
 
+    @classmethod
+    def toggle(cls, user_id, movie_id, interaction_type):
+        """
+        Переключает отметку одной командой INSERT ... SELECT ... ON CONFLICT DO UPDATE и возвращает новое
+        значение (None, если фильма нет). Параллельные нажатия не теряют друг друга: каждое переключение
+        выполняется базой атомарно.
+        """
+        field = cls.FLAGS[interaction_type]
+        if connection.vendor not in ('sqlite', 'postgresql'):
+            return cls._toggle_locked(user_id, movie_id, field)
+
+        quote = connection.ops.quote_name
+        table = quote(cls._meta.db_table)
+        column = quote(cls._meta.get_field(field).column)
+        user_column, movie_column = (quote(cls._meta.get_field(name).column) for name in ('user', 'movie'))
+        flag_columns = [quote(cls._meta.get_field(name).column) for name in cls.FLAGS.values()]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} ({user_column}, {movie_column}, {', '.join(flag_columns)}) "
+                f"SELECT %s, {quote(Movie._meta.pk.column)}, %s, %s, %s FROM {quote(Movie._meta.db_table)} "
+                f"WHERE {quote(Movie._meta.pk.column)} = %s "
+                f"ON CONFLICT ({user_column}, {movie_column}) DO UPDATE SET {column} = NOT {table}.{column} "
+                f"RETURNING {column}",
+                [user_id, *(name == field for name in cls.FLAGS.values()), movie_id],
+            )
+            row = cursor.fetchone()
+        return bool(row[0]) if row else None
+
+    @classmethod
+    def _toggle_locked(cls, user_id, movie_id, field):
+        """Запасной вариант для баз без INSERT ... ON CONFLICT ... RETURNING: блокировка строки"""
+        if not Movie.objects.filter(pk=movie_id).exists():
+            return None
+        with transaction.atomic():
+            cls.objects.get_or_create(user_id=user_id, movie_id=movie_id)
+            interaction = cls.objects.select_for_update().get(user_id=user_id, movie_id=movie_id)
+            setattr(interaction, field, not getattr(interaction, field))
+            interaction.save(update_fields=[field])
+        return getattr(interaction, field)
+
+    @classmethod
+    def marked(cls):
+        """Строки, где стоит хотя бы одна отметка"""
+        return cls.objects.filter(
+            models.Q(is_favorite=True) | models.Q(is_watched=True) | models.Q(is_planned=True))
+
+    @classmethod
+    def set_flags(cls, user_id, movie_id, **flags):
+        """Записывает отметки одной командой вставки с обновлением при конфликте"""
+        cls.objects.bulk_create(
+            [cls(user_id=user_id, movie_id=movie_id, **flags)],
+            update_conflicts=True, unique_fields=['user', 'movie'], update_fields=list(flags),
+        )
+
     class Meta:
         verbose_name = "Действия"
         verbose_name_plural = "Действия"
@@ -241,7 +723,7 @@ class RatingStar(models.Model):
 
 class Rating(models.Model):
     """Рейтинг"""
-    ip = models.CharField("IP адрес", max_length=15)
+    ip = models.CharField("IP адрес", max_length=45)
     star = models.ForeignKey(RatingStar, on_delete=models.CASCADE, verbose_name="звезда")
     movie = models.ForeignKey(Movie, on_delete=models.CASCADE, verbose_name="фильм")
 
@@ -251,10 +733,249 @@ class Rating(models.Model):
     class Meta:
         verbose_name = "Рейтинг"
         verbose_name_plural = "Рейтинги"
+        unique_together = ('movie', 'ip')
+
+
+class RatingCount(models.Model):
+    """Сколько голосов с данным значением звезды получил фильм; строки фильма образуют гистограмму оценок"""
+    movie = models.ForeignKey(Movie, on_delete=models.CASCADE, related_name="rating_counts", verbose_name="фильм")
+    value = models.SmallIntegerField("Значение")
+    count = models.PositiveIntegerField("Количество голосов", default=0)
+
+    def __str__(self):
+        return f"{self.movie_id}: {self.value} - {self.count}"
+
+    @classmethod
+    def apply(cls, movie_id, changes):
+        """Сдвигает счетчики фильма на {значение: сдвиг}; недостающие строки создаются с нулем"""
+        changes = {value: delta for value, delta in changes.items() if delta}
+        if not changes:
+            return
+        cls.objects.bulk_create([cls(movie_id=movie_id, value=value) for value in changes], ignore_conflicts=True)
+        cls.objects.filter(movie_id=movie_id, value__in=changes).update(count=Greatest(Case(
+            *(When(value=value, then=F('count') + delta) for value, delta in changes.items()),
+            default=F('count'),
+            output_field=models.IntegerField(),
+        ), Value(0)))
+
+    @classmethod
+    def histogram(cls, movie_id):
+        return dict(cls.objects.filter(movie_id=movie_id, count__gt=0).values_list('value', 'count'))
+
+    @classmethod
+    def histograms_from_ratings(cls):
+        """Гистограммы всех фильмов, посчитанные по таблице рейтингов: {(фильм, значение): количество}"""
+        rows = Rating.objects.values('movie_id', 'star__value').annotate(count=Count('id'))
+        return {(row['movie_id'], row['star__value']): row['count'] for row in rows}
+
+    class Meta:
+        verbose_name = "Счетчик оценок"
+        verbose_name_plural = "Счетчики оценок"
+        unique_together = ('movie', 'value')
+
+
+class PopularitySnapshot(models.Model):
+    """Версия рейтинга популярности"""
+    KEEP_VERSIONS = 3
+
+    created_at = models.DateTimeField("Построен", auto_now_add=True)
+    stale_since = models.DateTimeField("Устарел с", null=True, blank=True)
+    movie_count = models.PositiveIntegerField("Количество фильмов", default=0)
+
+    def __str__(self):
+        return f"Версия {self.pk} от {self.created_at:%d.%m.%Y %H:%M}"
+
+    @property
+    def age(self):
+        return timezone.now() - self.created_at
+
+    @classmethod
+    def current(cls):
+        """Последняя версия или None; страницы не строят рейтинг сами - до первой сборки он читается из фильмов"""
+        return cls.objects.order_by('-pk').first()
+
+    @staticmethod
+    def ranked_movies():
+        """Фильмы с оценками в порядке рейтинга - то, что сохраняет снимок"""
+        return Movie.objects.filter(rating_count__gt=0).order_by('-average_rating', '-rating_count', 'pk')
+
+    @classmethod
+    def mark_stale(cls):
+        latest = cls.objects.order_by('-pk').values_list('pk', flat=True)[:1]
+        cls.objects.filter(pk__in=list(latest), stale_since__isnull=True).update(stale_since=timezone.now())
+
+    @classmethod
+    def rebuild(cls, batch_size=1000):
+        """Строит новую версию рейтинга из сохранённых агрегатов оценок и удаляет старые версии"""
+        ranked = cls.ranked_movies().values_list('pk', 'average_rating')
+        with transaction.atomic():
+            snapshot = cls.objects.create()
+            ranks = (
+                PopularityRank(snapshot=snapshot, rank=rank, movie_id=movie_id, score=score)
+                for rank, (movie_id, score) in enumerate(ranked.iterator(), start=1)
+            )
+            created = 0
+            while batch := list(islice(ranks, batch_size)):
+                PopularityRank.objects.bulk_create(batch)
+                created += len(batch)
+            snapshot.movie_count = created
+            snapshot.save(update_fields=['movie_count'])
+            PopularityRank.objects.filter(snapshot__lte=snapshot.pk - cls.KEEP_VERSIONS).delete()
+            cls.objects.filter(pk__lte=snapshot.pk - cls.KEEP_VERSIONS).delete()
+        return snapshot
+
+    class Meta:
+        verbose_name = "Рейтинг популярности"
+        verbose_name_plural = "Рейтинги популярности"
+
+
+class PopularityRank(models.Model):
+    """Место фильма в версии рейтинга популярности"""
+    snapshot = models.ForeignKey(PopularitySnapshot, on_delete=models.CASCADE, related_name="ranks")
+    rank = models.PositiveIntegerField("Место")
+    movie = models.ForeignKey(Movie, on_delete=models.CASCADE, related_name="popularity_ranks")
+    score = models.DecimalField("Средний рейтинг", max_digits=4, decimal_places=2)
+
+    def __str__(self):
+        return f"{self.rank}. {self.movie_id}"
+
+    class Meta:
+        verbose_name = "Место в рейтинге"
+        verbose_name_plural = "Места в рейтинге"
+        unique_together = ('snapshot', 'rank')
+
+
+class SimilarMovie(models.Model):
+    """Сосед фильма по общим жанрам, актерам и режиссерам; строки фильма - его top-K (строит movie.similarity)"""
+    movie = models.ForeignKey(Movie, on_delete=models.CASCADE, related_name="similar_links", verbose_name="фильм")
+    similar = models.ForeignKey(Movie, on_delete=models.CASCADE, related_name="+", verbose_name="Похожий фильм")
+    rank = models.PositiveSmallIntegerField("Место")
+    score = models.FloatField("Близость")
+
+    def __str__(self):
+        return f"{self.movie_id} -> {self.similar_id} ({self.score:.3f})"
+
+    class Meta:
+        verbose_name = "Похожий фильм"
+        verbose_name_plural = "Похожие фильмы"
+        unique_together = ('movie', 'rank')
+
+
+class SimilarMovieUpdate(models.Model):
+    """
+    Фильм, связи которого изменились после последнего пересчета соседей. Сигналы только ставят отметку в той же
+    транзакции; соседей пересчитывает ``manage.py build_similar_movies --pending`` по расписанию.
+    """
+    movie = models.OneToOneField(Movie, on_delete=models.CASCADE, primary_key=True, related_name="+",
+                                 verbose_name="фильм")
+    marked_at = models.DateTimeField("Отмечен", auto_now=True)
+
+    def __str__(self):
+        return f"{self.movie_id} ({self.marked_at:%d.%m.%Y %H:%M})"
+
+    @classmethod
+    def mark(cls, movie_ids):
+        """Отмечает фильмы; повторная отметка сдвигает время, чтобы идущий пересчет ее не снял"""
+        movie_ids = {movie_id for movie_id in movie_ids if movie_id is not None}
+        cls.objects.bulk_create([cls(movie_id=movie_id) for movie_id in movie_ids], update_conflicts=True,
+                                unique_fields=['movie'], update_fields=['marked_at'])
+
+    class Meta:
+        verbose_name = "Пересчет похожих фильмов"
+        verbose_name_plural = "Пересчеты похожих фильмов"
+
+
+class ImageVariantsUpdate(models.Model):
+    """
+    Новое изображение, для которого еще не построены уменьшенные копии (см. movie.images). Сигналы только ставят
+    отметку; копии строит ``manage.py build_image_variants --pending`` по расписанию или воркером.
+    """
+    file = models.CharField("Файл", max_length=255, unique=True)
+    kind = models.CharField("Вид", max_length=20)
+    marked_at = models.DateTimeField("Отмечен", auto_now=True)
+
+    def __str__(self):
+        return self.file
+
+    @classmethod
+    def mark(cls, jobs):
+        """jobs - пары (имя файла, вид); повторная отметка сдвигает время, чтобы идущая обработка ее не сняла"""
+        cls.objects.bulk_create([cls(file=name, kind=kind) for name, kind in jobs if name and kind],
+                                update_conflicts=True, unique_fields=['file'], update_fields=['kind', 'marked_at'])
+
+    class Meta:
+        verbose_name = "Построение вариантов изображения"
+        verbose_name_plural = "Построение вариантов изображений"
+
+
+class Recommendation(models.Model):
+    """Фильм, рекомендованный пользователю по его отметкам; строки пользователя - его top-N (строит movie.recommendations)"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="recommendations", verbose_name="Пользователь")
+    movie = models.ForeignKey(Movie, on_delete=models.CASCADE, related_name="+", verbose_name="фильм")
+    rank = models.PositiveSmallIntegerField("Место")
+    score = models.FloatField("Оценка")
+
+    def __str__(self):
+        return f"{self.user_id} -> {self.movie_id} ({self.score:.3f})"
+
+    @classmethod
+    def for_user(cls, user_id, limit=None):
+        """Рекомендованные фильмы по порядку одним запросом; отмеченные после расчета фильмы пропускаются"""
+        links = cls.objects.filter(user_id=user_id).exclude(
+            movie_id__in=MovieInteraction.marked().filter(user_id=user_id).values('movie_id'),
+        ).select_related('movie').order_by('rank')
+        if limit:
+            links = links[:limit]
+        movies = []
+        for link in links:
+            link.movie.recommendation_score = link.score
+            movies.append(link.movie)
+        return movies
+
+    class Meta:
+        verbose_name = "Рекомендация"
+        verbose_name_plural = "Рекомендации"
+        unique_together = ('user', 'rank')
+
+
+class CatalogVersion(models.Model):
+    """Номер изменения раздела каталога (movies, actors, genres, seasons) для ETag и Last-Modified API"""
+    name = models.CharField("Раздел", max_length=20, primary_key=True)
+    version = models.PositiveBigIntegerField("Версия", default=0)
+    changed_at = models.DateTimeField("Изменен", default=timezone.now)
+
+    def __str__(self):
+        return f"{self.name}: {self.version}"
+
+    @classmethod
+    def bump(cls, *names):
+        """Сдвигает версии разделов; строки разделов создаются при первом изменении"""
+        now = timezone.now()
+        if cls.objects.filter(name__in=names).update(version=F('version') + 1, changed_at=now) < len(set(names)):
+            cls.objects.bulk_create([cls(name=name, version=1, changed_at=now) for name in set(names)],
+                                    ignore_conflicts=True)
+
+    @classmethod
+    def current(cls, names):
+        """{раздел: (версия, время изменения)}; у еще не менявшегося раздела - (0, None)"""
+        found = {name: (version, changed_at) for name, version, changed_at in
+                 cls.objects.filter(name__in=names).values_list('name', 'version', 'changed_at')}
+        return {name: found.get(name, (0, None)) for name in names}
+
+    class Meta:
+        verbose_name = "Версия раздела каталога"
+        verbose_name_plural = "Версии разделов каталога"
 
 
 class Reviews(models.Model):
-    """Отзывы"""
+    """
+    Отзывы. Ветка хранится материализованным путем: path - id предков и самого отзыва по 10 цифр
+    через "/", root - первый отзыв ветки, depth - уровень вложенности. Сортировка по path выдает
+    ветку сразу в порядке показа, а все ветки страницы выбираются одним запросом по root.
+    """
+    PATH_DIGITS = 10
+    MAX_DEPTH = 30
+
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     email = models.EmailField()
     text = models.TextField("Сообщение", max_length=5000)
@@ -262,13 +983,112 @@ class Reviews(models.Model):
         'self', verbose_name="Родитель", on_delete=models.SET_NULL, blank=True, null=True, related_name='replies'
     )
     movie = models.ForeignKey(Movie, verbose_name="фильм", on_delete=models.CASCADE)
+    root = models.ForeignKey(
+        'self', verbose_name="Начало ветки", on_delete=models.SET_NULL, blank=True, null=True, editable=False,
+        related_name='thread_reviews'
+    )
+    depth = models.PositiveSmallIntegerField("Вложенность", default=0, editable=False)
+    path = models.CharField("Путь в ветке", max_length=(PATH_DIGITS + 1) * (MAX_DEPTH + 1), blank=True,
+                            editable=False)
 
     def __str__(self):
         return f"{self.email} - {self.movie}"
 
+    @classmethod
+    def path_segment(cls, pk):
+        return f"{pk:0{cls.PATH_DIGITS}d}/"
+
+    def save(self, *args, **kwargs):
+        # Слишком глубокие ответы прикрепляются к ближайшему предку на допустимой глубине
+        parent = self.parent
+        while parent is not None and parent.depth >= self.MAX_DEPTH:
+            parent = parent.parent
+        self.parent = parent
+        super().save(*args, **kwargs)
+
+        old_path = self.path
+        self.path = (parent.path if parent else '') + self.path_segment(self.pk)
+        self.depth = parent.depth + 1 if parent else 0
+        self.root_id = parent.root_id if parent else self.pk
+        if self.path == old_path:
+            return
+        if old_path:
+            self.move_subtree(self.movie_id, old_path, self.path, self.root_id)
+        else:
+            type(self).objects.filter(pk=self.pk).update(path=self.path, depth=self.depth, root_id=self.root_id)
+
+    @classmethod
+    def move_subtree(cls, movie_id, old_path, new_path, root_id):
+        """Переносит отзыв с путем old_path вместе с потомками на новый путь"""
+        depth_shift = new_path.count('/') - old_path.count('/')
+        subtree = list(cls.objects.filter(movie_id=movie_id, path__startswith=old_path).only(
+            'pk', 'path', 'depth', 'root'))
+        for review in subtree:
+            review.path = new_path + review.path[len(old_path):]
+            review.depth += depth_shift
+            review.root_id = root_id
+        cls.objects.bulk_update(subtree, ['path', 'depth', 'root'], batch_size=500)
+
+    @classmethod
+    def rebuild_paths(cls, movie_ids=None):
+        """Пересчитывает пути всех отзывов (например, после bulk_create, который обходит save)"""
+        reviews = cls.objects.only('pk', 'parent', 'path', 'depth', 'root').order_by('pk')
+        if movie_ids is not None:
+            reviews = reviews.filter(movie_id__in=movie_ids)
+        reviews = {review.pk: review for review in reviews}
+        placed = set()
+        for review in reviews.values():
+            # Поднимаемся до ближайшего размещенного предка и размещаем цепочку сверху вниз
+            chain = {}
+            current = review
+            while current is not None and current.pk not in placed and current.pk not in chain:
+                chain[current.pk] = current
+                current = reviews.get(current.parent_id)
+            for item in reversed(chain.values()):
+                # Родитель из этой же цепочки, который еще не размещен, означает цикл - разрываем его
+                parent = reviews.get(item.parent_id) if item.parent_id in placed else None
+                item.path = (parent.path if parent else '') + cls.path_segment(item.pk)
+                item.depth = parent.depth + 1 if parent else 0
+                item.root_id = parent.root_id if parent else item.pk
+                placed.add(item.pk)
+        cls.objects.bulk_update(reviews.values(), ['path', 'depth', 'root'], batch_size=500)
+
+    @classmethod
+    def get_threads(cls, movie_id, after=None, limit=20):
+        """
+        Страница веток фильма: (корневые отзывы, курсор следующей страницы или None). Ветки идут по
+        возрастанию id, у каждого корня в thread_replies - все ответы ветки в порядке показа.
+        Все отзывы страницы с авторами и профилями выбираются одним запросом.
+        """
+        roots = cls.objects.filter(movie_id=movie_id, depth=0).order_by('pk').values('pk')
+        if after is not None:
+            roots = roots.filter(pk__gt=after)
+        # Корень следующей ветки выбирается тем же запросом (без ответов), чтобы узнать, есть ли еще страница
+        rows = cls.objects.filter(
+            models.Q(root_id__in=models.Subquery(roots[:limit])) | models.Q(pk=models.Subquery(roots[limit:limit + 1]))
+        ).select_related('user__profile').order_by('path')
+
+        threads = []
+        next_cursor = None
+        for review in rows:
+            if review.depth == 0:
+                if len(threads) == limit:
+                    next_cursor = threads[-1].pk
+                    break
+                review.thread_replies = []
+                threads.append(review)
+            elif threads:
+                review.indent = min(review.depth - 1, 5) * 24
+                threads[-1].thread_replies.append(review)
+        return threads, next_cursor
+
     class Meta:
         verbose_name = "Отзыв"
         verbose_name_plural = "Отзывы"
+        indexes = [
+            models.Index(fields=['movie', 'depth', 'id'], name='movie_reviews_roots_idx'),
+            models.Index(fields=['root', 'path'], name='movie_reviews_thread_idx'),
+        ]
 
 
 class Profile(models.Model):
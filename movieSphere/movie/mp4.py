@@ -0,0 +1,269 @@
+"""Подготовка MP4/MOV к воспроизведению в браузере без внешних утилит.
+
+``faststart()`` переносит атом ``moov`` в начало файла и сдвигает смещения чанков (``stco``/``co64``),
+чтобы браузер мог начать воспроизведение, не скачивая хвост файла. Данные копируются кусками
+во временный файл рядом с исходным, поэтому в памяти держится только ``moov``, а не весь файл.
+``keyframe_index()`` строит по таблицам сэмплов видеодорожки список ключевых кадров
+(время в миллисекундах -> смещение в байтах).
+"""
+import os
+import struct
+import tempfile
+
+VIDEO_EXTENSIONS = ('.mp4', '.m4v', '.mov')
+TOP_LEVEL_TYPES = {b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'pnot', b'uuid', b'meta', b'moof', b'mfra'}
+CONTAINER_TYPES = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+MAX_MOOV_SIZE = 512 * 1024 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+# Если в дорожке нет stss (все кадры ключевые), в индекс попадает не больше одного кадра в секунду
+MIN_INDEX_STEP_MS = 1000
+
+
+class MP4Error(ValueError):
+    pass
+
+
+class Box:
+    """Атом MP4: у контейнеров есть дочерние атомы, у остальных - сырое содержимое"""
+
+    def __init__(self, type, payload=b'', children=None):
+        self.type = type
+        self.payload = payload
+        self.children = children
+
+    def find(self, *path):
+        """Первый потомок по пути типов, например find(b'mdia', b'minf', b'stbl')"""
+        box = self
+        for type in path:
+            box = next((child for child in box.children or () if child.type == type), None)
+            if box is None:
+                return None
+        return box
+
+    def find_all(self, type):
+        return [child for child in self.children or () if child.type == type]
+
+    def serialize(self):
+        payload = b''.join(child.serialize() for child in self.children) if self.children is not None else self.payload
+        if len(payload) + 8 > 0xFFFFFFFF:
+            return struct.pack('>I4sQ', 1, self.type, len(payload) + 16) + payload
+        return struct.pack('>I4s', len(payload) + 8, self.type) + payload
+
+
+def parse_boxes(data):
+    boxes = []
+    position = 0
+    while position + 8 <= len(data):
+        size, type = struct.unpack_from('>I4s', data, position)
+        header = 8
+        if size == 1:
+            size, = struct.unpack_from('>Q', data, position + 8)
+            header = 16
+        elif size == 0:
+            size = len(data) - position
+        if size < header or position + size > len(data):
+            raise MP4Error(f"Поврежденный атом {type!r}")
+        payload = bytes(data[position + header:position + size])
+        if type in CONTAINER_TYPES:
+            boxes.append(Box(type, children=parse_boxes(payload)))
+        else:
+            boxes.append(Box(type, payload))
+        position += size
+    return boxes
+
+
+def scan_top_level(file):
+    """Атомы верхнего уровня: (тип, смещение, размер); содержимое не читается"""
+    file.seek(0, os.SEEK_END)
+    file_size = file.tell()
+    boxes = []
+    position = 0
+    while position < file_size:
+        file.seek(position)
+        header = file.read(16)
+        if len(header) < 8:
+            raise MP4Error("Обрезанный заголовок атома")
+        size, type = struct.unpack_from('>I4s', header)
+        if size == 1:
+            if len(header) < 16:
+                raise MP4Error("Обрезанный заголовок атома")
+            size, = struct.unpack_from('>Q', header, 8)
+        elif size == 0:
+            size = file_size - position
+        if size < 8 or position + size > file_size:
+            raise MP4Error(f"Поврежденный атом {type!r}")
+        if not boxes and type not in TOP_LEVEL_TYPES:
+            raise MP4Error("Файл не похож на MP4/MOV")
+        boxes.append((type, position, size))
+        position += size
+    return boxes
+
+
+def read_moov(file, boxes):
+    moov = next(((offset, size) for type, offset, size in boxes if type == b'moov'), None)
+    if moov is None:
+        return None, None
+    offset, size = moov
+    if size > MAX_MOOV_SIZE:
+        raise MP4Error("Слишком большой атом moov")
+    file.seek(offset)
+    return offset, parse_boxes(file.read(size))[0]
+
+
+def _chunk_offset_boxes(moov):
+    for trak in moov.find_all(b'trak'):
+        stbl = trak.find(b'mdia', b'minf', b'stbl')
+        if stbl is None:
+            continue
+        for box in stbl.children:
+            if box.type in (b'stco', b'co64'):
+                yield box
+
+
+def _read_chunk_offsets(box):
+    count, = struct.unpack_from('>I', box.payload, 4)
+    fmt = '>I' if box.type == b'stco' else '>Q'
+    return [value for value, in struct.iter_unpack(fmt, box.payload[8:8 + count * struct.calcsize(fmt)])]
+
+
+def _shift_chunk_offsets(moov, shift):
+    """Пересчитывает смещения чанков функцией shift; stco, которым не хватает 32 бит, превращаются в co64"""
+    for box in _chunk_offset_boxes(moov):
+        offsets = [shift(value) for value in _read_chunk_offsets(box)]
+        if box.type == b'stco' and offsets and max(offsets) > 0xFFFFFFFF:
+            box.type = b'co64'
+        fmt = '>I' if box.type == b'stco' else '>Q'
+        box.payload = box.payload[:4] + struct.pack('>I', len(offsets)) + b''.join(
+            struct.pack(fmt, value) for value in offsets)
+
+
+def _copy_range(source, target, offset, length):
+    source.seek(offset)
+    while length > 0:
+        data = source.read(min(COPY_CHUNK_SIZE, length))
+        if not data:
+            raise MP4Error("Файл закончился раньше, чем ожидалось")
+        target.write(data)
+        length -= len(data)
+
+
+def faststart(path):
+    """Переносит moov перед mdat; возвращает True, если файл был переписан"""
+    with open(path, 'rb') as source:
+        boxes = scan_top_level(source)
+        moov_offset, moov = read_moov(source, boxes)
+        mdat_offsets = [offset for type, offset, _ in boxes if type == b'mdat']
+        if moov is None or not mdat_offsets or moov_offset < mdat_offsets[0]:
+            return False
+
+        # moov встаёт перед первым mdat: данные между ними сдвигаются на размер нового moov, а данные
+        # после старого moov - на разницу размеров. co64 увеличивает moov, поэтому размер
+        # пересчитывается, пока не перестанет меняться.
+        original = moov.serialize()
+        moov_size = len(original)
+        while True:
+            moov = parse_boxes(original)[0]
+            _shift_chunk_offsets(moov, lambda value, size=moov_size: value + size - (
+                len(original) if value >= moov_offset else 0))
+            data = moov.serialize()
+            if len(data) == moov_size:
+                break
+            moov_size = len(data)
+
+        directory = os.path.dirname(os.path.abspath(path))
+        descriptor, temporary_path = tempfile.mkstemp(dir=directory, suffix='.faststart')
+        try:
+            with os.fdopen(descriptor, 'wb') as target:
+                for type, offset, size in boxes:
+                    if type == b'moov':
+                        continue
+                    if offset == mdat_offsets[0]:
+                        target.write(data)
+                    _copy_range(source, target, offset, size)
+                target.flush()
+                os.fsync(target.fileno())
+            os.chmod(temporary_path, os.stat(path).st_mode & 0o7777)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+    return True
+
+
+def _table(stbl, type, header, fmt):
+    box = stbl.find(type)
+    if box is None:
+        return None
+    count, = struct.unpack_from('>I', box.payload, header)
+    start = header + 4
+    return list(struct.iter_unpack(fmt, box.payload[start:start + count * struct.calcsize(fmt)]))
+
+
+def _video_track(moov):
+    for trak in moov.find_all(b'trak'):
+        hdlr = trak.find(b'mdia', b'hdlr')
+        if hdlr is not None and hdlr.payload[8:12] == b'vide':
+            return trak
+    return None
+
+
+def keyframe_index(path):
+    """
+    Ключевые кадры первой видеодорожки: (длительность в секундах, [(время в мс, смещение в байтах), ...]).
+    Для файлов без moov (фрагментированных или не MP4) возвращает None.
+    """
+    with open(path, 'rb') as file:
+        _, moov = read_moov(file, scan_top_level(file))
+    if moov is None:
+        return None
+    trak = _video_track(moov)
+    if trak is None:
+        return None
+
+    mdhd = trak.find(b'mdia', b'mdhd')
+    stbl = trak.find(b'mdia', b'minf', b'stbl')
+    stsz = stbl.find(b'stsz') if stbl is not None else None
+    if mdhd is None or stsz is None:
+        raise MP4Error("В видеодорожке нет mdhd или таблицы размеров сэмплов")
+    mdhd, stsz = mdhd.payload, stsz.payload
+    if mdhd[0] == 1:
+        timescale, duration = struct.unpack_from('>IQ', mdhd, 20)
+    else:
+        timescale, duration = struct.unpack_from('>II', mdhd, 12)
+    if not timescale:
+        raise MP4Error("Нулевой timescale видеодорожки")
+
+    time_to_sample = _table(stbl, b'stts', 4, '>II') or []
+    sample_to_chunk = _table(stbl, b'stsc', 4, '>III') or []
+    sync_samples = _table(stbl, b'stss', 4, '>I')
+    chunk_offsets = next((_read_chunk_offsets(box) for box in stbl.children if box.type in (b'stco', b'co64')), [])
+    sample_size, sample_count = struct.unpack_from('>II', stsz, 4)
+    sizes = ([size for size, in struct.iter_unpack('>I', stsz[12:12 + sample_count * 4])]
+             if sample_size == 0 else None)
+    keyframes = {number for number, in sync_samples} if sync_samples is not None else None
+
+    durations = (delta for count, delta in time_to_sample for _ in range(count))
+    index = []
+    sample = 1
+    time = 0
+    for position, (first_chunk, samples_per_chunk, _) in enumerate(sample_to_chunk):
+        last_chunk = sample_to_chunk[position + 1][0] - 1 if position + 1 < len(sample_to_chunk) else len(chunk_offsets)
+        for chunk in range(first_chunk, last_chunk + 1):
+            offset = chunk_offsets[chunk - 1]
+            for _ in range(samples_per_chunk):
+                if sample > sample_count:
+                    break
+                milliseconds = time * 1000 // timescale
+                if keyframes is None:
+                    if not index or milliseconds - index[-1][0] >= MIN_INDEX_STEP_MS:
+                        index.append((milliseconds, offset))
+                elif sample in keyframes:
+                    index.append((milliseconds, offset))
+                offset += sizes[sample - 1] if sizes is not None else sample_size
+                time += next(durations, 0)
+                sample += 1
+    return duration / timescale, index
+
+
+def is_video(path):
+    return path.lower().endswith(VIDEO_EXTENSIONS)
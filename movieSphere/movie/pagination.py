@@ -0,0 +1,183 @@
+"""Постраничный вывод по ключу (keyset) вместо COUNT и OFFSET.
+
+Страница задаётся непрозрачным курсором - значениями полей сортировки у крайнего объекта соседней
+страницы. Следующая страница выбирается условием "после курсора" в порядке сортировки queryset,
+поэтому тысячная страница стоит столько же, сколько первая. Порядок всегда дополняется первичным
+ключом, чтобы объекты с одинаковыми значениями сортировки не терялись и не повторялись.
+
+NULL в полях, которые могут его содержать, считается больше любого значения: при сортировке по
+возрастанию такие объекты идут в конце, по убыванию - в начале, одинаково во всех базах.
+"""
+import base64
+import json
+
+from django.conf import settings
+from django.core.exceptions import BadRequest, FieldDoesNotExist, ImproperlyConfigured, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q
+
+
+def encode_cursor(values, backwards=False):
+    payload = json.dumps({'v': values, 'b': backwards}, cls=DjangoJSONEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return list(payload['v']), bool(payload['b'])
+    except (ValueError, KeyError, TypeError):
+        raise BadRequest("Некорректный курсор страницы")
+
+
+def is_nullable(model, name):
+    """Может ли значение сортировки быть NULL; для аннотаций и неизвестных путей считается, что может"""
+    if name == 'pk':
+        return False
+    for part in name.split('__'):
+        try:
+            field = model._meta.get_field(part)
+        except FieldDoesNotExist:
+            return True
+        if field.null:
+            return True
+        if field.is_relation:
+            model = field.related_model
+            if model is None:
+                return True
+    return False
+
+
+class KeysetPage:
+    is_keyset = True
+
+    def __init__(self, object_list, paginator, next_values=None, previous_values=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = encode_cursor(next_values) if next_values is not None else None
+        self.previous_cursor = encode_cursor(previous_values, backwards=True) if previous_values is not None else None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    """Страницы queryset по курсору; сортировка берётся из самого queryset"""
+
+    def __init__(self, object_list, per_page):
+        self.per_page = int(per_page)
+        ordering = list(object_list.query.order_by or object_list.model._meta.ordering)
+        if not all(isinstance(name, str) and name != '?' for name in ordering):
+            raise ImproperlyConfigured("Keyset-пагинация поддерживает только сортировку по именам полей")
+        if not any(name.lstrip('-') in ('pk', 'id') for name in ordering):
+            ordering.append('pk')
+        self.ordering = [(name.lstrip('-'), name.startswith('-'), is_nullable(object_list.model, name.lstrip('-')))
+                         for name in ordering]
+        self.keys = [f'keyset_{position}' for position in range(len(self.ordering))]
+        self.object_list = object_list.annotate(
+            **{key: F(name) for key, (name, _, _) in zip(self.keys, self.ordering)}
+        )
+
+    def _order(self, backwards):
+        order = []
+        for key, (_, descending, nullable) in zip(self.keys, self.ordering):
+            if not nullable:
+                order.append(f"{'-' if descending != backwards else ''}{key}")
+            elif descending != backwards:
+                order.append(F(key).desc(nulls_first=True))
+            else:
+                order.append(F(key).asc(nulls_last=True))
+        return order
+
+    def _after(self, values, backwards):
+        """Условие "строго после values" в порядке сортировки (или до них, если backwards)"""
+        condition = Q()
+        for position, (key, (_, descending, nullable)) in enumerate(zip(self.keys, self.ordering)):
+            value = values[position]
+            if descending != backwards:
+                step = Q(**{f'{key}__isnull': False}) if value is None else Q(**{f'{key}__lt': value})
+            elif value is None:
+                # После NULL в порядке по возрастанию ничего нет
+                continue
+            else:
+                step = Q(**{f'{key}__gt': value})
+                if nullable:
+                    step |= Q(**{f'{key}__isnull': True})
+            for previous_key, previous in zip(self.keys[:position], values):
+                step &= Q(**{f'{previous_key}__isnull': True}) if previous is None else Q(**{previous_key: previous})
+            condition |= step
+        # Пустое условие значило бы "все объекты", а после курсора из одних NULL их нет
+        return condition if condition else Q(pk__in=[])
+
+    def _values(self, obj):
+        return [getattr(obj, key) for key in self.keys]
+
+    def page(self, cursor=None):
+        backwards = False
+        queryset = self.object_list
+        if cursor:
+            values, backwards = decode_cursor(cursor)
+            if len(values) != len(self.keys):
+                raise BadRequest("Курсор не подходит к этому списку")
+            try:
+                queryset = queryset.filter(self._after(values, backwards))
+            except (ValidationError, ValueError, TypeError):
+                raise BadRequest("Курсор не подходит к этому списку")
+
+        rows = list(queryset.order_by(*self._order(backwards))[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+
+        if not rows:
+            return KeysetPage(rows, self)
+        has_next = (has_more and not backwards) or (backwards and bool(cursor))
+        has_previous = (has_more and backwards) or (not backwards and bool(cursor))
+        return KeysetPage(
+            rows, self,
+            next_values=self._values(rows[-1]) if has_next else None,
+            previous_values=self._values(rows[0]) if has_previous else None,
+        )
+
+
+class KeysetPaginationMixin:
+    """Подключается к ListView; keyset_pagination = True переключает вид на страницы по курсору"""
+    keyset_pagination = None
+    cursor_kwarg = 'cursor'
+
+    def uses_keyset_pagination(self):
+        if self.keyset_pagination is None:
+            return getattr(settings, 'KEYSET_PAGINATION', False)
+        return self.keyset_pagination
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.uses_keyset_pagination():
+            return super().paginate_queryset(queryset, page_size)
+        paginator = KeysetPaginator(queryset, page_size)
+        page = paginator.page(self.request.GET.get(self.cursor_kwarg))
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get_query_params(self):
+        """GET-параметры без номера страницы и курсора - для ссылок пагинации в шаблонах"""
+        query_params = self.request.GET.copy()
+        for name in (self.page_kwarg, self.cursor_kwarg):
+            query_params.pop(name, None)
+        return query_params
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.setdefault('query_params', self.get_query_params())
+        return context
@@ -0,0 +1,103 @@
+"""Готовые ответы для случайного фильма на главной странице.
+
+Кандидаты (топ популярных фильмов) хранятся в кеше компактным массивом id, а для каждого кандидата
+заранее собран JSON с сезонами и сериями. Выбор фильма - случайный индекс в массиве, поэтому при
+попадании в кеш запрос не обращается к базе. Сигналы сбрасывают массив при новом снимке популярности
+и ответ фильма при изменении самого фильма, его сезонов или серий.
+"""
+import json
+import random
+from array import array
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Prefetch
+
+from .images import variant_url
+from .models import Movie, Season, Episode
+
+CANDIDATES_KEY = 'movie:random_candidates'
+CANDIDATES_LIMIT = 10
+
+
+def _payload_key(movie_id):
+    return f'movie:random_payload:{movie_id}'
+
+
+def _timeout():
+    return getattr(settings, 'RANDOM_MOVIE_CACHE_TIMEOUT', 600)
+
+
+def build_payload(movie):
+    """JSON фильма в виде байтов; сезоны и серии должны быть предзагружены"""
+    data = {
+        'title': movie.title,
+        'description': movie.description,
+        'preview_poster': variant_url(movie.preview_poster, 1920),
+        'trailer_url': movie.trailer.url if movie.trailer else None,
+        'movie_url': movie.movie_file.url if movie.movie_file else None,
+        'is_series': movie.is_series,
+        'seasons': [{
+            'id': season.id,
+            'season_number': season.season_number,
+            'episodes': [{
+                'id': episode.id,
+                'episode_number': episode.episode_number,
+                'title': episode.title,
+                'description': episode.description,
+                'video_url': episode.video.url
+            } for episode in season.episodes.all()]
+        } for season in movie.seasons.all()] if movie.is_series else None,
+    }
+    return json.dumps(data).encode()
+
+
+def _movies_with_episodes(movie_ids):
+    return Movie.objects.filter(pk__in=movie_ids).prefetch_related(
+        Prefetch('seasons', queryset=Season.objects.order_by('season_number', 'pk')),
+        Prefetch('seasons__episodes', queryset=Episode.objects.order_by('episode_number', 'pk')),
+    )
+
+
+def build_payloads(movie_ids):
+    payloads = {movie.pk: build_payload(movie) for movie in _movies_with_episodes(movie_ids)}
+    cache.set_many({_payload_key(movie_id): payload for movie_id, payload in payloads.items()}, _timeout())
+    return payloads
+
+
+def get_candidates():
+    """Массив id кандидатов; при промахе собирается вместе с ответами всех кандидатов"""
+    candidates = cache.get(CANDIDATES_KEY)
+    if candidates is None:
+        candidates = array('q', Movie.get_popular_movies(limit=CANDIDATES_LIMIT).values_list('pk', flat=True))
+        build_payloads(candidates)
+        cache.set(CANDIDATES_KEY, candidates, _timeout())
+    return candidates
+
+
+def get_payload(movie_id):
+    payload = cache.get(_payload_key(movie_id))
+    if payload is None:
+        payload = build_payloads([movie_id]).get(movie_id)
+    return payload
+
+
+def random_payload():
+    """JSON случайного популярного фильма или None, если популярных фильмов нет"""
+    candidates = get_candidates()
+    if not candidates:
+        return None
+    payload = get_payload(candidates[random.randrange(len(candidates))])
+    if payload is None:
+        # Фильм удалили, а массив ещё не сброшен
+        invalidate_candidates()
+        return None
+    return payload
+
+
+def invalidate_candidates():
+    cache.delete(CANDIDATES_KEY)
+
+
+def invalidate_payloads(movie_ids):
+    cache.delete_many([_payload_key(movie_id) for movie_id in set(movie_ids)])
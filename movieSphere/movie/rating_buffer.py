@@ -0,0 +1,186 @@
+"""Буфер голосов за фильмы.
+
+Голос посетителя не пишется в базу сразу, а складывается в словарь процесса по ключу ``(movie_id, ip)``,
+поэтому повторные голоса одного посетителя схлопываются в последний. Буфер сбрасывается в базу, когда
+набирается ``RATING_BUFFER_SIZE`` голосов или проходит ``RATING_BUFFER_INTERVAL`` секунд с первого
+несброшенного голоса (``None`` отключает сброс по таймеру). Сброс - одна вставка с обновлением при
+конфликте по уникальному ключу ``(movie, ip)`` и сдвиг агрегатов и гистограммы каждого затронутого фильма.
+Прежние голоса читаются после блокировки строк затронутых фильмов, поэтому параллельные сбросы голосов
+за один фильм идут по очереди и первый голос посетителя учитывается в агрегатах один раз.
+``flush()`` вызывается явно в тестах и автоматически при завершении процесса.
+
+Адрес посетителя проверяется при постановке голоса: голос с некорректным адресом не принимается. Если запись пачки падает на данных (``IntegrityError`` или
+``DataError``, например звезду удалили до сброса), голоса пишутся по одному, а не записавшиеся отбрасываются
+с записью в журнал; при прочих ошибках базы голоса возвращаются в буфер до следующего сброса.
+"""
+import atexit
+import ipaddress
+import logging
+import threading
+from collections import defaultdict
+from functools import partial
+
+from django.conf import settings
+from django.db import DataError, IntegrityError, connection, transaction
+
+from .models import Actor, CatalogVersion, Movie, PopularitySnapshot, Rating, RatingCount, RatingStar
+
+logger = logging.getLogger(__name__)
+
+_pending = {}
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_timer = None
+
+
+def _max_size():
+    return getattr(settings, 'RATING_BUFFER_SIZE', 500)
+
+
+def _interval():
+    return getattr(settings, 'RATING_BUFFER_INTERVAL', 2.0)
+
+
+def normalize_ip(ip):
+    """Адрес (IPv4 или IPv6) в каноническом виде или None, если это не IP-адрес"""
+    try:
+        return str(ipaddress.ip_address((ip or '').strip()))
+    except ValueError:
+        return None
+
+
+def add(movie_id, ip, star):
+    """
+    Ставит голос в буфер; более ранний голос того же посетителя за этот фильм отбрасывается. Возвращает
+    False, если голос не принят из-за адреса.
+    """
+    global _timer
+    ip = normalize_ip(ip)
+    if ip is None:
+        return False
+    with _lock:
+        _pending[(movie_id, ip)] = (star.pk, star.value)
+        full = len(_pending) >= _max_size()
+        if not full and _timer is None and _interval() is not None:
+            _timer = threading.Timer(_interval(), _flush_on_timer)
+            _timer.daemon = True
+            _timer.start()
+    if full:
+        flush()
+    return True
+
+
+def pending_value(movie_id, ip):
+    """Значение ещё не сброшенного голоса посетителя в этом процессе или None"""
+    with _lock:
+        vote = _pending.get((movie_id, normalize_ip(ip)))
+    return vote[1] if vote else None
+
+
+def pending_count():
+    with _lock:
+        return len(_pending)
+
+
+def flush():
+    """Записывает накопленные голоса в базу; возвращает количество записанных"""
+    global _timer
+    with _flush_lock:
+        with _lock:
+            votes = dict(_pending)
+            _pending.clear()
+            if _timer is not None:
+                _timer.cancel()
+                _timer = None
+        if not votes:
+            return 0
+        try:
+            return _write(votes)
+        except (IntegrityError, DataError):
+            # Пачку не записать из-за отдельных голосов: остальные не должны застревать в буфере вместе с ними
+            return _write_each(votes)
+        except Exception:
+            _requeue(votes)
+            raise
+
+
+def _write_each(votes):
+    """Пишет голоса по одному; голоса с ошибкой в данных отбрасываются, возвращает число записанных"""
+    written = 0
+    keys = list(votes)
+    for position, key in enumerate(keys):
+        try:
+            written += _write({key: votes[key]})
+        except (IntegrityError, DataError):
+            logger.exception("Голос %s за фильм %s не записан и отброшен", key[1], key[0])
+        except Exception:
+            _requeue({rest: votes[rest] for rest in keys[position:]})
+            raise
+    return written
+
+
+def _requeue(votes):
+    # Голоса возвращаются в буфер, если за время записи посетитель не проголосовал заново
+    with _lock:
+        for key, vote in votes.items():
+            _pending.setdefault(key, vote)
+
+
+def _write(votes):
+    """Пишет голоса одной транзакцией; голоса за удаленные фильмы и звезды пропускаются. Возвращает число записанных"""
+    movie_ids = {movie_id for movie_id, _ in votes}
+    with transaction.atomic():
+        # Блокировка фильмов (в порядке id, чтобы сбросы не ждали друг друга по кругу) ставит параллельные
+        # сбросы в очередь: следующий прочитает прежние голоса уже после того, как предыдущий их записал
+        existing_movies = set(Movie.objects.select_for_update().filter(pk__in=movie_ids).order_by('pk').values_list(
+            'pk', flat=True))
+        # Звезду могли удалить, пока голос ждал сброса
+        existing_stars = set(RatingStar.objects.filter(
+            pk__in={star_id for star_id, _ in votes.values()}).values_list('pk', flat=True))
+        votes = {key: vote for key, vote in votes.items()
+                 if key[0] in existing_movies and vote[0] in existing_stars}
+        if not votes:
+            return 0
+        # Прежние голоса нужны для сдвига агрегатов; строки блокируются до конца транзакции
+        rows = Rating.objects.select_for_update(of=('self',)).filter(
+            movie_id__in=existing_movies, ip__in={ip for _, ip in votes},
+        ).values_list('movie_id', 'ip', 'star__value')
+        previous = {(movie_id, ip): value for movie_id, ip, value in rows if (movie_id, ip) in votes}
+
+        Rating.objects.bulk_create(
+            [Rating(movie_id=movie_id, ip=ip, star_id=star_id) for (movie_id, ip), (star_id, _) in votes.items()],
+            update_conflicts=True, unique_fields=['movie', 'ip'], update_fields=['star'],
+        )
+
+        deltas = defaultdict(lambda: [0, 0])
+        histograms = defaultdict(lambda: defaultdict(int))
+        for key, (_, value) in votes.items():
+            old_value = previous.get(key)
+            deltas[key[0]][0] += value - (old_value or 0)
+            deltas[key[0]][1] += old_value is None
+            histograms[key[0]][value] += 1
+            if old_value is not None:
+                histograms[key[0]][old_value] -= 1
+        for movie_id, (sum_delta, count_delta) in deltas.items():
+            if sum_delta or count_delta:
+                Movie.apply_rating_delta(movie_id, sum_delta, count_delta)
+            RatingCount.apply(movie_id, histograms[movie_id])
+        PopularitySnapshot.mark_stale()
+        transaction.on_commit(partial(CatalogVersion.bump, 'movies'))
+        transaction.on_commit(partial(Actor.refresh_stats_for_movies, list(deltas)))
+    return len(votes)
+
+
+def _flush_on_timer():
+    global _timer
+    with _lock:
+        _timer = None
+    try:
+        flush()
+    except Exception:
+        logger.exception("Не удалось записать голоса из буфера")
+    finally:
+        connection.close()
+
+
+atexit.register(flush)
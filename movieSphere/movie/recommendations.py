@@ -0,0 +1,242 @@
+"""Персональные рекомендации по отметкам пользователей (item-based collaborative filtering).
+
+Отметки ``MovieInteraction`` превращаются в разреженную матрицу "пользователь x фильм" с весами
+``FLAG_WEIGHTS``. Близость фильмов - косинус их столбцов, у каждого фильма остаются ``ITEM_NEIGHBOURS``
+самых похожих. Оценка фильма для пользователя - сумма близостей к фильмам с его отметками; фильмы, которые
+пользователь уже отметил, не рекомендуются. Лучшие ``RECOMMENDATIONS_PER_USER`` фильмов каждого пользователя
+записываются в ``Recommendation``.
+
+Обе матрицы считаются плотными блоками не больше ``BLOCK_CELLS`` ячеек, поэтому память не растет с числом
+пользователей. Пользователи делятся на шарды по номеру строки, и шарды считаются в отдельных процессах;
+в базу пишет только родительский процесс. Функции над массивами не обращаются к базе - их же использует
+``manage.py evaluate_recommendations`` на синтетических данных.
+"""
+import multiprocessing
+import time
+from itertools import chain
+
+import numpy as np
+from scipy import sparse
+from django.conf import settings
+from django.db import connections, transaction
+
+from .models import MovieInteraction, Recommendation
+
+FLAG_WEIGHTS = {'is_favorite': 3.0, 'is_planned': 2.0, 'is_watched': 1.0}
+ITEM_NEIGHBOURS = 50
+BLOCK_CELLS = 10_000_000
+WRITE_BATCH_USERS = 1000
+
+_model = None
+
+
+def _per_user():
+    return getattr(settings, 'RECOMMENDATIONS_PER_USER', 20)
+
+
+def _block_rows(columns):
+    return max(1, BLOCK_CELLS // max(columns, 1))
+
+
+def top_n(scores, n):
+    """Столбцы и значения n наибольших элементов каждой строки плотного блока, по убыванию"""
+    n = min(n, scores.shape[1])
+    if n == 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64), np.empty((scores.shape[0], 0), dtype=scores.dtype)
+    columns = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    values = np.take_along_axis(scores, columns, axis=1)
+    order = np.argsort(-values, axis=1, kind='stable')
+    return np.take_along_axis(columns, order, axis=1), np.take_along_axis(values, order, axis=1)
+
+
+def interaction_matrix(user_rows, movie_columns, weights, shape):
+    return sparse.csr_matrix((weights.astype(np.float32), (user_rows, movie_columns)), shape=shape)
+
+
+def item_similarity(matrix, neighbours=ITEM_NEIGHBOURS):
+    """Разреженная матрица "фильм x фильм": у каждого фильма его neighbours самых похожих по косинусу"""
+    items = matrix.T.tocsr()
+    norms = np.sqrt(np.asarray(items.multiply(items).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    items = sparse.diags(1 / norms).dot(items).tocsr().astype(np.float32)
+    items_t = items.T.tocsr()
+    count = items.shape[0]
+    rows, columns, values = [], [], []
+    step = _block_rows(count)
+    for start in range(0, count, step):
+        end = min(start + step, count)
+        block = items[start:end].dot(items_t).toarray()
+        block[np.arange(end - start), np.arange(start, end)] = 0
+        found, scores = top_n(block, neighbours)
+        keep = scores > 0
+        rows.append(np.broadcast_to(np.arange(start, end)[:, None], found.shape)[keep])
+        columns.append(found[keep])
+        values.append(scores[keep])
+    if not rows:
+        return sparse.csr_matrix((count, count), dtype=np.float32)
+    return sparse.csr_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))), shape=(count, count))
+
+
+def recommend(matrix, similarity, user_rows, n):
+    """Для строк пользователей: столбцы n лучших неотмеченных фильмов и их оценки (0 - рекомендации нет)"""
+    found, values = [], []
+    step = _block_rows(matrix.shape[1])
+    for start in range(0, len(user_rows), step):
+        block = matrix[user_rows[start:start + step]]
+        scores = block.dot(similarity).toarray()
+        scores[block.nonzero()] = 0
+        block_found, block_values = top_n(scores, n)
+        found.append(block_found)
+        values.append(block_values)
+    if not found:
+        return np.empty((0, n), dtype=np.int64), np.empty((0, n), dtype=np.float32)
+    return np.concatenate(found), np.concatenate(values)
+
+
+def _init_worker(matrix, similarity):
+    global _model
+    _model = (matrix, similarity)
+
+
+def _recommend_shard(task):
+    shard, shards, n = task
+    matrix, similarity = _model
+    user_rows = np.arange(shard, matrix.shape[0], shards)
+    return (user_rows, *recommend(matrix, similarity, user_rows, n))
+
+
+def recommend_all(matrix, similarity, n, processes=1):
+    """Рекомендации всех строк матрицы, по шарду пользователей на процесс; отдает (строки, столбцы, оценки)"""
+    tasks = [(shard, processes, n) for shard in range(processes)]
+    if processes == 1:
+        _init_worker(matrix, similarity)
+        yield from map(_recommend_shard, tasks)
+        return
+    context = multiprocessing.get_context()
+    with context.Pool(processes, initializer=_init_worker, initargs=(matrix, similarity)) as pool:
+        yield from pool.imap_unordered(_recommend_shard, tasks)
+
+
+def load_interactions():
+    """Отметки из базы: id пользователей и фильмов строк и столбцов и матрица весов"""
+    flags = list(FLAG_WEIGHTS)
+    rows = MovieInteraction.marked().values_list('user_id', 'movie_id', *flags)
+    data = np.fromiter(chain.from_iterable(rows.iterator(chunk_size=10000)), dtype=np.float64)
+    data = data.reshape(-1, 2 + len(flags))
+    user_ids, user_rows = np.unique(data[:, 0].astype(np.int64), return_inverse=True)
+    movie_ids, movie_columns = np.unique(data[:, 1].astype(np.int64), return_inverse=True)
+    weights = data[:, 2:].dot(np.array([FLAG_WEIGHTS[flag] for flag in flags]))
+    matrix = interaction_matrix(user_rows, movie_columns, weights, (len(user_ids), len(movie_ids)))
+    return user_ids, movie_ids, matrix
+
+
+def _write(user_ids, movie_ids, rows, found, values):
+    """Заменяет рекомендации пользователей строк rows; пишет пачками по WRITE_BATCH_USERS пользователей"""
+    for start in range(0, len(rows), WRITE_BATCH_USERS):
+        batch = slice(start, start + WRITE_BATCH_USERS)
+        batch_users = [int(user_id) for user_id in user_ids[rows[batch]]]
+        with transaction.atomic():
+            Recommendation.objects.filter(user_id__in=batch_users).delete()
+            Recommendation.objects.bulk_create([
+                Recommendation(user_id=user_id, movie_id=int(movie_ids[column]), rank=rank, score=float(score))
+                for user_id, user_found, user_values in zip(batch_users, found[batch], values[batch])
+                for rank, (column, score) in enumerate(
+                    ((column, score) for column, score in zip(user_found, user_values) if score > 0), start=1)
+            ], batch_size=1000)
+
+
+def build(processes=1, n=None):
+    """Пересчитывает рекомендации всех пользователей; возвращает (число пользователей, секунды)"""
+    started = time.monotonic()
+    n = n or _per_user()
+    user_ids, movie_ids, matrix = load_interactions()
+    similarity = item_similarity(matrix)
+    if processes > 1:
+        # Дочерние процессы не должны наследовать открытые соединения с базой
+        connections.close_all()
+    for rows, found, values in recommend_all(matrix, similarity, n, processes):
+        _write(user_ids, movie_ids, rows, found, values)
+    # Пользователи, снявшие все отметки, остаются без рекомендаций
+    Recommendation.objects.exclude(user_id__in=MovieInteraction.marked().values('user_id')).delete()
+    return len(user_ids), time.monotonic() - started
+
+
+def synthetic_interactions(users, movies, interactions, clusters=50, seed=0):
+    """
+    Синтетические отметки для оценки качества: у каждого пользователя один вкус (группа фильмов), 80% его
+    отметок - фильмы своей группы, остальные - популярные фильмы каталога. Возвращает массивы строк,
+    столбцов и весов без повторов пар.
+    """
+    rng = np.random.default_rng(seed)
+    user_cluster = rng.integers(clusters, size=users)
+    movie_cluster = rng.integers(clusters, size=movies)
+    by_cluster = np.argsort(movie_cluster, kind='stable')
+    bounds = np.searchsorted(movie_cluster[by_cluster], np.arange(clusters + 1))
+
+    keys = np.empty(0, dtype=np.int64)
+    while len(keys) < interactions:
+        count = interactions - len(keys)
+        user = rng.integers(users, size=count)
+        cluster = user_cluster[user]
+        size = bounds[cluster + 1] - bounds[cluster]
+        # Квадрат и куб равномерной величины дают фильмам в начале группы и каталога больше отметок
+        in_taste = by_cluster[np.minimum(bounds[cluster] + (size * rng.random(count) ** 2).astype(np.int64),
+                                         movies - 1)]
+        popular = (movies * rng.random(count) ** 3).astype(np.int64)
+        movie = np.where((rng.random(count) < 0.8) & (size > 0), in_taste, popular)
+        keys = np.unique(np.concatenate([keys, user.astype(np.int64) * movies + movie]))
+    keys = rng.permutation(keys)[:interactions]
+    weights = [FLAG_WEIGHTS['is_watched'], FLAG_WEIGHTS['is_planned'], FLAG_WEIGHTS['is_favorite']]
+    return keys // movies, keys % movies, rng.choice(weights, size=len(keys), p=[0.6, 0.25, 0.15])
+
+
+def _popular_baseline(matrix, user_rows, k):
+    """Самые популярные неотмеченные фильмы - точка отсчета для precision@k"""
+    popularity = np.asarray((matrix > 0).sum(axis=0), dtype=np.float32).ravel()
+    found = []
+    for start in range(0, len(user_rows), _block_rows(matrix.shape[1])):
+        block = matrix[user_rows[start:start + _block_rows(matrix.shape[1])]]
+        scores = np.tile(popularity, (block.shape[0], 1))
+        scores[block.nonzero()] = 0
+        found.append(top_n(scores, k)[0])
+    return np.concatenate(found) if found else np.empty((0, k), dtype=np.int64)
+
+
+def _hits(test, rows, found):
+    return np.asarray(test[np.repeat(rows, found.shape[1]), found.ravel()]).reshape(found.shape) > 0
+
+
+def evaluate(users=50_000, movies=10_000, interactions=1_000_000, k=10, holdout=0.2, processes=1, seed=0):
+    """
+    Офлайн-оценка на синтетических данных: случайная доля holdout отметок скрывается, модель строится по
+    остальным, precision@k - доля скрытых фильмов среди k рекомендаций (по пользователям со скрытыми
+    отметками). Для сравнения считается precision@k рекомендаций самых популярных фильмов.
+    """
+    user, movie, weight = synthetic_interactions(users, movies, interactions, seed=seed)
+    hidden = np.random.default_rng(seed + 1).random(len(user)) < holdout
+    train = interaction_matrix(user[~hidden], movie[~hidden], weight[~hidden], (users, movies))
+    test = sparse.csr_matrix((np.ones(hidden.sum(), dtype=np.int8), (user[hidden], movie[hidden])),
+                             shape=(users, movies))
+    evaluated = np.diff(test.indptr) > 0
+
+    started = time.monotonic()
+    similarity = item_similarity(train)
+    fitted = time.monotonic()
+    hits = np.zeros(users)
+    for rows, found, values in recommend_all(train, similarity, k, processes):
+        hits[rows] = (_hits(test, rows, found) & (values > 0)).sum(axis=1)
+    finished = time.monotonic()
+
+    all_rows = np.flatnonzero(evaluated)
+    baseline = _hits(test, all_rows, _popular_baseline(train, all_rows, k)).sum(axis=1)
+    return {
+        'interactions': len(user),
+        'users': users,
+        'movies': movies,
+        'k': k,
+        'precision': float(hits[evaluated].sum() / (k * evaluated.sum())) if evaluated.any() else 0.0,
+        'baseline_precision': float(baseline.sum() / (k * len(all_rows))) if len(all_rows) else 0.0,
+        'fit_seconds': fitted - started,
+        'recommend_seconds': finished - fitted,
+    }
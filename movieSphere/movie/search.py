@@ -0,0 +1,358 @@
+"""Полнотекстовый поиск по фильмам.
+
+Индекс хранится в отдельной таблице ``movie_search``: на SQLite это виртуальная таблица FTS5, на
+PostgreSQL - tsvector с GIN-индексом. Оба варианта ранжируют по BM25 с весом заголовка и скрыты за
+``get_search_backend()``, а ``search_movies()`` накладывает результат поиска на любой queryset фильмов,
+поэтому фильтры по жанрам, годам и категориям продолжают работать. К найденному добавляются фильмы, название
+которых совпало с запросом с опечатками или записано другим алфавитом (``movie.fuzzy``).
+
+Таблицу создает миграция ``0034_search_index`` (на PostgreSQL она же заполняет индекс, пустой индекс SQLite
+заполняется после ``migrate``); ``manage.py rebuild_search_index`` перестраивает индекс целиком.
+"""
+import math
+import re
+from itertools import islice
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Case, When, Value, IntegerField, Q
+
+from . import fuzzy
+
+SEARCH_TABLE = 'movie_search'
+TITLE_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 1.0
+# Параметры BM25 - те же, что у bm25() в FTS5
+BM25_K1 = 1.2
+BM25_B = 0.75
+# PostgreSQL: сколько совпадений, предварительно упорядоченных ts_rank_cd, пересчитывается по BM25
+BM25_CANDIDATES = 2000
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+_CYRILLIC_RE = re.compile(r'[а-я]')
+_LEXEME_RE = re.compile(r"'((?:[^']|'')*)'(?::([0-9A-D,]+))?")
+
+
+# Стеммер Snowball для русского языка
+
+_VOWELS = 'аеиоуыэюя'
+
+_PERFECTIVE_GERUND = (('в', 'вши', 'вшись'), ('ив', 'ивши', 'ившись', 'ыв', 'ывши', 'ывшись'))
+_ADJECTIVE = ('ее', 'ие', 'ые', 'ое', 'ими', 'ыми', 'ей', 'ий', 'ый', 'ой', 'ем', 'им', 'ым', 'ом', 'его', 'ого',
+              'ему', 'ому', 'их', 'ых', 'ую', 'юю', 'ая', 'яя', 'ою', 'ею')
+_PARTICIPLE = (('ем', 'нн', 'вш', 'ющ', 'щ'), ('ивш', 'ывш', 'ующ'))
+_REFLEXIVE = ('ся', 'сь')
+_VERB = (('ла', 'на', 'ете', 'йте', 'ли', 'й', 'л', 'ем', 'н', 'ло', 'но', 'ет', 'ют', 'ны', 'ть', 'ешь', 'нно'),
+         ('ила', 'ыла', 'ена', 'ейте', 'уйте', 'ите', 'или', 'ыли', 'ей', 'уй', 'ил', 'ыл', 'им', 'ым', 'ен', 'ило',
+          'ыло', 'ено', 'ят', 'ует', 'уют', 'ит', 'ыт', 'ены', 'ить', 'ыть', 'ишь', 'ую', 'ю'))
+_NOUN = ('а', 'ев', 'ов', 'ие', 'ье', 'е', 'иями', 'ями', 'ами', 'еи', 'ии', 'и', 'ией', 'ей', 'ой', 'ий', 'й',
+         'иям', 'ям', 'ием', 'ем', 'ам', 'ом', 'о', 'у', 'ах', 'иях', 'ях', 'ы', 'ь', 'ию', 'ью', 'ю', 'ия', 'ья', 'я')
+_SUPERLATIVE = ('ейше', 'ейш')
+_DERIVATIONAL = ('ость', 'ост')
+
+
+def _region_after_vowel_pair(word, start):
+    for i in range(start + 1, len(word)):
+        if word[i] not in _VOWELS and word[i - 1] in _VOWELS:
+            return i + 1
+    return len(word)
+
+
+def _strip(word, limit, endings, preceded_by=''):
+    """Отрезает самое длинное окончание, не выходящее за границу limit"""
+    for ending in sorted(endings, key=len, reverse=True):
+        cut = len(word) - len(ending)
+        if not word.endswith(ending) or cut < limit:
+            continue
+        if preceded_by and (cut - 1 < limit or word[cut - 1] not in preceded_by):
+            continue
+        return word[:cut]
+    return None
+
+
+def _strip_grouped(word, limit, groups):
+    return _strip(word, limit, groups[0], preceded_by='ая') or _strip(word, limit, groups[1])
+
+
+def russian_stem(word):
+    word = word.lower().replace('ё', 'е')
+    rv = next((i + 1 for i, char in enumerate(word) if char in _VOWELS), len(word))
+    r2 = _region_after_vowel_pair(word, _region_after_vowel_pair(word, 0))
+
+    # Шаг 1
+    stripped = _strip_grouped(word, rv, _PERFECTIVE_GERUND)
+    if stripped is not None:
+        word = stripped
+    else:
+        word = _strip(word, rv, _REFLEXIVE) or word
+        stripped = _strip(word, rv, _ADJECTIVE)
+        if stripped is not None:
+            word = _strip_grouped(stripped, rv, _PARTICIPLE) or stripped
+        else:
+            stripped = _strip_grouped(word, rv, _VERB)
+            if stripped is None:
+                stripped = _strip(word, rv, _NOUN)
+            word = stripped if stripped is not None else word
+
+    # Шаг 2
+    if word.endswith('и') and len(word) - 1 >= rv:
+        word = word[:-1]
+
+    # Шаг 3
+    word = _strip(word, r2, _DERIVATIONAL) or word
+
+    # Шаг 4
+    if word.endswith('нн') and len(word) - 2 >= rv:
+        word = word[:-1]
+    else:
+        stripped = _strip(word, rv, _SUPERLATIVE)
+        if stripped is not None:
+            word = stripped[:-1] if stripped.endswith('нн') else stripped
+        elif word.endswith('ь') and len(word) - 1 >= rv:
+            word = word[:-1]
+    return word
+
+
+def tokenize(text):
+    """Слова текста в нижнем регистре; русские слова приводятся к основе"""
+    tokens = []
+    for word in _WORD_RE.findall((text or '').lower().replace('ё', 'е')):
+        tokens.append(russian_stem(word) if _CYRILLIC_RE.search(word) else word)
+    return tokens
+
+
+def bm25_scores(documents, document_frequencies, total, average_lengths, weights):
+    """
+    BM25 с весами полей, как bm25() в FTS5: сумма по полям вес * сумма по словам запроса
+    idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * длина поля / средняя длина поля)).
+
+    documents - {id: (частоты слов по полям [{слово: tf}, ...], длины полей [...])},
+    document_frequencies - {слово: число документов со словом}, total - документов в индексе.
+    Возвращает {id: оценка}, больше - лучше.
+    """
+    # Как в FTS5: у слова, которое есть больше чем в половине документов, idf не становится отрицательным
+    idf = {word: max(math.log((total - count + 0.5) / (count + 0.5)), 1e-6)
+           for word, count in document_frequencies.items()}
+    scores = {}
+    for document_id, (frequencies, lengths) in documents.items():
+        score = 0.0
+        for weight, field, length, average in zip(weights, frequencies, lengths, average_lengths):
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average) if average else BM25_K1
+            score += weight * sum(idf[word] * tf * (BM25_K1 + 1) / (tf + norm)
+                                  for word, tf in field.items() if word in idf)
+        scores[document_id] = score
+    return scores
+
+
+def order_by_ids(queryset, ids):
+    """Оставляет в queryset объекты ids в их порядке (аннотация search_rank)"""
+    if not ids:
+        return queryset.none()
+    return queryset.filter(pk__in=ids).annotate(
+        search_rank=Case(*[When(pk=pk, then=Value(position)) for position, pk in enumerate(ids)],
+                         output_field=IntegerField())
+    ).order_by('search_rank')
+
+
+class SearchBackend:
+    """Поиск подстрокой без индекса - для баз, у которых нет своего полнотекстового поиска"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def install(self):
+        pass
+
+    def drop(self):
+        pass
+
+    def index(self, movies):
+        pass
+
+    def remove(self, movie_ids):
+        pass
+
+    def clear(self):
+        pass
+
+    def is_empty(self):
+        return False
+
+    def ranked_ids(self, query, limit):
+        return None
+
+    def rebuild(self, movies, batch_size=1000):
+        """Создает индекс, если его нет, и заполняет заново; movies - queryset фильмов. Возвращает их число"""
+        self.install()
+        self.clear()
+        movies = movies.only('id', 'title', 'description').iterator(chunk_size=batch_size)
+        indexed = 0
+        while batch := list(islice(movies, batch_size)):
+            self.index(batch)
+            indexed += len(batch)
+        return indexed
+
+    def search(self, queryset, query, limit=None):
+        """Оставляет в queryset найденные фильмы и сортирует их по релевантности, совпавшие с опечатками - в конце"""
+        limit = limit or getattr(settings, 'SEARCH_MAX_RESULTS', 500)
+        ids = self.ranked_ids(query, limit)
+        similar = fuzzy.search(fuzzy.MOVIE, query, limit)
+        if ids is None:
+            return queryset.filter(Q(title__icontains=query) | Q(description__icontains=query) | Q(pk__in=similar))
+        return order_by_ids(queryset, list(dict.fromkeys(ids + similar)))
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """FTS5 по заранее приведённым к основе словам, ранжирование BM25 с весом заголовка"""
+
+    def install(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} "
+                f"USING fts5(title, description, tokenize='unicode61 remove_diacritics 2')"
+            )
+
+    def drop(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+
+    def index(self, movies):
+        rows = [(movie.pk, ' '.join(tokenize(movie.title)), ' '.join(tokenize(movie.description)))
+                for movie in movies]
+        with self.connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [(row[0],) for row in rows])
+            cursor.executemany(
+                f"INSERT INTO {SEARCH_TABLE} (rowid, title, description) VALUES (%s, %s, %s)", rows
+            )
+
+    def remove(self, movie_ids):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [(pk,) for pk in movie_ids])
+
+    def clear(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE}")
+
+    def is_empty(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"SELECT 1 FROM {SEARCH_TABLE} LIMIT 1")
+            return cursor.fetchone() is None
+
+    def ranked_ids(self, query, limit):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        # Каждое слово ищется как префикс, чтобы поиск работал по мере набора
+        match = ' AND '.join(f'"{token}"*' for token in tokens)
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s "
+                f"ORDER BY bm25({SEARCH_TABLE}, %s, %s) LIMIT %s",
+                [match, TITLE_WEIGHT, DESCRIPTION_WEIGHT, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class PostgreSQLSearchBackend(SearchBackend):
+    """
+    tsvector с конфигурацией russian и GIN-индексом; заголовок имеет вес A, описание - B. Встроенного BM25 в
+    PostgreSQL нет: индекс отбирает совпадения, а оценка считается ``bm25_scores`` по позициям слов из tsvector,
+    длинам полей и числу документов с каждым словом.
+    """
+
+    def install(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} ("
+                f"movie_id bigint PRIMARY KEY REFERENCES movie_movie (id) ON DELETE CASCADE, "
+                f"document tsvector NOT NULL, "
+                f"title_length integer NOT NULL DEFAULT 0, "
+                f"description_length integer NOT NULL DEFAULT 0)"
+            )
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS {SEARCH_TABLE}_document_idx ON {SEARCH_TABLE} USING GIN (document)"
+            )
+
+    def drop(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+
+    def index(self, movies):
+        rows = [(movie.pk, movie.title, movie.description or '', len(_WORD_RE.findall(movie.title)),
+                 len(_WORD_RE.findall(movie.description or ''))) for movie in movies]
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {SEARCH_TABLE} (movie_id, document, title_length, description_length) VALUES (%s, "
+                f"setweight(to_tsvector('russian', %s), 'A') || setweight(to_tsvector('russian', %s), 'B'), "
+                f"%s, %s) "
+                f"ON CONFLICT (movie_id) DO UPDATE SET document = EXCLUDED.document, "
+                f"title_length = EXCLUDED.title_length, description_length = EXCLUDED.description_length",
+                rows,
+            )
+
+    def remove(self, movie_ids):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE movie_id = ANY(%s)", [list(movie_ids)])
+
+    def clear(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"TRUNCATE {SEARCH_TABLE}")
+
+    def ranked_ids(self, query, limit):
+        words = _WORD_RE.findall(query.lower())
+        if not words:
+            return []
+        with self.connection.cursor() as cursor:
+            # Основы слов запроса в том виде, в каком они лежат в tsvector; стоп-слова выпадают
+            cursor.execute("SELECT to_tsquery('russian', %s)::text", [' & '.join(f"{word}:*" for word in words)])
+            terms = list(dict.fromkeys(lexeme.replace("''", "'") for lexeme, _ in
+                                       _LEXEME_RE.findall(cursor.fetchone()[0])))
+            if not terms:
+                return []
+            term_queries = ["'{}':*".format(term.replace("'", "''")) for term in terms]
+            cursor.execute(
+                f"SELECT count(*), coalesce(avg(title_length), 0), coalesce(avg(description_length), 0), "
+                + ', '.join(f"count(*) FILTER (WHERE document @@ %s::tsquery)" for _ in terms)
+                + f" FROM {SEARCH_TABLE}",
+                term_queries,
+            )
+            total, average_title, average_description, *frequencies = cursor.fetchone()
+            cursor.execute(
+                f"SELECT movie_id, document::text, title_length, description_length FROM {SEARCH_TABLE}, "
+                f"CAST(%s AS tsquery) query WHERE document @@ query "
+                f"ORDER BY ts_rank_cd(document, query) DESC LIMIT %s",
+                [' & '.join(term_queries), max(limit, BM25_CANDIDATES)],
+            )
+            documents = {movie_id: (self._frequencies(document, terms), (title_length, description_length))
+                         for movie_id, document, title_length, description_length in cursor.fetchall()}
+        scores = bm25_scores(documents, dict(zip(terms, frequencies)), total,
+                             (float(average_title), float(average_description)), (TITLE_WEIGHT, DESCRIPTION_WEIGHT))
+        return sorted(scores, key=lambda movie_id: (-scores[movie_id], movie_id))[:limit]
+
+    @staticmethod
+    def _frequencies(document, terms):
+        """Частоты слов запроса (как префиксов) в заголовке (вес A) и описании (вес B) по тексту tsvector"""
+        title, description = {}, {}
+        for lexeme, positions in _LEXEME_RE.findall(document):
+            lexeme = lexeme.replace("''", "'")
+            weights = [position[-1] if position[-1] in 'ABCD' else 'D' for position in positions.split(',') if position]
+            for term in terms:
+                if lexeme.startswith(term):
+                    title[term] = title.get(term, 0) + weights.count('A')
+                    description[term] = description.get(term, 0) + weights.count('B')
+        return title, description
+
+
+_BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgreSQLSearchBackend,
+}
+
+
+def get_search_backend(using=DEFAULT_DB_ALIAS):
+    connection = connections[using]
+    return _BACKENDS.get(connection.vendor, SearchBackend)(connection)
+
+
+def search_movies(queryset, query):
+    return get_search_backend().search(queryset, query)
@@ -0,0 +1,151 @@
+"""Индекс в памяти процесса, который процессы держат согласованным через кеш.
+
+Индексы подсказок (``movie.typeahead``) и нечеткого поиска (``movie.fuzzy``) строятся из базы в памяти каждого
+процесса при первом обращении. Изменение одной записи (сохранение или удаление фильма, персоны) индекс не
+перестраивает: процесс, получивший сигнал, применяет изменение к своему индексу и кладет его в журнал в кеше под
+очередным номером счетчика, а остальные процессы при следующем обращении дочитывают журнал со своего номера и
+применяют те же изменения. Изменения применяются идемпотентно (запись заменяется или удаляется целиком), поэтому
+повторное применение не портит индекс.
+
+Индекс перестраивается целиком в фоне (до конца перестройки отвечает прежний), только если журнал не дочитать -
+изменения вытеснены из кеша или процесс отстал больше чем на ``MAX_REPLAY`` - либо после ``invalidate()``:
+массовые изменения мимо сигналов (импорт) начинают новое поколение журнала.
+
+Ключи кеша: ``<key>`` - поколение, ``<key>:<поколение>`` - счетчик изменений, ``<key>:<поколение>:<номер>`` -
+изменение.
+"""
+import logging
+import threading
+import uuid
+
+from django.core.cache import cache
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+MAX_REPLAY = 1000
+CHANGE_TIMEOUT = 24 * 60 * 60
+
+
+class _Loaded:
+    """Построенный индекс, его поколение и номер последнего примененного изменения"""
+
+    def __init__(self, generation, applied, index):
+        self.generation = generation
+        self.applied = applied
+        self.index = index
+        self.lock = threading.Lock()
+
+
+class SharedIndex:
+    """
+    load() строит индекс из базы, apply(index, change) применяет к нему одно изменение; change - кортеж, который
+    кладется в кеш. description называет индекс в журнале ошибок.
+    """
+
+    def __init__(self, key, load, apply, description):
+        self.key = key
+        self.load = load
+        self.apply = apply
+        self.description = description
+        self._loaded = None
+        self._build_lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+
+    def get(self):
+        """Индекс процесса; строится при первом обращении, чужие изменения дочитываются из журнала"""
+        generation, counter = self._position()
+        loaded = self._loaded
+        if loaded is None:
+            with self._build_lock:
+                if self._loaded is None:
+                    self._loaded = _Loaded(generation, counter, self.load())
+            return self._loaded.index
+        if loaded.generation != generation or not self._replay(loaded, counter):
+            self._start_rebuild()
+        return loaded.index
+
+    def changed(self, change):
+        """Применяет изменение к индексу процесса и записывает его в журнал для остальных процессов"""
+        generation = cache.get(self.key)
+        try:
+            number = cache.incr(self._counter_key(generation)) if generation is not None else None
+        except ValueError:
+            number = None
+        if number is None:
+            # Журнала нет или счетчик вытеснен: остальные процессы все равно перестроятся целиком
+            self.invalidate()
+            return
+        cache.set(self._change_key(generation, number), change, CHANGE_TIMEOUT)
+        loaded = self._loaded
+        if loaded is not None and loaded.generation == generation:
+            with loaded.lock:
+                self.apply(loaded.index, change)
+                if loaded.applied == number - 1:
+                    loaded.applied = number
+
+    def invalidate(self):
+        """Новое поколение журнала: все процессы, включая текущий, перестраивают индекс"""
+        generation = uuid.uuid4().hex
+        cache.set(self._counter_key(generation), 0, None)
+        cache.set(self.key, generation, None)
+        return generation
+
+    def reset(self):
+        self._loaded = None
+
+    def warm_up(self):
+        """Строит индекс в фоне при старте процесса, чтобы его не ждал первый запрос"""
+        threading.Thread(target=self._warm_up, daemon=True).start()
+
+    def _warm_up(self):
+        try:
+            self.get()
+        except Exception:
+            logger.exception("Не удалось построить %s при старте", self.description)
+        finally:
+            connection.close()
+
+    def _counter_key(self, generation):
+        return f'{self.key}:{generation}'
+
+    def _change_key(self, generation, number):
+        return f'{self.key}:{generation}:{number}'
+
+    def _position(self):
+        """(поколение, счетчик изменений); если счетчик пропал из кеша, начинается новое поколение"""
+        generation = cache.get(self.key)
+        counter = cache.get(self._counter_key(generation)) if generation is not None else None
+        if counter is None:
+            return self.invalidate(), 0
+        return generation, counter
+
+    def _replay(self, loaded, counter):
+        """Дочитывает журнал до номера counter; False - журнал не дочитать и индекс нужно перестроить"""
+        with loaded.lock:
+            if loaded.applied >= counter:
+                return True
+            if counter - loaded.applied > MAX_REPLAY:
+                return False
+            keys = [self._change_key(loaded.generation, number) for number in range(loaded.applied + 1, counter + 1)]
+            changes = cache.get_many(keys)
+            if len(changes) < len(keys):
+                return False
+            for key in keys:
+                self.apply(loaded.index, changes[key])
+            loaded.applied = counter
+            return True
+
+    def _start_rebuild(self):
+        if self._rebuild_lock.acquire(blocking=False):
+            threading.Thread(target=self._rebuild, daemon=True).start()
+
+    def _rebuild(self):
+        try:
+            generation, counter = self._position()
+            self._loaded = _Loaded(generation, counter, self.load())
+        except Exception:
+            logger.exception("Не удалось перестроить %s", self.description)
+        finally:
+            self._rebuild_lock.release()
+            connection.close()
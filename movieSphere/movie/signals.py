@@ -0,0 +1,481 @@
+from functools import partial
+
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Q
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, post_migrate, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .facets import invalidate_catalog_facets
+from .images import image_kind, invalidate_variants
+from .interactions import invalidate_statuses
+from . import fuzzy, random_movie, typeahead
+from .fragments import invalidate_fragments
+from .models import Movie, Rating, RatingStar, PopularitySnapshot, Genre, Actor, Reviews, Profile, Episode, MediaSeekIndex, Season, \
+    MovieInteraction, RatingCount, SimilarMovie, SimilarMovieUpdate, Category, CatalogVersion, ImageVariantsUpdate
+from .search import get_search_backend
+
+
+def _star_value(star_id):
+    return RatingStar.objects.filter(pk=star_id).values_list('value', flat=True).first() or 0
+
+
+@receiver(pre_save, sender=Rating)
+def remember_previous_rating(sender, instance, **kwargs):
+    """Запоминаем прежнюю оценку, чтобы потом сдвинуть агрегаты фильма на разницу"""
+    instance._previous_rating = None
+    if instance.pk:
+        instance._previous_rating = Rating.objects.filter(pk=instance.pk).values_list(
+            'movie_id', 'star__value').first()
+
+
+@receiver(post_save, sender=Rating)
+def update_rating_aggregates_on_save(sender, instance, created, **kwargs):
+    value = _star_value(instance.star_id)
+    previous = None if created else getattr(instance, '_previous_rating', None)
+
+    PopularitySnapshot.mark_stale()
+    transaction.on_commit(partial(CatalogVersion.bump, 'movies'))
+    if previous is None:
+        Movie.apply_rating_delta(instance.movie_id, value, 1)
+        RatingCount.apply(instance.movie_id, {value: 1})
+        return
+
+    previous_movie_id, previous_value = previous
+    if previous_movie_id == instance.movie_id:
+        if value != previous_value:
+            Movie.apply_rating_delta(instance.movie_id, value - previous_value, 0)
+            RatingCount.apply(instance.movie_id, {previous_value: -1, value: 1})
+    else:
+        Movie.apply_rating_delta(previous_movie_id, -previous_value, -1)
+        Movie.apply_rating_delta(instance.movie_id, value, 1)
+        RatingCount.apply(previous_movie_id, {previous_value: -1})
+        RatingCount.apply(instance.movie_id, {value: 1})
+
+
+@receiver(pre_delete, sender=Rating)
+def remember_deleted_rating(sender, instance, **kwargs):
+    instance._deleted_value = _star_value(instance.star_id)
+
+
+@receiver(post_delete, sender=Rating)
+def update_rating_aggregates_on_delete(sender, instance, **kwargs):
+    Movie.apply_rating_delta(instance.movie_id, -getattr(instance, '_deleted_value', 0), -1)
+    RatingCount.apply(instance.movie_id, {getattr(instance, '_deleted_value', 0): -1})
+    PopularitySnapshot.mark_stale()
+    transaction.on_commit(partial(CatalogVersion.bump, 'movies'))
+
+
+@receiver(post_save, sender=Rating)
+@receiver(post_delete, sender=Rating)
+def refresh_actor_stats_on_rating(sender, instance, **kwargs):
+    # Лучшие фильмы персон зависят от среднего рейтинга фильма
+    previous = getattr(instance, '_previous_rating', None)
+    movie_ids = [instance.movie_id, previous[0] if previous else None]
+    transaction.on_commit(partial(Actor.refresh_stats_for_movies, movie_ids))
+
+
+def _role_relation(sender):
+    return 'actors' if sender is Movie.actors.through else 'directors'
+
+
+@receiver(m2m_changed, sender=Movie.actors.through)
+@receiver(m2m_changed, sender=Movie.directors.through)
+def refresh_actor_stats_on_roles(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and not reverse:
+        # После очистки связей персон уже не найти, запоминаем их заранее
+        instance._cleared_actor_ids = list(getattr(instance, _role_relation(sender)).values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        actor_ids = [instance.pk]
+    elif action == 'post_clear':
+        actor_ids = getattr(instance, '_cleared_actor_ids', [])
+    else:
+        actor_ids = pk_set or []
+    transaction.on_commit(partial(Actor.refresh_stats, actor_ids))
+
+
+@receiver(post_save, sender=Movie)
+def refresh_actor_stats_on_movie(sender, instance, created, raw=False, **kwargs):
+    # Год выхода фильма входит в годы карьеры; у нового фильма ролей еще нет
+    if not created and not raw:
+        transaction.on_commit(partial(Actor.refresh_stats_for_movies, [instance.pk]))
+
+
+@receiver(pre_delete, sender=Movie)
+def remember_movie_people(sender, instance, **kwargs):
+    instance._people_ids = set(instance.actors.values_list('pk', flat=True))
+    instance._people_ids.update(instance.directors.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Movie)
+def refresh_actor_stats_on_movie_delete(sender, instance, **kwargs):
+    transaction.on_commit(partial(Actor.refresh_stats, getattr(instance, '_people_ids', ())))
+
+
+@receiver(post_delete, sender=Movie)
+def mark_popularity_stale_on_movie_delete(sender, instance, **kwargs):
+    PopularitySnapshot.mark_stale()
+
+
+@receiver(post_migrate)
+def install_search_index(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    # Индекс создает миграция 0034; здесь - для баз, созданных без миграций (тестовые), и заполнение индекса
+    # SQLite после миграции: основы слов считаются кодом movie.search, который миграция не импортирует
+    if sender.name == 'movie':
+        backend = get_search_backend(using)
+        backend.install()
+        movies = Movie.objects.using(using)
+        if backend.is_empty() and movies.exists():
+            backend.rebuild(movies.all())
+
+
+@receiver(post_save, sender=Movie)
+def update_search_index(sender, instance, raw=False, **kwargs):
+    if not raw:
+        get_search_backend().index([instance])
+
+
+@receiver(post_delete, sender=Movie)
+def remove_from_search_index(sender, instance, **kwargs):
+    get_search_backend().remove([instance.pk])
+
+
+@receiver(post_save, sender=Movie)
+def update_typeahead_movie(sender, instance, raw=False, **kwargs):
+    if not raw:
+        # Значения берутся сразу: к моменту коммита объект могут изменить или удалить
+        transaction.on_commit(partial(
+            typeahead.movie_saved, instance.pk, instance.title, instance.url, instance.rating_count))
+
+
+@receiver(post_delete, sender=Movie)
+def remove_typeahead_movie(sender, instance, **kwargs):
+    transaction.on_commit(partial(typeahead.movie_deleted, instance.pk))
+
+
+@receiver(post_save, sender=Actor)
+def update_typeahead_person(sender, instance, raw=False, **kwargs):
+    if not raw:
+        transaction.on_commit(partial(typeahead.person_saved, instance.pk, instance.name, instance.movies_count))
+
+
+@receiver(post_delete, sender=Actor)
+def remove_typeahead_person(sender, instance, **kwargs):
+    transaction.on_commit(partial(typeahead.person_deleted, instance.pk))
+
+
+@receiver(post_save, sender=Movie)
+def update_fuzzy_movie(sender, instance, raw=False, **kwargs):
+    if not raw:
+        transaction.on_commit(partial(fuzzy.movie_saved, instance.pk, instance.title, instance.rating_count))
+
+
+@receiver(post_delete, sender=Movie)
+def remove_fuzzy_movie(sender, instance, **kwargs):
+    transaction.on_commit(partial(fuzzy.movie_deleted, instance.pk))
+
+
+@receiver(post_save, sender=Actor)
+def update_fuzzy_person(sender, instance, raw=False, **kwargs):
+    if not raw:
+        transaction.on_commit(partial(fuzzy.person_saved, instance.pk, instance.name, instance.movies_count))
+
+
+@receiver(post_delete, sender=Actor)
+def remove_fuzzy_person(sender, instance, **kwargs):
+    transaction.on_commit(partial(fuzzy.person_deleted, instance.pk))
+
+
+@receiver(post_save, sender=Movie)
+@receiver(post_delete, sender=Movie)
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+@receiver(m2m_changed, sender=Movie.genre.through)
+def reset_catalog_facets(sender, **kwargs):
+    invalidate_catalog_facets()
+
+
+# Раздел каталога API, версию которого сдвигает изменение модели или связи (см. movie.api)
+CATALOG_SECTIONS = {
+    Movie: 'movies', Category: 'movies', Movie.genre.through: 'movies', Movie.actors.through: 'movies',
+    Movie.directors.through: 'movies', Actor: 'actors', Actor.genres.through: 'actors', Genre: 'genres',
+    Season: 'seasons', Episode: 'seasons',
+}
+
+
+@receiver(post_save, sender=Movie)
+@receiver(post_delete, sender=Movie)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Actor)
+@receiver(post_delete, sender=Actor)
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+@receiver(post_save, sender=Season)
+@receiver(post_delete, sender=Season)
+@receiver(post_save, sender=Episode)
+@receiver(post_delete, sender=Episode)
+@receiver(m2m_changed, sender=Movie.genre.through)
+@receiver(m2m_changed, sender=Movie.actors.through)
+@receiver(m2m_changed, sender=Movie.directors.through)
+@receiver(m2m_changed, sender=Actor.genres.through)
+def bump_catalog_version(sender, **kwargs):
+    if kwargs.get('action', 'post_').startswith('post_'):
+        # После коммита: строка версии не блокируется на всю транзакцию изменения
+        transaction.on_commit(partial(CatalogVersion.bump, CATALOG_SECTIONS[sender]))
+
+
+@receiver(post_save, sender=Movie)
+@receiver(post_delete, sender=Movie)
+def reset_movie_fragments(sender, instance, **kwargs):
+    invalidate_fragments([instance.pk])
+
+
+@receiver(post_save, sender=Actor)
+@receiver(pre_delete, sender=Actor)
+def reset_actor_fragments(sender, instance, **kwargs):
+    movie_ids = Movie.objects.filter(Q(actors=instance) | Q(directors=instance)).values_list('pk', flat=True)
+    invalidate_fragments(movie_ids, ['people'])
+
+
+@receiver(post_save, sender=Genre)
+@receiver(pre_delete, sender=Genre)
+def reset_genre_fragments(sender, instance, **kwargs):
+    invalidate_fragments(instance.movie_set.values_list('pk', flat=True), ['card', 'genres'])
+
+
+def _changed_movie_ids(instance, action, reverse, pk_set, relation):
+    if not reverse:
+        return [instance.pk]
+    if action == 'pre_clear':
+        return list(getattr(instance, relation).values_list('pk', flat=True))
+    return pk_set or []
+
+
+@receiver(m2m_changed, sender=Movie.actors.through)
+@receiver(m2m_changed, sender=Movie.directors.through)
+def reset_people_fragments(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'pre_clear'):
+        relation = 'film_actor' if sender is Movie.actors.through else 'film_director'
+        invalidate_fragments(_changed_movie_ids(instance, action, reverse, pk_set, relation), ['people'])
+
+
+@receiver(m2m_changed, sender=Movie.genre.through)
+def reset_genre_relation_fragments(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'pre_clear'):
+        invalidate_fragments(_changed_movie_ids(instance, action, reverse, pk_set, 'movie_set'), ['card', 'genres'])
+
+
+def _relation_name(sender):
+    return {Movie.genre.through: 'movie_set', Movie.actors.through: 'film_actor'}.get(sender, 'film_director')
+
+
+@receiver(m2m_changed, sender=Movie.genre.through)
+@receiver(m2m_changed, sender=Movie.actors.through)
+@receiver(m2m_changed, sender=Movie.directors.through)
+def touch_movies_on_relations(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'pre_clear'):
+        Movie.touch(_changed_movie_ids(instance, action, reverse, pk_set, _relation_name(sender)))
+
+
+@receiver(post_save, sender=Actor)
+@receiver(pre_delete, sender=Actor)
+@receiver(post_save, sender=Genre)
+@receiver(pre_delete, sender=Genre)
+@receiver(post_save, sender=Category)
+@receiver(pre_delete, sender=Category)
+def touch_movies_on_related_object(sender, instance, raw=False, created=False, **kwargs):
+    # Имена людей, жанров и категорий входят в выгрузку фильма; у нового объекта фильмов еще нет
+    if raw or created:
+        return
+    if sender is Actor:
+        movies = Movie.objects.filter(Q(actors=instance) | Q(directors=instance))
+    else:
+        movies = instance.movie_set.all()
+    Movie.objects.filter(pk__in=movies.values('pk')).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Season)
+@receiver(post_delete, sender=Season)
+@receiver(post_save, sender=Episode)
+@receiver(post_delete, sender=Episode)
+def touch_movie_on_episodes(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    if sender is Season:
+        movie_id = instance.movie_id
+    else:
+        movie_id = Season.objects.filter(pk=instance.season_id).values_list('movie_id', flat=True).first()
+    Movie.touch([movie_id])
+
+
+@receiver(m2m_changed, sender=Movie.genre.through)
+@receiver(m2m_changed, sender=Movie.actors.through)
+@receiver(m2m_changed, sender=Movie.directors.through)
+def update_similar_movies_on_relations(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'pre_clear'):
+        SimilarMovieUpdate.mark(_changed_movie_ids(instance, action, reverse, pk_set, _relation_name(sender)))
+
+
+@receiver(pre_delete, sender=Actor)
+@receiver(pre_delete, sender=Genre)
+def update_similar_movies_on_feature_delete(sender, instance, **kwargs):
+    # Связи удаляются каскадом без m2m_changed
+    if sender is Genre:
+        movie_ids = set(instance.movie_set.values_list('pk', flat=True))
+    else:
+        movie_ids = set(instance.film_actor.values_list('pk', flat=True))
+        movie_ids.update(instance.film_director.values_list('pk', flat=True))
+    SimilarMovieUpdate.mark(movie_ids)
+
+
+@receiver(pre_delete, sender=Movie)
+def remember_similar_referrers(sender, instance, **kwargs):
+    instance._similar_referrer_ids = list(SimilarMovie.objects.filter(similar=instance).values_list('movie_id', flat=True))
+
+
+@receiver(post_delete, sender=Movie)
+def update_similar_movies_on_movie_delete(sender, instance, **kwargs):
+    # Фильмы, у которых удаленный фильм был соседом, добирают соседа до top-K
+    SimilarMovieUpdate.mark(getattr(instance, '_similar_referrer_ids', ()))
+
+
+@receiver(post_save, sender=Rating)
+@receiver(post_delete, sender=Rating)
+def reset_rating_fragments(sender, instance, **kwargs):
+    previous = getattr(instance, '_previous_rating', None)
+    invalidate_fragments([instance.movie_id, previous[0] if previous else None], ['card'])
+
+
+@receiver(post_save, sender=Reviews)
+@receiver(post_delete, sender=Reviews)
+def reset_review_fragments(sender, instance, **kwargs):
+    invalidate_fragments([instance.movie_id], ['reviews'])
+
+
+@receiver(post_delete, sender=Reviews)
+def reroot_orphaned_replies(sender, instance, origin=None, **kwargs):
+    """Ответы удаленного отзыва (parent уже обнулен) становятся началами своих веток"""
+    if not instance.path or isinstance(origin, Movie):
+        return
+    children = Reviews.objects.filter(
+        movie_id=instance.movie_id, path__startswith=instance.path, depth=instance.depth + 1,
+    ).values_list('pk', 'path')
+    for pk, path in children:
+        Reviews.move_subtree(instance.movie_id, path, Reviews.path_segment(pk), pk)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Profile)
+def reset_author_fragments(sender, instance, **kwargs):
+    user_id = instance.pk if sender is User else instance.user_id
+    movie_ids = Reviews.objects.filter(user_id=user_id).values_list('movie_id', flat=True).distinct()
+    invalidate_fragments(movie_ids, ['reviews'])
+
+
+VIDEO_FIELDS = {Movie: ('trailer', 'movie_file'), Episode: ('video',)}
+IMAGE_FILE_FIELDS = {Movie: ('poster', 'preview_poster'), Actor: ('image',), Genre: ('image',), Profile: ('photo',)}
+
+
+def _file_names(instance, fields):
+    return {name: getattr(instance, name).name for name in fields.get(type(instance), ())}
+
+
+def _changed_files(instance, fields):
+    previous = getattr(instance, '_previous_files', {})
+    return [getattr(instance, field) for field, name in _file_names(instance, fields).items()
+            if name and name != previous.get(field)]
+
+
+@receiver(pre_save, sender=Movie)
+@receiver(pre_save, sender=Episode)
+@receiver(pre_save, sender=Actor)
+@receiver(pre_save, sender=Genre)
+@receiver(pre_save, sender=Profile)
+def remember_previous_files(sender, instance, **kwargs):
+    """Запоминаем прежние файлы, чтобы после сохранения обработать только новые загрузки"""
+    instance._previous_files = {}
+    if instance.pk:
+        fields = VIDEO_FIELDS.get(sender, ()) + IMAGE_FILE_FIELDS.get(sender, ())
+        instance._previous_files = sender.objects.filter(pk=instance.pk).values(*fields).first() or {}
+
+
+@receiver(post_save, sender=Movie)
+@receiver(post_save, sender=Episode)
+def prepare_uploaded_videos(sender, instance, raw=False, **kwargs):
+    """Новые видео отмечаются для prepare_media --pending: перенос moov и индекс строятся вне запроса"""
+    if not raw:
+        MediaSeekIndex.mark_pending(field_file.name for field_file in _changed_files(instance, VIDEO_FIELDS))
+
+
+@receiver(post_delete, sender=Movie)
+@receiver(post_delete, sender=Episode)
+def remove_seek_indexes(sender, instance, **kwargs):
+    names = [name for name in _file_names(instance, VIDEO_FIELDS).values() if name]
+    MediaSeekIndex.objects.filter(file__in=names).delete()
+
+
+@receiver(post_save, sender=Movie)
+@receiver(post_save, sender=Actor)
+@receiver(post_save, sender=Genre)
+@receiver(post_save, sender=Profile)
+def mark_image_variants(sender, instance, raw=False, **kwargs):
+    """Новые изображения отмечаются для build_image_variants --pending: копии строятся вне запроса"""
+    if raw:
+        return
+    changed = _changed_files(instance, IMAGE_FILE_FIELDS)
+    ImageVariantsUpdate.mark((field_file.name, image_kind(instance, field_file.field.name)) for field_file in changed)
+    # Новая картинка под прежним именем: до построения копий отдается оригинал, а не старые копии
+    for field_file in changed:
+        transaction.on_commit(partial(invalidate_variants, field_file.name))
+
+
+def reset_image_fragments(instance):
+    """Кешированные фрагменты с картинками объекта были собраны до появления вариантов"""
+    if isinstance(instance, Movie):
+        invalidate_fragments([instance.pk])
+        random_movie.invalidate_payloads([instance.pk])
+    elif isinstance(instance, Actor):
+        reset_actor_fragments(Actor, instance)
+    elif isinstance(instance, Genre):
+        reset_genre_fragments(Genre, instance)
+    else:
+        reset_author_fragments(Profile, instance)
+
+
+@receiver(post_save, sender=PopularitySnapshot)
+def reset_random_movie_candidates(sender, **kwargs):
+    # Места в рейтинге пишутся в той же транзакции после создания снимка
+    transaction.on_commit(random_movie.invalidate_candidates)
+
+
+@receiver(post_save, sender=Movie)
+@receiver(post_delete, sender=Movie)
+def reset_random_movie_payload(sender, instance, **kwargs):
+    random_movie.invalidate_payloads([instance.pk])
+    if kwargs.get('signal') is post_delete:
+        random_movie.invalidate_candidates()
+
+
+@receiver(post_save, sender=Season)
+@receiver(post_delete, sender=Season)
+def reset_random_movie_payload_on_season(sender, instance, **kwargs):
+    random_movie.invalidate_payloads([instance.movie_id])
+
+
+@receiver(post_save, sender=Episode)
+@receiver(post_delete, sender=Episode)
+def reset_random_movie_payload_on_episode(sender, instance, **kwargs):
+    movie_id = Season.objects.filter(pk=instance.season_id).values_list('movie_id', flat=True).first()
+    random_movie.invalidate_payloads([movie_id])
+
+
+@receiver(post_save, sender=MovieInteraction)
+@receiver(post_delete, sender=MovieInteraction)
+def reset_interaction_statuses(sender, instance, **kwargs):
+    # Переключения из views пишут мимо ORM и сбрасывают кеш сами; здесь - правки через админку и удаления
+    invalidate_statuses(instance.user_id)
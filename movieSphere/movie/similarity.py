@@ -0,0 +1,246 @@
+"""Похожие фильмы по общим жанрам, актерам и режиссерам.
+
+Каждый фильм - строка разреженной матрицы "фильм x признак"; признаки - жанры, актеры и режиссеры (актер и
+режиссер - разные признаки одной персоны). Вес признака - вес его группы из ``SIMILAR_MOVIES_WEIGHTS``,
+умноженный на idf, поэтому общий режиссер значит больше общего жанра "драма". Строки нормированы, и
+произведение двух строк - взвешенная косинусная близость фильмов.
+
+Соседи считаются блоками по ``block_size`` фильмов: блок строк умножается на транспонированную матрицу, из
+каждой строки остаются ``SIMILAR_MOVIES_TOP_K`` лучших, и блок сразу записывается в ``SimilarMovie``. Память
+ограничена матрицей признаков и произведением одного блока, а не квадратом числа фильмов.
+
+``update_movies`` пересчитывает соседей после изменения связей отдельных фильмов: самих фильмов, фильмов,
+у которых они были в соседях, и фильмов, в чей top-K они теперь попадают. Матрица для этого строится не по
+всему каталогу, а по фильмам, у которых есть общий признак с пересчитываемыми (idf - по всему каталогу).
+Близость остальных фильмов не пересчитывается, хотя idf признаков немного сдвигается; ``manage.py
+build_similar_movies`` по расписанию пересчитывает всё.
+
+Сигналы не пересчитывают соседей в запросе: они отмечают измененные фильмы (``SimilarMovieUpdate``), а
+``update_pending`` (``build_similar_movies --pending``) пересчитывает все отметки разом.
+"""
+from functools import reduce
+from itertools import chain
+from operator import or_
+
+import numpy as np
+from scipy import sparse
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef
+from django.utils import timezone
+
+from .models import Movie, SimilarMovie, SimilarMovieUpdate
+
+DEFAULT_WEIGHTS = {'genre': 1.0, 'actors': 2.0, 'directors': 3.0}
+BLOCK_SIZE = 500
+# Сколько id передавать в одном IN (...): SQLite ограничивает число параметров запроса
+QUERY_CHUNK = 500
+
+
+def _top_k():
+    return getattr(settings, 'SIMILAR_MOVIES_TOP_K', 12)
+
+
+def _weights():
+    return getattr(settings, 'SIMILAR_MOVIES_WEIGHTS', DEFAULT_WEIGHTS)
+
+
+def _chunks(values, size=QUERY_CHUNK):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _relation_columns(relation):
+    """Модель связи Movie.<relation> и имена ее полей фильма и признака"""
+    field = getattr(Movie, relation).field
+    return field.remote_field.through, field.m2m_field_name(), field.m2m_reverse_field_name()
+
+
+def _relation_pairs(relation, movie_ids=None, feature_ids=None):
+    """
+    Массив пар (id фильма, id признака) связи Movie.<relation> без создания объектов моделей; movie_ids или
+    feature_ids ограничивают выборку этими фильмами или признаками
+    """
+    through, movie_column, feature_column = _relation_columns(relation)
+    rows = through.objects.values_list(movie_column, feature_column)
+    if movie_ids is not None:
+        querysets = [rows.filter(**{f'{movie_column}__in': chunk}) for chunk in _chunks(sorted(movie_ids))]
+    elif feature_ids is not None:
+        querysets = [rows.filter(**{f'{feature_column}__in': chunk}) for chunk in _chunks(sorted(feature_ids))]
+    else:
+        querysets = [rows]
+    values = chain.from_iterable(chain.from_iterable(
+        queryset.iterator(chunk_size=10000) for queryset in querysets))
+    return np.fromiter(values, dtype=np.int64).reshape(-1, 2)
+
+
+def _document_frequencies(relation, features):
+    """Сколько фильмов каталога у каждого признака features (отсортированный массив id)"""
+    through, _, feature_column = _relation_columns(relation)
+    counts = {}
+    for chunk in _chunks(features.tolist()):
+        counts.update(through.objects.filter(**{f'{feature_column}__in': chunk}).order_by()
+                      .values_list(feature_column).annotate(count=Count('pk')))
+    return np.array([counts.get(int(feature), 0) for feature in features], dtype=np.int64)
+
+
+def _movies_with_features(relations):
+    """Число фильмов каталога, у которых есть хотя бы один признак, - строк полной матрицы"""
+    exists = []
+    for relation in relations:
+        through, movie_column, _ = _relation_columns(relation)
+        exists.append(Exists(through.objects.filter(**{movie_column: OuterRef('pk')})))
+    return Movie.objects.filter(reduce(or_, exists)).count() if exists else 0
+
+
+def related_movies(movie_ids):
+    """Фильмы movie_ids и все фильмы, у которых есть общий с ними признак"""
+    related = set(movie_ids)
+    for relation, weight in _weights().items():
+        if weight > 0:
+            features = np.unique(_relation_pairs(relation, movie_ids=movie_ids)[:, 1])
+            related.update(_relation_pairs(relation, feature_ids=features.tolist())[:, 0].tolist())
+    return related
+
+
+def build_matrix(seed_ids=None):
+    """
+    Матрица CSR float32 с нормированными строками и отсортированный массив id фильмов её строк. С seed_ids в
+    матрице только строки этих фильмов и фильмов с общими с ними признаками - соседи seed_ids те же, что по
+    полной матрице
+    """
+    relations = [(relation, weight) for relation, weight in _weights().items() if weight > 0]
+    scope = None if seed_ids is None else related_movies(seed_ids)
+    pairs = [(relation, weight, _relation_pairs(relation, movie_ids=scope)) for relation, weight in relations]
+    pairs = [(relation, weight, relation_pairs) for relation, weight, relation_pairs in pairs if len(relation_pairs)]
+    if not pairs:
+        return sparse.csr_matrix((0, 0), dtype=np.float32), np.empty(0, dtype=np.int64)
+
+    movie_ids = np.unique(np.concatenate([relation_pairs[:, 0] for _, _, relation_pairs in pairs]))
+    total = len(movie_ids) if scope is None else _movies_with_features([relation for relation, _ in relations])
+    rows, columns, values = [], [], []
+    offset = 0
+    for relation, weight, relation_pairs in pairs:
+        features, feature_columns = np.unique(relation_pairs[:, 1], return_inverse=True)
+        counts = np.bincount(feature_columns) if scope is None else _document_frequencies(relation, features)
+        idf = np.log((1 + total) / (1 + counts)) + 1
+        rows.append(np.searchsorted(movie_ids, relation_pairs[:, 0]))
+        columns.append(feature_columns + offset)
+        values.append((weight * idf[feature_columns]).astype(np.float32))
+        offset += len(features)
+
+    matrix = sparse.csr_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))),
+        shape=(len(movie_ids), offset), dtype=np.float32,
+    )
+    # У каждой строки есть хотя бы один признак с положительным весом, деления на ноль нет
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    return sparse.diags(1 / norms).dot(matrix).tocsr().astype(np.float32), movie_ids
+
+
+def _rows(movie_ids, ids):
+    """Номера строк матрицы для id фильмов; фильмов без признаков в матрице нет"""
+    ids = np.fromiter(ids, dtype=np.int64)
+    positions = np.searchsorted(movie_ids, ids).clip(max=max(len(movie_ids) - 1, 0))
+    return positions[movie_ids[positions] == ids] if len(movie_ids) else positions[:0]
+
+
+def neighbours(matrix, transposed, movie_ids, rows, top_k):
+    """Соседи фильмов строк rows: {id фильма: [(id соседа, близость), ...]} по убыванию близости"""
+    product = matrix[rows].dot(transposed).tocsr()
+    result = {}
+    for index, row in enumerate(rows):
+        start, end = product.indptr[index], product.indptr[index + 1]
+        columns, scores = product.indices[start:end], product.data[start:end]
+        keep = (columns != row) & (scores > 0)
+        columns, scores = columns[keep], scores[keep]
+        if len(scores) > top_k:
+            threshold = np.partition(scores, len(scores) - top_k)[len(scores) - top_k]
+            keep = scores >= threshold
+            columns, scores = columns[keep], scores[keep]
+        # При равной близости выше фильм с меньшим id - результат не зависит от порядка строк
+        order = np.lexsort((columns, -scores))[:top_k]
+        result[int(movie_ids[row])] = [(int(movie_ids[columns[i]]), float(scores[i])) for i in order]
+    return result
+
+
+def _replace(stale, found):
+    """Заменяет строки stale соседями found одной транзакцией"""
+    with transaction.atomic():
+        stale.delete()
+        SimilarMovie.objects.bulk_create([
+            SimilarMovie(movie_id=movie_id, similar_id=similar_id, rank=rank, score=score)
+            for movie_id, similar in found.items()
+            for rank, (similar_id, score) in enumerate(similar, start=1)
+        ], batch_size=1000)
+
+
+def rebuild(block_size=BLOCK_SIZE, top_k=None):
+    """Пересчитывает соседей всех фильмов; возвращает число фильмов, у которых есть соседи"""
+    top_k = top_k or _top_k()
+    started = timezone.now()
+    matrix, movie_ids = build_matrix()
+    transposed = matrix.T.tocsr()
+    with_neighbours = 0
+    previous = None
+    for start in range(0, len(movie_ids), block_size):
+        rows = np.arange(start, min(start + block_size, len(movie_ids)))
+        found = neighbours(matrix, transposed, movie_ids, rows, top_k)
+        # Диапазон id блока захватывает и фильмы без признаков между строками матрицы
+        last = int(movie_ids[rows[-1]])
+        stale = SimilarMovie.objects.filter(movie_id__lte=last)
+        if previous is not None:
+            stale = stale.filter(movie_id__gt=previous)
+        _replace(stale, found)
+        with_neighbours += sum(1 for similar in found.values() if similar)
+        previous = last
+    tail = SimilarMovie.objects.all() if previous is None else SimilarMovie.objects.filter(movie_id__gt=previous)
+    tail.delete()
+    SimilarMovieUpdate.objects.filter(marked_at__lte=started).delete()
+    return with_neighbours
+
+
+def update_movies(movie_ids, block_size=BLOCK_SIZE, top_k=None):
+    """Пересчитывает соседей после изменения связей фильмов movie_ids; возвращает число пересчитанных фильмов"""
+    changed = {int(movie_id) for movie_id in movie_ids if movie_id is not None}
+    if not changed:
+        return 0
+    top_k = top_k or _top_k()
+    affected = set(changed)
+    for chunk in _chunks(changed):
+        affected.update(SimilarMovie.objects.filter(similar_id__in=chunk).values_list('movie_id', flat=True))
+    # Кандидаты в пересчет - фильмы с общими признаками с измененными; в матрице нужны и их соседи
+    matrix, all_ids = build_matrix(affected | related_movies(changed))
+    transposed = matrix.T.tocsr()
+
+    changed_rows = _rows(all_ids, changed)
+    if len(changed_rows):
+        # Лучшая близость каждого фильма к измененным; если она не ниже его K-го соседа, top-K мог измениться
+        best = matrix[changed_rows].dot(transposed).max(axis=0).toarray().ravel()
+        candidates = {int(all_ids[column]): best[column] for column in np.flatnonzero(best > 0)}
+        thresholds = {}
+        for chunk in _chunks(candidates.keys() - affected):
+            thresholds.update(SimilarMovie.objects.filter(movie_id__in=chunk, rank=top_k).values_list('movie_id', 'score'))
+        affected.update(movie_id for movie_id, score in candidates.items() if score >= thresholds.get(movie_id, 0))
+
+    rows = _rows(all_ids, sorted(affected))
+    for start in range(0, len(rows), block_size):
+        found = neighbours(matrix, transposed, all_ids, rows[start:start + block_size], top_k)
+        _replace(SimilarMovie.objects.filter(movie_id__in=list(found)), found)
+    # У фильмов без признаков (или удаленных) соседей нет
+    missing = affected - {int(movie_id) for movie_id in all_ids[rows]}
+    for chunk in _chunks(missing):
+        SimilarMovie.objects.filter(movie_id__in=chunk).delete()
+    return len(affected)
+
+
+def update_pending(block_size=BLOCK_SIZE, top_k=None):
+    """Пересчитывает соседей фильмов, отмеченных сигналами; возвращает число пересчитанных фильмов"""
+    started = timezone.now()
+    movie_ids = list(SimilarMovieUpdate.objects.filter(marked_at__lte=started).values_list('movie_id', flat=True))
+    updated = update_movies(movie_ids, block_size, top_k)
+    # Отметки, поставленные во время пересчета, остаются до следующего запуска
+    for chunk in _chunks(movie_ids):
+        SimilarMovieUpdate.objects.filter(movie_id__in=chunk, marked_at__lte=started).delete()
+    return updated
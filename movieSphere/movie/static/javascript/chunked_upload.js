@@ -0,0 +1,140 @@
+// Загрузка больших видео частями с проверкой SHA-256 и продолжением после обрыва
+(function() {
+    const RETRY_DELAYS = [1000, 2000, 5000, 10000, 30000];
+
+    function csrfToken() {
+        const match = document.cookie.match(/(?:^|;\s*)csrftoken=([^;]+)/);
+        return match ? decodeURIComponent(match[1]) : '';
+    }
+
+    function toHex(buffer) {
+        return Array.from(new Uint8Array(buffer), byte => byte.toString(16).padStart(2, '0')).join('');
+    }
+
+    async function sha256(data) {
+        return crypto.subtle.digest('SHA-256', data);
+    }
+
+    async function request(url, options) {
+        options = options || {};
+        options.headers = Object.assign({'X-CSRFToken': csrfToken()}, options.headers || {});
+        options.credentials = 'same-origin';
+        const response = await fetch(url, options);
+        const data = await response.json().catch(() => ({}));
+        if (!response.ok) {
+            const error = new Error(data.error || response.statusText);
+            error.status = response.status;
+            throw error;
+        }
+        return data;
+    }
+
+    // Повторяем запрос при обрыве сети и ошибках сервера, но не при ошибках протокола (4xx)
+    async function withRetries(action) {
+        for (let attempt = 0; ; attempt++) {
+            try {
+                return await action();
+            } catch (error) {
+                if ((error.status && error.status < 500) || attempt >= RETRY_DELAYS.length) {
+                    throw error;
+                }
+                await new Promise(resolve => setTimeout(resolve, RETRY_DELAYS[attempt]));
+            }
+        }
+    }
+
+    async function upload(widget, file) {
+        const target = widget.dataset.target;
+        const startUrl = widget.dataset.startUrl;
+        const progress = widget.querySelector('.chunked-upload-progress');
+        const status = widget.querySelector('.chunked-upload-status');
+        const hidden = widget.querySelector('input[type=hidden]');
+        const storageKey = ['chunked-upload', target, file.name, file.size, file.lastModified].join(':');
+
+        hidden.value = '';
+        progress.hidden = false;
+        const form = widget.closest('form');
+        const submits = form ? form.querySelectorAll('[type=submit]') : [];
+        submits.forEach(button => button.disabled = true);
+
+        try {
+            let state = null;
+            const savedId = localStorage.getItem(storageKey);
+            if (savedId) {
+                state = await request(startUrl + savedId + '/').catch(() => null);
+            }
+            if (!state) {
+                const body = new FormData();
+                body.append('target', target);
+                body.append('filename', file.name);
+                body.append('size', file.size);
+                state = await withRetries(() => request(startUrl, {method: 'POST', body: body}));
+                localStorage.setItem(storageKey, state.id);
+            }
+            const uploadUrl = startUrl + state.id + '/';
+            const chunkSize = state.chunk_size;
+
+            // Суммы уже загруженных частей считаются заново по локальному файлу
+            const digests = [];
+            for (let offset = 0; offset < state.offset; offset += chunkSize) {
+                const data = await file.slice(offset, Math.min(offset + chunkSize, file.size)).arrayBuffer();
+                digests.push(await sha256(data));
+                status.textContent = 'Проверка загруженной части: ' + Math.round(offset / file.size * 100) + '%';
+            }
+
+            let offset = state.offset;
+            while (!state.complete && offset < file.size) {
+                const data = await file.slice(offset, Math.min(offset + chunkSize, file.size)).arrayBuffer();
+                const digest = await sha256(data);
+                try {
+                    state = await withRetries(() => request(uploadUrl + '?offset=' + offset, {
+                        method: 'PUT',
+                        body: data,
+                        headers: {'Content-Type': 'application/octet-stream', 'X-Chunk-SHA256': toHex(digest)},
+                    }));
+                } catch (error) {
+                    if (error.status !== 409) {
+                        throw error;
+                    }
+                    // Сервер уже получил эту часть (например, ответ потерялся) - сверяем смещение
+                    state = await request(uploadUrl);
+                }
+                if (state.offset !== offset && state.offset !== offset + data.byteLength) {
+                    throw new Error('смещение на сервере не совпадает с загруженными частями');
+                }
+                if (state.offset > offset) {
+                    digests.push(digest);
+                }
+                offset = state.offset;
+                progress.value = Math.round(offset / file.size * 100);
+                status.textContent = progress.value + '%';
+            }
+
+            if (!state.complete) {
+                const joined = new Uint8Array(digests.length * 32);
+                digests.forEach((digest, index) => joined.set(new Uint8Array(digest), index * 32));
+                const body = new FormData();
+                body.append('checksum', toHex(await sha256(joined)));
+                state = await withRetries(() => request(uploadUrl + 'complete/', {method: 'POST', body: body}));
+            }
+            localStorage.removeItem(storageKey);
+            hidden.value = state.id;
+            progress.value = 100;
+            status.textContent = 'Загружено: ' + state.file;
+        } catch (error) {
+            status.textContent = 'Ошибка загрузки: ' + error.message + '. Выберите файл снова, чтобы продолжить.';
+        } finally {
+            submits.forEach(button => button.disabled = false);
+        }
+    }
+
+    document.addEventListener('DOMContentLoaded', function() {
+        document.querySelectorAll('.chunked-upload').forEach(widget => {
+            widget.querySelector('.chunked-upload-file').addEventListener('change', function() {
+                if (this.files.length) {
+                    upload(widget, this.files[0]);
+                }
+            });
+        });
+    });
+})();
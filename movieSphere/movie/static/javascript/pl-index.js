@@ -89,7 +89,7 @@ document.addEventListener('DOMContentLoaded', function() {
     // Fetch a random movie from the server
     function fetchRandomMovie() {
         fetch("{% url 'get_random_movie' %}")
-            .then(response => response.json())
+            .then(response => response.ok ? response.json() : Promise.reject(response.status))
             .then(data => updatePreviewBlock(data))
             .catch(error => console.error('Error fetching random movie:', error));
     }
@@ -10,9 +10,8 @@ rating.addEventListener("change", function (e) {
     .then(response => {
         if (response.ok) {
             alert("Рейтинг установлен");
-            location.reload(); // Перезагрузка страницы для обновления рейтинга
-            updateAverageRating();
-
+            // Сводку оценок обновляет star.js
+            document.dispatchEvent(new CustomEvent('rating:changed'));
         } else {
             alert("Ошибка");
         }
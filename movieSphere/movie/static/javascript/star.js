@@ -14,13 +14,15 @@ function ajaxSend(url, params) {
 // Filter movies
 const forms = document.querySelector('form[name=filter]');
 
-forms.addEventListener('submit', function (e) {
-    // Получаем данные из формы
-    e.preventDefault();
-    let url = this.action;
-    let params = new URLSearchParams(new FormData(this)).toString();
-    ajaxSend(url, params);
-});
+if (forms) {
+    forms.addEventListener('submit', function (e) {
+        // Получаем данные из формы
+        e.preventDefault();
+        let url = this.action;
+        let params = new URLSearchParams(new FormData(this)).toString();
+        ajaxSend(url, params);
+    });
+}
 
 function render(data) {
     // Рендер шаблона
@@ -61,3 +63,40 @@ let html = '\
 
 
 // Add star rating
+// Сводка оценок фильма: гистограмма по звездам, количество, среднее и своя оценка
+function loadRatingSummary() {
+    const summary = document.querySelector('.rating-summary');
+    if (!summary) {
+        return;
+    }
+    fetch(summary.dataset.url, {headers: {'X-Requested-With': 'XMLHttpRequest'}})
+        .then(response => response.ok ? response.json() : Promise.reject(response.status))
+        .then(data => renderRatingSummary(summary, data))
+        .catch(error => console.error(error));
+}
+
+function renderRatingSummary(summary, data) {
+    const values = Object.keys(data.histogram).sort((a, b) => b - a);
+    const largest = Math.max(1, ...values.map(value => data.histogram[value]));
+    summary.querySelector('.rating-summary-average').textContent = data.average.toFixed(2);
+    summary.querySelector('.rating-summary-count').textContent = data.count + ' оценок';
+    summary.querySelector('.rating-summary-own').textContent = data.user_rating ? 'Ваша оценка: ' + data.user_rating : '';
+    const bars = summary.querySelector('.rating-summary-bars');
+    bars.innerHTML = '';
+    values.forEach(value => {
+        const row = document.createElement('div');
+        row.className = 'rating-summary-row';
+        const label = document.createElement('span');
+        label.textContent = value;
+        const bar = document.createElement('span');
+        bar.className = 'rating-summary-bar';
+        bar.style.width = Math.round(data.histogram[value] / largest * 100) + '%';
+        const count = document.createElement('span');
+        count.textContent = data.histogram[value];
+        row.append(label, bar, count);
+        bars.append(row);
+    });
+}
+
+document.addEventListener('DOMContentLoaded', loadRatingSummary);
+document.addEventListener('rating:changed', loadRatingSummary);
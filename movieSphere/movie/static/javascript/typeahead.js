@@ -0,0 +1,101 @@
+// Подсказки под строкой поиска: фильмы и персоны по началу названия или имени
+(function() {
+    const MIN_LENGTH = 2;
+    const DELAY = 120;
+    const GROUPS = [['movies', 'Фильмы'], ['people', 'Актеры и режиссеры']];
+
+    function attach(input) {
+        const form = input.closest('form');
+        const list = document.createElement('div');
+        list.className = 'typeahead-results';
+        list.hidden = true;
+        form.classList.add('typeahead');
+        form.appendChild(list);
+
+        let timer = null;
+        let controller = null;
+        let active = -1;
+
+        function links() {
+            return Array.from(list.querySelectorAll('a'));
+        }
+
+        function highlight(index) {
+            const items = links();
+            items.forEach(item => item.classList.remove('active'));
+            active = items.length ? (index + items.length) % items.length : -1;
+            if (active >= 0) {
+                items[active].classList.add('active');
+            }
+        }
+
+        function render(data) {
+            list.innerHTML = '';
+            GROUPS.forEach(([key, title]) => {
+                if (!data[key] || !data[key].length) {
+                    return;
+                }
+                const header = document.createElement('div');
+                header.className = 'typeahead-group';
+                header.textContent = title;
+                list.appendChild(header);
+                data[key].forEach(item => {
+                    const link = document.createElement('a');
+                    link.href = item.url;
+                    link.textContent = item.label;
+                    list.appendChild(link);
+                });
+            });
+            active = -1;
+            list.hidden = !list.children.length;
+        }
+
+        function load() {
+            const query = input.value.trim();
+            if (query.length < MIN_LENGTH) {
+                list.hidden = true;
+                return;
+            }
+            if (controller) {
+                controller.abort();
+            }
+            controller = new AbortController();
+            fetch(input.dataset.typeaheadUrl + '?q=' + encodeURIComponent(query), {signal: controller.signal})
+                .then(response => response.json())
+                .then(render)
+                .catch(error => {
+                    if (error.name !== 'AbortError') {
+                        list.hidden = true;
+                    }
+                });
+        }
+
+        input.addEventListener('input', function() {
+            clearTimeout(timer);
+            timer = setTimeout(load, DELAY);
+        });
+        input.addEventListener('keydown', function(event) {
+            if (list.hidden) {
+                return;
+            }
+            if (event.key === 'ArrowDown' || event.key === 'ArrowUp') {
+                event.preventDefault();
+                highlight(active + (event.key === 'ArrowDown' ? 1 : -1));
+            } else if (event.key === 'Enter' && active >= 0) {
+                event.preventDefault();
+                window.location.href = links()[active].href;
+            } else if (event.key === 'Escape') {
+                list.hidden = true;
+            }
+        });
+        document.addEventListener('click', function(event) {
+            if (!form.contains(event.target)) {
+                list.hidden = true;
+            }
+        });
+    }
+
+    document.addEventListener('DOMContentLoaded', function() {
+        document.querySelectorAll('input[data-typeahead-url]').forEach(attach);
+    });
+})();
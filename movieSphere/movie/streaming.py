@@ -0,0 +1,231 @@
+"""Отдача медиафайлов (фильмы, трейлеры, серии) с поддержкой HTTP Range.
+
+Плеер при перемотке запрашивает нужный отрезок файла заголовком ``Range``, поэтому вид отвечает
+``206 Partial Content`` на один или несколько отрезков, учитывает ``ETag``/``Last-Modified``,
+``If-Range`` и остальные условные заголовки. Один отрезок отдаётся через ``FileResponse``: WSGI-сервер
+с ``wsgi.file_wrapper`` (например, gunicorn) отправляет его через ``os.sendfile`` без копирования в
+Python. Несколько отрезков читаются по частям через ``os.pread``, так что одновременные запросы к одному
+файлу не мешают друг другу. Если настроен фронтенд-сервер, отдачу можно переложить на него заголовком
+``X-Accel-Redirect`` (nginx) или ``X-Sendfile`` (Apache, lighttpd).
+
+Параметр ``?t=<секунды>`` без заголовка ``Range`` отдаёт видео с последнего ключевого кадра не позже этого
+времени: смещение берётся из ``MediaSeekIndex``, так что файл при этом не читается. Если индекса нет или он
+построен для прежней версии файла, параметр игнорируется; при выгрузке на фронтенд-сервер он не действует.
+"""
+import math
+import mimetypes
+import os
+import posixpath
+import stat
+import uuid
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+from .models import MediaSeekIndex
+
+CHUNK_SIZE = 64 * 1024
+MAX_RANGES = 16
+
+
+def parse_range_header(header, size):
+    """
+    Отрезки (start, end) включительно из заголовка Range.
+    None - заголовок нужно проигнорировать и отдать файл целиком, [] - ни один отрезок не попадает в файл.
+    """
+    units, _, spec = header.partition('=')
+    if units.strip().lower() != 'bytes':
+        return None
+    parts = [part.strip() for part in spec.split(',') if part.strip()]
+    if not parts or len(parts) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for part in parts:
+        first, dash, last = (value.strip() for value in part.partition('-'))
+        if not dash or not (first or last) or not all(value.isdigit() for value in (first, last) if value):
+            return None
+        if not first:
+            suffix = int(last)
+            if suffix and size:
+                ranges.append((max(size - suffix, 0), size - 1))
+            continue
+        start, end = int(first), int(last) if last else size - 1
+        if last and end < start:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+
+    # Перекрывающиеся и соседние отрезки склеиваются, чтобы не отдавать одни байты несколько раз
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def file_etag(stat_result):
+    return f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
+def range_is_fresh(request, etag, last_modified):
+    """Условие If-Range: отрезок отдаётся, только если файл не изменился с момента первого запроса"""
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+class RangeFile:
+    """Отрезок открытого файла; fileno() позволяет серверу отправить его через sendfile"""
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.name = file.name
+        self.remaining = length
+        file.seek(start)
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def read_ranges(file, ranges, boundary, content_type, size):
+    """Тело multipart/byteranges; каждый отрезок читается через pread без общего смещения файла"""
+    try:
+        descriptor = file.fileno()
+        for start, end in ranges:
+            yield _part_header(boundary, content_type, start, end, size)
+            offset = start
+            while offset <= end:
+                data = os.pread(descriptor, min(CHUNK_SIZE, end - offset + 1), offset)
+                if not data:
+                    break
+                offset += len(data)
+                yield data
+            yield b'\r\n'
+        yield f'--{boundary}--\r\n'.encode()
+    finally:
+        file.close()
+
+
+def _part_header(boundary, content_type, start, end, size):
+    return (f'--{boundary}\r\nContent-Type: {content_type}\r\n'
+            f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n').encode()
+
+
+def offload_response(path, content_type):
+    """Ответ без тела, который фронтенд-сервер заменит содержимым файла (или None, если выгрузка выключена)"""
+    offload = getattr(settings, 'MEDIA_STREAMING_OFFLOAD', None)
+    if not offload:
+        return None
+    response = HttpResponse(content_type=content_type)
+    if offload == 'x-accel-redirect':
+        prefix = getattr(settings, 'MEDIA_STREAMING_ACCEL_PREFIX', '/protected-media/')
+        response['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + quote(path)
+    elif offload == 'x-sendfile':
+        response['X-Sendfile'] = safe_join(settings.MEDIA_ROOT, path)
+    else:
+        raise ValueError(f"Неизвестный способ выгрузки медиафайлов: {offload}")
+    return response
+
+
+def seek_offset(path, stat_result, value):
+    """Смещение ключевого кадра для ?t=<секунды> или None, если время некорректно или индекса для файла нет"""
+    try:
+        seconds = float(value)
+    except ValueError:
+        return None
+    if not math.isfinite(seconds):
+        return None
+    seek_index = MediaSeekIndex.objects.filter(file=path, pending=False).first()
+    if seek_index is None or not seek_index.is_current(stat_result):
+        return None
+    return seek_index.offset_for(seconds)
+
+
+@require_safe
+def serve_media(request, path):
+    """Отдаёт файл из MEDIA_ROOT целиком или отрезками по заголовку Range"""
+    path = posixpath.normpath(path).lstrip('/')
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        stat_result = os.stat(full_path)
+    except (SuspiciousFileOperation, OSError, ValueError):
+        raise Http404("Файл не найден")
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise Http404("Файл не найден")
+
+    size = stat_result.st_size
+    etag = file_etag(stat_result)
+    last_modified = int(stat_result.st_mtime)
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    headers = {'ETag': etag, 'Last-Modified': http_date(last_modified), 'Accept-Ranges': 'bytes'}
+
+    conditional = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if conditional is not None:
+        for name, value in headers.items():
+            conditional[name] = value
+        return conditional
+
+    response = offload_response(path, content_type)
+    if response is not None:
+        for name, value in headers.items():
+            response[name] = value
+        return response
+
+    ranges = None
+    range_header = request.META.get('HTTP_RANGE')
+    if range_header and range_is_fresh(request, etag, last_modified):
+        ranges = parse_range_header(range_header, size)
+        if ranges == []:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+    elif not range_header and 't' in request.GET:
+        start = seek_offset(path, stat_result, request.GET['t'])
+        if start and start < size:
+            ranges = [(start, size - 1)]
+
+    file = open(full_path, 'rb')
+    if not ranges:
+        response = FileResponse(RangeFile(file, 0, size), content_type=content_type)
+        response['Content-Length'] = size
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        response = FileResponse(RangeFile(file, start, end - start + 1), content_type=content_type, status=206)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    else:
+        boundary = uuid.uuid4().hex
+        response = StreamingHttpResponse(
+            read_ranges(file, ranges, boundary, content_type, size),
+            content_type=f'multipart/byteranges; boundary={boundary}', status=206,
+        )
+        response['Content-Length'] = sum(
+            len(_part_header(boundary, content_type, start, end, size)) + end - start + 1 + 2
+            for start, end in ranges
+        ) + len(f'--{boundary}--\r\n')
+    response.block_size = CHUNK_SIZE
+    for name, value in headers.items():
+        response[name] = value
+    return response
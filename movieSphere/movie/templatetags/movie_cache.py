@@ -0,0 +1,47 @@
+from django import template
+from django.core.cache import cache
+
+from movie.fragments import SECTIONS, fragment_key, fragment_timeout, record
+
+register = template.Library()
+
+
+class MovieFragmentNode(template.Node):
+    def __init__(self, nodelist, movie, section, name):
+        self.nodelist = nodelist
+        self.movie = movie
+        self.section = section
+        self.name = name
+
+    def render(self, context):
+        movie = self.movie.resolve(context)
+        section = self.section.resolve(context)
+        if section not in SECTIONS:
+            raise template.TemplateSyntaxError(f"Неизвестная группа фрагментов: {section}")
+        key = fragment_key(movie.pk, section, self.name.resolve(context))
+        html = cache.get(key)
+        if html is not None:
+            record('hits')
+            return html
+        record('misses')
+        html = self.nodelist.render(context)
+        cache.set(key, html, fragment_timeout())
+        return html
+
+
+@register.tag('moviefragment')
+def do_moviefragment(parser, token):
+    """
+    Кеширует фрагмент, относящийся к одному фильму:
+
+        {% moviefragment movie "card" "index_popular" %} ... {% endmoviefragment %}
+
+    Второй аргумент - группа, по которой сигналы сбрасывают фрагмент (card, people, genres, reviews),
+    третий - имя фрагмента, чтобы разные шаблоны одной группы не пересекались.
+    """
+    bits = token.split_contents()
+    if len(bits) != 4:
+        raise template.TemplateSyntaxError(f"'{bits[0]}' ожидает фильм, группу и имя фрагмента")
+    nodelist = parser.parse(('endmoviefragment',))
+    parser.delete_first_token()
+    return MovieFragmentNode(nodelist, *(parser.compile_filter(bit) for bit in bits[1:]))
@@ -0,0 +1,37 @@
+from django import template
+from django.utils.html import format_html, format_html_join
+
+from movie.images import IMAGE_SIZES, IMAGE_VARIANTS, get_variants, srcset, variant_url
+
+register = template.Library()
+
+
+@register.simple_tag
+def responsive_image(field_file, kind, alt='', sizes=None, **attrs):
+    """
+    <picture> с вариантами в WebP и JPEG для поля-изображения:
+
+        {% responsive_image movie.poster "poster" alt=movie.title %}
+
+    Пока варианты не построены, выводится обычный <img> с оригиналом.
+    """
+    if not field_file:
+        return ''
+    extra = format_html_join('', ' {}="{}"', ((name.rstrip('_').replace('_', '-'), value) for name, value in attrs.items()))
+    manifest = get_variants(field_file)
+    if manifest is None:
+        return format_html('<img src="{}" alt="{}"{}>', field_file.url, alt, extra)
+    sizes = sizes or IMAGE_SIZES[kind]
+    return format_html(
+        '<picture><source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}" alt="{}"{}></picture>',
+        srcset(manifest, 'image/webp'), sizes,
+        variant_url(field_file, IMAGE_VARIANTS[kind][len(IMAGE_VARIANTS[kind]) // 2]), srcset(manifest, 'image/jpeg'),
+        sizes, alt, extra,
+    )
+
+
+@register.simple_tag
+def image_variant_url(field_file, width):
+    """URL JPEG-варианта не уже width - для фоновых картинок, где srcset недоступен"""
+    return variant_url(field_file, int(width))
@@ -1,3 +1,1904 @@
-from django.test import TestCase
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import struct
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from decimal import Decimal
+from importlib import import_module
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+from django.apps import apps
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.exceptions import BadRequest, ImproperlyConfigured, ValidationError
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection
+from django.db.models import Q
+from django.db.models.functions import Lower
+from django.http import Http404
+from django.template import Context, Template
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import export, fragments, fuzzy, images, importer, mp4, random_movie, rating_buffer, recommendations, search, \
+    shared_index, similarity, typeahead
+from .facets import get_catalog_facets, year_range_filter
+from .forms import ChunkedUploadField
+from .interactions import MAX_IDS, annotate_movies
+from .models import Movie, Actor, Category, Genre, Season, Episode, Reviews, Profile, RatingStar, MovieInteraction, \
+    Rating, RatingCount, SimilarMovie, Recommendation, MediaSeekIndex, ChunkedUpload, ChunkedUploadError, \
+    PopularitySnapshot, CatalogVersion, SimilarMovieUpdate, ImageVariantsUpdate
+from .pagination import KeysetPaginator, encode_cursor
+from .signals import install_search_index
+from .streaming import serve_media
+
+
+class MovieDetailQueryBudgetTest(TestCase):
+    """Количество запросов страницы фильма не зависит от числа отзывов, актеров и эпизодов"""
+    QUERY_BUDGET = 15
+
+    @classmethod
+    def setUpTestData(cls):
+        RatingStar.objects.bulk_create(RatingStar(value=value) for value in range(1, 6))
+        cls.user = User.objects.create_user('viewer', 'viewer@example.com', 'password')
+        Profile.objects.create(user=cls.user, photo='media/profile_photos/viewer.png')
+
+    def make_movie(self, slug, size):
+        movie = Movie.objects.create(
+            title=slug, url=slug, description='Описание', country='Страна', is_series=True,
+            preview_poster='media/moviesP/preview.png', poster='media/moviesp/poster.png',
+            trailer='media/trailers/trailer.mp4',
+        )
+        movie.genre.set(Genre.objects.bulk_create(
+            Genre(name=f'{slug}-genre-{i}', url=f'{slug}-genre-{i}', descriptions='') for i in range(3)))
+        people = Actor.objects.bulk_create(Actor(name=f'{slug}-actor-{i}') for i in range(max(size // 50, 3)))
+        movie.actors.set(people)
+        movie.directors.set(people[:2])
+        for season_number in range(1, 4):
+            season = Season.objects.create(movie=movie, season_number=season_number)
+            Episode.objects.bulk_create(
+                Episode(season=season, episode_number=number, title=f'Эпизод {number}',
+                        video='media/episodes/episode.mp4') for number in range(1, 11))
+
+        authors = []
+        for i in range(5):
+            author = User.objects.create_user(f'{slug}-author-{i}', f'{slug}-{i}@example.com', 'password')
+            Profile.objects.create(user=author, photo='media/profile_photos/author.png' if i % 2 else None)
+            authors.append(author)
+        reviews = Reviews.objects.bulk_create(
+            Reviews(user=authors[i % 5], email=authors[i % 5].email, text=f'Отзыв {i}', movie=movie)
+            for i in range(size))
+        Reviews.objects.bulk_create(
+            Reviews(user=authors[(i + 1) % 5], email=authors[(i + 1) % 5].email, text='Текст ответа', movie=movie,
+                    parent=review)
+            for i, review in enumerate(reviews[::2]))
+        Reviews.rebuild_paths([movie.pk])
+        return movie
+
+    def count_queries(self, movie):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(movie.get_absolute_url(), {'season': 2, 'episode': 3})
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_is_constant(self):
+        self.client.force_login(self.user)
+        small = self.count_queries(self.make_movie('small', 5))
+        large = self.count_queries(self.make_movie('large', 500))
+        self.assertEqual(small, large)
+        self.assertLessEqual(large, self.QUERY_BUDGET)
+
+    def test_page_renders_reviews_and_replies(self):
+        movie = self.make_movie('render', 500)
+        response = self.client.get(movie.get_absolute_url())
+        threads = response.context['review_threads']['threads']
+        self.assertEqual(len(threads), 20)
+        self.assertEqual(sum(len(review.thread_replies) for review in threads), 10)
+        self.assertEqual(response.context['series_info'],
+                         {'seasons_count': 3, 'total_episodes': 30, 'episode_duration': 0})
+        self.assertContains(response, 'Текст ответа', count=10)
+
+
+class ReviewThreadsTest(TestCase):
+    """Ветки отзывов любой вложенности выбираются одним запросом и листаются курсором"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('critic', 'critic@example.com', 'password')
+        Profile.objects.create(user=cls.user)
+        cls.movie = Movie.objects.create(
+            title='Threads', url='threads', description='Описание', country='Страна',
+            preview_poster='media/moviesP/preview.png', poster='media/moviesp/poster.png',
+            trailer='media/trailers/trailer.mp4', movie_file='media/movies/film.mp4',
+        )
+
+    def review(self, text, parent=None):
+        return Reviews.objects.create(user=self.user, email=self.user.email, text=text, movie=self.movie,
+                                      parent=parent)
+
+    def test_nested_replies_in_display_order(self):
+        first = self.review('первый')
+        second = self.review('второй')
+        reply = self.review('ответ', first)
+        self.review('ответ на ответ', reply)
+        self.review('второй ответ', first)
+        self.review('ответ второму', second)
+
+        with CaptureQueriesContext(connection) as queries:
+            threads, next_cursor = self.movie.get_review_threads()
+        self.assertEqual(len(queries), 1)
+        self.assertIsNone(next_cursor)
+        self.assertEqual([review.text for review in threads], ['первый', 'второй'])
+        self.assertEqual([(review.text, review.depth) for review in threads[0].thread_replies],
+                         [('ответ', 1), ('ответ на ответ', 2), ('второй ответ', 1)])
+
+        # Ответы удаленного отзыва становятся отдельной веткой, как раньше при обнулении parent
+        first.delete()
+        threads, _ = self.movie.get_review_threads()
+        self.assertEqual([review.text for review in threads], ['второй', 'ответ', 'второй ответ'])
+        self.assertEqual([review.text for review in threads[1].thread_replies], ['ответ на ответ'])
+
+    def test_first_page_of_ten_thousand_reviews(self):
+        roots = Reviews.objects.bulk_create(
+            Reviews(user=self.user, email=self.user.email, text=f'Отзыв {i}', movie=self.movie) for i in range(10000))
+        Reviews.objects.bulk_create(
+            Reviews(user=self.user, email=self.user.email, text='Ответ', movie=self.movie, parent=review)
+            for review in roots[::3])
+        Reviews.rebuild_paths([self.movie.pk])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.movie.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sum('movie_reviews' in query['sql'] for query in queries.captured_queries), 1)
+        self.assertContains(response, 'Отзыв 19<')
+        self.assertNotContains(response, 'Отзыв 20<')
+
+        next_cursor = response.context['review_threads']['next']
+        response = self.client.get(f'/review/{self.movie.pk}/threads/', {'after': next_cursor})
+        data = response.json()
+        self.assertIn('Отзыв 20<', data['html'])
+        self.assertEqual(data['next'], roots[39].pk)
+
+
+class KeysetPaginationTest(TestCase):
+    """Страницы по курсору: оба направления, одинаковые ключи, NULL и ошибки курсора"""
+
+    def setUp(self):
+        # Годы повторяются, у части актеров года нет
+        years = [2001, 2001, None, 1999, 2001, None, 2005]
+        self.actors = [Actor.objects.create(name=f'Актер {i}', first_year=year) for i, year in enumerate(years)]
+
+    def walk(self, queryset, per_page=2):
+        paginator = KeysetPaginator(queryset, per_page)
+        pages = [paginator.page()]
+        while pages[-1].has_next():
+            pages.append(paginator.page(pages[-1].next_cursor))
+        return paginator, pages
+
+    def test_forward_and_backward(self):
+        paginator, pages = self.walk(Actor.objects.order_by('name'))
+        self.assertEqual([[actor.name for actor in page] for page in pages],
+                         [['Актер 0', 'Актер 1'], ['Актер 2', 'Актер 3'], ['Актер 4', 'Актер 5'], ['Актер 6']])
+        self.assertFalse(pages[0].has_previous())
+        back = paginator.page(pages[3].previous_cursor)
+        self.assertEqual(list(back), list(pages[2]))
+        self.assertTrue(back.has_next())
+        back = paginator.page(paginator.page(back.previous_cursor).previous_cursor)
+        self.assertEqual(list(back), list(pages[0]))
+        self.assertFalse(back.has_previous())
+
+    def test_ties_are_broken_by_pk(self):
+        _, pages = self.walk(Actor.objects.filter(first_year=2001).order_by('-first_year'), per_page=1)
+        self.assertEqual([actor.pk for page in pages for actor in page],
+                         [self.actors[0].pk, self.actors[1].pk, self.actors[4].pk])
+
+    def test_nullable_ordering(self):
+        # NULL больше любого года: в конце по возрастанию и в начале по убыванию
+        ascending = sorted(self.actors, key=lambda actor: (actor.first_year is None, actor.first_year or 0, actor.pk))
+        descending = sorted(self.actors, key=lambda actor: (
+            actor.first_year is not None, -(actor.first_year or 0), actor.pk))
+        for ordering, expected in (('first_year', ascending), ('-first_year', descending)):
+            paginator, pages = self.walk(Actor.objects.order_by(ordering))
+            self.assertEqual([actor.pk for page in pages for actor in page], [actor.pk for actor in expected])
+            previous = []
+            page = pages[-1]
+            while page.has_previous():
+                page = paginator.page(page.previous_cursor)
+                previous = list(page) + previous
+            self.assertEqual(previous, expected[:len(previous)])
+            self.assertEqual(len(previous) + len(pages[-1]), len(expected))
+
+    def test_expression_ordering_is_rejected(self):
+        with self.assertRaises(ImproperlyConfigured):
+            KeysetPaginator(Actor.objects.order_by(Lower('name')), 2)
+        with self.assertRaises(ImproperlyConfigured):
+            KeysetPaginator(Actor.objects.order_by('?'), 2)
+
+    def test_bad_cursor(self):
+        paginator = KeysetPaginator(Actor.objects.order_by('first_year'), 2)
+        other = KeysetPaginator(Actor.objects.order_by('name', 'first_year'), 2).page()
+        for cursor in ('not base64!', encode_cursor({'a': 1}), other.next_cursor, encode_cursor([{'x': 1}, 1])):
+            with self.assertRaises(BadRequest):
+                paginator.page(cursor)
+
+        with override_settings(KEYSET_PAGINATION=True):
+            response = self.client.get(reverse('movies'), {'cursor': 'garbage'})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(self.client.get(reverse('movies')).status_code, 200)
+
+
+class ActorStatsTest(TestCase):
+    """Статистика фильмографии обновляется сигналами, а страница персоны не зависит от числа фильмов"""
+
+    def make_movies(self, person, count, first_year=2000):
+        movies = Movie.objects.bulk_create(
+            Movie(title=f'{person.name} {i}', url=f'{person.pk}-{i}', description='Описание', country='Страна',
+                  preview_poster='media/moviesP/preview.png', poster='media/moviesp/poster.png',
+                  year=first_year + i, average_rating=i % 10, rating_count=i)
+            for i in range(count))
+        with self.captureOnCommitCallbacks(execute=True):
+            person.film_actor.add(*movies)
+            person.film_director.add(*movies[:2])
+        return movies
+
+    def test_stats_follow_roles_and_page_queries_are_constant(self):
+        small, large = Actor.objects.bulk_create([Actor(name='Малый'), Actor(name='Большой')])
+        self.make_movies(small, 3)
+        movies = self.make_movies(large, 30, first_year=1990)
+
+        large.refresh_from_db()
+        self.assertEqual((large.movies_count, large.acting_count, large.directing_count), (30, 30, 2))
+        self.assertEqual((large.first_year, large.last_year), (1990, 2019))
+        self.assertEqual(large.top_movie_ids, [movies[29].pk, movies[19].pk, movies[9].pk])
+
+        counts = []
+        for person in (small, large):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(person.get_absolute_url())
+            self.assertEqual(response.status_code, 200)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertContains(response, 'Годы карьеры:</strong> 1990 - 2019')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            movies[29].delete()
+            large.film_director.clear()
+        large.refresh_from_db()
+        self.assertEqual((large.movies_count, large.directing_count, large.last_year), (29, 0, 2018))
+        self.assertEqual(large.top_movie_ids, [movies[19].pk, movies[9].pk, movies[28].pk])
+
+        Actor.objects.filter(pk=large.pk).update(movies_count=0, top_movie_ids=[])
+        call_command('rebuild_actor_stats', stdout=StringIO())
+        large.refresh_from_db()
+        self.assertEqual(large.movies_count, 29)
+        self.assertEqual(len(large.top_movie_ids), 3)
+
+
+class SimilarMoviesTest(TestCase):
+    """Соседи по общим жанрам и людям; инкрементальное обновление совпадает с полным пересчетом"""
+
+    def setUp(self):
+        self.genres = Genre.objects.bulk_create(
+            Genre(name=f'Жанр {i}', url=f'similar-genre-{i}', descriptions='') for i in range(3))
+        self.people = Actor.objects.bulk_create(Actor(name=f'Персона {i}') for i in range(4))
+        self.movies = Movie.objects.bulk_create(
+            Movie(title=f'Похожий {i}', url=f'similar-{i}', description='Описание', country='Страна',
+                  preview_poster='media/moviesP/preview.png', poster='media/moviesp/poster.png', year=2000 + i)
+            for i in range(6))
+        first, second, third, fourth, _, sixth = self.movies
+        for movie in (first, second, third, sixth):
+            movie.genre.add(self.genres[0])
+        fourth.genre.add(self.genres[1])
+        first.actors.add(*self.people[:2])
+        second.actors.add(*self.people[:2])
+        sixth.actors.add(self.people[1])
+        first.directors.add(self.people[3])
+        second.directors.add(self.people[3])
+        similarity.update_pending()
+
+    def stored(self):
+        return sorted(SimilarMovie.objects.values_list('movie_id', 'rank', 'similar_id'))
+
+    def assert_matches_rebuild(self):
+        # Веса idf у нетронутых фильмов после инкрементального обновления слегка устаревают, порядок соседей - нет
+        incremental = self.stored()
+        similarity.rebuild(block_size=2)
+        self.assertEqual(incremental, self.stored())
+
+    def test_neighbours_ranked_by_weighted_overlap(self):
+        first, second, third, fourth, fifth, sixth = self.movies
+        self.assertEqual([movie.pk for movie in first.get_similar_movies()], [second.pk, sixth.pk, third.pk])
+        self.assertAlmostEqual(first.get_similar_movies()[0].similarity, 1.0, places=5)
+        self.assertEqual(fourth.get_similar_movies(), [])
+        self.assertEqual(fifth.get_similar_movies(), [])
+        self.assert_matches_rebuild()
+
+        with self.assertNumQueries(1):
+            first.get_similar_movies(2)
+        response = self.client.get(reverse('similar_movies', args=[first.pk]), {'limit': 1})
+        self.assertEqual([item['id'] for item in response.json()['results']], [second.pk])
+        self.assertEqual(self.client.get(reverse('similar_movies', args=[fifth.pk])).json()['results'], [])
+        self.assertEqual(self.client.get(reverse('similar_movies', args=[0])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('similar_movies', args=[first.pk]), {'limit': 'x'}).status_code, 400)
+
+    def test_block_size_does_not_change_result(self):
+        similarity.rebuild(block_size=1, top_k=2)
+        small_blocks = self.stored()
+        similarity.rebuild(block_size=500, top_k=2)
+        self.assertEqual(small_blocks, self.stored())
+        self.assertEqual(SimilarMovie.objects.filter(movie=self.movies[0]).count(), 2)
+
+    def test_incremental_updates_follow_relations(self):
+        first, second, third, fourth, fifth, sixth = self.movies
+        # Изменение связей в запросе только отмечает фильмы, соседи пересчитываются командой
+        with self.captureOnCommitCallbacks() as callbacks:
+            second.actors.clear()
+            second.directors.remove(self.people[3])
+        self.assertNotIn(similarity.update_movies, [getattr(callback, 'func', None) for callback in callbacks])
+        self.assertEqual(list(SimilarMovieUpdate.objects.values_list('movie_id', flat=True)), [second.pk])
+        self.assertEqual([movie.pk for movie in first.get_similar_movies()], [second.pk, sixth.pk, third.pk])
+        call_command('build_similar_movies', pending=True, stdout=StringIO())
+        self.assertFalse(SimilarMovieUpdate.objects.exists())
+        self.assertEqual([movie.pk for movie in first.get_similar_movies()], [sixth.pk, second.pk, third.pk])
+        self.assert_matches_rebuild()
+
+        self.genres[1].movie_set.add(fifth)
+        similarity.update_pending()
+        self.assertEqual([movie.pk for movie in fourth.get_similar_movies()], [fifth.pk])
+        self.assert_matches_rebuild()
+
+        sixth.delete()
+        self.people[0].delete()
+        similarity.update_pending()
+        self.assertNotIn(sixth.pk, [movie.pk for movie in first.get_similar_movies()])
+        self.assert_matches_rebuild()
+
+        first.genre.clear()
+        first.actors.clear()
+        first.directors.clear()
+        similarity.update_pending()
+        self.assertEqual(first.get_similar_movies(), [])
+        self.assertFalse(SimilarMovie.objects.filter(similar=first).exists())
+        self.assert_matches_rebuild()
+
+        call_command('build_similar_movies', stdout=StringIO())
+        call_command('build_similar_movies', movie_ids=[second.pk], stdout=StringIO())
+        self.assert_matches_rebuild()
+
+    def test_partial_matrix_covers_related_movies(self):
+        first, second, third, fourth, fifth, sixth = self.movies
+        seventh = Movie.objects.create(title='Похожий 6', url='similar-6', description='', country='')
+        seventh.genre.add(self.genres[2])
+        full, full_ids = similarity.build_matrix()
+        partial, partial_ids = similarity.build_matrix([fourth.pk])
+        self.assertEqual(partial_ids.tolist(), [fourth.pk])
+        partial, partial_ids = similarity.build_matrix([sixth.pk])
+        self.assertEqual(partial_ids.tolist(), sorted([first.pk, second.pk, third.pk, sixth.pk]))
+        self.assertNotIn(seventh.pk, partial_ids)
+        # Строки те же, что в полной матрице: idf считается по всему каталогу
+        full_rows = similarity._rows(full_ids, partial_ids)
+        self.assertTrue(np.allclose(sorted(full[full_rows].data), sorted(partial.data)))
+        self.assertEqual(full[full_rows].dot(full.T).max(), partial.dot(partial.T).max())
+
+
+class RecommendationsTest(TestCase):
+    """Рекомендации по отметкам похожих пользователей, шарды по процессам и офлайн-оценка"""
+
+    def setUp(self):
+        self.fans = User.objects.bulk_create(User(username=f'fan-{i}', password='!') for i in range(4))
+        self.movies = Movie.objects.bulk_create(
+            Movie(title=f'Рекомендация {i}', url=f'recommended-{i}', description='Описание', country='Страна',
+                  preview_poster='media/moviesP/preview.png', poster='media/moviesp/poster.png',
+                  trailer='media/trailers/trailer.mp4', movie_file='media/movies/movie.mp4',
+                  rating_count=1, average_rating=5)
+            for i in range(5))
+        marks = [(0, 0, 'is_favorite'), (0, 1, 'is_watched'),
+                 (1, 0, 'is_watched'), (1, 1, 'is_favorite'), (1, 2, 'is_favorite'),
+                 (2, 0, 'is_planned'), (2, 2, 'is_watched'), (3, 3, 'is_watched')]
+        MovieInteraction.objects.bulk_create(
+            MovieInteraction(user=self.fans[fan], movie=self.movies[movie], **{flag: True})
+            for fan, movie, flag in marks)
+
+    def test_build_recommends_unseen_movies(self):
+        first, second, third, fourth = self.fans
+        self.assertEqual(recommendations.build()[0], 4)
+        self.assertEqual([movie.pk for movie in Recommendation.for_user(first.pk)], [self.movies[2].pk])
+        self.assertEqual([movie.pk for movie in Recommendation.for_user(third.pk)], [self.movies[1].pk])
+        self.assertEqual(Recommendation.for_user(fourth.pk), [])
+        with self.assertNumQueries(1):
+            Recommendation.for_user(second.pk)
+
+        self.assertEqual(self.client.get(reverse('recommendations')).status_code, 403)
+        self.client.force_login(first)
+        response = self.client.get(reverse('recommendations'))
+        self.assertEqual([item['id'] for item in response.json()['results']], [self.movies[2].pk])
+        self.assertContains(self.client.get(reverse('home')), 'Для вас')
+
+        # Отмеченный после расчета фильм сразу пропадает из рекомендаций
+        MovieInteraction.set_flags(first.pk, self.movies[2].pk, is_planned=True)
+        self.assertEqual(self.client.get(reverse('recommendations')).json()['results'], [])
+        self.assertNotContains(self.client.get(reverse('home')), 'Для вас')
+
+        MovieInteraction.objects.filter(user=fourth).delete()
+        call_command('build_recommendations', processes=1, stdout=StringIO())
+        self.assertFalse(Recommendation.objects.filter(user=fourth).exists())
+
+    def test_sharded_run_matches_single_process(self):
+        rows, columns, weights = recommendations.synthetic_interactions(300, 80, 3000, clusters=5)
+        matrix = recommendations.interaction_matrix(rows, columns, weights, (300, 80))
+        similarity_matrix = recommendations.item_similarity(matrix)
+
+        def run(processes):
+            found = {}
+            for user_rows, user_found, values in recommendations.recommend_all(matrix, similarity_matrix, 5, processes):
+                found.update((int(row), (list(movies), list(scores)))
+                             for row, movies, scores in zip(user_rows, user_found, values))
+            return found
+
+        single = run(1)
+        self.assertEqual(len(single), 300)
+        self.assertEqual(single, run(2))
+
+    def test_evaluation_beats_popularity(self):
+        result = recommendations.evaluate(users=2000, movies=500, interactions=40000, k=10)
+        self.assertEqual(result['interactions'], 40000)
+        self.assertGreater(result['precision'], result['baseline_precision'])
+
+
+class TypeaheadTest(TestCase):
+    """Подсказки по началу слов без регистра и диакритики, по популярности; сигналы обновляют индекс на месте"""
+
+    def setUp(self):
+        typeahead.reset()
+        fuzzy.reset()
+        self.addCleanup(typeahead.reset)
+        self.addCleanup(fuzzy.reset)
+        titles = [('The Matrix', 100), ('Matrix Reloaded', 50), ('Amélie Poulain', 10), ('Ёлки', 5), ('Мастер', 1)]
+        self.movies = Movie.objects.bulk_create(
+            Movie(title=title, url=f'typeahead-{i}', description='', country='', rating_count=votes)
+            for i, (title, votes) in enumerate(titles))
+        self.keanu = Actor.objects.create(name='Keanu Reeves', movies_count=3)
+
+    def labels(self, query, group='movies'):
+        return [item['label'] for item in typeahead.search(query)[group]]
+
+    def test_prefix_search_is_folded_and_ranked(self):
+        self.assertEqual(self.labels('matr'), ['The Matrix', 'Matrix Reloaded'])
+        self.assertEqual(self.labels('RELOA'), ['Matrix Reloaded'])
+        self.assertEqual(self.labels('amelie p'), ['Amélie Poulain'])
+        self.assertEqual(self.labels('елк'), ['Ёлки'])
+        self.assertEqual(self.labels('kea', 'people'), ['Keanu Reeves'])
+        self.assertEqual(self.labels('atr'), [])
+        # С четырех букв подсказки по началу слов дополняются совпавшими с опечаткой
+        self.assertEqual(self.labels('atrix'), ['The Matrix', 'Matrix Reloaded'])
+        self.assertEqual(self.labels('Киану', 'people'), ['Keanu Reeves'])
+        self.assertEqual(typeahead.search('  ')['movies'], [])
+
+        response = self.client.get(reverse('typeahead'), {'q': 'matrix r'})
+        self.assertEqual(response.json()['movies'][0]['url'], self.movies[1].get_absolute_url())
+        self.assertEqual(self.client.get(reverse('typeahead'), {'q': 'kea'}).json()['people'][0]['url'],
+                         self.keanu.get_absolute_url())
+        self.assertEqual(self.client.get(reverse('typeahead'), {'q': 'm', 'limit': 'x'}).status_code, 400)
+
+    def test_signals_update_index_in_place(self):
+        index = typeahead.get_index()
+        self.assertEqual(self.labels('ma'), ['The Matrix', 'Matrix Reloaded'])
+        with self.captureOnCommitCallbacks(execute=True):
+            Movie.objects.create(title='Mad Max', url='typeahead-max', description='', country='', rating_count=500)
+            self.movies[0].title = 'Neo'
+            self.movies[0].save()
+            self.movies[1].delete()
+            self.keanu.name = 'Keanu Charles Reeves'
+            self.keanu.save()
+        self.assertIs(typeahead.get_index(), index)
+        self.assertEqual(self.labels('ma'), ['Mad Max'])
+        self.assertEqual(self.labels('neo'), ['Neo'])
+        self.assertEqual(self.labels('charl', 'people'), ['Keanu Charles Reeves'])
+
+    def test_updates_match_fresh_build(self):
+        index = typeahead.PrefixIndex.build([], [])
+        entries = {}
+        for step in range(300):
+            kind, object_id = step % 2, step * 7 % 50
+            if step % 5 == 4:
+                index.remove(kind, object_id)
+                entries.pop((kind, object_id), None)
+            else:
+                label = f'Запись {step % 13} title-{object_id} é{step}'
+                index.put(kind, object_id, label, f'slug-{object_id}', step)
+                entries[kind, object_id] = (object_id, label, f'slug-{object_id}', step)
+        fresh = typeahead.PrefixIndex.build(
+            *[[row for (kind, _), row in sorted(entries.items()) if kind == wanted] for wanted in (0, 1)])
+        self.assertEqual(len(index), len(entries))
+        self.assertEqual([index._key(code) for code in index._codes], [fresh._key(code) for code in fresh._codes])
+        for query in ('зап', 'title-1', 'e1', 'запись 3 t'):
+            self.assertEqual(index.search(query, 20), fresh.search(query, 20))
+
+
+class SharedIndexTest(SimpleTestCase):
+    """Изменения записей доходят до индексов других процессов через журнал в кеше, без перестройки"""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.rows = {1: 'a'}
+        self.loads = 0
+
+    def make(self):
+        def load():
+            self.loads += 1
+            return dict(self.rows)
+
+        def apply(index, change):
+            action, key, *value = change
+            if action == 'put':
+                index[key] = value[0]
+            else:
+                index.pop(key, None)
+        return shared_index.SharedIndex('test:shared', load, apply, "тестовый индекс")
+
+    def test_changes_are_replayed_in_other_processes(self):
+        first, second = self.make(), self.make()
+        self.assertEqual(first.get(), {1: 'a'})
+        self.assertEqual(second.get(), {1: 'a'})
+        first.changed(('put', 2, 'b'))
+        first.changed(('remove', 1))
+        self.assertEqual(first.get(), {2: 'b'})
+        self.assertEqual(second.get(), {2: 'b'})
+        second.changed(('put', 3, 'c'))
+        self.assertEqual(first.get(), {2: 'b', 3: 'c'})
+        self.assertEqual(self.loads, 2)
+
+    def test_lost_changes_and_invalidate_rebuild(self):
+        first, second = self.make(), self.make()
+        first.get()
+        second.get()
+        self.rows[2] = 'b'
+        first.changed(('put', 2, 'b'))
+        cache.delete(f"test:shared:{cache.get('test:shared')}:1")
+        with mock.patch.object(second, '_start_rebuild') as rebuild:
+            self.assertEqual(second.get(), {1: 'a'})
+        rebuild.assert_called_once()
+        second._rebuild_lock.acquire()
+        second._rebuild()
+        self.assertEqual(second.get(), {1: 'a', 2: 'b'})
+
+        second.invalidate()
+        with mock.patch.object(first, '_start_rebuild') as rebuild:
+            first.get()
+        rebuild.assert_called_once()
+        self.assertEqual(self.loads, 3)
+
+class FuzzySearchTest(TestCase):
+    """Поиск имен и названий с опечатками и в другом алфавите"""
+
+    def setUp(self):
+        fuzzy.reset()
+        self.addCleanup(fuzzy.reset)
+        self.movie = Movie.objects.create(title='Шерлок', url='sherlock', description='', country='')
+        names = ['Benedict Cumberbatch', 'Martin Freeman', 'Andrew Scott', 'Бенедикт Вонг']
+        self.actors = [Actor.objects.create(name=name, movies_count=len(names) - i) for i, name in enumerate(names)]
+        self.movie.actors.set(self.actors[:3])
+
+    def test_normalization_and_distance(self):
+        self.assertEqual(fuzzy.normalize('Бенедикт Камбербэтч'), ['benedikt', 'kamberbech'])
+        self.assertEqual(fuzzy.normalize('Benedict Cumberbatch'), ['benedikt', 'kumberbach'])
+        self.assertEqual(fuzzy.normalize('Джонни Депп'), fuzzy.normalize('Johnny Depp'))
+        self.assertEqual(fuzzy.distances('abcd', ['abcd', 'abdc', 'bcd', 'abxcd', 'dcba', '']).tolist(),
+                         [0, 1, 1, 1, 3, 4])
+        self.assertEqual(fuzzy.distances('kitten', ['sitting']).tolist(), [3])
+
+    def test_index_finds_typos_and_transliteration(self):
+        index = fuzzy.NgramIndex.build((actor.pk, actor.name, actor.movies_count) for actor in self.actors)
+        benedict, martin, _, wong = (actor.pk for actor in self.actors)
+        self.assertEqual(index.search('Бенедикт Камбербэтч'), [(benedict, 2)])
+        self.assertEqual(index.search('Cumbrebatch'), [(benedict, 1)])
+        self.assertEqual(index.search('Бенедикт'), [(benedict, 0), (wong, 0)])
+        self.assertEqual(index.search('Фриман'), [(martin, 1)])
+        self.assertEqual(index.search('Tom'), [])
+
+        index.put(wong, 'Benedict Wong', 10)
+        index.remove(martin)
+        self.assertEqual(index.search('benedict'), [(wong, 0), (benedict, 0)])
+        self.assertEqual(index.search('Фриман'), [])
+        self.assertEqual(len(index), 3)
+
+    def test_actor_list_and_movie_search(self):
+        url = reverse('actor_list', args=[self.movie.url])
+        # Фильм, актеры фильма для сверки имен, число найденных и страница - фильм читается один раз
+        with self.assertNumQueries(4):
+            response = self.client.get(url, {'search': 'Камбербэтч'})
+        self.assertEqual([actor.name for actor in response.context['actors']], ['Benedict Cumberbatch'])
+        self.assertEqual(response.context['movie'], self.movie)
+        response = self.client.get(url, {'search': 'eem'})
+        self.assertEqual([actor.name for actor in response.context['actors']], ['Martin Freeman'])
+        response = self.client.get(url, {'search': 'Вонг'})
+        self.assertEqual(list(response.context['actors']), [])
+
+        self.assertEqual(list(self.client.get(reverse('movies'), {'q': 'Sherlok'}).context['movies']), [self.movie])
+        self.assertEqual(list(self.client.get(reverse('movies'), {'q': 'Шерлок'}).context['movies']), [self.movie])
+
+
+class FragmentCacheTest(TestCase):
+    """Версии фрагментов меняются только у затронутых фильмов и групп; счетчики попаданий сбрасываются в кеш"""
+    TEMPLATE = Template(
+        '{% load movie_cache %}{% moviefragment movie "card" "test_card" %}'
+        '{{ movie.title }} {{ movie.rating_count }}{% endmoviefragment %}'
+    )
+
+    def setUp(self):
+        cache.clear()
+        fragments.reset_stats()
+        self.addCleanup(fragments.reset_stats)
+        self.movie = Movie.objects.create(title='Фильм', url='film', description='', country='')
+        self.other = Movie.objects.create(title='Другой', url='other', description='', country='')
+
+    def render(self, movie):
+        return self.TEMPLATE.render(Context({'movie': movie}))
+
+    def versions(self, movie):
+        return {section: fragments.fragment_key(movie.pk, section, 'test') for section in fragments.SECTIONS}
+
+    def test_movie_save_invalidates_its_fragments(self):
+        self.assertEqual(self.render(self.movie), 'Фильм 0')
+        other_versions = self.versions(self.other)
+        self.movie.title = 'Новое название'
+        # Без сохранения фрагмент берется из кеша
+        self.assertEqual(self.render(self.movie), 'Фильм 0')
+        self.movie.save()
+        self.assertEqual(self.render(self.movie), 'Новое название 0')
+        self.assertEqual(self.versions(self.other), other_versions)
+
+    def test_rating_changes_only_card(self):
+        star = RatingStar.objects.create(value=4)
+        self.render(self.movie)
+        before = self.versions(self.movie)
+        Rating.objects.create(ip='10.0.0.1', star=star, movie=self.movie)
+        after = self.versions(self.movie)
+        self.assertEqual([section for section in fragments.SECTIONS if before[section] != after[section]], ['card'])
+        self.movie.refresh_from_db()
+        self.assertEqual(self.render(self.movie), 'Фильм 1')
+
+    def test_season_keeps_fragments_and_bumps_catalog(self):
+        before = self.versions(self.movie)
+        with self.captureOnCommitCallbacks(execute=True):
+            Season.objects.create(movie=self.movie, season_number=1)
+        # Сезоны не входят во фрагменты; меняется только версия раздела API
+        self.assertEqual(self.versions(self.movie), before)
+        self.assertEqual(CatalogVersion.current(['seasons', 'movies'])['seasons'][0], 1)
+
+    def test_stats_are_flushed(self):
+        self.render(self.movie)
+        self.render(self.movie)
+        self.assertEqual(fragments.get_stats()['hits'], 0)
+        fragments.flush_stats()
+        self.assertEqual(fragments.get_stats(), {'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+        for _ in range(fragments.STATS_FLUSH_EVERY):
+            fragments.record('hits')
+        self.assertEqual(fragments.get_stats()['hits'], 1 + fragments.STATS_FLUSH_EVERY)
+
+
+class RatingAggregatesTest(TestCase):
+    """Сумма, количество и среднее оценок фильма сдвигаются сигналами и сверяются с таблицей рейтингов"""
+
+    def setUp(self):
+        self.stars = {value: RatingStar.objects.create(value=value) for value in range(1, 6)}
+        self.movie = Movie.objects.create(title='Фильм', url='film', description='', country='')
+        self.other = Movie.objects.create(title='Другой', url='other', description='', country='')
+
+    def assertAggregates(self, movie, total, count, average):
+        movie.refresh_from_db()
+        self.assertEqual((movie.rating_sum, movie.rating_count, movie.average_rating),
+                         (total, count, Decimal(average)))
+
+    def test_create_change_delete(self):
+        top = Rating.objects.create(ip='10.0.0.1', star=self.stars[5], movie=self.movie)
+        Rating.objects.create(ip='10.0.0.2', star=self.stars[4], movie=self.movie)
+        low = Rating.objects.create(ip='10.0.0.3', star=self.stars[2], movie=self.movie)
+        self.assertAggregates(self.movie, 11, 3, '3.67')
+
+        low.star = self.stars[3]
+        low.save()
+        self.assertAggregates(self.movie, 12, 3, '4.00')
+
+        low.movie = self.other
+        low.save()
+        self.assertAggregates(self.movie, 9, 2, '4.50')
+        self.assertAggregates(self.other, 3, 1, '3.00')
+
+        top.delete()
+        low.delete()
+        self.assertAggregates(self.movie, 4, 1, '4.00')
+        self.assertAggregates(self.other, 0, 0, '0.00')
+
+    def test_rebuild_check(self):
+        Rating.objects.create(ip='10.0.0.1', star=self.stars[5], movie=self.movie)
+        Rating.objects.create(ip='10.0.0.2', star=self.stars[2], movie=self.movie)
+        out = StringIO()
+        call_command('rebuild_rating_aggregates', check=True, stdout=out)
+        self.assertIn('совпадают', out.getvalue())
+
+        Movie.objects.filter(pk=self.movie.pk).update(rating_sum=1, rating_count=1, average_rating=1)
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('rebuild_rating_aggregates', check=True, stdout=out)
+        self.assertIn(f'id={self.movie.pk}', out.getvalue())
+        self.assertNotIn(f'id={self.other.pk}', out.getvalue())
+        # --check ничего не записывает
+        self.assertAggregates(self.movie, 1, 1, '1.00')
+
+        call_command('rebuild_rating_aggregates', stdout=StringIO())
+        self.assertAggregates(self.movie, 7, 2, '3.50')
+        call_command('rebuild_rating_aggregates', check=True, stdout=StringIO())
+
+
+class PopularityTest(TestCase):
+    """Рейтинг популярности: страницы снимка, пометка устаревания и пересборка по расписанию"""
+
+    def setUp(self):
+        self.movies = [
+            Movie.objects.create(title=f'Фильм {i}', url=f'popular-{i}', description='', country='',
+                                 average_rating=5 - i * Decimal('0.5'), rating_count=10 + i)
+            for i in range(7)
+        ]
+        Movie.objects.create(title='Без оценок', url='unrated', description='', country='')
+
+    def page(self, number):
+        return list(self.client.get(reverse('popularity'), {'page': number}).context['page_obj'])
+
+    def test_live_ranking_without_snapshot(self):
+        self.assertEqual(self.page(1), self.movies[:5])
+        self.assertEqual(self.page(2), self.movies[5:])
+        self.assertEqual(list(Movie.get_popular_movies(limit=2, offset=1)), self.movies[1:3])
+        # Страница не строит снимок сама
+        self.assertFalse(PopularitySnapshot.objects.exists())
+
+    def test_snapshot_pages(self):
+        snapshot = PopularitySnapshot.rebuild()
+        self.assertEqual(snapshot.movie_count, 7)
+        # Снимок не меняется, пока его не пересоберут
+        Movie.objects.filter(pk=self.movies[6].pk).update(average_rating=Decimal('9.99'))
+        self.assertEqual(self.page(1), self.movies[:5])
+        self.assertEqual(self.page(2), self.movies[5:])
+        self.assertEqual(self.page(3), self.movies[5:])
+        self.assertEqual(list(Movie.get_popular_movies(limit=2, offset=4)), self.movies[4:6])
+
+    def test_mark_stale_only_latest(self):
+        first = PopularitySnapshot.rebuild()
+        latest = PopularitySnapshot.rebuild()
+        PopularitySnapshot.mark_stale()
+        stale_since = PopularitySnapshot.objects.get(pk=latest.pk).stale_since
+        self.assertIsNotNone(stale_since)
+        self.assertIsNone(PopularitySnapshot.objects.get(pk=first.pk).stale_since)
+        PopularitySnapshot.mark_stale()
+        self.assertEqual(PopularitySnapshot.objects.get(pk=latest.pk).stale_since, stale_since)
+
+    def test_refresh_if_stale(self):
+        call_command('refresh_popularity', if_stale=True, stdout=StringIO())
+        latest = PopularitySnapshot.current()
+        self.assertEqual(latest.movie_count, 7)
+
+        call_command('refresh_popularity', if_stale=True, stdout=StringIO())
+        self.assertEqual(PopularitySnapshot.current(), latest)
+
+        PopularitySnapshot.mark_stale()
+        call_command('refresh_popularity', if_stale=True, stdout=StringIO())
+        rebuilt = PopularitySnapshot.current()
+        self.assertNotEqual(rebuilt, latest)
+        self.assertIsNone(rebuilt.stale_since)
+
+        for _ in range(PopularitySnapshot.KEEP_VERSIONS + 1):
+            call_command('refresh_popularity', stdout=StringIO())
+        self.assertEqual(PopularitySnapshot.objects.count(), PopularitySnapshot.KEEP_VERSIONS)
+
+
+class RandomMovieTest(TestCase):
+    """Готовые ответы случайного фильма: попадание без запросов и сброс при изменении фильма, сезонов и серий"""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.movie = Movie.objects.create(title='Сериал', url='serial', description='', country='', is_series=True,
+                                          average_rating=4, rating_count=3)
+
+    def payload(self):
+        response = self.client.get(reverse('get_random_movie'))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_no_popular_movies(self):
+        Movie.objects.filter(pk=self.movie.pk).update(rating_count=0)
+        self.assertIsNone(random_movie.random_payload())
+        self.assertEqual(self.client.get(reverse('get_random_movie')).status_code, 404)
+
+    def test_cache_hit_without_queries(self):
+        self.assertEqual(self.payload()['title'], 'Сериал')
+        with self.assertNumQueries(0):
+            self.assertEqual(json.loads(random_movie.random_payload())['title'], 'Сериал')
+
+    def test_invalidation(self):
+        self.assertEqual(self.payload()['seasons'], [])
+        self.movie.title = 'Новое название'
+        self.movie.save()
+        self.assertEqual(self.payload()['title'], 'Новое название')
+
+        season = Season.objects.create(movie=self.movie, season_number=1)
+        self.assertEqual(self.payload()['seasons'], [{'id': season.pk, 'season_number': 1, 'episodes': []}])
+
+        episode = Episode.objects.create(season=season, episode_number=1, title='Пилот', video='media/episodes/1.mp4')
+        self.assertEqual([item['title'] for item in self.payload()['seasons'][0]['episodes']], ['Пилот'])
+        episode.title = 'Начало'
+        episode.save()
+        self.assertEqual([item['title'] for item in self.payload()['seasons'][0]['episodes']], ['Начало'])
+        episode.delete()
+        season.delete()
+        self.assertEqual(self.payload()['seasons'], [])
+
+    def test_new_snapshot_resets_candidates(self):
+        self.payload()
+        other = Movie.objects.create(title='Фильм', url='film', description='', country='',
+                                     average_rating=5, rating_count=3)
+        self.assertEqual(list(random_movie.get_candidates()), [self.movie.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            PopularitySnapshot.rebuild()
+        self.assertEqual(list(random_movie.get_candidates()), [other.pk, self.movie.pk])
+        other.delete()
+        self.assertEqual(list(random_movie.get_candidates()), [self.movie.pk])
+
+
+class CatalogFacetsTest(TestCase):
+    """Фильтр по годам диапазонами дат и кеш списков жанров и годов"""
+
+    def setUp(self):
+        cache.clear()
+        self.drama = Genre.objects.create(name='Драма', url='drama', descriptions='')
+        self.movies = [
+            Movie.objects.create(title=title, url=f'facet-{i}', description='', country='', world_premiere=premiere)
+            for i, (title, premiere) in enumerate((
+                ('Начало года', date(2010, 1, 1)), ('Конец года', date(2010, 12, 31)),
+                ('Следующий год', date(2011, 1, 1)), ('Давно', date(1999, 6, 1)),
+            ))
+        ]
+        self.movies[0].genre.add(self.drama)
+
+    def titles(self, years):
+        return sorted(Movie.objects.filter(year_range_filter(years)).values_list('title', flat=True))
+
+    def test_year_range_bounds(self):
+        self.assertEqual(self.titles(['2010']), ['Конец года', 'Начало года'])
+        self.assertEqual(self.titles(['2011', '1999', '2011']), ['Давно', 'Следующий год'])
+        self.assertEqual(self.titles(['2009']), [])
+        # Некорректные и выходящие за диапазон дат годы пропускаются
+        self.assertEqual(self.titles(['abc', '-2010', '0', '9999', '2010']), ['Конец года', 'Начало года'])
+        self.assertEqual(year_range_filter(['abc', '10000']), Q())
+
+    def test_facets_are_cached_and_reset(self):
+        facets = get_catalog_facets()
+        self.assertEqual(facets['years'], [1999, 2010, 2011])
+        self.assertEqual(facets['year_counts'][2010], 2)
+        self.assertEqual([(genre['name'], genre['movie_count']) for genre in facets['genres']], [('Драма', 1)])
+        with self.assertNumQueries(0):
+            get_catalog_facets()
+
+        self.movies[1].genre.add(self.drama)
+        self.assertEqual(get_catalog_facets()['genres'][0]['movie_count'], 2)
+        self.drama.name = 'Драмы'
+        self.drama.save()
+        self.assertEqual(get_catalog_facets()['genres'][0]['name'], 'Драмы')
+        Genre.objects.create(name='Комедия', url='comedy', descriptions='')
+        self.assertEqual([genre['movie_count'] for genre in get_catalog_facets()['genres']], [2, 0])
+
+    def test_movie_save_and_delete_reset_facets(self):
+        self.assertEqual(get_catalog_facets()['year_counts'][2010], 2)
+        self.movies[1].world_premiere = date(2011, 12, 31)
+        self.movies[1].save()
+        self.assertEqual(get_catalog_facets()['year_counts'], {1999: 1, 2010: 1, 2011: 2})
+        Movie.objects.create(title='Черновик', url='draft', description='', country='', draft=True)
+        self.assertEqual(sum(get_catalog_facets()['year_counts'].values()), 4)
+        self.movies[3].delete()
+        self.assertEqual(get_catalog_facets()['years'], [2010, 2011])
+
+
+class MovieSearchTest(TestCase):
+    """Полнотекстовый поиск фильмов: основы слов, BM25 и фильтры каталога"""
+
+    def setUp(self):
+        self.serials = Category.objects.create(name='Сериалы', descriptions='', url='serials')
+        self.films = Category.objects.create(name='Фильмы', descriptions='', url='films')
+        self.drama = Genre.objects.create(name='Драма', url='drama', descriptions='')
+        self.in_title = self.movie('Приключения в космосе', 'Экипаж возвращается домой', date(2010, 5, 1))
+        self.in_description = self.movie('Экипаж', 'Долгие приключения на далекой планете', date(2010, 6, 1))
+        self.other_year = self.movie('Приключение', 'Продолжение', date(2012, 1, 1))
+        self.film = self.movie('Приключения кота', 'Кот ищет дом', date(2010, 7, 1), self.films)
+        self.unrelated = self.movie('Тишина', 'Ничего не происходит', date(2010, 8, 1))
+
+    def movie(self, title, description, premiere, category=None):
+        movie = Movie.objects.create(title=title, description=description, world_premiere=premiere,
+                                     url=f'movie-{Movie.objects.count()}', country='', category=category or self.serials)
+        movie.genre.add(self.drama)
+        return movie
+
+    def test_russian_stem(self):
+        self.assertEqual(search.russian_stem('фильмы'), 'фильм')
+        self.assertEqual(search.russian_stem('фильмов'), 'фильм')
+        self.assertEqual(search.russian_stem('приключения'), search.russian_stem('приключение'))
+        self.assertEqual(search.russian_stem('кот'), 'кот')
+        self.assertEqual(search.russian_stem('matrix'), 'matrix')
+        self.assertEqual(search.tokenize('Приключения в КОСМОСЕ'), ['приключен', 'в', 'космос'])
+
+    def test_bm25_prefers_title_and_rare_words(self):
+        documents = {
+            1: ([{'кот': 1}, {}], (2, 10)),
+            2: ([{}, {'кот': 1}], (2, 10)),
+            3: ([{'мир': 1}, {}], (2, 10)),
+        }
+        scores = search.bm25_scores(documents, {'кот': 2, 'мир': 1}, 10, (2, 10), (10.0, 1.0))
+        self.assertGreater(scores[1], scores[2])
+        self.assertGreater(scores[3], scores[1])
+        # Слово почти во всех документах не дает отрицательной оценки
+        scores = search.bm25_scores(documents, {'кот': 10}, 10, (2, 10), (10.0, 1.0))
+        self.assertGreater(scores[1], 0)
+        self.assertEqual(search.PostgreSQLSearchBackend._frequencies("'кот':1A,5B 'котенок':3B 'мяу':2", ['кот']),
+                         ({'кот': 1}, {'кот': 2}))
+
+    def test_title_match_ranks_above_description(self):
+        found = list(search.search_movies(Movie.objects.all(), 'приключения'))
+        self.assertLess(found.index(self.in_title), found.index(self.in_description))
+        self.assertNotIn(self.unrelated, found)
+        self.assertEqual(list(search.search_movies(Movie.objects.all(), 'экипаж'))[:2],
+                         [self.in_description, self.in_title])
+
+    def test_search_with_catalog_filters(self):
+        comedy = Genre.objects.create(name='Комедия', url='comedy', descriptions='')
+        self.in_description.genre.set([comedy])
+        response = self.client.get(reverse('movies'), {
+            'q': 'приключения', 'genre': 'Драма', 'year': '2010', 'category': 'serials'})
+        self.assertEqual(list(response.context['movies']), [self.in_title])
+        response = self.client.get(reverse('movies'), {'q': 'приключения', 'category': 'movies'})
+        self.assertEqual(list(response.context['movies']), [self.film])
+
+    def test_migration_creates_index_and_post_migrate_fills_it(self):
+        migration = import_module('movie.migrations.0034_search_index')
+        backend = search.get_search_backend()
+        backend.drop()
+        migration.create_search_index(apps, SimpleNamespace(connection=connection))
+        if connection.vendor == 'sqlite':
+            # Основы слов считает код приложения: индекс SQLite заполняет post_migrate
+            self.assertTrue(backend.is_empty())
+            install_search_index(apps.get_app_config('movie'))
+        self.assertEqual(backend.ranked_ids('космос', 10), [self.in_title.pk])
+        install_search_index(apps.get_app_config('movie'))
+        self.assertEqual(backend.ranked_ids('космос', 10), [self.in_title.pk])
+        migration.drop_search_index(apps, SimpleNamespace(connection=connection))
+        migration.create_search_index(apps, SimpleNamespace(connection=connection))
+
+
+class CatalogApiTest(TestCase):
+    """JSON API каталога: выбор полей, вложенные связи, число запросов и условный GET"""
+
+    def setUp(self):
+        self.drama = Genre.objects.create(name='Драма', url='drama', descriptions='')
+        self.crime = Genre.objects.create(name='Криминал', url='crime', descriptions='')
+        self.actor = Actor.objects.create(name='Benedict Cumberbatch')
+        self.series = Movie.objects.create(title='Шерлок', url='sherlock', description='', country='', is_series=True)
+        self.series.genre.set([self.drama, self.crime])
+        self.series.actors.set([self.actor])
+        season = Season.objects.create(movie=self.series, season_number=1)
+        for number in (2, 1):
+            Episode.objects.create(season=season, episode_number=number, title=f'Серия {number}')
+        self.draft = Movie.objects.create(title='Черновик', url='draft', description='', country='', draft=True)
+
+    def url(self, resource, pk=None):
+        return reverse('api_detail', args=[resource, pk]) if pk else reverse('api_list', args=[resource])
+
+    def test_sparse_fields_and_includes(self):
+        response = self.client.get(self.url('movies'), {
+            'fields[movies]': 'title,genres,actors', 'fields[episodes]': 'episode_number',
+            'include': 'actors,seasons.episodes',
+        })
+        self.assertEqual(response.status_code, 200)
+        movie, = response.json()['data']
+        self.assertEqual(movie['title'], 'Шерлок')
+        self.assertEqual(set(movie), {'id', 'title', 'genres', 'actors', 'seasons'})
+        self.assertEqual(movie['genres'], [self.drama.pk, self.crime.pk])
+        self.assertEqual(movie['actors'][0]['name'], 'Benedict Cumberbatch')
+        self.assertEqual([episode['episode_number'] for episode in movie['seasons'][0]['episodes']], [1, 2])
+
+        response = self.client.get(self.url('movies', self.series.pk))
+        self.assertEqual(response.json()['data']['average_rating'], 0.0)
+        self.assertNotIn('genres', response.json()['data'])
+        self.assertEqual(self.client.get(self.url('movies', self.draft.pk)).status_code, 404)
+        self.assertEqual(self.client.get(self.url('genres'), {'fields[genres]': 'nope'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url('movies'), {'include': 'seasons.movie'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url('movies'), {'limit': '101'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url('unknown')).status_code, 404)
+
+    def test_page_is_a_fixed_number_of_queries(self):
+        for number in range(60):
+            movie = Movie.objects.create(title=f'Фильм {number}', url=f'movie-{number}', description='', country='')
+            movie.genre.set([self.drama])
+            movie.directors.set([self.actor])
+            Season.objects.create(movie=movie, season_number=1)
+        params = {'include': 'genres,actors,directors,seasons.episodes', 'limit': 50}
+        # Версии разделов, страница и по запросу на каждую связь
+        with self.assertNumQueries(7):
+            response = self.client.get(self.url('movies'), params)
+        page = response.json()
+        self.assertEqual(len(page['data']), 50)
+        self.assertEqual(page['data'][1]['directors'][0]['id'], self.actor.pk)
+        response = self.client.get(self.url('movies'), {**params, 'cursor': page['next']})
+        self.assertEqual(len(response.json()['data']), 11)
+        self.assertIsNone(response.json()['next'])
+
+    def test_conditional_get(self):
+        url = self.url('movies', self.series.pk)
+        response = self.client.get(url, {'include': 'genres'})
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('"'))
+        with self.assertNumQueries(1):
+            response = self.client.get(url, {'include': 'genres'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # Другие поля - другой ответ и другой ETag
+        self.assertNotEqual(self.client.get(url)['ETag'], etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.crime.name = 'Детектив'
+            self.crime.save()
+        response = self.client.get(url, {'include': 'genres'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['data']['genres'][1]['name'], 'Детектив')
+        self.assertIn('Last-Modified', response)
+        # Жанры не входят в ответ без связи - его ETag не меняется
+        plain = self.client.get(url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.drama.save()
+        self.assertEqual(self.client.get(url)['ETag'], plain)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Rating.objects.create(movie=self.series, ip='127.0.0.1', star=RatingStar.objects.create(value=5))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=plain)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['data']['average_rating'], 5.0)
+
+
+class CatalogExportTest(TestCase):
+    """Потоковая выгрузка каталога: пачки по pk, инкрементальный режим и доступ к выгрузке"""
+
+    def setUp(self):
+        self.genre = Genre.objects.create(name='Драма', url='drama', descriptions='')
+        self.actor = Actor.objects.create(name='Benedict Cumberbatch')
+        self.movies = [Movie.objects.create(title=f'Фильм {number}', url=f'movie-{number}', description='', country='')
+                       for number in range(3)]
+        self.movies[0].genre.set([self.genre])
+        self.movies[0].actors.set([self.actor])
+        season = Season.objects.create(movie=self.movies[1], season_number=1)
+        Episode.objects.create(season=season, episode_number=1, title='Пилот')
+        Movie.objects.create(title='Черновик', url='draft', description='', country='', draft=True)
+
+    def read(self, since=None, chunk_size=export.CHUNK_SIZE):
+        data = b''.join(export.stream(since, chunk_size))
+        return [json.loads(line) for line in gzip.decompress(data).decode().splitlines()]
+
+    def test_full_export_in_keyset_chunks(self):
+        # На пачку - фильмы, три связи, жанры, люди и сезоны; эпизоды - только если есть сезоны
+        with self.assertNumQueries(15):
+            rows = self.read(chunk_size=2)
+        self.assertEqual([row['id'] for row in rows], [movie.pk for movie in self.movies])
+        self.assertEqual(rows[0]['genres'], [{'id': self.genre.pk, 'name': 'Драма', 'slug': 'drama'}])
+        self.assertEqual(rows[0]['actors'], [{'id': self.actor.pk, 'name': 'Benedict Cumberbatch'}])
+        self.assertEqual(rows[1]['seasons'][0]['episodes'][0]['title'], 'Пилот')
+        self.assertEqual(rows[2]['rating_count'], 0)
+
+    def test_incremental_export(self):
+        since = timezone.now()
+        Movie.objects.update(updated_at=since - timedelta(days=1))
+        self.assertEqual(self.read(since), [])
+        self.genre.name = 'Триллер'
+        self.genre.save()
+        Episode.objects.create(season=self.movies[1].seasons.get(), episode_number=2, title='Вторая')
+        Movie.objects.filter(pk=self.movies[2].pk).update(draft=True, updated_at=timezone.now())
+        rows = self.read(since)
+        self.assertEqual([row['id'] for row in rows], [self.movies[0].pk, self.movies[1].pk, self.movies[2].pk])
+        self.assertEqual(rows[0]['genres'][0]['name'], 'Триллер')
+        self.assertEqual(rows[2], {'id': self.movies[2].pk, 'deleted': True})
+
+    def test_view_and_command(self):
+        url = reverse('catalog_export')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_login(User.objects.create_user('staff', password='x', is_staff=True))
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertEqual(len(gzip.decompress(b''.join(response.streaming_content)).splitlines()), 3)
+        self.assertEqual(self.client.get(url, {'since': 'вчера'}).status_code, 400)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'catalog.ndjson.gz')
+            out = StringIO()
+            call_command('export_catalog', path, stdout=out)
+            with gzip.open(path, 'rt') as output:
+                self.assertEqual(len(output.readlines()), 3)
+        self.assertIn('строк/с', out.getvalue())
+
+
+class CatalogImportTest(TestCase):
+    """Массовый импорт каталога: повторная загрузка выгрузки, CSV и продолжение с контрольной точки"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.actor = Actor.objects.create(name='Benedict Cumberbatch')
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', encoding='utf-8') as output:
+            output.write(text)
+        return path
+
+    def test_export_reimport_is_idempotent(self):
+        genre = Genre.objects.create(name='Драма', url='drama', descriptions='')
+        movie = Movie.objects.create(title='Шерлок', url='sherlock', description='', country='')
+        movie.genre.set([genre])
+        movie.actors.set([self.actor])
+        Episode.objects.create(season=Season.objects.create(movie=movie, season_number=1), episode_number=1,
+                               title='Этюд в розовых тонах')
+        rows = [json.loads(line) for line in gzip.decompress(b''.join(export.stream())).decode().splitlines()]
+        rows[0]['title'] = 'Шерлок Холмс'
+        rows[0]['seasons'][0]['episodes'].append({'episode_number': 2, 'title': 'Слепой банкир'})
+        path = self.write('catalog.ndjson', ''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows))
+
+        stats = importer.import_file(path)
+        self.assertEqual((stats.created, stats.updated, stats.errors), (0, 1, []))
+        self.assertEqual(Movie.objects.get().title, 'Шерлок Холмс')
+        self.assertEqual(list(movie.actors.all()), [self.actor])
+        self.assertEqual(list(movie.genre.all()), [genre])
+        self.assertEqual(list(Episode.objects.order_by('episode_number').values_list('title', flat=True)),
+                         ['Этюд в розовых тонах', 'Слепой банкир'])
+        self.assertEqual(Actor.objects.count(), 1)
+
+    def test_csv_resolves_natural_keys(self):
+        path = self.write('catalog.csv', (
+            'slug,title,description,country,year,is_series,genres,actors,directors\n'
+            'sherlock,Шерлок,,UK,2010,true,drama|crime,Benedict Cumberbatch|Martin Freeman,Paul McGuigan\n'
+            'no-title,,,,,,,,\n'
+            'bad-year,Фильм,,,год,,,,\n'
+        ))
+        stats = importer.import_file(path)
+        self.assertEqual(stats.created, 1)
+        self.assertEqual([line for line, _ in stats.errors], [4, 3])
+        movie = Movie.objects.get(url='sherlock')
+        self.assertEqual((movie.year, movie.is_series), (2010, True))
+        self.assertEqual(sorted(movie.genre.values_list('url', flat=True)), ['crime', 'drama'])
+        self.assertEqual(sorted(movie.actors.values_list('name', flat=True)),
+                         ['Benedict Cumberbatch', 'Martin Freeman'])
+        self.assertEqual(list(movie.directors.values_list('name', flat=True)), ['Paul McGuigan'])
+        self.assertEqual(Actor.objects.filter(name='Benedict Cumberbatch').count(), 1)
+        self.actor.refresh_from_db()
+        self.assertEqual((self.actor.acting_count, self.actor.first_year), (1, 2010))
+
+    def test_malformed_rows_do_not_break_the_batch(self):
+        rows = [
+            {'slug': 'null-tagline', 'title': 'Б', 'tagline': None},
+            {'slug': 'valid', 'title': 'Фильм', 'description': '', 'country': '', 'genres': [{'slug': 'drama'}]},
+            {'slug': 'no-number', 'title': 'В', 'seasons': [{'title': 'Первый'}]},
+            {'slug': 'long-genre', 'title': 'Г', 'genres': ['g' * 200]},
+            {'slug': 'bad-seasons', 'title': 'Д', 'seasons': ['1']},
+        ]
+        path = self.write('catalog.ndjson', ''.join(json.dumps(row) + '\n' for row in rows) + '{"slug":\n')
+        stats = importer.import_file(path)
+        self.assertEqual([line for line, _ in stats.errors], [1, 3, 4, 5, 6])
+        self.assertIn('tagline', stats.errors[0][1])
+        self.assertEqual(stats.created, 1)
+        self.assertEqual(list(Movie.objects.values_list('url', flat=True)), ['valid'])
+        self.assertEqual(list(Genre.objects.values_list('url', flat=True)), ['drama'])
+
+    def test_interrupted_import_resumes_from_checkpoint(self):
+        path = self.write('catalog.csv', 'slug,title,description,country\n' + ''.join(
+            f'movie-{number},Фильм {number},,\n' for number in range(5)))
+        checkpoint = importer.Checkpoint(f'{path}.checkpoint', path)
+
+        def interrupt(stats):
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            importer.import_file(path, batch_size=2, checkpoint=checkpoint, progress=interrupt)
+        self.assertEqual(Movie.objects.count(), 2)
+        self.assertEqual(checkpoint.load(), 2)
+
+        stats = importer.import_file(path, batch_size=2, checkpoint=checkpoint)
+        self.assertEqual((stats.rows, stats.created), (3, 3))
+        self.assertEqual(Movie.objects.count(), 5)
+        self.assertFalse(os.path.exists(checkpoint.path))
+
+        out = StringIO()
+        call_command('import_catalog', path, stdout=out)
+        self.assertIn('строк/с', out.getvalue())
+        self.assertEqual(Movie.objects.count(), 5)
+
+
+def box(type, *children, payload=b'', large=False):
+    """Атом MP4; large - заголовок с 64-битным размером"""
+    payload = b''.join(children) + payload
+    if large:
+        return struct.pack('>I4sQ', 1, type, len(payload) + 16) + payload
+    return struct.pack('>I4s', len(payload) + 8, type) + payload
+
+
+def table(type, fmt, rows, prefix=b''):
+    return box(type, payload=b'\0' * 4 + prefix + struct.pack('>I', len(rows)) + b''.join(
+        struct.pack(fmt, *row) for row in rows))
+
+
+class ImageVariantsTest(TestCase):
+    """Варианты изображений по содержимому и srcset в шаблонном теге"""
+    TEMPLATE = Template('{% load movie_images %}{% responsive_image actor.image "actor" alt="Фото" %}')
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, MEDIA_URL='/media/')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        cache.clear()
+
+    def write_image(self, name, size, color='red'):
+        os.makedirs(os.path.dirname(os.path.join(self.media_root, name)), exist_ok=True)
+        Image.new('RGB', size, color).save(os.path.join(self.media_root, name), 'PNG')
+
+    def test_variants_are_content_addressed(self):
+        self.write_image('actors/face.png', (500, 250))
+        manifest = images.generate_variants('actors/face.png', 'actor')
+        self.assertEqual([(variant['width'], variant['height'], variant['type']) for variant in manifest['variants']],
+                         [(100, 50, 'image/webp'), (100, 50, 'image/jpeg'), (200, 100, 'image/webp'),
+                          (200, 100, 'image/jpeg'), (400, 200, 'image/webp'), (400, 200, 'image/jpeg')])
+        for variant in manifest['variants']:
+            self.assertIn(manifest['hash'][:32], variant['name'])
+            with Image.open(os.path.join(self.media_root, variant['name'])) as image:
+                self.assertEqual(image.size, (variant['width'], variant['height']))
+
+        # Тот же файл второй раз не обрабатывается, тот же контент под другим именем дает те же варианты
+        with mock.patch.object(images.Image, 'open') as image_open:
+            self.assertEqual(images.generate_variants('actors/face.png', 'actor'), manifest)
+        image_open.assert_not_called()
+        self.write_image('actors/copy.png', (500, 250))
+        self.assertEqual(images.generate_variants('actors/copy.png', 'actor')['variants'], manifest['variants'])
+
+        # Новая картинка под тем же именем получает новые варианты; узкий исходник не увеличивается
+        self.write_image('actors/face.png', (150, 300), color='blue')
+        self.assertIsNone(images.read_manifest('actors/face.png'))
+        changed = images.generate_variants('actors/face.png', 'actor')
+        self.assertNotEqual(changed['hash'], manifest['hash'])
+        self.assertEqual(sorted({variant['width'] for variant in changed['variants']}), [100, 150])
+
+    def test_srcset(self):
+        self.write_image('actors/face.png', (500, 250))
+        with self.captureOnCommitCallbacks(execute=True):
+            actor = Actor.objects.create(name='Актер')
+        self.assertEqual(self.TEMPLATE.render(Context({'actor': actor})), '')
+        actor.image = 'actors/face.png'
+        self.assertEqual(self.TEMPLATE.render(Context({'actor': actor})),
+                         '<img src="/media/actors/face.png" alt="Фото">')
+
+        # Сохранение только отмечает картинку: варианты строит команда
+        with self.captureOnCommitCallbacks(execute=True):
+            actor.save()
+        self.assertEqual(list(ImageVariantsUpdate.objects.values_list('file', 'kind')), [('actors/face.png', 'actor')])
+        self.assertIsNone(images.get_variants(actor.image))
+        call_command('build_image_variants', '--pending', workers=1, stdout=StringIO())
+        self.assertFalse(ImageVariantsUpdate.objects.exists())
+        html = self.TEMPLATE.render(Context({'actor': actor}))
+        manifest = images.get_variants(actor.image)
+        webp = [f"/media/{variant['name']} {variant['width']}w"
+                for variant in manifest['variants'] if variant['type'] == 'image/webp']
+        self.assertEqual(len(webp), 3)
+        self.assertIn(f'<source type="image/webp" srcset="{", ".join(webp)}" sizes="200px">', html)
+        self.assertIn(f'src="/media/{manifest["variants"][3]["name"]}"', html)
+        self.assertTrue(html.startswith('<picture>') and html.endswith('</picture>'))
+        self.assertEqual(images.variant_url(actor.image, 1000), f'/media/{manifest["variants"][5]["name"]}')
+
+
+class ChunkedUploadTest(TestCase):
+    """Загрузка видео частями: протокол, продолжение после обрыва и выдача файла форме"""
+    DATA = b'0123456789'
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(
+            MEDIA_ROOT=self.media_root, CHUNKED_UPLOAD_TEMP_DIR=os.path.join(self.media_root, 'partials'),
+            CHUNKED_UPLOAD_CHUNK_SIZE=4)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create_user('staff', password='x', is_staff=True)
+        self.client.force_login(self.user)
+
+    def start(self):
+        response = self.client.post(reverse('chunked_upload_start'),
+                                    {'target': 'episode.video', 'filename': 'clip.mp4', 'size': len(self.DATA)})
+        self.assertEqual(response.status_code, 201)
+        return response.json()['id']
+
+    def put(self, pk, offset, data, checksum=None):
+        return self.client.put(f"{reverse('chunked_upload', args=[pk])}?offset={offset}", data,
+                               content_type='application/octet-stream',
+                               headers={'X-Chunk-SHA256': checksum or hashlib.sha256(data).hexdigest()})
+
+    def upload(self):
+        pk = self.start()
+        for offset in range(0, len(self.DATA), 4):
+            self.assertEqual(self.put(pk, offset, self.DATA[offset:offset + 4]).status_code, 200)
+        self.assertEqual(self.client.post(reverse('chunked_upload_complete', args=[pk]),
+                                          {'checksum': self.checksum()}).status_code, 200)
+        return pk
+
+    def checksum(self):
+        return hashlib.sha256(b''.join(hashlib.sha256(self.DATA[offset:offset + 4]).digest()
+                                       for offset in range(0, len(self.DATA), 4))).hexdigest()
+
+    def test_resume_and_complete(self):
+        pk = self.start()
+        self.assertEqual(self.put(pk, 0, b'0123').json()['offset'], 4)
+        # После обрыва клиент узнает смещение и продолжает с него
+        self.assertEqual(self.client.get(reverse('chunked_upload', args=[pk])).json()['offset'], 4)
+        self.assertEqual(self.put(pk, 0, b'0123').status_code, 409)
+        self.assertEqual(self.put(pk, 4, b'4567').json()['offset'], 8)
+        response = self.client.post(reverse('chunked_upload_complete', args=[pk]), {'checksum': 'f' * 64})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.put(pk, 8, b'89').json()['offset'], 10)
+        response = self.client.post(reverse('chunked_upload_complete', args=[pk]), {'checksum': self.checksum()})
+        status = response.json()
+        self.assertTrue(status['complete'])
+        with open(os.path.join(self.media_root, status['file']), 'rb') as file:
+            self.assertEqual(file.read(), self.DATA)
+
+        other = User.objects.create_user('other', password='x', is_staff=True)
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(reverse('chunked_upload', args=[pk])).status_code, 404)
+
+    def test_checksum_mismatch(self):
+        pk = self.start()
+        response = self.put(pk, 0, b'0123', checksum=hashlib.sha256(b'3210').hexdigest())
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(ChunkedUpload.objects.get(pk=pk).offset, 0)
+        self.assertEqual(os.path.getsize(ChunkedUpload.objects.get(pk=pk).partial_path), 0)
+        for offset in range(0, len(self.DATA), 4):
+            self.put(pk, offset, self.DATA[offset:offset + 4])
+        response = self.client.post(reverse('chunked_upload_complete', args=[pk]),
+                                    {'checksum': hashlib.sha256(self.DATA).hexdigest()})
+        self.assertEqual(response.status_code, 400)
+        self.assertIsNone(ChunkedUpload.objects.get(pk=pk).completed_at)
+
+    def test_field_accepts_own_upload_once(self):
+        pk = self.upload()
+        name = ChunkedUpload.objects.get(pk=pk).file
+        other = User.objects.create_user('other', password='x', is_staff=True)
+        with self.assertRaises(ValidationError):
+            ChunkedUploadField('episode.video', user=other).clean(pk)
+        with self.assertRaises(ValidationError):
+            ChunkedUploadField('movie.trailer', user=self.user).clean(pk)
+        with self.assertRaises(ValidationError):
+            ChunkedUploadField('episode.video', user=self.user).clean('not-a-uuid')
+        field = ChunkedUploadField('episode.video', user=self.user)
+        # Проверка формы загрузку не забирает: форму можно отправить повторно
+        self.assertEqual(field.clean(pk), name)
+        self.assertEqual(field.clean(pk), name)
+        field.claim(pk)
+        with self.assertRaises(ValidationError):
+            field.clean(pk)
+        with self.assertRaises(ChunkedUploadError):
+            field.claim(pk)
+        self.assertIsNone(field.clean(''))
+
+    def test_admin_claims_upload_after_valid_form(self):
+        self.user.is_superuser = True
+        self.user.save()
+        movie = Movie.objects.create(title='Сериал', url='serial', description='', country='', is_series=True)
+        season = Season.objects.create(movie=movie, season_number=1)
+        pk = self.upload()
+        name = ChunkedUpload.objects.get(pk=pk).file
+        data = {'season': season.pk, 'episode_number': 1, 'title': '', 'duration_minutes': 0, 'video': pk}
+
+        response = self.client.post(reverse('admin:movie_episode_add'), data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(ChunkedUpload.objects.filter(pk=pk).exists())
+        self.assertContains(response, f'value="{pk}"')
+
+        response = self.client.post(reverse('admin:movie_episode_add'), dict(data, title='Пилот'))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Episode.objects.get(season=season).video.name, name)
+        self.assertFalse(ChunkedUpload.objects.filter(pk=pk).exists())
+
+    def test_clean_abandoned(self):
+        abandoned = ChunkedUpload.objects.get(pk=self.start())
+        self.put(abandoned.pk, 0, b'0123')
+        fresh = ChunkedUpload.objects.get(pk=self.start())
+        completed = self.upload()
+        unclaimed = ChunkedUpload.objects.get(pk=self.upload())
+        in_use = ChunkedUpload.objects.get(pk=self.upload())
+        Episode.objects.create(season=Season.objects.create(movie=Movie.objects.create(
+            title='Сериал', url='serial', description='', country=''), season_number=1),
+            episode_number=1, title='Пилот', video=in_use.file)
+        ChunkedUpload.objects.filter(pk__in=[abandoned.pk, completed]).update(
+            updated_at=timezone.now() - timedelta(days=2))
+        ChunkedUpload.objects.filter(pk__in=[unclaimed.pk, in_use.pk]).update(
+            completed_at=timezone.now() - timedelta(days=2))
+
+        call_command('clean_chunked_uploads', hours=24, stdout=StringIO())
+        self.assertEqual({str(pk) for pk in ChunkedUpload.objects.values_list('pk', flat=True)},
+                         {str(fresh.pk), completed})
+        self.assertFalse(os.path.exists(abandoned.partial_path))
+        self.assertTrue(os.path.exists(fresh.partial_path))
+        # Никем не забранный файл удаляется, а уже сохраненный в записи остается
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, unclaimed.file)))
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, in_use.file)))
+
+
+class MediaPreparationTest(TestCase):
+    """Перенос moov в начало с пересчетом смещений чанков и индекс ключевых кадров"""
+    # Четыре сэмпла по секунде в двух чанках; ключевые - первый и третий
+    SAMPLES = [bytes([number]) * size for number, size in enumerate((10, 20, 30, 40), start=1)]
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def write_video(self, name, large_moov=False):
+        ftyp = box(b'ftyp', payload=b'isom\0\0\0\0isom')
+        mdat_data = b''.join(self.SAMPLES)
+        first_chunk = len(ftyp) + 8
+        stbl = box(
+            b'stbl',
+            table(b'stts', '>II', [(4, 1000)]),
+            table(b'stsc', '>III', [(1, 2, 1)]),
+            table(b'stsz', '>I', [(len(sample),) for sample in self.SAMPLES], prefix=struct.pack('>I', 0)),
+            table(b'stco', '>I', [(first_chunk,), (first_chunk + 30,)]),
+            table(b'stss', '>I', [(1,), (3,)]),
+        )
+        trak = box(b'trak', box(
+            b'mdia',
+            box(b'mdhd', payload=b'\0' * 12 + struct.pack('>II', 1000, 4000) + b'\0' * 4),
+            box(b'hdlr', payload=b'\0' * 8 + b'vide' + b'\0' * 13),
+            box(b'minf', stbl),
+        ))
+        path = os.path.join(self.media_root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(ftyp + box(b'mdat', payload=mdat_data) + box(b'moov', trak, large=large_moov))
+        return path
+
+    def assert_samples_at_chunk_offsets(self, path):
+        with open(path, 'rb') as file:
+            boxes = mp4.scan_top_level(file)
+            self.assertEqual([type for type, _, _ in boxes], [b'ftyp', b'moov', b'mdat'])
+            _, moov = mp4.read_moov(file, boxes)
+            stbl = moov.find(b'trak', b'mdia', b'minf', b'stbl')
+            offsets = mp4._read_chunk_offsets(stbl.find(b'stco'))
+            data = []
+            for offset, samples in zip(offsets, (self.SAMPLES[:2], self.SAMPLES[2:])):
+                file.seek(offset)
+                data.append(file.read(sum(len(sample) for sample in samples)))
+        self.assertEqual(data, [b''.join(self.SAMPLES[:2]), b''.join(self.SAMPLES[2:])])
+        return offsets
+
+    def test_faststart_shifts_chunk_offsets(self):
+        for large_moov in (False, True):
+            with self.subTest(large_moov=large_moov):
+                path = self.write_video('film.mp4', large_moov)
+                self.assertTrue(mp4.faststart(path))
+                offsets = self.assert_samples_at_chunk_offsets(path)
+                self.assertFalse(mp4.faststart(path))
+
+                duration, keyframes = mp4.keyframe_index(path)
+                self.assertEqual(duration, 4.0)
+                self.assertEqual(keyframes, [(0, offsets[0]), (2000, offsets[1])])
+
+    def test_upload_is_marked_and_prepared_by_command(self):
+        self.write_video('media/episodes/pilot.mp4')
+        movie = Movie.objects.create(title='Сериал', url='series', description='', country='')
+        season = Season.objects.create(movie=movie, season_number=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            Episode.objects.create(season=season, episode_number=1, title='Пилот', video='media/episodes/pilot.mp4')
+        # Сохранение только отмечает файл: перезапись выполняет команда
+        seek_index = MediaSeekIndex.objects.get(file='media/episodes/pilot.mp4')
+        self.assertTrue(seek_index.pending)
+        self.assertEqual(seek_index.keyframe_list(), [])
+
+        call_command('prepare_media', '--pending', stdout=StringIO())
+        seek_index.refresh_from_db()
+        self.assertFalse(seek_index.pending)
+        offsets = self.assert_samples_at_chunk_offsets(os.path.join(self.media_root, seek_index.file))
+        self.assertEqual(seek_index.duration, 4.0)
+        self.assertEqual([seek_index.offset_for(seconds) for seconds in (-1, 0, 1.9, 2, 2.5, 60)],
+                         [0, offsets[0], offsets[0], offsets[1], offsets[1], offsets[1]])
+
+
+    def test_missing_tables_raise_mp4_error(self):
+        path = os.path.join(self.media_root, 'broken.mp4')
+        trak = box(b'trak', box(b'mdia', box(b'hdlr', payload=b'\0' * 8 + b'vide' + b'\0' * 13)))
+        with open(path, 'wb') as file:
+            file.write(box(b'ftyp', payload=b'isom\0\0\0\0isom') + box(b'moov', trak))
+        with self.assertRaises(mp4.MP4Error):
+            mp4.keyframe_index(path)
+
+    def test_seek_parameter_starts_at_keyframe(self):
+        path = self.write_video('media/films/film.mp4')
+        MediaSeekIndex.prepare(SimpleNamespace(name='media/films/film.mp4', path=path))
+        offsets = self.assert_samples_at_chunk_offsets(path)
+        with open(path, 'rb') as file:
+            data = file.read()
+        url = reverse('media', kwargs={'path': 'media/films/film.mp4'})
+
+        response = self.client.get(url, {'t': '2.5'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes {offsets[1]}-{len(data) - 1}/{len(data)}')
+        self.assertEqual(b''.join(response.streaming_content), data[offsets[1]:])
+        # Заголовок Range важнее параметра, некорректное время игнорируется
+        self.assertEqual(self.client.get(url, {'t': '2.5'}, headers={'Range': 'bytes=0-9'})['Content-Range'],
+                         f'bytes 0-9/{len(data)}')
+        self.assertEqual(self.client.get(url, {'t': 'nan'}).status_code, 200)
+
+        # Индекс от прежней версии файла не используется
+        with open(path, 'ab') as file:
+            file.write(b'\0')
+        self.assertEqual(self.client.get(url, {'t': '2.5'}).status_code, 200)
+
+class MediaStreamingTest(SimpleTestCase):
+    """Отдача больших медиафайлов целиком, отрезками и условными запросами"""
+    SIZE = 32 * 1024 * 1024 + 123
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.media_root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(cls.media_root, 'media', 'movies'))
+        cls.content = bytes(range(256)) * (cls.SIZE // 256) + bytes(range(cls.SIZE % 256))
+        with open(os.path.join(cls.media_root, 'media', 'movies', 'film.mp4'), 'wb') as file:
+            file.write(cls.content)
+        cls.settings_override = override_settings(MEDIA_ROOT=cls.media_root, MEDIA_STREAMING_OFFLOAD=None)
+        cls.settings_override.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings_override.disable()
+        shutil.rmtree(cls.media_root)
+        super().tearDownClass()
+
+    def get(self, **headers):
+        request = RequestFactory().get('/media/media/movies/film.mp4', headers=headers)
+        return serve_media(request, 'media/movies/film.mp4')
+
+    def body(self, response):
+        try:
+            return b''.join(response.streaming_content)
+        finally:
+            response.close()
+
+    def test_full_file(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'video/mp4')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(int(response['Content-Length']), self.SIZE)
+        self.assertEqual(self.body(response), self.content)
+
+    def test_single_range(self):
+        response = self.get(range='bytes=1000-1999')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 1000-1999/{self.SIZE}')
+        self.assertEqual(response['Content-Length'], '1000')
+        self.assertEqual(self.body(response), self.content[1000:2000])
+
+    def test_seeking_open_ended_and_suffix_ranges(self):
+        for offset in (0, self.SIZE // 3, self.SIZE - 1):
+            response = self.get(range=f'bytes={offset}-')
+            self.assertEqual(response['Content-Range'], f'bytes {offset}-{self.SIZE - 1}/{self.SIZE}')
+            self.assertEqual(self.body(response), self.content[offset:])
+        response = self.get(range='bytes=-500')
+        self.assertEqual(self.body(response), self.content[-500:])
+        response = self.get(range=f'bytes=10-{self.SIZE * 2}')
+        self.assertEqual(self.body(response), self.content[10:])
+
+    def test_multiple_ranges(self):
+        response = self.get(range='bytes=0-9, 5000000-5000099, -10')
+        self.assertEqual(response.status_code, 206)
+        boundary = re.search(r'boundary=(\w+)', response['Content-Type']).group(1)
+        body = self.body(response)
+        self.assertEqual(len(body), int(response['Content-Length']))
+        parts = body.split(f'--{boundary}'.encode())[1:-1]
+        expected = [(0, 9), (5000000, 5000099), (self.SIZE - 10, self.SIZE - 1)]
+        self.assertEqual(len(parts), len(expected))
+        for part, (start, end) in zip(parts, expected):
+            head, data = part.split(b'\r\n\r\n', 1)
+            self.assertIn(f'Content-Range: bytes {start}-{end}/{self.SIZE}'.encode(), head)
+            self.assertEqual(data[:-2], self.content[start:end + 1])
+
+    def test_overlapping_ranges_are_merged(self):
+        response = self.get(range='bytes=100-199,150-299')
+        self.assertEqual(response['Content-Range'], f'bytes 100-299/{self.SIZE}')
+        self.assertEqual(self.body(response), self.content[100:300])
+
+    def test_unsatisfiable_and_invalid_ranges(self):
+        response = self.get(range=f'bytes={self.SIZE}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{self.SIZE}')
+        for header in ('bytes=abc', 'bytes=5-1', 'items=0-1'):
+            response = self.get(range=header)
+            self.assertEqual(response.status_code, 200)
+            response.close()
+
+    def test_conditional_requests(self):
+        first = self.get(range='bytes=0-0')
+        etag, last_modified = first['ETag'], first['Last-Modified']
+        first.close()
+        self.assertEqual(self.get(if_none_match=etag).status_code, 304)
+        self.assertEqual(self.get(if_modified_since=last_modified).status_code, 304)
+
+        response = self.get(range='bytes=0-9', if_range=etag)
+        self.assertEqual(response.status_code, 206)
+        response.close()
+        response = self.get(range='bytes=0-9', if_range='"stale"')
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+    def test_concurrent_readers(self):
+        chunk = 1024 * 1024
+        offsets = [index * chunk + 17 for index in range(24)]
+
+        def read(offset):
+            response = self.get(range=f'bytes={offset}-{offset + chunk - 1}')
+            return offset, self.body(response)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for offset, data in executor.map(read, offsets):
+                self.assertEqual(data, self.content[offset:offset + chunk])
+
+    def test_offload_to_frontend_server(self):
+        with self.settings(MEDIA_STREAMING_OFFLOAD='x-accel-redirect', MEDIA_STREAMING_ACCEL_PREFIX='/protected/'):
+            response = self.get(range='bytes=0-9')
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/media/movies/film.mp4')
+        self.assertEqual(response.content, b'')
+
+    def test_paths_outside_media_root(self):
+        request = RequestFactory().get('/media/../settings.py')
+        for path in ('../settings.py', 'media/movies', 'media/movies/missing.mp4'):
+            with self.assertRaises(Http404):
+                serve_media(request, path)
+
+
+class InteractionStatusTest(TestCase):
+    """Отметки пользователя для списка фильмов одним запросом, ETag и сброс при переключении"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('viewer', 'viewer@example.com', 'password')
+        self.movies = [Movie.objects.create(title=f'Фильм {i}', url=f'status-{i}', description='', country='')
+                       for i in range(3)]
+        MovieInteraction.objects.create(user=self.user, movie=self.movies[0], is_favorite=True)
+
+    def get(self, ids, **headers):
+        return self.client.get(reverse('interaction_statuses'), {'ids': ids}, headers=headers)
+
+    def test_etag_and_not_modified(self):
+        ids = f'{self.movies[0].pk},{self.movies[1].pk}'
+        self.assertEqual(self.get(ids).status_code, 403)
+        self.client.force_login(self.user)
+
+        response = self.get(ids)
+        statuses = response.json()['statuses']
+        self.assertEqual(statuses[str(self.movies[0].pk)]['is_favorite'], True)
+        self.assertEqual(statuses[str(self.movies[1].pk)], {'is_favorite': False, 'is_watched': False,
+                                                            'is_planned': False})
+        etag = response['ETag']
+        self.assertIn('private', response['Cache-Control'])
+        with self.assertNumQueries(2):  # сессия и пользователь
+            self.assertEqual(self.get(ids, if_none_match=etag).status_code, 304)
+        self.assertNotEqual(self.get(str(self.movies[2].pk))['ETag'], etag)
+
+        self.client.post(f'/toggle/{self.movies[1].pk}/watched/')
+        response = self.get(ids, if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['statuses'][str(self.movies[1].pk)]['is_watched'])
+
+    def test_bad_ids(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.get('1,x').status_code, 400)
+        self.assertEqual(self.get(','.join(map(str, range(1, MAX_IDS + 2)))).status_code, 400)
+        self.assertEqual(self.get('').json(), {'statuses': {}})
+
+    def test_annotate_movies(self):
+        with self.assertNumQueries(1):
+            statuses = annotate_movies(self.user, self.movies)
+        self.assertEqual([movie.interaction_status['is_favorite'] for movie in self.movies], [True, False, False])
+        self.assertEqual(set(statuses), {movie.pk for movie in self.movies})
+        with self.assertNumQueries(0):
+            annotate_movies(self.user, self.movies)
+
+        # Правка через админку сбрасывает кеш сигналом
+        MovieInteraction.objects.get(movie=self.movies[0]).delete()
+        annotate_movies(self.user, self.movies)
+        self.assertFalse(self.movies[0].interaction_status['is_favorite'])
+
+        self.assertEqual(annotate_movies(AnonymousUser(), self.movies), {})
+        self.assertIsNone(self.movies[0].interaction_status)
+
+
+class InteractionToggleTest(TransactionTestCase):
+    """Одновременные переключения одной отметки не теряются: итог определяется чётностью числа нажатий"""
+    TOGGLES = 41
+
+    def setUp(self):
+        self.user = User.objects.create_user('toggler', 'toggler@example.com', 'password')
+        self.movie = Movie.objects.create(
+            title='Toggle', url='toggle', description='Описание', country='Страна',
+            preview_poster='media/moviesP/preview.png', poster='media/moviesp/poster.png',
+        )
+
+    def toggle(self, _):
+        try:
+            while True:
+                try:
+                    return MovieInteraction.toggle(self.user.pk, self.movie.pk, 'favorite')
+                except OperationalError:
+                    # SQLite с общей памятью не ждёт блокировку, а сразу возвращает ошибку; команда при
+                    # этом не выполняется, поэтому повтор безопасен
+                    continue
+        finally:
+            connection.close()
+
+    def test_parallel_toggles_keep_parity(self):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(self.toggle, range(self.TOGGLES)))
+        interaction = MovieInteraction.objects.get(user=self.user, movie=self.movie)
+        self.assertTrue(interaction.is_favorite)
+        self.assertFalse(interaction.is_watched or interaction.is_planned)
+        self.assertEqual(results.count(True), self.TOGGLES // 2 + 1)
+        self.assertEqual(MovieInteraction.objects.count(), 1)
+
+    def test_view_requires_post_and_login(self):
+        url = f'/toggle/{self.movie.pk}/watched/'
+        self.assertEqual(self.client.post(url).status_code, 403)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(url).status_code, 405)
+        self.assertEqual(self.client.post(url).json(), {'is_watched': True})
+        self.assertEqual(self.client.post(url).json(), {'is_watched': False})
+        self.assertEqual(self.client.post(f'/toggle/{self.movie.pk}/liked/').status_code, 400)
+        self.assertEqual(self.client.post(f'/toggle/{self.movie.pk + 1}/watched/').status_code, 404)
+
+
+@override_settings(RATING_BUFFER_INTERVAL=None, RATING_BUFFER_SIZE=10)
+class RatingBufferTest(TestCase):
+    """Голоса копятся в буфере, повторные голоса схлопываются, сброс пишет одну строку на посетителя"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.stars = {star.value: star for star in RatingStar.objects.bulk_create(
+            RatingStar(value=value) for value in range(1, 6))}
+        cls.movie = Movie.objects.create(
+            title='Rated', url='rated', description='Описание', country='Страна',
+            preview_poster='media/moviesP/preview.png', poster='media/moviesp/poster.png',
+        )
+
+    def setUp(self):
+        self.addCleanup(rating_buffer.flush)
+
+    def vote(self, value, ip='10.0.0.1', movie_id=None):
+        return self.client.post('/add-rating/', {'movie': movie_id or self.movie.pk, 'star': self.stars[value].pk},
+                                REMOTE_ADDR=ip)
+
+    def test_repeat_votes_are_coalesced(self):
+        for value in (1, 5, 3):
+            response = self.vote(value)
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(response.json(), {'rating': value})
+        self.vote(4, ip='10.0.0.2')
+        self.assertFalse(Rating.objects.exists())
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(rating_buffer.flush(), 2)
+        self.assertLessEqual(len(queries), 10)
+        self.assertEqual(dict(Rating.objects.values_list('ip', 'star__value')), {'10.0.0.1': 3, '10.0.0.2': 4})
+        self.movie.refresh_from_db()
+        self.assertEqual((self.movie.rating_sum, self.movie.rating_count), (7, 2))
+
+        self.vote(1)
+        rating_buffer.flush()
+        self.movie.refresh_from_db()
+        self.assertEqual((self.movie.rating_sum, self.movie.rating_count), (5, 2))
+        self.assertEqual(Rating.objects.count(), 2)
+        self.assertEqual(sorted(RatingStar.objects.values_list('value', flat=True)), [1, 2, 3, 4, 5])
+
+    def test_flush_on_size_threshold(self):
+        for number in range(10):
+            self.vote(2, ip=f'10.0.1.{number}')
+        self.assertEqual(rating_buffer.pending_count(), 0)
+        self.assertEqual(Rating.objects.count(), 10)
+
+    def test_unknown_movie(self):
+        self.assertEqual(self.vote(5, movie_id=self.movie.pk + 1).status_code, 404)
+        self.assertEqual(rating_buffer.pending_count(), 0)
+
+    def test_invalid_address_is_rejected(self):
+        response = self.client.post('/add-rating/', {'movie': self.movie.pk, 'star': self.stars[5].pk},
+                                    HTTP_X_FORWARDED_FOR='x' * 40 + ', 10.0.0.1')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.vote(5, ip=' 10.0.0.7 ').status_code, 201)
+        self.assertEqual(rating_buffer.pending_value(self.movie.pk, '10.0.0.7'), 5)
+        self.assertEqual(rating_buffer.pending_count(), 1)
+
+    def test_ipv6_vote(self):
+        self.assertEqual(self.vote(4, ip='2001:0DB8:85A3:0000:0000:8A2E:0370:7334').status_code, 201)
+        self.assertEqual(rating_buffer.pending_value(self.movie.pk, '2001:db8:85a3::8a2e:370:7334'), 4)
+        self.assertEqual(rating_buffer.flush(), 1)
+        self.assertEqual(Rating.objects.get().ip, '2001:db8:85a3::8a2e:370:7334')
+
+    @skipUnless(connection.vendor == 'sqlite', "Ошибка записи одного голоса имитируется триггером SQLite")
+    def test_failing_vote_is_dropped_and_others_written(self):
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE TRIGGER reject_vote BEFORE INSERT ON movie_rating WHEN NEW.ip = '10.0.3.1' "
+                           "BEGIN SELECT RAISE(ABORT, 'rejected'); END")
+        removed_star = RatingStar.objects.create(value=6)
+        for number, value in enumerate((4, 2, 5)):
+            self.vote(value, ip=f'10.0.3.{number}')
+        rating_buffer.add(self.movie.pk, '10.0.3.9', removed_star)
+        removed_star.delete()
+
+        with self.assertLogs('movie.rating_buffer', 'ERROR') as logs:
+            self.assertEqual(rating_buffer.flush(), 2)
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(rating_buffer.pending_count(), 0)
+        self.assertEqual(dict(Rating.objects.values_list('ip', 'star__value')), {'10.0.3.0': 4, '10.0.3.2': 5})
+        self.movie.refresh_from_db()
+        self.assertEqual((self.movie.rating_sum, self.movie.rating_count), (9, 2))
+
+        # Следующий сброс не спотыкается о прежние голоса
+        self.vote(3, ip='10.0.3.3')
+        self.assertEqual(rating_buffer.flush(), 1)
+        self.assertEqual(Rating.objects.count(), 3)
+
+    def test_summary_from_counters(self):
+        for number, value in enumerate((5, 5, 4, 1)):
+            self.vote(value, ip=f'10.0.2.{number}')
+        rating_buffer.flush()
+        self.vote(3, ip='10.0.2.3')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/get-rating/', {'movie_id': self.movie.pk}, REMOTE_ADDR='10.0.2.3')
+        self.assertLessEqual(len(queries), 3)
+        # Свой ещё не записанный голос посетитель видит и в сводке: он заменяет записанный, а не добавляется к нему
+        self.assertEqual(response.json(), {
+            'movie_id': self.movie.pk, 'count': 4, 'average': 4.25,
+            'histogram': {'1': 0, '2': 0, '3': 1, '4': 1, '5': 2},
+            'user_rating': 3, 'rating': 3,
+        })
+        self.vote(2, ip='10.0.2.9')
+        response = self.client.get('/get-rating/', {'movie_id': self.movie.pk}, REMOTE_ADDR='10.0.2.9').json()
+        self.assertEqual(response['histogram'], {'1': 1, '2': 1, '3': 0, '4': 1, '5': 2})
+        self.assertEqual((response['count'], response['user_rating']), (5, 2))
+        # Чужие голоса из буфера в сводку не попадают до сброса
+        response = self.client.get('/get-rating/', {'movie_id': self.movie.pk}, REMOTE_ADDR='10.0.2.0').json()
+        self.assertEqual((response['count'], response['user_rating']), (4, 5))
+
+        rating_buffer.flush()
+        self.assertEqual(RatingCount.histogram(self.movie.pk), {2: 1, 3: 1, 4: 1, 5: 2})
+        Rating.objects.filter(ip='10.0.2.0').delete()
+        self.assertEqual(RatingCount.histogram(self.movie.pk), {2: 1, 3: 1, 4: 1, 5: 1})
+
+        call_command('rebuild_rating_counts', '--check', stdout=StringIO())
+        RatingCount.objects.filter(movie=self.movie, value=4).update(count=7)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_rating_counts', '--check', stdout=StringIO())
+        call_command('rebuild_rating_counts', stdout=StringIO())
+        self.assertEqual(RatingCount.histogram(self.movie.pk), {2: 1, 3: 1, 4: 1, 5: 1})
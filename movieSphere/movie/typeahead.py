@@ -0,0 +1,266 @@
+"""Подсказки при наборе запроса: префиксный индекс названий фильмов и имен персон в памяти процесса.
+
+Каждая запись (фильм или персона) дает до ``WORD_KEYS`` ключей - свернутое название с начала каждого слова,
+поэтому "matrix" находит и "The Matrix". Свертка (``fold``) убирает регистр и диакритику. Ключи лежат в
+отсортированном массиве; поиск - bisect по префиксу и выбор самых популярных записей диапазона (у фильмов -
+число оценок, у персон - число фильмов). Ответы для коротких префиксов, у которых диапазон большой,
+запоминаются до следующего изменения индекса. Если по началу слов подсказок мало, они дополняются записями,
+найденными с опечатками или записанными другим алфавитом (``movie.fuzzy``).
+
+Индекс строится при первом запросе или в фоне при старте процесса (``SEARCH_INDEX_WARM_UP``). Сигналы меняют
+отдельные записи, а другие процессы получают эти изменения через журнал в кеше (``movie.shared_index``), не
+перестраивая индекс. Популярность записи обновляется при её сохранении и при перестройке: голоса меняют
+счетчики фильма без сигналов сохранения.
+"""
+import functools
+import heapq
+import re
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+from django.urls import reverse
+
+from . import fuzzy
+from .fuzzy import MOVIE, PERSON, fold
+from .models import Actor, Movie
+from .shared_index import SharedIndex
+
+GROUPS = {MOVIE: 'movies', PERSON: 'people'}
+WORD_KEYS = 5
+MAX_KEY_LENGTH = 48
+# Позиция слова хранится в младшем байте кода ключа
+MAX_LABEL_LENGTH = 256 - MAX_KEY_LENGTH
+CACHED_PREFIX_LENGTH = 3
+MAX_CACHED_PREFIXES = 10000
+MAX_LIMIT = 20
+# С какой длины запроса подсказки дополняются нечетким поиском (см. movie.fuzzy)
+FUZZY_MIN_LENGTH = 4
+KEY = 'movie:typeahead'
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+# Больше любого символа ключа: диапазон префикса p - [p, p + _PREFIX_END)
+_PREFIX_END = '\U0010ffff'
+
+def key_starts(folded):
+    """Позиции начала первых WORD_KEYS слов свернутого названия"""
+    return [match.start() for match in _WORD_RE.finditer(folded[:MAX_LABEL_LENGTH])][:WORD_KEYS]
+
+
+class PrefixIndex:
+    """
+    Ключ хранится не строкой, а числом ``номер записи * 256 + позиция слова`` в массиве, отсортированном по
+    свернутому названию с этой позиции; строки ключей вычисляются только при bisect. Записи лежат по номерам
+    в компактных массивах (вид, id, популярность) и списках (название, свернутое название, slug), номера
+    записей по id - в массивах, индексируемых id. Номера удаленных записей переиспользуются. Все обращения
+    идут под блокировкой.
+    """
+
+    def __init__(self):
+        self.version = None
+        self._codes = array('q')
+        self._labels = []
+        self._folded = []
+        self._slugs = []
+        self._kinds = array('b')
+        self._object_ids = array('q')
+        self._popularity = array('q')
+        self._slot_by_id = (array('l'), array('l'))
+        self._free = []
+        self._answers = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._labels) - len(self._free)
+
+    @classmethod
+    def build(cls, movies, people):
+        """movies и people - итерируемые кортежи (id, название, slug, популярность)"""
+        index = cls()
+        for kind, rows in ((MOVIE, movies), (PERSON, people)):
+            for object_id, label, slug, popularity in rows:
+                index._allocate(kind, object_id, label, slug, popularity)
+        codes = [slot * 256 + start for slot, folded in enumerate(index._folded) for start in key_starts(folded)]
+        codes.sort(key=index._key)
+        index._codes = array('q', codes)
+        return index
+
+    def put(self, kind, object_id, label, slug=None, popularity=0):
+        """Добавляет или заменяет запись"""
+        with self._lock:
+            self._remove(kind, object_id)
+            slot = self._allocate(kind, object_id, label, slug, popularity)
+            for start in key_starts(self._folded[slot]):
+                code = slot * 256 + start
+                self._codes.insert(bisect_right(self._codes, self._key(code), key=self._key), code)
+            self._forget(self._folded[slot])
+
+    def remove(self, kind, object_id):
+        with self._lock:
+            self._remove(kind, object_id)
+
+    def search(self, query, limit=10):
+        """{'movies': [...], 'people': [...]} - до limit самых популярных записей каждого вида"""
+        prefix = fold(query)[:MAX_KEY_LENGTH]
+        if not prefix:
+            return {group: [] for group in GROUPS.values()}
+        with self._lock:
+            answer = self._answers.get(prefix, {}).get(limit)
+            if answer is None:
+                answer = {GROUPS[kind]: [self._entry(slot) for slot in slots]
+                          for kind, slots in self._top_slots(prefix, limit).items()}
+                if len(prefix) <= CACHED_PREFIX_LENGTH:
+                    if len(self._answers) >= MAX_CACHED_PREFIXES:
+                        self._answers.clear()
+                    self._answers.setdefault(prefix, {})[limit] = answer
+            return answer
+
+    def entries(self, kind, object_ids):
+        """Подсказки записей вида kind по id в том же порядке; записи, которых нет в индексе, пропускаются"""
+        with self._lock:
+            slot_by_id = self._slot_by_id[kind]
+            slots = (slot_by_id[object_id] if object_id < len(slot_by_id) else -1 for object_id in object_ids)
+            return [self._entry(slot) for slot in slots if slot >= 0]
+
+    def _key(self, code):
+        start = code & 255
+        return self._folded[code >> 8][start:start + MAX_KEY_LENGTH]
+
+    def _allocate(self, kind, object_id, label, slug, popularity):
+        values = (label, fold(label), slug, kind, object_id, popularity)
+        columns = (self._labels, self._folded, self._slugs, self._kinds, self._object_ids, self._popularity)
+        if self._free:
+            slot = self._free.pop()
+            for column, value in zip(columns, values):
+                column[slot] = value
+        else:
+            slot = len(self._labels)
+            for column, value in zip(columns, values):
+                column.append(value)
+        # id выдаются базой подряд, поэтому массив по id почти без пустот
+        slot_by_id = self._slot_by_id[kind]
+        if object_id >= len(slot_by_id):
+            slot_by_id.extend([-1] * (object_id + 1 - len(slot_by_id)))
+        slot_by_id[object_id] = slot
+        return slot
+
+    def _forget(self, folded):
+        """Сбрасывает запомненные ответы префиксов, под которые попадает название"""
+        for start in key_starts(folded):
+            for length in range(1, CACHED_PREFIX_LENGTH + 1):
+                self._answers.pop(folded[start:start + length], None)
+
+    def _remove(self, kind, object_id):
+        slot_by_id = self._slot_by_id[kind]
+        slot = slot_by_id[object_id] if object_id < len(slot_by_id) else -1
+        if slot < 0:
+            return
+        for start in key_starts(self._folded[slot]):
+            code = slot * 256 + start
+            position = bisect_left(self._codes, self._key(code), key=self._key)
+            while self._codes[position] != code:
+                position += 1
+            del self._codes[position]
+        self._forget(self._folded[slot])
+        slot_by_id[object_id] = -1
+        self._labels[slot] = self._folded[slot] = self._slugs[slot] = None
+        self._free.append(slot)
+
+    def _top_slots(self, prefix, limit):
+        start = bisect_left(self._codes, prefix, key=self._key)
+        end = bisect_left(self._codes, prefix + _PREFIX_END, start, key=self._key)
+        found = {kind: set() for kind in GROUPS}
+        for code in self._codes[start:end]:
+            slot = code >> 8
+            found[self._kinds[slot]].add(slot)
+
+        def rank(slot):
+            return self._popularity[slot], -self._object_ids[slot]
+        return {kind: heapq.nlargest(limit, slots, key=rank) for kind, slots in found.items()}
+
+    def _entry(self, slot):
+        object_id = self._object_ids[slot]
+        if self._kinds[slot] == MOVIE:
+            url = _url_templates()[MOVIE].format(self._slugs[slot])
+        else:
+            url = _url_templates()[PERSON].format(object_id)
+        return {'id': object_id, 'label': self._labels[slot], 'url': url}
+
+
+@functools.cache
+def _url_templates():
+    """Шаблоны адресов фильма и персоны: reverse на каждую подсказку заметно дороже поиска"""
+    return {
+        MOVIE: reverse('movie_detail', args=['SLUG']).replace('SLUG', '{}'),
+        PERSON: reverse('actor_detail', args=[987654321]).replace('987654321', '{}'),
+    }
+
+
+def load():
+    movies = Movie.objects.values_list('pk', 'title', 'url', 'rating_count').iterator(chunk_size=5000)
+    people = ((pk, name, None, count) for pk, name, count in
+              Actor.objects.values_list('pk', 'name', 'movies_count').iterator(chunk_size=5000))
+    return PrefixIndex.build(movies, people)
+
+
+def _apply(index, change):
+    action, kind, object_id, *values = change
+    if action == 'put':
+        index.put(kind, object_id, *values)
+    else:
+        index.remove(kind, object_id)
+
+
+_shared = SharedIndex(KEY, load, _apply, "индекс подсказок")
+
+
+def get_index():
+    """Индекс процесса; строится при первом обращении, изменения из других процессов дочитываются из кеша"""
+    return _shared.get()
+
+
+def warm_up():
+    """Начинает строить индекс в фоне при старте процесса (SEARCH_INDEX_WARM_UP)"""
+    _shared.warm_up()
+
+
+def reset():
+    _shared.reset()
+
+
+def invalidate():
+    """После массовых изменений мимо сигналов (импорт): все процессы, включая текущий, перестраивают индекс"""
+    _shared.invalidate()
+
+
+def search(query, limit=10):
+    """Подсказки по началу слов; если их меньше limit, добавляются записи, совпавшие с опечатками"""
+    limit = max(1, min(limit, MAX_LIMIT))
+    index = get_index()
+    answer = index.search(query, limit)
+    if len(fold(query)) < FUZZY_MIN_LENGTH:
+        return answer
+    # Запомненный ответ общий для всех запросов - дополняется копия
+    answer = dict(answer)
+    for kind, group in GROUPS.items():
+        if len(answer[group]) < limit:
+            seen = {entry['id'] for entry in answer[group]}
+            extra = [object_id for object_id in fuzzy.search(kind, query, limit) if object_id not in seen]
+            answer[group] = answer[group] + index.entries(kind, extra)[:limit - len(answer[group])]
+    return answer
+
+
+def movie_saved(movie_id, title, slug, rating_count):
+    _shared.changed(('put', MOVIE, movie_id, title, slug, rating_count))
+
+
+def movie_deleted(movie_id):
+    _shared.changed(('remove', MOVIE, movie_id))
+
+
+def person_saved(actor_id, name, movies_count):
+    _shared.changed(('put', PERSON, actor_id, name, None, movies_count))
+
+
+def person_deleted(actor_id):
+    _shared.changed(('remove', PERSON, actor_id))
@@ -16,13 +16,24 @@ urlpatterns = [
     path('add-rating/', views.AddStarRating.as_view(), name='add_rating'),
     path('get-rating/', views.GetRatingView.as_view(), name='get_rating'),
     path('review/<int:pk>/', views.AddReview.as_view(), name='add_review'),
+    path('review/<int:pk>/threads/', views.ReviewThreadsView.as_view(), name='review_threads'),
+    path('recommendations/', views.RecommendationsView.as_view(), name='recommendations'),
+    path('similar/<int:pk>/', views.SimilarMoviesView.as_view(), name='similar_movies'),
     path('popularity/', views.PopularMoviesView.as_view(), name='popularity'),
     path('editors-choice/', views.EditorsChoiceView.as_view(), name='editors_choice'),
+    path('typeahead/', views.TypeaheadView.as_view(), name='typeahead'),
     path('search/', views.SearchView.as_view(), name='movie_search'),
     path('genres/', views.GenreListView.as_view(), name='genre_list'),
     path('favorites/', views.FavoriteMoviesView.as_view(), name='favorite_movies'),
     path('watched/', views.WatchedMoviesView.as_view(), name='watched_movies'),
     path('planned/', views.PlannedMoviesView.as_view(), name='planned_movies'),
+    path('interactions/', views.InteractionStatusView.as_view(), name='interaction_statuses'),
+    path('uploads/', views.ChunkedUploadStartView.as_view(), name='chunked_upload_start'),
+    path('uploads/<uuid:pk>/', views.ChunkedUploadView.as_view(), name='chunked_upload'),
+    path('uploads/<uuid:pk>/complete/', views.ChunkedUploadCompleteView.as_view(), name='chunked_upload_complete'),
+    path('export/catalog/', views.CatalogExportView.as_view(), name='catalog_export'),
+    path('api/v1/<slug:resource>/', views.CatalogApiView.as_view(), name='api_list'),
+    path('api/v1/<slug:resource>/<int:pk>/', views.CatalogApiView.as_view(), name='api_detail'),
     path('<slug:slug>/', views.MovieDetailView.as_view(), name='movie_detail'),
     path('movie/<slug:slug>/actors/', views.ActorListView.as_view(), name='actor_list'),
     path('toggle/<int:movie_id>/<str:interaction_type>/', views.ToggleInteractionView.as_view(), name='toggle_interaction'),
@@ -1,17 +1,31 @@
 from django.contrib.auth import login, logout, authenticate
-from django.contrib.auth.mixins import LoginRequiredMixin
+from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
+from django.core.exceptions import BadRequest
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
-from django.db.models import Q
-from django.db.models.functions import ExtractYear
-from django.http import JsonResponse, HttpResponse
+from django.conf import settings
+from django.db.models import OuterRef, Subquery
+from django.http import JsonResponse, HttpResponse, Http404, StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
+from django.template.loader import render_to_string
 from django.views import View
 from django.views.generic import ListView, DetailView, TemplateView
 from django.utils.decorators import method_decorator
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.functional import SimpleLazyObject
+from django.utils.http import http_date
 from django.contrib.auth.decorators import login_required
 import random
 from .forms import ReviewForm, RatingForm, UserRegisterForm, UserLoginForm, UserProfileUpdateForm, InteractionForm
-from .models import Movie, Rating, RatingStar, Reviews, Genre, Profile, Actor, MovieInteraction, MovieInteractionState
+from .models import Movie, Rating, Reviews, Genre, Profile, Actor, MovieInteraction, MovieInteractionState, \
+    PopularitySnapshot, ChunkedUpload, ChunkedUploadError, RatingCount, RatingStar, Recommendation
+from .facets import get_catalog_facets, year_range_filter
+from .images import variant_url
+from .interactions import InteractionStatusMixin, annotate_movies, get_statuses, ids_digest, invalidate_statuses, \
+    parse_movie_ids, statuses_version
+from .pagination import KeysetPaginationMixin
+from . import api, export, fuzzy, rating_buffer, typeahead
+from .random_movie import random_payload
+from .search import order_by_ids, search_movies
 
 
 class MainView(ListView):
@@ -21,12 +35,15 @@ class MainView(ListView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        popular_movies = Movie.get_popular_movies(limit=3)  # Ограничиваем количество популярных фильмов до 3
+        popular_movies = Movie.get_popular_movies(limit=3).prefetch_related('genre')  # Ограничиваем количество популярных фильмов до 3
         current_movie = random.choice(popular_movies) if popular_movies else None
         context['current_movie'] = current_movie
         context['popular_movies'] = popular_movies
         context['genres'] = Genre.objects.all()[:6]
         context['editors_choice_movies'] = Movie.get_editors_choice()[:3]
+        context['recommended_movies'] = Recommendation.for_user(
+            self.request.user.pk, getattr(settings, 'RECOMMENDATIONS_ON_HOME', 6)
+        ) if self.request.user.is_authenticated else []
         if current_movie and current_movie.is_series:
             current_season = current_movie.seasons.first()
             context['current_season'] = current_season
@@ -39,7 +56,7 @@ class MainView(ListView):
 
 
 def index(request):
-    popular_movies = Movie.get_popular_movies(limit=10)
+    popular_movies = Movie.get_popular_movies(limit=10).prefetch_related('genre')
     first_movie = random.choice(popular_movies) if popular_movies else None
     genres = Genre.objects.all()[:6]
     trailer_url = first_movie.trailer.url if first_movie and first_movie.trailer else None
@@ -56,30 +73,13 @@ def index(request):
 
 
 def get_random_movie(request):
-    movie = random.choice(Movie.get_popular_movies(limit=10))
-    data = {
-        'title': movie.title,
-        'description': movie.description,
-        'preview_poster': movie.preview_poster.url,
-        'trailer_url': movie.trailer.url if movie.trailer else None,
-        'movie_url': movie.movie_file.url if movie.movie_file else None,
-        'is_series': movie.is_series,
-        'seasons': [{
-            'id': season.id,
-            'season_number': season.season_number,
-            'episodes': [{
-                'id': episode.id,
-                'episode_number': episode.episode_number,
-                'title': episode.title,
-                'description': episode.description,
-                'video_url': episode.video.url
-            } for episode in season.episodes.all()]
-        } for season in movie.seasons.all()] if movie.is_series else None,
-    }
-    return JsonResponse(data)
+    payload = random_payload()
+    if payload is None:
+        return JsonResponse({'error': 'Нет популярных фильмов'}, status=404)
+    return HttpResponse(payload, content_type='application/json')
 
 
-class MoviesView(ListView):
+class MoviesView(KeysetPaginationMixin, InteractionStatusMixin, ListView):
     """Список фильмов или сериалов"""
     model = Movie
     template_name = 'movie/movie_list.html'
@@ -94,7 +94,7 @@ class MoviesView(ListView):
         years = self.request.GET.getlist('year')
 
         if query:
-            queryset = queryset.filter(Q(title__icontains=query) | Q(description__icontains=query))
+            queryset = search_movies(queryset, query)
 
         if category == 'serials':
             queryset = queryset.filter(category__name='Сериалы')
@@ -106,20 +106,22 @@ class MoviesView(ListView):
         if genres:
             queryset = queryset.filter(genre__name__in=genres).distinct()
         if years:
-            queryset = queryset.annotate(movie_year=ExtractYear('world_premiere')).filter(movie_year__in=years)
+            queryset = queryset.filter(year_range_filter(years))
 
         return queryset
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         category = self.request.GET.get('category')
-        all_genres = Genre.objects.all()
-        all_years = Movie.objects.annotate(movie_year=ExtractYear('world_premiere')).values_list('movie_year', flat=True).distinct().order_by('movie_year')
+        facets = get_catalog_facets()
+        all_genres = facets['genres']
+        all_years = facets['years']
 
         context['first_five_genres'] = all_genres[:5]
         context['remaining_genres'] = all_genres[5:]
         context['first_five_years'] = all_years[:5]
         context['remaining_years'] = all_years[5:]
+        context['year_counts'] = facets['year_counts']
 
         context['category'] = category
         context['query'] = self.request.GET.get('q')
@@ -131,15 +133,12 @@ class MoviesView(ListView):
         elif category == 'cartoons':
             context['page_title'] = 'Мультфильмы'
 
-        query_params = self.request.GET.copy()
-        if 'page' in query_params:
-            query_params.pop('page')
-        context['query_params'] = query_params
+        context['query_params'] = self.get_query_params()
 
         return context
 
 
-class FavoriteMoviesView(LoginRequiredMixin, ListView):
+class FavoriteMoviesView(LoginRequiredMixin, KeysetPaginationMixin, InteractionStatusMixin, ListView):
     model = Movie
     template_name = 'movie/movie_list_interaction.html'
     context_object_name = 'movies'
@@ -154,7 +153,7 @@ class FavoriteMoviesView(LoginRequiredMixin, ListView):
         return context
 
 
-class WatchedMoviesView(LoginRequiredMixin, ListView):
+class WatchedMoviesView(LoginRequiredMixin, KeysetPaginationMixin, InteractionStatusMixin, ListView):
     model = Movie
     template_name = 'movie/movie_list_interaction.html'
     context_object_name = 'movies'
@@ -169,7 +168,7 @@ class WatchedMoviesView(LoginRequiredMixin, ListView):
         return context
 
 
-class PlannedMoviesView(LoginRequiredMixin, ListView):
+class PlannedMoviesView(LoginRequiredMixin, KeysetPaginationMixin, InteractionStatusMixin, ListView):
     model = Movie
     template_name = 'movie/movie_list_interaction.html'
     context_object_name = 'movies'
@@ -184,27 +183,38 @@ class PlannedMoviesView(LoginRequiredMixin, ListView):
         return context
 
 
-class ToggleInteractionView(View):
-    def get(self, request, movie_id, interaction_type):
-        movie = get_object_or_404(Movie, id=movie_id)
-        interaction, created = MovieInteraction.objects.get_or_create(user=request.user, movie=movie)
-
-        if interaction_type == 'favorite':
-            interaction.is_favorite = not interaction.is_favorite
-            state = interaction.is_favorite
-        elif interaction_type == 'watched':
-            interaction.is_watched = not interaction.is_watched
-            state = interaction.is_watched
-        elif interaction_type == 'planned':
-            interaction.is_planned = not interaction.is_planned
-            state = interaction.is_planned
-        else:
-            return JsonResponse({'error': 'Invalid interaction type'}, status=400)
+class ToggleInteractionView(LoginRequiredMixin, View):
+    """Переключение избранного, просмотренного или планов; только POST, чтобы предзагрузка ссылок ничего не меняла"""
+    raise_exception = True
 
-        interaction.save()
+    def post(self, request, movie_id, interaction_type):
+        if interaction_type not in MovieInteraction.FLAGS:
+            return JsonResponse({'error': 'Invalid interaction type'}, status=400)
+        state = MovieInteraction.toggle(request.user.pk, movie_id, interaction_type)
+        if state is None:
+            return JsonResponse({'error': 'Movie not found'}, status=404)
+        invalidate_statuses(request.user.pk)
         return JsonResponse({f'is_{interaction_type}': state})
 
 
+class InteractionStatusView(LoginRequiredMixin, View):
+    """Отметки пользователя для списка фильмов: /interactions/?ids=1,2,3"""
+    raise_exception = True
+
+    def get(self, request):
+        movie_ids = parse_movie_ids(request.GET.get('ids', ''))
+        version = statuses_version(request.user.pk)
+        etag = f'"{version}-{ids_digest(movie_ids)[:16]}"'
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            statuses = get_statuses(request.user.pk, movie_ids, version)
+            response = JsonResponse({'statuses': {str(movie_id): status for movie_id, status in statuses.items()}})
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ('Cookie',))
+        return response
+
+
 class EditorsChoiceView(ListView):
     model = Movie
     template_name = 'movie/editors_choice.html'
@@ -224,8 +234,8 @@ class MovieDetailView(DetailView):
         movie = self.object
         context["star_form"] = RatingForm()
         context["review_form"] = ReviewForm(initial={'parent': self.request.POST.get('parent_id')})
-        context["reviews"] = movie.get_reviews()
-        context["review_replies"] = self.get_review_replies(context["reviews"])
+        # Ветки отзывов загружаются только если фрагмент отзывов не найден в кеше
+        context["review_threads"] = SimpleLazyObject(lambda: self.get_review_page(movie))
         context["current_season"], context["current_episode"] = self.get_current_season_and_episode(movie)
         context["has_movie_file"] = bool(movie.movie_file)
 
@@ -236,32 +246,34 @@ class MovieDetailView(DetailView):
 
         context['interaction_states'] = MovieInteractionState.objects.all()
 
-        # Добавляем количество актеров в контекст
-        context['actors_count'] = movie.actors.count()
+        # Добавляем количество актеров в контекст (актеры уже загружены prefetch_related)
+        context['actors_count'] = len(movie.actors.all())
+        context['similar_movies'] = movie.get_similar_movies(getattr(settings, 'SIMILAR_MOVIES_PER_PAGE', 6))
 
         return context
 
-    def get_review_replies(self, reviews):
-        review_replies = {}
-        for review in reviews:
-            replies = Reviews.objects.filter(parent=review)
-            if replies:
-                review_replies[review.id] = replies
-        return review_replies
+    def get_review_page(self, movie):
+        threads, next_cursor = movie.get_review_threads()
+        return {'threads': threads, 'next': next_cursor}
 
     def get_current_season_and_episode(self, movie):
+        # Сезоны и эпизоды уже загружены get_detail_queryset, выбираем нужные без запросов
+        seasons = movie.seasons.all()
         current_season_number = self.request.GET.get('season')
         if not current_season_number:
-            current_season = movie.seasons.first()
+            current_season = seasons[0] if seasons else None
         else:
-            current_season = movie.seasons.filter(season_number=current_season_number).first()
+            current_season = next(
+                (season for season in seasons if str(season.season_number) == current_season_number), None)
 
         if current_season:
+            episodes = current_season.episodes.all()
             current_episode_number = self.request.GET.get('episode')
             if not current_episode_number:
-                current_episode = current_season.episodes.first()
+                current_episode = episodes[0] if episodes else None
             else:
-                current_episode = current_season.episodes.filter(episode_number=current_episode_number).first()
+                current_episode = next(
+                    (episode for episode in episodes if str(episode.episode_number) == current_episode_number), None)
         else:
             current_episode = None
 
@@ -277,23 +289,24 @@ class MovieDetailView(DetailView):
 
     def get(self, request, slug):
 
-        movie = get_object_or_404(Movie, url=slug)
+        movie = get_object_or_404(Movie.get_detail_queryset(), url=slug)
         self.object = movie
         context = self.get_context_data()
         context.update({
             'movie': movie,
-            'average_rating': movie.calculate_average_rating(),
+            'average_rating': movie.average_rating,
             'user_rating': self.get_user_rating(movie, request),
-            'trailer_url': movie.trailer.url,
+            'trailer_url': movie.trailer.url if movie.trailer else None,
             'series_info': movie.get_series_info() if movie.is_series else None
         })
         return render(request, self.template_name, context)
 
     def get_user_rating(self, movie, request):
-        try:
-            return Rating.objects.get(movie=movie, ip=self.get_client_ip(request)).star.value
-        except Rating.DoesNotExist:
-            return None
+        ip = self.get_client_ip(request)
+        pending = rating_buffer.pending_value(movie.pk, ip)
+        if pending is not None:
+            return pending
+        return Rating.objects.filter(movie=movie, ip=ip).values_list('star__value', flat=True).first()
 
     def post(self, request, slug):
         movie = get_object_or_404(Movie, url=slug)
@@ -301,64 +314,57 @@ class MovieDetailView(DetailView):
         interaction_form = InteractionForm(request.POST)
 
         if form.is_valid():
-            self.save_user_rating(movie, form.cleaned_data['rating'], request)
-            movie.calculate_average_rating()
+            self.save_user_rating(movie, form.cleaned_data['star'], request)
 
-        if interaction_form.is_valid() and request.user.is_authenticated:
+        # Форма оценки не содержит отметок, и без этой проверки каждая оценка сбрасывала бы их
+        has_interactions = any(name in request.POST for name in MovieInteraction.FLAGS.values())
+        if has_interactions and interaction_form.is_valid() and request.user.is_authenticated:
             self.save_user_interaction(movie, interaction_form.cleaned_data, request)
 
         return redirect('movie_detail', slug=slug)
 
-    def save_user_rating(self, movie, rating, request):
-        ip = self.get_client_ip(request)
-        try:
-            user_rating = Rating.objects.get(movie=movie, ip=ip)
-            user_rating.star.value = rating
-            user_rating.star.save()
-            user_rating.save()
-        except Rating.DoesNotExist:
-            star = RatingStar.objects.create(value=rating)
-            Rating.objects.create(movie=movie, star=star, ip=ip)
+    def save_user_rating(self, movie, star, request):
+        # Голос попадает в буфер и записывается вместе с остальными; общую звезду не трогаем
+        rating_buffer.add(movie.pk, self.get_client_ip(request), star)
 
     def save_user_interaction(self, movie, cleaned_data, request):
-        interaction, created = MovieInteraction.objects.get_or_create(user=request.user, movie=movie)
-        interaction.is_favorite = cleaned_data['is_favorite']
-        interaction.is_watched = cleaned_data['is_watched']
-        interaction.is_planned = cleaned_data['is_planned']
-        interaction.save()
+        MovieInteraction.set_flags(request.user.pk, movie.pk, **{
+            name: cleaned_data[name] for name in MovieInteraction.FLAGS.values()})
+        invalidate_statuses(request.user.pk)
 
 
 class ActorDetailView(DetailView):
     model = Actor
     template_name = 'movie/act.html'
     context_object_name = 'actor'
+    queryset = Actor.objects.prefetch_related('genres')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        actor = self.get_object()
-        context['popular_movies'] = actor.get_popular_movies()
+        context['popular_movies'] = self.object.get_popular_movies()
         return context
 
 
-class ActorListView(ListView):
+class ActorListView(KeysetPaginationMixin, ListView):
     model = Actor
     template_name = 'movie/actor_list.html'
     context_object_name = 'actors'
     paginate_by = 10
 
     def get_queryset(self):
-        movie = get_object_or_404(Movie, url=self.kwargs['slug'])
-        queryset = movie.actors.all()
+        self.movie = get_object_or_404(Movie, url=self.kwargs['slug'])
+        queryset = self.movie.actors.all()
 
         search_query = self.request.GET.get('search', '')
         if search_query:
-            queryset = queryset.filter(name__icontains=search_query)
+            # Актеров одного фильма немного: имена сверяются с запросом с опечатками без индекса
+            queryset = order_by_ids(queryset, fuzzy.rank(search_query, queryset.values_list('pk', 'name')))
 
         return queryset
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['movie'] = get_object_or_404(Movie, url=self.kwargs['slug'])
+        context['movie'] = self.movie
         context['search'] = self.request.GET.get('search', '')
         return context
 
@@ -381,6 +387,66 @@ class AddReview(View):
         return redirect(movie.get_absolute_url())
 
 
+class ReviewThreadsView(View):
+    """Следующая страница веток отзывов для кнопки "Показать еще": HTML веток и курсор"""
+
+    def get(self, request, pk):
+        movie = get_object_or_404(Movie.objects.only('pk'), pk=pk)
+        try:
+            after = int(request.GET['after']) if request.GET.get('after') else None
+        except ValueError:
+            return JsonResponse({'error': 'Некорректный курсор'}, status=400)
+        threads, next_cursor = movie.get_review_threads(after)
+        html = render_to_string('movie/review_threads.html', {'threads': threads}, request=request)
+        return JsonResponse({'html': html, 'next': next_cursor})
+
+
+def movie_summary(movie, score):
+    """Краткие данные фильма для JSON-списков похожих и рекомендованных фильмов"""
+    return {
+        'id': movie.pk,
+        'title': movie.title,
+        'year': movie.year,
+        'url': movie.get_absolute_url(),
+        'poster': variant_url(movie.poster, 300),
+        'score': round(score, 4),
+    }
+
+
+class SimilarMoviesView(View):
+    """Похожие фильмы в JSON; ?limit= ограничивает число соседей"""
+
+    def get(self, request, pk):
+        try:
+            limit = int(request.GET.get('limit') or 0) or None
+        except ValueError:
+            return JsonResponse({'error': 'Некорректный limit'}, status=400)
+        if limit is not None and limit < 0:
+            return JsonResponse({'error': 'Некорректный limit'}, status=400)
+        movie = Movie(pk=pk)
+        similar = movie.get_similar_movies(limit)
+        if not similar and not Movie.objects.filter(pk=pk).exists():
+            raise Http404("Фильм не найден")
+        return JsonResponse({'movie_id': pk, 'results': [movie_summary(item, item.similarity) for item in similar]})
+
+
+class RecommendationsView(LoginRequiredMixin, View):
+    """Персональные рекомендации пользователя в JSON; ?limit= ограничивает число фильмов"""
+    raise_exception = True
+
+    def get(self, request):
+        try:
+            limit = int(request.GET.get('limit') or 0) or None
+        except ValueError:
+            return JsonResponse({'error': 'Некорректный limit'}, status=400)
+        if limit is not None and limit < 0:
+            return JsonResponse({'error': 'Некорректный limit'}, status=400)
+        movies = Recommendation.for_user(request.user.pk, limit)
+        response = JsonResponse({'results': [movie_summary(movie, movie.recommendation_score) for movie in movies]})
+        patch_cache_control(response, private=True)
+        return response
+
+
 class AddStarRating(View):
     """Добавление рейтинга фильму"""
 
@@ -394,43 +460,146 @@ class AddStarRating(View):
 
     def post(self, request):
         form = RatingForm(request.POST)
+        try:
+            movie_id = int(request.POST.get("movie"))
+        except (TypeError, ValueError):
+            return HttpResponse(status=400)
         if form.is_valid():
-            rating, created = Rating.objects.update_or_create(
-                ip=self.get_client_ip(request),
-                movie_id=int(request.POST.get("movie")),
-                defaults={'star_id': int(request.POST.get("star"))}
-            )
-            return JsonResponse({'rating': rating.star.value}, status=201)
+            if not Movie.objects.filter(pk=movie_id).exists():
+                return JsonResponse({'error': 'Фильм не найден'}, status=404)
+            star = form.cleaned_data['star']
+            if not rating_buffer.add(movie_id, self.get_client_ip(request), star):
+                return JsonResponse({'error': 'Некорректный адрес посетителя'}, status=400)
+            return JsonResponse({'rating': star.value}, status=201)
         else:
             return HttpResponse(status=400)
 
 
 class GetRatingView(View):
+    """
+    Сводка оценок фильма по счетчикам: гистограмма, количество, среднее и голос посетителя. Ещё не записанный
+    голос посетителя из буфера учитывается в сводке, чтобы она сходилась с user_rating; голоса других
+    посетителей появляются после сброса буфера.
+    """
+
+    def get_client_ip(self, request):
+        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
+        if x_forwarded_for:
+            ip = x_forwarded_for.split(',')[0]
+        else:
+            ip = request.META.get('REMOTE_ADDR')
+        return ip
+
     def get(self, request):
-        movie_id = request.GET.get('movie_id')
         try:
-            movie = Movie.objects.get(pk=movie_id)
-            ratings = Rating.objects.filter(movie=movie)
-            if ratings.exists():
-                rating_value = ratings.first().star.value
-                return JsonResponse({'rating': rating_value})
-            else:
-                return JsonResponse({'rating': 0})
-        except Movie.DoesNotExist:
+            movie_id = int(request.GET.get('movie_id'))
+        except (TypeError, ValueError):
+            return JsonResponse({'error': 'Не указан фильм'}, status=400)
+        ip = rating_buffer.normalize_ip(self.get_client_ip(request))
+        # Фильм и записанный голос посетителя - одним запросом
+        stored_vote = Rating.objects.filter(movie_id=OuterRef('pk'), ip=ip).values('star__value')[:1]
+        row = Movie.objects.filter(pk=movie_id).values_list('pk', Subquery(stored_vote)).first()
+        if row is None:
             return JsonResponse({'error': 'Фильм не найден'}, status=404)
+        stored = row[1] if ip else None
+
+        counts = RatingCount.histogram(movie_id)
+        user_rating = rating_buffer.pending_value(movie_id, ip) if ip else None
+        if user_rating is None:
+            user_rating = stored
+        elif user_rating != stored:
+            # Голос из буфера заменит записанный голос посетителя, если он был
+            counts[user_rating] = counts.get(user_rating, 0) + 1
+            if stored is not None and counts.get(stored):
+                counts[stored] -= 1
+        histogram = {value: counts.get(value, 0) for value in sorted(
+            set(RatingStar.objects.values_list('value', flat=True)) | set(counts))}
+        total = sum(counts.values())
+        return JsonResponse({
+            'movie_id': movie_id,
+            'count': total,
+            'average': float(Movie.average_from(sum(value * count for value, count in counts.items()), total)),
+            'histogram': {str(value): count for value, count in histogram.items()},
+            'user_rating': user_rating,
+            # Прежнее поле ответа: собственная оценка посетителя или 0
+            'rating': user_rating or 0,
+        })
+
+
+class TypeaheadView(View):
+    """Подсказки для строки поиска: ?q= - начало названия или имени, ?limit= - подсказок в группе (до 20)"""
+
+    def get(self, request):
+        query = request.GET.get('q', '')
+        try:
+            limit = int(request.GET.get('limit') or 10)
+        except ValueError:
+            return JsonResponse({'error': 'Некорректный limit'}, status=400)
+        response = JsonResponse({'query': query, **typeahead.search(query, limit)})
+        patch_cache_control(response, public=True, max_age=60)
+        return response
+
+
+class CatalogApiView(View):
+    """JSON API каталога (см. movie.api): страница списка типа или один объект с условным GET"""
+
+    def get(self, request, resource, pk=None):
+        if resource not in api.RESOURCES:
+            return JsonResponse({'error': 'Неизвестный тип'}, status=404)
+        try:
+            query = api.ApiQuery(api.RESOURCES[resource], request.GET, detail=pk is not None)
+        except BadRequest as error:
+            return JsonResponse({'error': str(error)}, status=400)
+        etag, last_modified = query.validators(request.path)
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            if pk is not None:
+                data = query.detail(pk)
+                if data is None:
+                    return JsonResponse({'error': 'Не найдено'}, status=404)
+            else:
+                try:
+                    data = query.page()
+                except BadRequest as error:
+                    return JsonResponse({'error': str(error)}, status=400)
+            response = JsonResponse(data)
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, public=True, max_age=getattr(settings, 'API_CACHE_MAX_AGE', 60))
+        return response
+
+
+class CatalogExportView(UserPassesTestMixin, View):
+    """Выгрузка каталога для сотрудников и партнеров: NDJSON в gzip потоком; ?since= - только измененные фильмы"""
+    raise_exception = True
+
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def get(self, request):
+        try:
+            since = export.parse_since(request.GET['since']) if request.GET.get('since') else None
+        except ValueError as error:
+            return JsonResponse({'error': str(error)}, status=400)
+        response = StreamingHttpResponse(export.stream(since), content_type='application/gzip')
+        response['Content-Disposition'] = 'attachment; filename="catalog.ndjson.gz"'
+        patch_cache_control(response, private=True, no_store=True)
+        return response
 
 
 class SearchView(View):
     def get(self, request):
         query = request.GET.get('q')
         if query:
-            movies = Movie.objects.filter(Q(title__icontains=query) | Q(description__icontains=query))
-            return render(request, 'movie/movie_list.html', {'movies': movies})
+            movies = list(search_movies(Movie.objects.all(), query))
+            statuses = annotate_movies(request.user, movies)
+            return render(request, 'movie/movie_list.html', {'movies': movies, 'interaction_statuses': statuses})
         else:
             return redirect('movies')
 
 
-class GenreListView(ListView):
+class GenreListView(KeysetPaginationMixin, ListView):
     model = Genre
     template_name = 'movie/genre.html'
     context_object_name = 'genres'
@@ -438,6 +607,8 @@ class GenreListView(ListView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        if self.uses_keyset_pagination():
+            return context
         paginator = context.get('paginator')
         page_obj = context.get('page_obj')
 
@@ -453,20 +624,40 @@ class GenreListView(ListView):
         return context
 
 
+class PopularityPaginator(Paginator):
+    """
+    Страницы рейтинга выбираются диапазоном мест снимка, без COUNT и OFFSET. Пока снимок не построен
+    (refresh_popularity), страницы читаются прямо из фильмов по агрегатам оценок.
+    """
+
+    def __init__(self, snapshot, per_page):
+        super().__init__([], per_page)
+        self.snapshot = snapshot
+        self.count = snapshot.movie_count if snapshot else PopularitySnapshot.ranked_movies().count()
+
+    def page(self, number):
+        number = self.validate_number(number)
+        offset = (number - 1) * self.per_page
+        if self.snapshot is None:
+            movies = PopularitySnapshot.ranked_movies()[offset:offset + self.per_page]
+        else:
+            movies = Movie.get_popular_movies(limit=self.per_page, offset=offset, snapshot=self.snapshot)
+        return self._get_page(movies.prefetch_related('genre'), number, self)
+
+
 class PopularMoviesView(TemplateView):
     template_name = 'movie/popularity.html'
     paginate_by = 5
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        popular_movies = Movie.get_popular_movies().all()
-
-        paginator = Paginator(popular_movies, self.paginate_by)
+        paginator = PopularityPaginator(PopularitySnapshot.current(), self.paginate_by)
         page_number = self.request.GET.get('page')
         page_obj = paginator.get_page(page_number)
 
         context['page_obj'] = page_obj
         context['is_paginated'] = page_obj.has_other_pages()
+        context['interaction_statuses'] = annotate_movies(self.request.user, page_obj.object_list)
         return context
 
 
@@ -573,3 +764,53 @@ class LogoutView(View):
     def get(self, request):
         logout(request)
         return redirect('home')
+
+
+class ChunkedUploadMixin(UserPassesTestMixin):
+    """Загрузка видео частями доступна только сотрудникам; ошибки протокола возвращаются в JSON"""
+    raise_exception = True
+
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        except ChunkedUploadError as error:
+            return JsonResponse({'error': str(error)}, status=error.status)
+
+    def get_upload(self, pk):
+        return get_object_or_404(ChunkedUpload, pk=pk, user=self.request.user)
+
+
+class ChunkedUploadStartView(ChunkedUploadMixin, View):
+    def post(self, request):
+        try:
+            size = int(request.POST.get('size', ''))
+        except ValueError:
+            raise ChunkedUploadError("Нужны имя и размер файла")
+        upload = ChunkedUpload.start(request.user, request.POST.get('target'), request.POST.get('filename'), size)
+        return JsonResponse(upload.status(), status=201)
+
+
+class ChunkedUploadView(ChunkedUploadMixin, View):
+    def get(self, request, pk):
+        return JsonResponse(self.get_upload(pk).status())
+
+    def put(self, request, pk):
+        """Тело запроса - сырые байты части; читается из потока, а не через request.body"""
+        upload = self.get_upload(pk)
+        try:
+            offset = int(request.GET['offset'])
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except (KeyError, ValueError):
+            raise ChunkedUploadError("Нужны смещение и длина части")
+        upload.write_chunk(offset, request, length, request.headers.get('X-Chunk-SHA256', ''))
+        return JsonResponse(upload.status())
+
+
+class ChunkedUploadCompleteView(ChunkedUploadMixin, View):
+    def post(self, request, pk):
+        upload = self.get_upload(pk)
+        upload.complete(request.POST.get('checksum', ''))
+        return JsonResponse(upload.status())
@@ -128,3 +128,47 @@ AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend',
 ]
 DATA_UPLOAD_MAX_MEMORY_SIZE = 1024 * 1024 * 1024 * 30
+
+# Страницы списков по курсору вместо COUNT/OFFSET (см. movie.pagination)
+KEYSET_PAGINATION = False
+
+# Время жизни HTML-фрагментов фильмов в кеше (см. movie.fragments)
+FRAGMENT_CACHE_TIMEOUT = 60 * 60
+
+# Отдача медиафайлов фронтенд-сервером (см. movie.streaming): None, 'x-accel-redirect' (nginx) или 'x-sendfile'
+MEDIA_STREAMING_OFFLOAD = None
+MEDIA_STREAMING_ACCEL_PREFIX = '/protected-media/'
+
+# Загрузка больших видео частями (см. movie.models.ChunkedUpload): размер части и каталог недокачанных файлов
+CHUNKED_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+CHUNKED_UPLOAD_TEMP_DIR = os.path.join(BASE_DIR, 'upload_partials')
+
+# Время жизни кеша отметок пользователя для списков фильмов (сбрасывается при переключении отметки)
+INTERACTION_STATUS_CACHE_TIMEOUT = 60 * 60
+
+# Буфер голосов (см. movie.rating_buffer): сброс в базу по количеству голосов или через столько секунд
+RATING_BUFFER_SIZE = 500
+RATING_BUFFER_INTERVAL = 2.0
+
+# Сколько веток отзывов показывать на странице фильма и подгружать кнопкой "Показать еще"
+REVIEW_THREADS_PER_PAGE = 20
+
+# Похожие фильмы (см. movie.similarity): сколько соседей хранить, сколько показывать на странице фильма
+# и веса групп признаков во взвешенной косинусной близости
+SIMILAR_MOVIES_TOP_K = 12
+SIMILAR_MOVIES_PER_PAGE = 6
+SIMILAR_MOVIES_WEIGHTS = {'genre': 1.0, 'actors': 2.0, 'directors': 3.0}
+
+# Персональные рекомендации (см. movie.recommendations): сколько фильмов хранить на пользователя
+# и сколько показывать в блоке "Для вас" на главной
+RECOMMENDATIONS_PER_USER = 20
+RECOMMENDATIONS_ON_HOME = 6
+
+# JSON API каталога (см. movie.api): объектов на странице списка по умолчанию (не больше 100)
+# и сколько секунд клиенты могут не перепроверять ответ по ETag
+API_PAGE_SIZE = 50
+API_CACHE_MAX_AGE = 60
+
+# Индексы подсказок и нечеткого поиска (см. movie.typeahead, movie.fuzzy) строятся на первом запросе;
+# True - начинать их строить в фоне при старте процесса wsgi/asgi
+SEARCH_INDEX_WARM_UP = False
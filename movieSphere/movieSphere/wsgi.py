@@ -14,3 +14,13 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'movieSphere.settings')
 
 application = get_wsgi_application()
+
+from django.conf import settings  # noqa: E402
+
+# Индексы подсказок и нечеткого поиска по умолчанию строятся на первом запросе; при SEARCH_INDEX_WARM_UP
+# их построение начинается в фоне, и импорт приложения его не ждет
+if getattr(settings, 'SEARCH_INDEX_WARM_UP', False):
+    from movie import fuzzy, typeahead
+
+    typeahead.warm_up()
+    fuzzy.warm_up()